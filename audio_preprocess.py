@@ -0,0 +1,241 @@
+"""Preprocesamiento local del audio antes de subirlo a Google AI.
+
+Decodifica el .ogg, lo mezcla a mono, lo remuestrea a una frecuencia adecuada
+para voz, acorta los silencios largos (p. ej. mientras el médico examina al
+paciente) y lo re-codifica en Opus de baja tasa. Menos bytes y menos segundos de
+audio reducen el tiempo de subida, el PROCESSING en Google y los tokens de audio.
+
+Usa ``ffmpeg`` como dependencia opcional (``packages.txt``); si no está
+instalado la etapa se omite. La duración, canales y frecuencia se leen de los
+encabezados Ogg en Python puro, así que el reporte no necesita ``ffprobe``.
+
+Uso sin conexión sobre archivos de ejemplo::
+
+    python audio_preprocess.py consulta1.ogg consulta2.ogg
+"""
+import argparse
+import functools
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+
+# --- Parámetros del preprocesamiento ---
+TARGET_SAMPLE_RATE = 16000  # Hz; suficiente para voz
+TARGET_BITRATE = "24k"  # Opus en modo voz
+SILENCE_THRESHOLD_DB = -45  # Por debajo de este nivel se considera silencio
+SILENCE_MIN_S = 1.5  # Solo se acortan silencios más largos que esto
+SILENCE_KEEP_S = 0.5  # Silencio que se conserva en cada pausa acortada
+FFMPEG_TIMEOUT_S = 600
+
+# --- Supuestos para estimar el tiempo ahorrado ---
+ESTIMATED_UPLOAD_BYTES_PER_S = 1_000_000  # ~8 Mbit/s de subida
+ESTIMATED_PROCESSING_S_PER_AUDIO_S = 0.02  # PROCESSING en Google por segundo de audio
+AUDIO_TOKENS_PER_S = 32  # Tokens de audio de Gemini por segundo
+
+
+class AudioPreprocessError(RuntimeError):
+    """Fallo al decodificar o re-codificar el audio."""
+
+
+@dataclass
+class AudioInfo:
+    """Datos básicos de un archivo Ogg leídos de sus encabezados."""
+    codec: str | None
+    channels: int | None
+    sample_rate: int | None
+    duration_s: float | None
+
+
+@dataclass
+class PreprocessReport:
+    """Resultado del preprocesamiento de un archivo."""
+    original_bytes: int
+    processed_bytes: int
+    original: AudioInfo
+    processed: AudioInfo
+    elapsed_s: float
+    kept_original: bool = False  # El procesado no era más chico: se sube el original
+
+    @property
+    def bytes_saved(self):
+        if self.kept_original:
+            return 0
+        return self.original_bytes - self.processed_bytes
+
+    @property
+    def duration_saved_s(self):
+        if self.kept_original or self.original.duration_s is None or self.processed.duration_s is None:
+            return 0.0
+        return max(0.0, self.original.duration_s - self.processed.duration_s)
+
+    @property
+    def audio_tokens_saved(self):
+        return int(self.duration_saved_s * AUDIO_TOKENS_PER_S)
+
+    @property
+    def estimated_time_saved_s(self):
+        """Subida + PROCESSING estimados que se ahorran, menos el costo local."""
+        upload_saved = self.bytes_saved / ESTIMATED_UPLOAD_BYTES_PER_S
+        processing_saved = self.duration_saved_s * ESTIMATED_PROCESSING_S_PER_AUDIO_S
+        return upload_saved + processing_saved - self.elapsed_s
+
+    def as_dict(self):
+        data = asdict(self)
+        data.update(
+            bytes_saved=self.bytes_saved,
+            duration_saved_s=round(self.duration_saved_s, 2),
+            audio_tokens_saved=self.audio_tokens_saved,
+            estimated_time_saved_s=round(self.estimated_time_saved_s, 2),
+        )
+        return data
+
+    def summary(self):
+        """Resumen en una línea para la interfaz."""
+        if self.kept_original:
+            return (
+                f"el audio procesado ({self.processed_bytes / 1024:.0f} KB) no es más chico que el original "
+                f"({self.original_bytes / 1024:.0f} KB); se sube el original"
+            )
+        pct = 100.0 * self.bytes_saved / self.original_bytes if self.original_bytes else 0.0
+        return (
+            f"{self.original_bytes / 1024:.0f} KB → {self.processed_bytes / 1024:.0f} KB ({pct:.0f}% menos); "
+            f"silencios recortados: {self.duration_saved_s:.1f} s (~{self.audio_tokens_saved} tokens de audio); "
+            f"tiempo ahorrado estimado: {self.estimated_time_saved_s:.1f} s"
+        )
+
+
+@functools.lru_cache(maxsize=1)
+def ffmpeg_available():
+    """True si ffmpeg está en el PATH (se busca una vez por proceso: la app lo consulta en cada rerun)."""
+    return shutil.which("ffmpeg") is not None
+
+
+def ogg_info(data):
+    """Lee códec, canales, frecuencia y duración de un Ogg Opus/Vorbis (sin decodificar)."""
+    view = memoryview(data)
+    codec = channels = sample_rate = None
+    granule_rate = None
+    pre_skip = 0
+    head = bytes(view[:512])
+    opus_at = head.find(b"OpusHead")
+    vorbis_at = head.find(b"\x01vorbis")
+    if opus_at != -1 and len(head) >= opus_at + 16:
+        codec = "opus"
+        channels = head[opus_at + 9]
+        pre_skip = struct.unpack_from("<H", head, opus_at + 10)[0]
+        sample_rate = struct.unpack_from("<I", head, opus_at + 12)[0] or 48000
+        granule_rate = 48000  # La posición granular de Opus siempre va a 48 kHz
+    elif vorbis_at != -1 and len(head) >= vorbis_at + 16:
+        codec = "vorbis"
+        channels = head[vorbis_at + 11]
+        sample_rate = struct.unpack_from("<I", head, vorbis_at + 12)[0]
+        granule_rate = sample_rate
+
+    duration_s = None
+    if granule_rate:
+        # La última página Ogg lleva la posición granular final (muestras totales)
+        tail_start = max(0, len(view) - 65536)
+        tail = bytes(view[tail_start:])
+        last_page = tail.rfind(b"OggS")
+        if last_page != -1 and len(tail) >= last_page + 14:
+            granule = struct.unpack_from("<q", tail, last_page + 6)[0]
+            if granule > 0:
+                duration_s = max(0.0, (granule - pre_skip) / granule_rate)
+    return AudioInfo(codec, channels, sample_rate, duration_s)
+
+
+def build_ffmpeg_command(sample_rate=TARGET_SAMPLE_RATE, bitrate=TARGET_BITRATE, trim_silence=True):
+    """Comando ffmpeg que lee de stdin y escribe un Ogg Opus mono en stdout."""
+    filters = []
+    if trim_silence:
+        filters.append(
+            f"silenceremove=stop_periods=-1:stop_duration={SILENCE_MIN_S}"
+            f":stop_threshold={SILENCE_THRESHOLD_DB}dB:stop_silence={SILENCE_KEEP_S}"
+        )
+    command = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-ac", "1", "-ar", str(sample_rate)]
+    if filters:
+        command += ["-af", ",".join(filters)]
+    command += ["-c:a", "libopus", "-b:a", bitrate, "-application", "voip", "-f", "ogg", "pipe:1"]
+    return command
+
+
+def preprocess_audio(data, sample_rate=TARGET_SAMPLE_RATE, bitrate=TARGET_BITRATE, trim_silence=True):
+    """Preprocesa el audio (bytes o buffer). Devuelve (audio_a_subir, PreprocessReport).
+
+    Si el resultado no es más chico que el original (p. ej. un Opus mono que ya
+    venía a baja tasa), devuelve ``data`` tal cual y lo anota en
+    ``report.kept_original``.
+    """
+    if not ffmpeg_available():
+        raise AudioPreprocessError("ffmpeg no está instalado; no se puede preprocesar el audio.")
+    start_time = time.time()
+    try:
+        completed = subprocess.run(
+            build_ffmpeg_command(sample_rate, bitrate, trim_silence),
+            input=data, capture_output=True, timeout=FFMPEG_TIMEOUT_S, check=False,
+        )
+    except subprocess.TimeoutExpired as timeout_err:
+        raise AudioPreprocessError(f"ffmpeg excedió {FFMPEG_TIMEOUT_S} s.") from timeout_err
+    if completed.returncode != 0 or not completed.stdout:
+        detail = completed.stderr.decode("utf-8", "replace").strip()[-500:]
+        raise AudioPreprocessError(f"ffmpeg falló (código {completed.returncode}): {detail}")
+    processed = completed.stdout
+    report = PreprocessReport(
+        original_bytes=len(data),
+        processed_bytes=len(processed),
+        original=ogg_info(data),
+        processed=ogg_info(processed),
+        elapsed_s=time.time() - start_time,
+        kept_original=len(processed) >= len(data),
+    )
+    return (data if report.kept_original else processed), report
+
+
+def extract_segment(data, start_s, duration_s):
+    """Copia (sin re-codificar) el tramo [start_s, start_s + duration_s) de un Ogg."""
+    if not ffmpeg_available():
+        raise AudioPreprocessError("ffmpeg no está instalado; no se puede dividir el audio.")
+    command = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+        "-ss", f"{start_s:.3f}", "-t", f"{duration_s:.3f}", "-c:a", "copy", "-f", "ogg", "pipe:1",
+    ]
+    try:
+        completed = subprocess.run(command, input=data, capture_output=True, timeout=FFMPEG_TIMEOUT_S, check=False)
+    except subprocess.TimeoutExpired as timeout_err:
+        raise AudioPreprocessError(f"ffmpeg excedió {FFMPEG_TIMEOUT_S} s.") from timeout_err
+    if completed.returncode != 0 or not completed.stdout:
+        detail = completed.stderr.decode("utf-8", "replace").strip()[-500:]
+        raise AudioPreprocessError(f"ffmpeg no pudo extraer el segmento {start_s:.0f}-{start_s + duration_s:.0f} s: {detail}")
+    return completed.stdout
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Preprocesa archivos .ogg localmente y reporta el ahorro.")
+    parser.add_argument("files", nargs="+", help="Archivos .ogg de ejemplo")
+    parser.add_argument("--output-dir", help="Guarda aquí los archivos procesados")
+    parser.add_argument("--no-trim-silence", action="store_true", help="No acortar silencios")
+    args = parser.parse_args(argv)
+
+    for path in args.files:
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            processed, report = preprocess_audio(data, trim_silence=not args.no_trim_silence)
+        except AudioPreprocessError as e:
+            print(json.dumps({"file": path, "error": str(e)}, ensure_ascii=False))
+            continue
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            with open(os.path.join(args.output_dir, os.path.basename(path)), "wb") as f:
+                f.write(processed)
+        print(json.dumps({"file": path, **report.as_dict()}, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""Benchmark sin conexión del pipeline con sustitutos locales de Gemini y Sheets.
+
+Ejecuta el código real de ``pipeline`` (subida, espera de PROCESSING,
+generación, extracción de JSON, fila del log y append a la hoja) contra
+``fakes.FakeGenAI`` y ``fakes.FakeWorksheet``, sin gastar cuota. Reporta por
+nivel de concurrencia los percentiles de cada etapa, el throughput de extremo
+a extremo y el pico de memoria de Python, en JSON para comparar entre versiones::
+
+    python bench.py --files 16 --concurrency 1 2 4 8 --generate-latency 1.5 -o bench.json
+"""
+import argparse
+import json
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+import fakes
+import file_registry
+import pipeline
+import prompt_cache
+import prompts
+import routing
+import scheduler
+
+REPORT_VERSION = 1
+STAGES = ("upload", "processing", "generation", "parsing", "row_build", "sheets")
+PERCENTILES = (50, 90, 95, 99)
+BENCH_MODEL = "gemini-1.5-flash-latest"
+
+
+def percentiles(values, points=PERCENTILES):
+    """Percentiles (interpolación lineal) más media y máximo, en segundos."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    stats = {}
+    for point in points:
+        rank = (len(ordered) - 1) * point / 100.0
+        low = int(rank)
+        high = min(low + 1, len(ordered) - 1)
+        stats[f"p{point}"] = round(ordered[low] + (ordered[high] - ordered[low]) * (rank - low), 4)
+    stats["mean"] = round(sum(ordered) / len(ordered), 4)
+    stats["max"] = round(ordered[-1], 4)
+    stats["n"] = len(ordered)
+    return stats
+
+
+def synthetic_audio(n_files, size_bytes, seed=0):
+    """Archivos [(nombre, bytes)] de contenido aleatorio (el fake no decodifica audio)."""
+    rng = random.Random(seed)
+    return [(f"bench_{i:03d}.ogg", rng.randbytes(size_bytes)) for i in range(n_files)]
+
+
+def route_latencies(results):
+    """Percentiles de la generación por ruta (solo con enrutamiento)."""
+    routes = sorted({r.route for r in results if r.route})
+    return {route: percentiles([r.stage_times["generation"] for r in results if r.route == route]) for route in routes}
+
+
+def run_level(files, concurrency, genai_options, sheet_options, measure_memory=True, seed=0, routing_policy=None,
+              limits=None):
+    """Procesa ``files`` con ``concurrency`` workers y devuelve las métricas del nivel."""
+    scheduler.configure(**(limits or {}))  # Planificadores nuevos: contadores por nivel
+    prompt_cache.stats.reset()
+    backend = fakes.FakeGenAI(seed=seed, **genai_options)
+    worksheet = fakes.FakeWorksheet(seed=seed, **sheet_options)
+    if measure_memory:
+        tracemalloc.start()
+    try:
+        with pipeline.use_backend(backend):
+            results, summary = pipeline.run_batch(
+                files, BENCH_MODEL, prompts.PROMPT_TEXT, max_workers=concurrency, worksheet=worksheet,
+                routing_policy=routing_policy,
+            )
+            file_reuse = file_registry.get_registry().summary()
+        peak_memory = tracemalloc.get_traced_memory()[1] if measure_memory else None
+    finally:
+        if measure_memory:
+            tracemalloc.stop()
+
+    ok_results = [r for r in results if r.ok]
+    return {
+        "concurrency": concurrency,
+        "files": summary.total,
+        "succeeded": summary.succeeded,
+        "failed": summary.failed,
+        "wall_time_s": round(summary.wall_time_s, 3),
+        "files_per_minute": round(summary.files_per_minute, 2),
+        "end_to_end_s": percentiles([r.elapsed for r in ok_results]),
+        "stages_s": {
+            stage: percentiles([r.stage_times[stage] for r in ok_results if stage in r.stage_times])
+            for stage in STAGES
+        },
+        "processing_polls": percentiles([r.processing_polls for r in ok_results]),
+        "parse_methods": {m: sum(1 for r in ok_results if r.parse_method == m) for m in ("direct", "repaired")},
+        "peak_python_memory_bytes": peak_memory,
+        "routes_s": route_latencies(ok_results),
+        "api_calls": dict(backend.calls),
+        "generate_calls_by_model": dict(backend.generate_calls_by_model),
+        "fake_429s": {"gemini": backend.quota.rejected if backend.quota else 0,
+                      "sheets": worksheet.quota.rejected if worksheet.quota else 0},
+        "scheduler": scheduler.rows(),
+        "prompt_cache": prompt_cache.stats.summary(),
+        "file_reuse": file_reuse,
+        "sheet_calls": worksheet.calls,
+        "remote_files_leaked": backend.live_files,
+        "errors": sorted({r.error for r in results if r.error}),
+    }
+
+
+def run_benchmark(n_files=16, audio_bytes=512 * 1024, concurrency_levels=(1, 2, 4, 8), genai_options=None,
+                  sheet_options=None, measure_memory=True, seed=0, routing_policy=None, limits=None):
+    """Ejecuta todos los niveles de concurrencia y devuelve el reporte completo."""
+    genai_options = genai_options or {}
+    sheet_options = sheet_options or {}
+    files = synthetic_audio(n_files, audio_bytes, seed)
+    # El pico global se mide aquí; la medición por subida usaría el mismo tracemalloc
+    previous_measure = pipeline.UPLOAD_MEASURE_MEMORY
+    pipeline.UPLOAD_MEASURE_MEMORY = False
+    try:
+        levels = [run_level(files, c, genai_options, sheet_options, measure_memory, seed, routing_policy, limits)
+                  for c in concurrency_levels]
+    finally:
+        pipeline.UPLOAD_MEASURE_MEMORY = previous_measure
+    return {
+        "version": REPORT_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "config": {
+            "files": n_files,
+            "audio_bytes": audio_bytes,
+            "concurrency_levels": list(concurrency_levels),
+            "genai": genai_options,
+            "sheets": sheet_options,
+            "routing": vars(routing_policy) if routing_policy else None,
+            "limits": limits,
+            "prompt_cache": prompt_cache.enabled(),
+            "seed": seed,
+        },
+        "levels": levels,
+        # Pico de RSS del proceso (KB en Linux), incluye todos los niveles
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline con Gemini y Sheets simulados.")
+    parser.add_argument("--files", type=int, default=16, help="Archivos por nivel de concurrencia")
+    parser.add_argument("--audio-kb", type=int, default=512, help="Tamaño de cada audio sintético")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--upload-latency", type=float, default=0.05, help="Latencia fija de subida (s)")
+    parser.add_argument("--upload-mbps", type=float, default=160.0, help="Ancho de banda de subida (Mbit/s)")
+    parser.add_argument("--processing", type=float, default=0.5, help="Tiempo en PROCESSING (s)")
+    parser.add_argument("--generate-latency", type=float, default=1.0, help="Duración de generate_content (s)")
+    parser.add_argument("--response-kb", type=int, default=4, help="Tamaño de la respuesta JSON")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probabilidad de 503 en subida/generación")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Probabilidad de JSON mal formado")
+    parser.add_argument("--sheet-latency", type=float, default=0.1, help="Latencia de append_row (s)")
+    parser.add_argument("--sheet-failure-rate", type=float, default=0.0, help="Probabilidad de 429 en append_row")
+    parser.add_argument("--escalate-to", metavar="MODELO", help="Activar el enrutamiento con este modelo de escalado")
+    parser.add_argument("--hedge-after", type=float, metavar="S", help="Umbral de la solicitud de cobertura (s)")
+    parser.add_argument("--escalate-latency", type=float, default=2.0, help="Duración de generate_content del modelo de escalado (s)")
+    parser.add_argument("--incomplete-rate", type=float, default=0.0,
+                        help="Probabilidad de que el modelo rápido deje campos obligatorios sin extraer")
+    parser.add_argument("--quota-rpm", type=float, help="Cuota simulada de Gemini: responde 429 al excederla")
+    parser.add_argument("--sheet-quota-rpm", type=float, help="Cuota simulada de Sheets: responde 429 al excederla")
+    parser.add_argument("--quota-window", type=float, default=60.0, help="Ventana de las cuotas simuladas (s)")
+    parser.add_argument("--gemini-rpm", type=float, help="Límite del scheduler para Gemini (solicitudes/min)")
+    parser.add_argument("--sheets-rpm", type=float, help="Límite del scheduler para Sheets (escrituras/min)")
+    parser.add_argument("--prompt-cache", action="store_true", help="Enviar el prompt por caché de contexto")
+    parser.add_argument("--input-latency", type=float, default=0.0,
+                        help="Latencia simulada por cada 1000 tokens de texto enviados (s)")
+    parser.add_argument("--cache-min-tokens", type=int, default=0,
+                        help="Mínimo de tokens cacheables simulado (por debajo, la caché falla y se usa el prompt completo)")
+    parser.add_argument("--no-memory", action="store_true", help="No medir memoria (tracemalloc añade sobrecosto)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="Archivo JSON de salida (por defecto, stdout)")
+    args = parser.parse_args(argv)
+
+    prompt_cache.configure(enabled=args.prompt_cache)
+    routing_policy = None
+    model_overrides = {BENCH_MODEL: {"incomplete_rate": args.incomplete_rate}}
+    if args.escalate_to:
+        routing_policy = routing.RoutingPolicy(primary_model=BENCH_MODEL, escalation_model=args.escalate_to,
+                                               hedge_after_s=args.hedge_after)
+        model_overrides[args.escalate_to] = {"generate_latency_s": args.escalate_latency, "incomplete_rate": 0.0}
+    report = run_benchmark(
+        n_files=args.files,
+        audio_bytes=args.audio_kb * 1024,
+        concurrency_levels=args.concurrency,
+        genai_options={
+            "upload_latency_s": args.upload_latency,
+            "upload_bytes_per_s": args.upload_mbps * 1_000_000 / 8,
+            "processing_s": args.processing,
+            "generate_latency_s": args.generate_latency,
+            "response_bytes": args.response_kb * 1024,
+            "failure_rate": args.failure_rate,
+            "malformed_rate": args.malformed_rate,
+            "model_overrides": model_overrides,
+            "quota_rpm": args.quota_rpm,
+            "quota_window_s": args.quota_window,
+            "input_s_per_ktok": args.input_latency,
+            "cache_min_tokens": args.cache_min_tokens,
+        },
+        sheet_options={"latency_s": args.sheet_latency, "failure_rate": args.sheet_failure_rate,
+                       "quota_rpm": args.sheet_quota_rpm, "quota_window_s": args.quota_window},
+        measure_memory=not args.no_memory,
+        seed=args.seed,
+        routing_policy=routing_policy,
+        limits={"gemini_rpm": args.gemini_rpm, "sheets_rpm": args.sheets_rpm},
+    )
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
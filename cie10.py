@@ -0,0 +1,376 @@
+"""Índice local de la CIE-10 para asignar y validar los códigos de ``Diagnosticos``.
+
+Tras la generación, cada ``Diagnosticos[].Nombre`` se busca en un índice
+invertido de la tabla local (``data/cie10_es.tsv`` o ``CITAMED_CIE10_PATH``),
+sin distinguir tildes ni mayúsculas y tolerando erratas (trigramas y prefijos).
+El puntaje es un Dice ponderado por IDF entre las palabras del diagnóstico y la
+descripción (o un sinónimo) de cada código. Con una coincidencia clara:
+
+* si el modelo no dio código, se completa;
+* si dio un código de otra categoría que la tabla asocia a otra enfermedad, se
+  corrige y el original queda en ``IDModelo``;
+* si el código es compatible (misma categoría de tres caracteres), se conserva.
+
+Los códigos que no están en la tabla no se pueden verificar y se dejan como
+los dio el modelo. La tabla incluida es un subconjunto de códigos frecuentes;
+ver el encabezado del archivo para cargar la tabla oficial completa::
+
+    python cie10.py "hipertension arterial sistemica"
+    python cie10.py --bench
+"""
+import argparse
+import bisect
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+from dataclasses import asdict, dataclass
+
+import config
+
+DEFAULT_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cie10_es.tsv")
+NOT_FOUND = "NO_ENCONTRADO"
+
+FILL_MIN_SCORE = 0.6  # Puntaje mínimo para completar un código vacío
+CORRECT_MIN_SCORE = 0.75  # Puntaje mínimo para reemplazar el código del modelo
+AMBIGUITY_MARGIN = 0.05  # Si otra categoría queda a menos de este margen, no se decide (p. ej. "fractura")
+FUZZY_MIN_SIMILARITY = 0.6  # Jaccard de trigramas mínimo para aceptar una palabra con errata
+FUZZY_CACHE_SIZE = 20_000  # Palabras desconocidas ya resueltas (acotado)
+
+# Resultado de la validación de cada diagnóstico
+ACTION_CONFIRMED = "confirmado"  # El código del modelo coincide con la tabla
+ACTION_FILLED = "completado"  # El modelo no dio código y se asignó el de la tabla
+ACTION_CORRECTED = "corregido"  # El código del modelo era de otra enfermedad
+ACTION_UNVERIFIED = "sin verificar"  # El código no está en la tabla local
+ACTION_NO_MATCH = "sin coincidencia"  # El nombre no se parece a ninguna descripción
+
+_CODE_RE = re.compile(r"^([A-Z])(\d{2})\.?(\d{0,2})$")
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a al con de del e el en la las lo los o otra otras otro otros para por sin su sus u un una y".split()
+)
+
+
+def normalize_text(text):
+    """Minúsculas y sin tildes (la ñ pasa a n), para comparar sin importar la escritura."""
+    decomposed = unicodedata.normalize("NFKD", str(text).lower())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def tokenize(text):
+    return [token for token in _TOKEN_RE.findall(normalize_text(text)) if token not in STOPWORDS]
+
+
+def normalize_code(code):
+    """Código en forma canónica (``e119`` -> ``E11.9``), o None si no parece un código CIE-10."""
+    if not isinstance(code, str):
+        return None
+    match = _CODE_RE.match(code.strip().upper().replace(" ", ""))
+    if not match:
+        return None
+    letter, category, detail = match.groups()
+    return f"{letter}{category}.{detail}" if detail else f"{letter}{category}"
+
+
+def category(code):
+    """Categoría de tres caracteres (``E11.9`` -> ``E11``)."""
+    return code[:3]
+
+
+def _trigrams(token):
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+@dataclass(frozen=True)
+class Cie10Entry:
+    code: str
+    description: str
+
+
+@dataclass
+class Cie10Check:
+    """Validación de un diagnóstico: qué dio el modelo, qué quedó y por qué."""
+    nombre: str
+    id_modelo: str | None
+    id: str | None
+    descripcion: str | None
+    accion: str
+    puntaje: float
+
+
+class Cie10Index:
+    """Índice invertido de descripciones y sinónimos, con corrección de erratas por trigramas."""
+
+    def __init__(self, rows):
+        self.entries = {}  # código -> Cie10Entry
+        self._documents = []  # (código, {palabra: peso}, peso_total)
+        self._postings = {}  # palabra -> [índices de documento]
+        self._trigram_index = {}  # trigrama -> {palabras}
+        self._fuzzy_cache = {}  # palabra desconocida -> [(palabra, similitud)]
+        self._lock = threading.Lock()
+        documents = []
+        for code, description, aliases in rows:
+            code = normalize_code(code)
+            if code is None:
+                continue
+            self.entries[code] = Cie10Entry(code, description)
+            for text in (description, *aliases):
+                tokens = set(tokenize(text))
+                if tokens:
+                    documents.append((code, tokens))
+        doc_freq = {}
+        for _, tokens in documents:
+            for token in tokens:
+                doc_freq[token] = doc_freq.get(token, 0) + 1
+        total = len(documents)
+        self._idf = {token: math.log(1 + total / freq) for token, freq in doc_freq.items()}
+        for doc_id, (code, tokens) in enumerate(documents):
+            weights = {token: self._idf[token] for token in tokens}
+            self._documents.append((code, weights, sum(weights.values())))
+            for token in tokens:
+                self._postings.setdefault(token, []).append(doc_id)
+        for token in self._idf:
+            for trigram in _trigrams(token):
+                self._trigram_index.setdefault(trigram, set()).add(token)
+        self._vocabulary = sorted(self._idf)
+        self._unknown_weight = sum(self._idf.values()) / len(self._idf) if self._idf else 1.0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, code):
+        code = normalize_code(code)
+        return self.entries.get(code) if code else None
+
+    def _resolve_token(self, token):
+        """Palabras del índice que corresponden a ``token`` con su similitud (1.0 si es exacta)."""
+        if token in self._idf:
+            return [(token, 1.0)]
+        cached = self._fuzzy_cache.get(token)
+        if cached is not None:
+            return cached
+        candidates = {}
+        if len(token) >= 4:  # Abreviaturas: "hipert" -> "hipertension"
+            for vocab_token in self._prefixed(token):
+                candidates[vocab_token] = 0.9
+        grams = _trigrams(token)
+        overlap = {}
+        for trigram in grams:
+            for vocab_token in self._trigram_index.get(trigram, ()):
+                overlap[vocab_token] = overlap.get(vocab_token, 0) + 1
+        for vocab_token, shared in overlap.items():
+            similarity = shared / (len(grams) + len(_trigrams(vocab_token)) - shared)
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                candidates[vocab_token] = max(candidates.get(vocab_token, 0.0), similarity)
+        resolved = sorted(candidates.items(), key=lambda item: -item[1])[:3]
+        with self._lock:
+            if len(self._fuzzy_cache) >= FUZZY_CACHE_SIZE:
+                self._fuzzy_cache.clear()
+            self._fuzzy_cache[token] = resolved
+        return resolved
+
+    def _prefixed(self, prefix):
+        start = bisect.bisect_left(self._vocabulary, prefix)
+        matches = []
+        for vocab_token in self._vocabulary[start:start + 5]:
+            if not vocab_token.startswith(prefix):
+                break
+            matches.append(vocab_token)
+        return matches
+
+    def search(self, text, limit=5):
+        """[(Cie10Entry, puntaje)] ordenados de mejor a peor; puntaje entre 0 y 1."""
+        query = {}
+        unknown_weight = 0.0  # Las palabras sin correspondencia también pesan (penaliza coincidencias parciales)
+        for token in set(tokenize(text)):
+            resolved = self._resolve_token(token)
+            if not resolved:
+                unknown_weight += self._unknown_weight
+            for vocab_token, similarity in resolved:
+                query[vocab_token] = max(query.get(vocab_token, 0.0), similarity)
+        if not query:
+            return []
+        query_weight = sum(self._idf[token] for token in query) + unknown_weight
+        matched = {}
+        for token, similarity in query.items():
+            weight = self._idf[token] * similarity
+            for doc_id in self._postings[token]:
+                matched[doc_id] = matched.get(doc_id, 0.0) + weight
+        best = {}
+        for doc_id, weight in matched.items():
+            code, _, doc_weight = self._documents[doc_id]
+            score = 2 * weight / (query_weight + doc_weight)
+            if score > best.get(code, 0.0):
+                best[code] = score
+        ranked = sorted(best.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [(self.entries[code], round(min(score, 1.0), 4)) for code, score in ranked]
+
+    def best(self, text):
+        """(Cie10Entry, puntaje) de la mejor coincidencia, o (None, 0.0)."""
+        results = self.search(text, limit=1)
+        return results[0] if results else (None, 0.0)
+
+    def _decisive(self, text):
+        """Mejor coincidencia y si es inequívoca (ninguna otra categoría queda empatada)."""
+        results = self.search(text, limit=5)
+        if not results:
+            return None, 0.0, False
+        entry, score = results[0]
+        rivals = [s for other, s in results[1:] if category(other.code) != category(entry.code)]
+        return entry, score, not rivals or rivals[0] < score - AMBIGUITY_MARGIN
+
+    def check(self, name, model_code):
+        """Valida un diagnóstico (nombre y código del modelo) contra la tabla."""
+        given = model_code.strip() if isinstance(model_code, str) and model_code.strip().upper() != NOT_FOUND else None
+        code = normalize_code(given) if given else None
+        entry, score, decisive = self._decisive(name) if name else (None, 0.0, False)
+        if code is not None and entry is not None and category(code) == category(entry.code):
+            return Cie10Check(name, given, code, entry.description, ACTION_CONFIRMED, score)
+        if code is None:
+            # Sin código (o con un texto que no es un código): se completa si la coincidencia es clara
+            if entry is not None and decisive and score >= FILL_MIN_SCORE:
+                return Cie10Check(name, given, entry.code, entry.description, ACTION_FILLED, score)
+            return Cie10Check(name, given, given, None, ACTION_NO_MATCH, score)
+        known = self.get(code)
+        if known is None:
+            return Cie10Check(name, given, code, None, ACTION_UNVERIFIED, score)
+        if entry is not None and decisive and score >= CORRECT_MIN_SCORE:
+            return Cie10Check(name, given, entry.code, entry.description, ACTION_CORRECTED, score)
+        # Código conocido pero el nombre no coincide con claridad con ninguna descripción
+        return Cie10Check(name, given, code, known.description, ACTION_NO_MATCH, score)
+
+
+def load_table(path):
+    """Filas (código, descripción, [sinónimos]) de un TSV con el formato de ``data/cie10_es.tsv``."""
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            parts = line.split("\t")
+            if len(parts) < 2:
+                continue
+            aliases = [alias.strip() for alias in parts[2].split("|") if alias.strip()] if len(parts) > 2 else []
+            rows.append((parts[0].strip(), parts[1].strip(), aliases))
+    return rows
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Índice del proceso, construido en el primer uso."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = Cie10Index(load_table(config.CIE10_PATH or DEFAULT_TABLE_PATH))
+    return _index
+
+
+def apply(parsed_json, index=None):
+    """Completa o corrige en el sitio los ``ID`` de ``Diagnosticos``. Devuelve la lista de Cie10Check."""
+    data = parsed_json.get("data") if isinstance(parsed_json, dict) else None
+    existing_mrs = data.get("existing-mrs") if isinstance(data, dict) else None
+    diagnoses = existing_mrs.get("Diagnosticos") if isinstance(existing_mrs, dict) else None
+    if not isinstance(diagnoses, list):
+        return []
+    index = index or get_index()
+    checks = []
+    for diagnosis in diagnoses:
+        if not isinstance(diagnosis, dict) or not diagnosis.get("Nombre"):
+            continue
+        result = index.check(str(diagnosis["Nombre"]), diagnosis.get("ID"))
+        if result.accion == ACTION_CORRECTED:
+            diagnosis["IDModelo"] = result.id_modelo
+        if result.id and result.id != diagnosis.get("ID"):
+            diagnosis["ID"] = result.id  # Completado, corregido o solo normalizado ("e119" -> "E11.9")
+        checks.append(result)
+    return checks
+
+
+def summarize(checks):
+    """Conteo por acción, p. ej. {"confirmado": 2, "completado": 1}."""
+    counts = {}
+    for result in checks:
+        counts[result.accion] = counts.get(result.accion, 0) + 1
+    return counts
+
+
+# --- Benchmark de búsqueda ---
+def _typo(text, rng):
+    """Variante con una errata (dos letras intercambiadas) en la palabra más larga."""
+    words = text.split()
+    longest = max(range(len(words)), key=lambda i: len(words[i]))
+    word = words[longest]
+    if len(word) > 4:
+        i = rng.randrange(1, len(word) - 2)
+        words[longest] = word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return " ".join(words)
+
+
+def benchmark(index=None, rounds=3, seed=0, table=None):
+    """Busca todas las descripciones de la tabla (exactas, sin tildes y con errata) y mide el throughput.
+
+    Solo mide la tabla cargada: con el subconjunto incluido, el throughput y la
+    precisión no son representativos de la CIE-10 completa (``table`` etiqueta
+    el resultado).
+    """
+    import random
+    rng = random.Random(seed)
+    index = index or get_index()
+    queries = []
+    for entry in index.entries.values():
+        queries.append((entry.description, entry.code))
+        queries.append((normalize_text(entry.description).upper(), entry.code))
+        queries.append((_typo(entry.description, rng), entry.code))
+    latencies = []
+    hits = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        index._fuzzy_cache.clear()  # Cada ronda resuelve las erratas desde cero
+        for text, code in queries:
+            t0 = time.perf_counter()
+            found, _ = index.best(text)
+            latencies.append(time.perf_counter() - t0)
+            hits += found is not None and found.code == code
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "table": table or "desconocida",
+        "codes": len(index),
+        "lookups": len(latencies),
+        "lookups_per_s": round(len(latencies) / elapsed),
+        "p50_us": round(latencies[len(latencies) // 2] * 1e6, 1),
+        "p99_us": round(latencies[int(len(latencies) * 0.99)] * 1e6, 1),
+        "top1_accuracy": round(hits / len(latencies), 4),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Búsqueda en el índice local de la CIE-10.")
+    parser.add_argument("query", nargs="*", help="Diagnóstico a buscar")
+    parser.add_argument("--bench", action="store_true",
+                        help="Medir el throughput sobre la tabla cargada (la incluida es solo un subconjunto)")
+    parser.add_argument("--limit", type=int, default=5)
+    args = parser.parse_args(argv)
+    if args.bench:
+        table = config.CIE10_PATH or f"{os.path.relpath(DEFAULT_TABLE_PATH)} (subconjunto incluido; no es la CIE-10 completa)"
+        print(json.dumps(benchmark(table=table), ensure_ascii=False, indent=2))
+        return 0
+    if not args.query:
+        parser.error("indica un diagnóstico o --bench")
+    for entry, score in get_index().search(" ".join(args.query), limit=args.limit):
+        print(json.dumps({**asdict(entry), "score": score}, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
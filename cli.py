@@ -0,0 +1,247 @@
+"""Procesamiento por lotes sin interfaz (backfills nocturnos de grabaciones archivadas).
+
+Recorre directorios o patrones glob de archivos .ogg, los procesa con el mismo
+pipeline y prompt que la app en un pool de hilos o de procesos, escribe un
+registro JSON por archivo (JSONL) y, opcionalmente, registra cada consulta en
+la hoja de Google Sheets a través de la cola local durable.
+
+Las credenciales se leen de variables de entorno (``GOOGLE_API_KEY``,
+``GOOGLE_CREDENTIALS_JSON``, ``GOOGLE_SHEET_LOG_URL``) o, si faltan, de
+``.streamlit/secrets.toml``. Ejemplo::
+
+    python cli.py grabaciones/2024-05/ "archivo/**/*.ogg" -o resultados.jsonl --workers 8 --log-to-sheets
+"""
+import argparse
+import glob
+import json
+import logging
+import multiprocessing.util
+import os
+import sys
+import time
+import tomllib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import clients
+import file_registry
+import log_format
+import pipeline
+import prompt_cache
+import prompts
+import result_cache
+import routing
+import sheets_spool
+
+logger = logging.getLogger("citamed.cli")
+
+DEFAULT_MODEL = "gemini-1.5-flash-latest"
+SECRETS_FILE = os.path.join(".streamlit", "secrets.toml")
+SECRET_NAMES = ("GOOGLE_API_KEY", "GOOGLE_CREDENTIALS_JSON", "GOOGLE_SHEET_LOG_URL")
+SHEETS_DRAIN_TIMEOUT_S = 300  # Espera máxima para vaciar la cola de Sheets al terminar
+
+
+def load_secrets(secrets_file=SECRETS_FILE):
+    """Secretos desde el entorno, completados con ``secrets.toml`` si existe."""
+    secrets = {}
+    if os.path.exists(secrets_file):
+        with open(secrets_file, "rb") as f:
+            secrets.update({k: v for k, v in tomllib.load(f).items() if k in SECRET_NAMES})
+    secrets.update({name: os.environ[name] for name in SECRET_NAMES if os.environ.get(name)})
+    return secrets
+
+
+def find_audio_files(inputs, pattern="*.ogg"):
+    """Expande directorios (recursivamente) y patrones glob a rutas .ogg únicas y ordenadas."""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(glob.glob(os.path.join(item, "**", pattern), recursive=True))
+        elif os.path.isfile(item):
+            paths.append(item)
+        else:
+            paths.extend(p for p in glob.glob(item, recursive=True) if os.path.isfile(p))
+    return sorted({os.path.abspath(p) for p in paths})
+
+
+def completed_paths(output_path):
+    """Rutas ya procesadas con éxito en un JSONL previo (para reanudar)."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("ok"):
+                done.add(record.get("path"))
+    return done
+
+
+def _init_worker(api_key, use_prompt_cache=False, measure_memory=True):
+    # En modo procesos cada worker configura su propio cliente de Gemini (y su caché de contexto)
+    logging.basicConfig(level=logging.WARNING)
+    clients.configure_genai(api_key)
+    prompt_cache.configure(enabled=use_prompt_cache)
+    pipeline.UPLOAD_MEASURE_MEMORY = measure_memory
+    # Los workers terminan con os._exit (sin atexit): los finalizadores de multiprocessing sí se ejecutan
+    multiprocessing.util.Finalize(None, _collect_worker_files, exitpriority=10)
+
+
+def _collect_worker_files():
+    """Al salir un worker: borra los archivos que liberó y quedaron en su cola de borrado en memoria."""
+    registry = file_registry.registry
+    if registry is None:
+        return
+    try:
+        registry.collect(scan_orphans=False)  # Los vigentes siguen en el registro compartido para reutilizarse
+    except Exception as e:
+        logger.warning("No se pudieron borrar los archivos del worker %d: %s", os.getpid(), e)
+
+
+def process_path(path, model_name, prompt_text, use_cache=True, force_reprocess=False, preprocess=False,
+                 segment_long_audio=False, routing_policy=None):
+    """Procesa un archivo del disco. Función de nivel de módulo para poder usarse en un ProcessPool."""
+    with open(path, "rb") as f:
+        data = f.read()
+    return pipeline.process_audio(
+        data, os.path.basename(path), model_name, prompt_text,
+        cache=result_cache.get_result_cache() if use_cache else None,
+        force_reprocess=force_reprocess, preprocess=preprocess, segment_long_audio=segment_long_audio,
+        routing_policy=routing_policy,
+    )
+
+
+def make_log_writer(secrets):
+    """Escritor de log con cola durable (el mismo que usa la app)."""
+    creds_json_str = secrets["GOOGLE_CREDENTIALS_JSON"]
+    sheet_url = secrets["GOOGLE_SHEET_LOG_URL"]
+    clients.get_sheets_client(creds_json_str).authorize()  # Falla pronto si el JSON no es válido
+
+    def worksheet_factory():
+        return clients.get_sheets_client(creds_json_str).log_worksheet(sheet_url)
+
+    return sheets_spool.get_log_writer(worksheet_factory)
+
+
+def run(paths, output_path, model_name, workers=4, use_processes=False, log_writer=None, use_cache=True,
+        force_reprocess=False, preprocess=False, segment_long_audio=False, routing_policy=None, api_key=None):
+    """Procesa ``paths`` y añade un registro por archivo a ``output_path``. Devuelve el resumen."""
+    executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    executor_kwargs = {"initializer": _init_worker, "initargs": (api_key, prompt_cache.enabled(), pipeline.UPLOAD_MEASURE_MEMORY)} if use_processes else {}
+    summary = {"total": len(paths), "succeeded": 0, "failed": 0, "cache_hits": 0, "logged": 0, "routes": {}}
+    start_time = time.time()
+    with open(output_path, "a", encoding="utf-8") as out, executor_cls(max_workers=workers, **executor_kwargs) as executor:
+        futures = {
+            executor.submit(process_path, path, model_name, prompts.PROMPT_TEXT, use_cache, force_reprocess,
+                            preprocess, segment_long_audio, routing_policy): path
+            for path in paths
+        }
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:  # p. ej. archivo ilegible o worker caído
+                result = pipeline.ConsultResult(filename=os.path.basename(path), model_name=model_name,
+                                                status=pipeline.STATUS_FAILED, error=f"{type(e).__name__}: {e}")
+            # Los aciertos de caché ya se registraron cuando se procesaron por primera vez
+            if log_writer is not None and result.ok and not result.from_cache:
+                log_writer.append_row(pipeline.build_log_row(result.parsed_json, result.filename, result.model_name,
+                                                            stage_times=result.stage_times))
+                result.logged = True
+            out.write(json.dumps({"path": path, **result.as_record()}, ensure_ascii=False) + "\n")
+            out.flush()
+
+            summary["succeeded" if result.ok else "failed"] += 1
+            summary["cache_hits"] += result.from_cache
+            summary["logged"] += result.logged
+            if result.route:
+                summary["routes"][result.route] = summary["routes"].get(result.route, 0) + 1
+            logger.info("[%d/%d] %s: %s (%.1f s)%s", done_count, len(paths), result.filename, result.status,
+                        result.elapsed, f" - {result.error}" if result.error else "")
+    summary["wall_time_s"] = round(time.time() - start_time, 2)
+    summary["files_per_minute"] = round(len(paths) * 60.0 / summary["wall_time_s"], 2) if summary["wall_time_s"] else 0.0
+    if prompt_cache.enabled() and not use_processes:  # Con procesos, las estadísticas quedan en cada worker
+        summary["prompt_cache"] = prompt_cache.stats.summary()
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Procesa grabaciones .ogg sin interfaz y escribe los resultados en JSONL.")
+    parser.add_argument("inputs", nargs="+", help="Directorios, archivos o patrones glob (p. ej. 'archivo/**/*.ogg')")
+    parser.add_argument("-o", "--output", default="resultados.jsonl", help="Archivo JSONL de salida (se añade al final)")
+    parser.add_argument("-m", "--model", default=DEFAULT_MODEL, help=f"Modelo de Gemini (por defecto {DEFAULT_MODEL})")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Archivos en paralelo")
+    parser.add_argument("--processes", action="store_true", help="Usar un pool de procesos en lugar de hilos")
+    parser.add_argument("--log-to-sheets", action="store_true", help="Registrar cada consulta en la hoja de Google Sheets")
+    parser.add_argument("--resume", action="store_true", help="Omitir archivos ya procesados con éxito en --output")
+    parser.add_argument("--no-cache", action="store_true", help="No usar la caché local de resultados")
+    parser.add_argument("--force", action="store_true", help="Reprocesar aunque el resultado esté en caché")
+    parser.add_argument("--preprocess", action="store_true", help="Preprocesar el audio con ffmpeg antes de subirlo")
+    parser.add_argument("--long-audio", action="store_true", help="Dividir consultas largas en segmentos paralelos")
+    parser.add_argument("--escalate-to", metavar="MODELO",
+                        help="Enrutamiento: repetir con este modelo si --model no devuelve JSON o deja campos obligatorios vacíos")
+    parser.add_argument("--hedge-after", type=float, metavar="S",
+                        help="Con --escalate-to: lanzar también el modelo de escalado si --model no responde en S segundos")
+    parser.add_argument("--prompt-cache", action="store_true",
+                        help="Enviar el prompt por caché de contexto de Gemini (también CITAMED_PROMPT_CACHE=1)")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="No medir el pico de memoria de cada subida (tracemalloc añade sobrecosto)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    secrets = load_secrets()
+    api_key = secrets.get("GOOGLE_API_KEY")
+    if not api_key:
+        logger.error("Falta GOOGLE_API_KEY (variable de entorno o %s).", SECRETS_FILE)
+        return 2
+    clients.configure_genai(api_key)
+    if args.prompt_cache:
+        prompt_cache.configure(enabled=True)
+    pipeline.UPLOAD_MEASURE_MEMORY = not args.no_memory  # En la app queda desactivado (CITAMED_UPLOAD_MEASURE_MEMORY)
+
+    log_writer = None
+    if args.log_to_sheets:
+        missing = [name for name in SECRET_NAMES[1:] if not secrets.get(name)]
+        if missing:
+            logger.error("Faltan secretos para Google Sheets: %s.", ", ".join(missing))
+            return 2
+        log_writer = make_log_writer(secrets)
+
+    routing_policy = None
+    if args.escalate_to:
+        routing_policy = routing.RoutingPolicy(primary_model=args.model, escalation_model=args.escalate_to,
+                                               hedge_after_s=args.hedge_after)
+
+    paths = find_audio_files(args.inputs)
+    if args.resume:
+        already_done = completed_paths(args.output)
+        paths = [p for p in paths if p not in already_done]
+    if not paths:
+        logger.warning("No hay archivos .ogg que procesar.")
+        return 0
+    logger.info("Procesando %d archivos con %s (%d %s).", len(paths), args.model, args.workers,
+                "procesos" if args.processes else "hilos")
+
+    summary = run(
+        paths, args.output, args.model, workers=args.workers, use_processes=args.processes, log_writer=log_writer,
+        use_cache=not args.no_cache, force_reprocess=args.force, preprocess=args.preprocess,
+        segment_long_audio=args.long_audio, routing_policy=routing_policy, api_key=api_key,
+    )
+    registry = file_registry.get_registry()
+    registry.collect(scan_orphans=False)  # Borra ya los archivos pendientes (los vigentes quedan para reutilizarse)
+    summary["file_reuse"] = registry.summary()
+    if log_writer is not None:
+        pending = log_writer.drain(timeout=SHEETS_DRAIN_TIMEOUT_S)
+        summary["sheets_pending"] = pending
+        summary["log_rows"] = log_format.stats.summary()  # Bytes ahorrados por el formato compacto
+        if pending:
+            logger.warning("%d filas siguen en la cola local de Sheets; se enviarán en la próxima ejecución.", pending)
+    print(json.dumps(summary, ensure_ascii=False))
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
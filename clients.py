@@ -0,0 +1,196 @@
+"""Clientes compartidos (por proceso) de Gemini y Google Sheets.
+
+Los módulos importados sobreviven a los reruns de Streamlit y se comparten entre
+sesiones, así que aquí se guarda un único cliente gspread autorizado por
+credencial, un handle de hoja resuelto por URL y un objeto de modelo por nombre.
+Si el token expira o la API responde 401, el cliente se re-autoriza y la llamada
+se reintenta una vez de forma transparente.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import scheduler
+from startup import lazy_import
+
+# SDK pesados: se importan en su primer uso (ver startup.py)
+genai = lazy_import("google.generativeai")
+gspread = lazy_import("gspread")
+google_auth_exceptions = lazy_import("google.auth.exceptions")
+google_auth_requests = lazy_import("google.auth.transport.requests")
+service_account = lazy_import("google.oauth2.service_account")
+
+logger = logging.getLogger(__name__)
+
+GSHEET_SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive.file' # A veces necesario para algunas operaciones de gspread
+]
+# Cada cuánto se vuelve a resolver el handle de la hoja aunque no haya fallado
+WORKSHEET_MAX_AGE_S = 30 * 60
+
+_lock = threading.RLock()
+_sheets_clients = {}  # sha256(credenciales) -> SheetsClient
+_models = {}  # nombre de modelo -> genai.GenerativeModel
+_configured_api_key_hash = None
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def api_error_status(err):
+    """Código HTTP de un gspread APIError (compatible con gspread 5 y 6)."""
+    code = getattr(err, "code", None)
+    if isinstance(code, int):
+        return code
+    response = getattr(err, "response", None)
+    return getattr(response, "status_code", None)
+
+
+# --- Gemini ---
+def configure_genai(api_key):
+    """Configura el SDK de Gemini solo si la API key cambió desde la última vez."""
+    global _configured_api_key_hash
+    key_hash = _sha256(api_key)
+    with _lock:
+        if key_hash != _configured_api_key_hash:
+            genai.configure(api_key=api_key)
+            _configured_api_key_hash = key_hash
+            _models.clear()  # Los modelos se crearon con la configuración anterior
+
+
+def reset_models():
+    """Descarta los modelos cacheados (p. ej. al cambiar de backend)."""
+    with _lock:
+        _models.clear()
+
+
+def get_generative_model(model_name):
+    """Objeto GenerativeModel reutilizable para ``model_name``."""
+    with _lock:
+        model = _models.get(model_name)
+        if model is None:
+            model = genai.GenerativeModel(model_name)
+            _models[model_name] = model
+        return model
+
+
+# --- Google Sheets ---
+class SheetsClient:
+    """Cliente gspread autorizado y cacheado para un JSON de cuenta de servicio."""
+
+    def __init__(self, creds_json_str):
+        self._creds_json_str = creds_json_str
+        self._creds = None
+        self._gc = None
+        self._worksheets = {}  # url -> (worksheet, resuelto_en)
+        self._lock = threading.RLock()
+
+    def authorize(self):
+        """Devuelve el cliente gspread, autorizando o refrescando el token si hace falta."""
+        with self._lock:
+            if self._gc is None:
+                # Lanza json.JSONDecodeError si el secreto no es JSON válido
+                creds_dict = json.loads(self._creds_json_str)
+                self._creds = service_account.Credentials.from_service_account_info(creds_dict, scopes=GSHEET_SCOPES)
+                self._gc = gspread.authorize(self._creds)
+                self._worksheets.clear()
+            elif self._creds is not None and self._creds.token and self._creds.expired:
+                # Health check barato: refresca el token local antes de usarlo
+                try:
+                    self._creds.refresh(google_auth_requests.Request())
+                except (google_auth_exceptions.RefreshError, google_auth_exceptions.TransportError) as refresh_err:
+                    logger.warning("GSHEET: no se pudo refrescar el token (%s). Re-autorizando.", refresh_err)
+                    self.invalidate()
+                    return self.authorize()
+            return self._gc
+
+    def open_worksheet(self, sheet_url):
+        """Handle de la primera hoja (sheet1) de ``sheet_url``, resuelto una sola vez."""
+        with self._lock:
+            gc = self.authorize()
+            cached = self._worksheets.get(sheet_url)
+            if cached and time.time() - cached[1] < WORKSHEET_MAX_AGE_S:
+                return cached[0]
+            worksheet = gc.open_by_url(sheet_url).sheet1
+            self._worksheets[sheet_url] = (worksheet, time.time())
+            return worksheet
+
+    def forget_worksheet(self, sheet_url):
+        with self._lock:
+            self._worksheets.pop(sheet_url, None)
+
+    def invalidate(self):
+        """Descarta credenciales, cliente y handles (se recrean en el próximo uso)."""
+        with self._lock:
+            self._creds = None
+            self._gc = None
+            self._worksheets.clear()
+
+    def log_worksheet(self, sheet_url):
+        return LogWorksheet(self, sheet_url)
+
+
+class LogWorksheet:
+    """Hoja de log con re-autenticación y re-resolución transparentes.
+
+    Expone ``append_row``/``append_rows`` y ``get`` como un ``gspread.Worksheet``; si la
+    llamada falla por autenticación (401 o token no refrescable) se re-autoriza
+    el cliente, y si la hoja ya no existe (404) se vuelve a resolver por URL.
+    En ambos casos se reintenta una sola vez. Cada llamada pasa por
+    ``scheduler.sheets`` (cuota compartida y reintentos de 429/503).
+    """
+    self_scheduled = True  # pipeline.append_log_row no debe volver a encolarla
+
+    def __init__(self, sheets_client, sheet_url):
+        self.sheets_client = sheets_client
+        self.sheet_url = sheet_url
+
+    @property
+    def worksheet(self):
+        return self.sheets_client.open_worksheet(self.sheet_url)
+
+    def call(self, fn):
+        """Ejecuta ``fn(worksheet)`` con turno en el scheduler y un reintento tras re-autenticar."""
+        return scheduler.sheets.call(lambda: self._call(fn))
+
+    def _call(self, fn):
+        try:
+            return fn(self.worksheet)
+        except google_auth_exceptions.RefreshError as auth_err:
+            logger.warning("GSHEET: credenciales expiradas (%s). Re-autorizando.", auth_err)
+            self.sheets_client.invalidate()
+        except gspread.exceptions.APIError as api_err:
+            status = api_error_status(api_err)
+            if status == 401:
+                logger.warning("GSHEET: 401 de la API. Re-autorizando.")
+                self.sheets_client.invalidate()
+            elif status == 404:
+                logger.warning("GSHEET: la hoja ya no se encuentra. Re-resolviendo por URL.")
+                self.sheets_client.forget_worksheet(self.sheet_url)
+            else:
+                raise
+        return fn(self.worksheet)
+
+    def append_row(self, values, **kwargs):
+        return self.call(lambda ws: ws.append_row(values, **kwargs))
+
+    def append_rows(self, values, **kwargs):
+        return self.call(lambda ws: ws.append_rows(values, **kwargs))
+
+    def get(self, range_name, **kwargs):
+        return self.call(lambda ws: ws.get(range_name, **kwargs))
+
+
+def get_sheets_client(creds_json_str):
+    """SheetsClient compartido para este JSON de credenciales."""
+    key = _sha256(creds_json_str)
+    with _lock:
+        client = _sheets_clients.get(key)
+        if client is None:
+            client = SheetsClient(creds_json_str)
+            _sheets_clients[key] = client
+        return client
@@ -0,0 +1,257 @@
+"""Comparación de modelos sobre un mismo audio: una sola subida, generación en paralelo.
+
+El audio se sube una vez (``pipeline.acquire_audio_file``) y ``generate_content``
+se lanza a la vez con cada modelo elegido. Por modelo se mide la latencia de
+generación, los tokens de entrada y salida y si la respuesta fue JSON válido
+(directo o reparado) con los campos obligatorios. ``field_diff`` compara campo
+a campo los ``existing-mrs`` de las respuestas: diagnósticos (por código
+CIE-10 o nombre), medicamentos y signos vitales ya normalizados.
+
+Las consultas de comparación no se registran en la hoja de log. Desde la
+terminal (mismos secretos que cli.py)::
+
+    python compare.py consulta.ogg -m gemini-2.5-flash-preview-04-17 gemini-1.5-pro-latest -o comparacion.json
+"""
+import argparse
+import contextvars
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+import cie10
+import json_output
+import pipeline
+import routing
+import vitals
+
+logger = logging.getLogger(__name__)
+
+MAX_PARALLEL_MODELS = 4
+NOT_FOUND = "NO_ENCONTRADO"
+MISSING = "—"  # Celda de un modelo que no tiene el elemento
+VITAL_LABELS = {"FC_lpm": "FC (lpm)", "TAS_mmHg": "TAS (mmHg)", "TAD_mmHg": "TAD (mmHg)", "Peso_kg": "Peso (kg)",
+                "Talla_m": "Talla (m)", "IMC": "IMC"}
+
+# Secciones de field_diff
+SECTION_DIAGNOSES = "Diagnósticos"
+SECTION_MEDICATIONS = "Medicamentos"
+SECTION_VITALS = "Signos vitales"
+
+
+@dataclass
+class ModelRun:
+    """Respuesta de un modelo en la comparación."""
+    model_name: str
+    latency_s: float = 0.0
+    prompt_tokens: int | None = None
+    output_tokens: int | None = None
+    parsed_json: dict | None = None
+    parse_method: str | None = None  # "direct" o "repaired"
+    missing_fields: list = field(default_factory=list)  # Campos obligatorios vacíos (ver routing)
+    error: str | None = None
+
+    @property
+    def valid_json(self):
+        return self.parsed_json is not None
+
+    def as_row(self, agreement=None):
+        """Fila de la tabla resumen de la comparación."""
+        return {
+            "Modelo": self.model_name,
+            "Generación (s)": round(self.latency_s, 2),
+            "Tokens entrada": self.prompt_tokens if self.prompt_tokens is not None else "",
+            "Tokens salida": self.output_tokens if self.output_tokens is not None else "",
+            "JSON válido": ("Sí (reparado)" if self.parse_method == "repaired" else "Sí") if self.valid_json else "No",
+            "Campos obligatorios vacíos": ", ".join(self.missing_fields) if self.valid_json else "",
+            "Coincidencia con la mayoría (%)": "" if agreement is None else round(100 * agreement, 1),
+            "Error": self.error or "",
+        }
+
+    def as_record(self):
+        return {
+            "model": self.model_name,
+            "latency_s": round(self.latency_s, 3),
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "valid_json": self.valid_json,
+            "parse_method": self.parse_method,
+            "missing_fields": self.missing_fields,
+            "error": self.error,
+            "parsed_json": self.parsed_json,
+        }
+
+
+def run_model(audio_file_ref, model_name, prompt_text, on_wait=None):
+    """Genera y parsea con ``model_name`` sobre el archivo ya subido. No lanza excepciones."""
+    run = ModelRun(model_name)
+    start = time.perf_counter()
+    try:
+        response = pipeline.generate_content(audio_file_ref, model_name, prompt_text, on_wait=on_wait)
+        response_text = response.text
+        run.latency_s = time.perf_counter() - start
+        usage = getattr(response, "usage_metadata", None)
+        run.prompt_tokens = getattr(usage, "prompt_token_count", None)
+        run.output_tokens = getattr(usage, "candidates_token_count", None)
+        run.parsed_json, run.parse_method = json_output.parse_model_json(response_text, model_name)
+        pipeline.postprocess_consult(run.parsed_json)  # Códigos CIE-10 y signos vitales, como en una consulta normal
+        run.missing_fields = routing.missing_required_fields(run.parsed_json)
+    except Exception as e:
+        run.latency_s = run.latency_s or time.perf_counter() - start
+        run.parsed_json = None
+        run.error = f"{type(e).__name__}: {e}"
+    return run
+
+
+def iter_compare(audio_file_ref, model_names, prompt_text, on_wait=None, max_workers=MAX_PARALLEL_MODELS):
+    """Lanza todos los modelos a la vez y devuelve cada ModelRun a medida que termina.
+
+    Se puede consumir desde el hilo de la interfaz para mostrar el progreso.
+    """
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(model_names)) or 1,
+                            thread_name_prefix="citamed-compare") as executor:
+        # Cada solicitud conserva la sesión (turnos del scheduler) y la consulta (metrics) del llamador
+        futures = [executor.submit(contextvars.copy_context().run, run_model, audio_file_ref, model_name, prompt_text,
+                                   on_wait) for model_name in model_names]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def compare_audio(data, filename, model_names, prompt_text, on_run=None):
+    """Sube ``data`` una vez, compara ``model_names`` y libera el archivo. Devuelve los ModelRun en el orden pedido."""
+    upload = pipeline.ConsultResult(filename=filename, model_name="+".join(model_names))
+    audio_file_ref = pipeline.acquire_audio_file(data, filename, upload)
+    try:
+        runs = {}
+        for run in iter_compare(audio_file_ref, model_names, prompt_text):
+            runs[run.model_name] = run
+            if on_run:
+                on_run(run)
+    finally:
+        pipeline.release_remote_file(audio_file_ref)
+    return [runs[model_name] for model_name in model_names], upload
+
+
+# --- Diferencias campo a campo ---
+def _existing_mrs(parsed_json):
+    data = parsed_json.get("data") if isinstance(parsed_json, dict) else None
+    existing_mrs = data.get("existing-mrs") if isinstance(data, dict) else None
+    return existing_mrs if isinstance(existing_mrs, dict) else {}
+
+
+def _text(value):
+    text = str(value or "").strip()
+    return "" if text.upper() == NOT_FOUND else text
+
+
+def _diagnoses(parsed_json):
+    """{clave: texto}; la clave es la categoría CIE-10 si hay código, si no el nombre normalizado."""
+    items = {}
+    for dx in _existing_mrs(parsed_json).get("Diagnosticos") or []:
+        if not isinstance(dx, dict):
+            continue
+        name, code = _text(dx.get("Nombre")), cie10.normalize_code(dx.get("ID"))
+        if not name and not code:
+            continue
+        key = cie10.category(code) if code else " ".join(cie10.tokenize(name))
+        items.setdefault(key, f"{name} ({code})" if code else name)
+    return items
+
+
+def _medications(parsed_json):
+    """{nombre normalizado: "Nombre Presentación Dosis"}."""
+    items = {}
+    for med in _existing_mrs(parsed_json).get("Medicinas") or []:
+        if not isinstance(med, dict) or not _text(med.get("Nombre")):
+            continue
+        detail = " ".join(part for part in (_text(med.get("Nombre")), _text(med.get("Presentacion")),
+                                            _text(med.get("Dosis"))) if part)
+        items.setdefault(" ".join(cie10.tokenize(med["Nombre"])), detail)
+    return items
+
+
+def _vitals(parsed_json):
+    normalized = vitals.from_consult(parsed_json).as_json()
+    return {key: "" if normalized[key] is None else f"{normalized[key]:g}" for key in VITAL_LABELS}
+
+
+def field_diff(runs):
+    """Filas ``{"Sección", "Campo", <modelo>: valor..., "Coincide"}`` para los modelos con JSON válido.
+
+    Diagnósticos y medicamentos tienen una fila por elemento presente en algún
+    modelo (``MISSING`` donde falta); los medicamentos coinciden solo si también
+    coinciden presentación y dosis.
+    """
+    valid = [run for run in runs if run.valid_json]
+    rows = []
+    for section, extract, label in ((SECTION_DIAGNOSES, _diagnoses, None), (SECTION_MEDICATIONS, _medications, None),
+                                    (SECTION_VITALS, _vitals, VITAL_LABELS)):
+        per_model = {run.model_name: extract(run.parsed_json) for run in valid}
+        keys = list(dict.fromkeys(key for items in per_model.values() for key in items))
+        for key in keys:
+            values = {model_name: items.get(key) or MISSING for model_name, items in per_model.items()}
+            first = next((value for value in values.values() if value != MISSING), key)
+            compared = {model_name: cie10.normalize_text(value) for model_name, value in values.items()}
+            rows.append({
+                "Sección": section,
+                "Campo": label[key] if label else first,
+                **values,
+                "Coincide": "Sí" if len(set(compared.values())) == 1 else "No",
+            })
+    return rows
+
+
+def agreement(runs, rows=None):
+    """Por modelo, fracción de filas de ``field_diff`` en que coincide con el valor más frecuente."""
+    rows = field_diff(runs) if rows is None else rows
+    model_names = [run.model_name for run in runs if run.valid_json]
+    if not rows or len(model_names) < 2:
+        return {}
+    hits = Counter()
+    for row in rows:
+        majority, _ = Counter(cie10.normalize_text(row[name]) for name in model_names).most_common(1)[0]
+        hits.update(name for name in model_names if cie10.normalize_text(row[name]) == majority)
+    return {name: hits[name] / len(rows) for name in model_names}
+
+
+def summary_rows(runs, rows=None):
+    scores = agreement(runs, rows)
+    return [run.as_row(scores.get(run.model_name)) for run in runs]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compara varios modelos sobre el mismo audio (una sola subida).")
+    parser.add_argument("audio", help="Archivo .ogg")
+    parser.add_argument("-m", "--models", nargs="+", required=True, help="Modelos de Gemini a comparar")
+    parser.add_argument("-o", "--output", help="JSON con las respuestas y las diferencias (por defecto, solo el resumen)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    import clients
+    import cli
+    import prompts
+    secrets = cli.load_secrets()
+    if not secrets.get("GOOGLE_API_KEY"):
+        logger.error("Falta GOOGLE_API_KEY (variable de entorno o %s).", cli.SECRETS_FILE)
+        return 2
+    clients.configure_genai(secrets["GOOGLE_API_KEY"])
+    with open(args.audio, "rb") as f:
+        data = f.read()
+    runs, upload = compare_audio(data, args.audio, args.models, prompts.PROMPT_TEXT)
+    rows = field_diff(runs)
+    for row in summary_rows(runs, rows):
+        print(json.dumps(row, ensure_ascii=False))
+    differing = [row for row in rows if row["Coincide"] == "No"]
+    upload_note = "reutilizada" if upload.file_reused else f"{upload.stage_times.get('upload', 0.0):.2f} s"
+    print(f"{len(rows)} campos comparados, {len(differing)} con diferencias (subida {upload_note}).", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"runs": [run.as_record() for run in runs], "diff": rows}, f, ensure_ascii=False, indent=2)
+    return 0 if any(run.valid_json for run in runs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
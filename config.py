@@ -0,0 +1,61 @@
+"""Configuración local de la app (rutas de datos y ajustes por variables de entorno)."""
+import os
+
+# Directorio para datos locales persistentes (cola de registros, cachés, etc.)
+DATA_DIR = os.environ.get("CITAMED_DATA_DIR", ".citamed")
+
+# Caché de resultados (audio + modelo + prompt -> JSON)
+RESULT_CACHE_MAX_BYTES = int(float(os.environ.get("CITAMED_RESULT_CACHE_MAX_MB", "200")) * 1024 * 1024)
+RESULT_CACHE_TTL_S = float(os.environ.get("CITAMED_RESULT_CACHE_TTL_DAYS", "7")) * 24 * 3600
+
+# Pico de memoria de cada subida con tracemalloc: ralentiza todas las asignaciones del proceso
+# y en la app mezcla las de otras sesiones, así que solo se activa en la CLI y en bench.py
+UPLOAD_MEASURE_MEMORY = os.environ.get("CITAMED_UPLOAD_MEASURE_MEMORY", "0") == "1"
+
+
+def data_path(*parts):
+    """Ruta dentro de DATA_DIR, creando el directorio si no existe."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    return os.path.join(DATA_DIR, *parts)
+
+# Métricas por etapa (ver metrics.py)
+METRICS_LOG_PATH = os.environ.get("CITAMED_METRICS_LOG")  # JSONL con un evento por etapa
+METRICS_PORT = int(os.environ.get("CITAMED_METRICS_PORT", "0"))  # Endpoint /metrics de Prometheus (0 = desactivado)
+LOG_STAGE_TIMINGS = os.environ.get("CITAMED_LOG_STAGE_TIMINGS", "0") == "1"  # Columnas de tiempos en la hoja
+
+# Cuotas de las APIs compartidas por todas las sesiones del proceso (ver scheduler.py)
+GEMINI_RPM = float(os.environ.get("CITAMED_GEMINI_RPM", "60"))  # Solicitudes por minuto a generate_content
+GEMINI_TPM = float(os.environ.get("CITAMED_GEMINI_TPM", "1000000"))  # Tokens por minuto (0 = sin límite)
+SHEETS_RPM = float(os.environ.get("CITAMED_SHEETS_RPM", "60"))  # Escrituras por minuto en la hoja
+API_QUEUE_TIMEOUT_S = float(os.environ.get("CITAMED_API_QUEUE_TIMEOUT_S", "900"))  # Espera máxima en la cola
+
+# Caché de contexto de Gemini para el prompt estático (ver prompt_cache.py)
+PROMPT_CACHE_ENABLED = os.environ.get("CITAMED_PROMPT_CACHE", "0") == "1"
+PROMPT_CACHE_TTL_S = int(os.environ.get("CITAMED_PROMPT_CACHE_TTL_S", "3600"))
+
+# Tabla CIE-10 para validar Diagnosticos (ver cie10.py); por defecto, data/cie10_es.tsv
+CIE10_PATH = os.environ.get("CITAMED_CIE10_PATH")
+CIE10_VALIDATE = os.environ.get("CITAMED_CIE10", "1") == "1"  # Completar/corregir códigos tras la generación
+# El prompt sigue pidiendo el código al modelo: la tabla incluida es un subconjunto (~300 códigos) y solo
+# completa los diagnósticos que cubre; el resto quedaría sin ID. Con la tabla completa en CITAMED_CIE10_PATH,
+# CITAMED_CIE10_FROM_MODEL=0 deja la asignación solo a cie10.py
+CIE10_FROM_MODEL = os.environ.get("CITAMED_CIE10_FROM_MODEL", "1") == "1"  # 0 = el prompt no pide el código
+
+# Signos vitales normalizados (ver vitals.py)
+VITALS_NORMALIZE = os.environ.get("CITAMED_VITALS", "1") == "1"  # Números, IMC calculado y alertas en existing-mrs
+LOG_VITALS_COLUMNS = os.environ.get("CITAMED_LOG_VITALS_COLUMNS", "0") == "1"  # Columnas numéricas en la hoja
+
+# Copia local de la hoja de log para búsquedas (ver log_mirror.py)
+LOG_MIRROR_MAX_AGE_S = float(os.environ.get("CITAMED_LOG_MIRROR_MAX_AGE_S", "300"))  # Sincronización en segundo plano (0 = solo a mano)
+
+# Formato de las celdas Literal y JSON_Completo del log (ver log_format.py)
+LOG_JSON_FORMAT = os.environ.get("CITAMED_LOG_JSON_FORMAT", "compact")  # legacy | compact | zlib
+LOG_BLOBS = os.environ.get("CITAMED_LOG_BLOBS", "0") == "1"  # Celdas grandes a DATA_DIR/log_blobs
+LOG_BLOB_MIN_CHARS = int(os.environ.get("CITAMED_LOG_BLOB_MIN_CHARS", "20000"))
+
+# Archivos subidos a Google AI reutilizables por hash de audio (ver file_registry.py)
+FILE_REUSE_TTL_S = float(os.environ.get("CITAMED_FILE_TTL_S", "900"))  # 0 = no reutilizar (se borran tras cada consulta)
+FILE_GC_INTERVAL_S = float(os.environ.get("CITAMED_FILE_GC_INTERVAL_S", "60"))  # Limpieza en segundo plano
+
+# Cola de trabajos en segundo plano (ver job_queue.py)
+JOB_RETENTION_S = float(os.environ.get("CITAMED_JOB_RETENTION_DAYS", "7")) * 24 * 3600  # Trabajos terminados que se conservan
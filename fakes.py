@@ -0,0 +1,378 @@
+"""Sustitutos locales de servicios externos para pruebas y mediciones sin cuota.
+
+``FakeWorksheet`` imita la parte de ``gspread.Worksheet`` que usa la app
+(``append_row``/``append_rows``) y puede simular errores transitorios.
+``FakeGenAI`` imita las funciones de ``google.generativeai`` que usa el
+pipeline (subida, estado PROCESSING, generación y borrado) con latencias,
+tasa de fallos y tamaño de respuesta configurables; se activa con
+``pipeline.use_backend(FakeGenAI(...))``.
+"""
+import json
+import random
+import threading
+import time
+import types
+from collections import deque
+
+import gspread.exceptions
+from google.api_core import exceptions as google_exceptions
+
+
+class _FakeResponse:
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = {"Retry-After": str(retry_after)} if retry_after is not None else {}
+        self.text = f"fake error {status_code}"
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": self.text, "status": "FAKE"}}
+
+
+def fake_api_error(status_code, retry_after=None):
+    """Crea un gspread APIError con el código HTTP indicado."""
+    response = _FakeResponse(status_code, retry_after)
+    try:
+        err = gspread.exceptions.APIError(response)
+    except Exception:
+        err = gspread.exceptions.APIError(response.text)
+        err.response = response
+    err.code = status_code
+    return err
+
+
+class _FakeQuota:
+    """Ventana deslizante de ``rpm`` solicitudes por minuto; al excederla, la API responde 429."""
+
+    def __init__(self, rpm, window_s=60.0):
+        self.limit = max(1, int(rpm * window_s / 60.0))
+        self.window_s = window_s
+        self.rejected = 0
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def check(self):
+        """None si la solicitud entra en la cuota; si no, segundos hasta que se libere."""
+        with self._lock:
+            now = time.monotonic()
+            while self._calls and now - self._calls[0] >= self.window_s:
+                self._calls.popleft()
+            if len(self._calls) >= self.limit:
+                self.rejected += 1
+                return self.window_s - (now - self._calls[0])
+            self._calls.append(now)
+            return None
+
+
+class FakeWorksheet:
+    """Hoja en memoria con latencia y tasa de fallos configurables."""
+
+    def __init__(self, latency_s=0.0, failure_rate=0.0, failure_status=429, seed=None, quota_rpm=None,
+                 quota_window_s=60.0):
+        self.latency_s = latency_s
+        self.quota = _FakeQuota(quota_rpm, quota_window_s) if quota_rpm else None
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.rows = []
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _maybe_fail(self):
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.failure_rate
+        retry_after = self.quota.check() if self.quota else None
+        if retry_after is not None:
+            raise fake_api_error(429, retry_after=round(retry_after, 3))
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        if fail:
+            raise fake_api_error(self.failure_status)
+
+    def append_row(self, values, value_input_option=None, **kwargs):
+        self._maybe_fail()
+        with self._lock:
+            self.rows.append(list(values))
+
+    def append_rows(self, values, value_input_option=None, **kwargs):
+        self._maybe_fail()
+        with self._lock:
+            self.rows.extend(list(v) for v in values)
+
+
+# --- Gemini ---
+class _FakeFileState:
+    def __init__(self, name):
+        self.name = name
+
+
+class _FakeFile:
+    def __init__(self, name, display_name, size_bytes, state):
+        self.name = name
+        self.display_name = display_name
+        self.size_bytes = size_bytes
+        self.state = _FakeFileState(state)
+
+
+class _FakeGenerateResponse:
+    """Respuesta de generate_content; en streaming es iterable por fragmentos."""
+
+    def __init__(self, text, chunks=None, prompt_tokens=0, cached_tokens=0):
+        self.text = text
+        self._chunks = chunks
+        self.prompt_feedback = None
+        self.usage_metadata = types.SimpleNamespace(
+            prompt_token_count=prompt_tokens, cached_content_token_count=cached_tokens,
+            candidates_token_count=len(text) // 4, total_token_count=prompt_tokens + len(text) // 4,
+        )
+
+    def __iter__(self):
+        for chunk_text in self._chunks or [self.text]:
+            yield types.SimpleNamespace(text=chunk_text)
+
+
+def _fake_tokens(contents):
+    """Tokens aproximados de las partes de texto (el audio se ignora)."""
+    return sum(len(part) // 4 for part in contents if isinstance(part, str))
+
+
+class _FakeCachedContent:
+    """Entrada de ``genai.caching.CachedContent`` con vencimiento."""
+
+    def __init__(self, backend, name, model, contents, ttl):
+        self._backend = backend
+        self.name = name
+        self.model = model
+        self.tokens = _fake_tokens(contents)
+        self.usage_metadata = types.SimpleNamespace(total_token_count=self.tokens)
+        self.expire_time = time.time() + ttl.total_seconds()
+
+    def update(self, ttl=None, **kwargs):
+        if self.name not in self._backend.cached_contents:
+            raise google_exceptions.NotFound(f"fake cached content {self.name} not found")
+        self.expire_time = time.time() + ttl.total_seconds()
+
+    def delete(self):
+        self._backend.cached_contents.pop(self.name, None)
+
+
+def fake_consult_json(response_bytes=4096, malformed=False, incomplete=False):
+    """Respuesta JSON con la estructura de ``existing-mrs`` de ~``response_bytes``.
+
+    Con ``incomplete`` el motivo de consulta y los diagnósticos quedan sin extraer.
+    """
+    existing_mrs = {
+        "MotivoConsulta": "Control de hipertensión arterial",
+        "EnfermedadActual": "Paciente refiere cefalea ocasional.",
+        "Antecedentes": "HTA desde hace 5 años.",
+        "ExamenFisico": "Sin hallazgos relevantes.",
+        "DiasReposo": "NO_ENCONTRADO",
+        "SignosVitales": {"FC": "78", "IMC": "27.1", "Size": "1.70", "TAD": "85", "TAS": "135", "PESO": "78"},
+        "Examenes": [{"Name": "Perfil lipídico", "Resultado": "NO_ENCONTRADO", "UnidadMedida": "NO_ENCONTRADO"}],
+        "Diagnosticos": [{"ID": "I10", "Nombre": "Hipertensión esencial (primaria)"}],
+        "Medicinas": [{"Nombre": "Losartán", "Presentacion": "Tableta 50 mg", "Dosis": "1 cada 12 horas"}],
+        "PlanDeAccion": ["Control en 3 meses", "Dieta baja en sodio"],
+        "ComentariosModelo": "",
+        "Literal": "",  # Al final, como en la plantilla del prompt
+    }
+    if incomplete:
+        existing_mrs.update(MotivoConsulta="NO_ENCONTRADO", Diagnosticos=[])
+    payload = {"status": "OK", "message": "SUCCESS", "data": {"existing-mrs": existing_mrs}}
+    filler = "Doctor: ¿cómo se ha sentido? Paciente: bien, con algo de dolor de cabeza. "
+    base_size = len(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+    repeats = max(0, response_bytes - base_size) // len(filler.encode("utf-8")) + 1
+    existing_mrs["Literal"] = (filler * repeats).strip()
+    text = json.dumps(payload, ensure_ascii=False, indent=2)
+    if malformed:
+        # Errores típicos del modo texto: coma final y comentario copiado de la plantilla
+        text = text.replace('"PlanDeAccion": [', '"PlanDeAccion": [ // Añadir objetos aquí', 1)
+        text = text.replace('"Dieta baja en sodio"', '"Dieta baja en sodio",', 1)
+    return "```json\n" + text + "\n```"
+
+
+class FakeGenAI:
+    """Sustituto de ``google.generativeai`` para el pipeline.
+
+    * ``upload_latency_s`` + tamaño / ``upload_bytes_per_s``: duración de la subida.
+    * ``processing_s``: tiempo que el archivo queda en PROCESSING.
+    * ``generate_latency_s``: duración de generate_content (en streaming se
+      reparte entre ``stream_chunks`` fragmentos).
+    * ``failure_rate``: probabilidad de error 503 en subida y generación.
+    * ``response_bytes`` y ``malformed_rate``: tamaño y calidad del JSON devuelto.
+    * ``model_overrides``: {modelo: {"generate_latency_s": ..., "failure_rate": ...,
+      "malformed_rate": ..., "incomplete_rate": ...}} para simular modelos rápidos
+      y lentos, o que dejan campos sin extraer (enrutamiento).
+    * ``quota_rpm``: cuota de generate_content por ventana de ``quota_window_s``;
+      al excederla responde 429 ResourceExhausted con ``retry_delay``.
+    * ``input_s_per_ktok``: latencia extra por cada 1000 tokens de texto enviados
+      en la solicitud (el prompt en caché de contexto no cuenta).
+    * ``cache_min_tokens`` y ``cache_unsupported_models``: ``caching.CachedContent.create``
+      responde 400 si el contenido es más corto o el modelo no admite caché.
+    """
+
+    def __init__(self, upload_latency_s=0.05, upload_bytes_per_s=20_000_000, processing_s=0.5,
+                 generate_latency_s=1.0, response_bytes=4096, failure_rate=0.0, malformed_rate=0.0,
+                 stream_chunks=8, seed=None, model_overrides=None, quota_rpm=None, quota_window_s=60.0,
+                 input_s_per_ktok=0.0, cache_min_tokens=0, cache_unsupported_models=()):
+        self.upload_latency_s = upload_latency_s
+        self.upload_bytes_per_s = upload_bytes_per_s
+        self.processing_s = processing_s
+        self.generate_latency_s = generate_latency_s
+        self.response_bytes = response_bytes
+        self.failure_rate = failure_rate
+        self.malformed_rate = malformed_rate
+        self.stream_chunks = max(1, stream_chunks)
+        self.model_overrides = dict(model_overrides or {})
+        self.quota = _FakeQuota(quota_rpm, quota_window_s) if quota_rpm else None
+        self.generate_calls_by_model = {}
+        self.input_s_per_ktok = input_s_per_ktok
+        self.cache_min_tokens = cache_min_tokens
+        self.cache_unsupported_models = set(cache_unsupported_models)
+        self.cached_contents = {}  # nombre -> _FakeCachedContent
+        self.GenerationConfig = lambda **kwargs: types.SimpleNamespace(**kwargs)
+        self.calls = {"upload_file": 0, "get_file": 0, "generate_content": 0, "delete_file": 0,
+                      "create_cached_content": 0}
+        self._files = {}  # nombre -> (display_name, bytes, listo_en)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counter = 0
+        backend = self
+
+        class GenerativeModel:
+            def __init__(self, model_name, **kwargs):
+                self.model_name = model_name
+                self.cached_content = None
+
+            @classmethod
+            def from_cached_content(cls, cached_content, **kwargs):
+                model = cls(cached_content.model)
+                model.cached_content = cached_content
+                return model
+
+            def generate_content(self, contents, stream=False, **kwargs):
+                return backend._generate(self.model_name, contents, stream, self.cached_content)
+
+        class CachedContent:
+            @classmethod
+            def create(cls, model, contents=None, ttl=None, **kwargs):
+                return backend._create_cached_content(model, contents or [], ttl)
+
+        self.GenerativeModel = GenerativeModel
+        self.caching = types.SimpleNamespace(CachedContent=CachedContent)
+
+    def _roll(self, probability):
+        with self._lock:
+            return self._random.random() < probability
+
+    def _count(self, call):
+        with self._lock:
+            self.calls[call] += 1
+
+    def configure(self, **kwargs):
+        pass
+
+    def upload_file(self, path=None, display_name=None, mime_type=None, **kwargs):
+        self._count("upload_file")
+        if hasattr(path, "read"):
+            size_bytes = 0
+            while True:  # Lee por bloques como el SDK real
+                block = path.read(256 * 1024)
+                if not block:
+                    break
+                size_bytes += len(block)
+        else:
+            with open(path, "rb") as f:
+                size_bytes = len(f.read())
+        delay = self.upload_latency_s + (size_bytes / self.upload_bytes_per_s if self.upload_bytes_per_s else 0.0)
+        time.sleep(delay)
+        if self._roll(self.failure_rate):
+            raise google_exceptions.ServiceUnavailable("fake upload error 503")
+        with self._lock:
+            self._counter += 1
+            name = f"files/fake-{self._counter}"
+            self._files[name] = (display_name, size_bytes, time.time() + self.processing_s)
+        return _FakeFile(name, display_name, size_bytes, "PROCESSING" if self.processing_s else "ACTIVE")
+
+    def get_file(self, name):
+        self._count("get_file")
+        with self._lock:
+            entry = self._files.get(name)
+        if entry is None:
+            raise google_exceptions.NotFound(f"fake file {name} not found")
+        display_name, size_bytes, ready_at = entry
+        return _FakeFile(name, display_name, size_bytes, "ACTIVE" if time.time() >= ready_at else "PROCESSING")
+
+    def delete_file(self, name):
+        self._count("delete_file")
+        with self._lock:
+            self._files.pop(name, None)
+
+    def list_files(self):
+        with self._lock:
+            items = list(self._files.items())
+        return [_FakeFile(name, entry[0], entry[1], "ACTIVE") for name, entry in items]
+
+    @property
+    def live_files(self):
+        """Archivos subidos y no borrados (deberían ser 0 al terminar)."""
+        with self._lock:
+            return len(self._files)
+
+    def _create_cached_content(self, model, contents, ttl):
+        self._count("create_cached_content")
+        model_name = model.removeprefix("models/")
+        tokens = _fake_tokens(contents)
+        if model_name in self.cache_unsupported_models:
+            raise google_exceptions.InvalidArgument(f"fake 400: {model_name} does not support cached content")
+        if tokens < self.cache_min_tokens:
+            raise google_exceptions.InvalidArgument(
+                f"fake 400: cached content has {tokens} tokens, minimum is {self.cache_min_tokens}")
+        with self._lock:
+            self._counter += 1
+            name = f"cachedContents/fake-{self._counter}"
+        entry = _FakeCachedContent(self, name, model_name, contents, ttl)
+        self.cached_contents[name] = entry
+        return entry
+
+    def _generate(self, model_name, contents, stream, cached_content=None):
+        self._count("generate_content")
+        cached_tokens = 0
+        if cached_content is not None:
+            live = self.cached_contents.get(cached_content.name)
+            if live is None or live.expire_time <= time.time():
+                raise google_exceptions.NotFound(f"fake cached content {cached_content.name} not found")
+            cached_tokens = live.tokens
+        prompt_tokens = _fake_tokens(contents)
+        overrides = self.model_overrides.get(model_name.removeprefix("models/"), {})
+        latency_s = overrides.get("generate_latency_s", self.generate_latency_s)
+        failure_rate = overrides.get("failure_rate", self.failure_rate)
+        with self._lock:
+            self.generate_calls_by_model[model_name] = self.generate_calls_by_model.get(model_name, 0) + 1
+        retry_after = self.quota.check() if self.quota else None
+        if retry_after is not None:
+            seconds = int(retry_after)
+            retry_info = types.SimpleNamespace(retry_delay=types.SimpleNamespace(
+                seconds=seconds, nanos=int((retry_after - seconds) * 1e9)))
+            raise google_exceptions.ResourceExhausted("fake 429: quota exceeded", details=[retry_info])
+        latency_s += self.input_s_per_ktok * prompt_tokens / 1000
+        prompt_tokens += cached_tokens  # Como la API: prompt_token_count incluye los tokens en caché
+        text = fake_consult_json(self.response_bytes,
+                                 malformed=self._roll(overrides.get("malformed_rate", self.malformed_rate)),
+                                 incomplete=self._roll(overrides.get("incomplete_rate", 0.0)))
+        if not stream:
+            time.sleep(latency_s)
+            if self._roll(failure_rate):
+                raise google_exceptions.ServiceUnavailable("fake generate error 503")
+            return _FakeGenerateResponse(text, prompt_tokens=prompt_tokens, cached_tokens=cached_tokens)
+        if self._roll(failure_rate):
+            time.sleep(latency_s / self.stream_chunks)
+            raise google_exceptions.ServiceUnavailable("fake generate error 503")
+        size = -(-len(text) // self.stream_chunks)
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        delay = latency_s / len(chunks)
+
+        def paced():
+            for chunk_text in chunks:
+                time.sleep(delay)
+                yield chunk_text
+        return _FakeGenerateResponse(text, paced(), prompt_tokens=prompt_tokens, cached_tokens=cached_tokens)
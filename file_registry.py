@@ -0,0 +1,328 @@
+"""Registro de archivos subidos a Google AI para reutilizarlos y borrarlos en segundo plano.
+
+Cada audio subido se registra por su SHA-256 y se mantiene en Google AI durante
+``CITAMED_FILE_TTL_S``: un reintento, otro modelo o una segunda consulta con el
+mismo audio reutilizan el archivo ya ACTIVE, sin volver a subirlo ni esperar
+PROCESSING. El registro vive en ``DATA_DIR/files.sqlite3``, así que lo comparten
+la app, la CLI y los workers de la misma máquina.
+
+Los archivos ya no se borran en la ruta de la consulta: ``release`` deja el
+archivo hasta que vence su TTL (o lo encola para borrarlo si no se reutiliza) y
+un hilo de fondo borra los vencidos. Mientras una consulta usa el archivo
+(entre ``acquire`` y ``release``) queda fijado en el registro (``in_use``) y
+ningún proceso lo borra; cada reutilización renueva el TTL. El mismo hilo busca con ``list_files`` los
+archivos huérfanos (``display_name`` con prefijo ``streamlit_``, fuera del
+registro y más antiguos que ``ORPHAN_MIN_AGE_S``), p. ej. los de sesiones que
+se cortaron antes de borrar su archivo.
+"""
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import clients
+import config
+from startup import lazy_import
+
+google_exceptions = lazy_import("google.api_core.exceptions")
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = "files.sqlite3"  # Relativo a config.DATA_DIR
+DISPLAY_NAME_PREFIX = "streamlit_"  # Prefijo de los archivos que sube pipeline.upload_audio_with_stats
+MAX_TTL_S = 47 * 3600  # Google AI borra los archivos a las 48 h
+ORPHAN_MIN_AGE_S = 3600  # Además del TTL: margen para subidas que aún no se registraron
+ORPHAN_SCAN_S = 900  # Cada cuánto se listan los archivos remotos
+LOCK_STRIPES = 64  # Locks por hash: una sola subida concurrente del mismo audio
+# Un archivo en uso no se borra durante este tiempo aunque el proceso muera sin release:
+# cubre la espera en la cola de Gemini (API_QUEUE_TIMEOUT_S) y pipeline.GENERATION_TIMEOUT_S
+PIN_S = config.API_QUEUE_TIMEOUT_S + 900
+REUSE_MIN_REMAINING_S = 120  # No se reutiliza un archivo al que le queda menos vida que esto
+RECENT_SAMPLES = 500
+_UPLOADED_AT_RE = re.compile(rf"^{DISPLAY_NAME_PREFIX}(\d+)_")
+
+
+def _uploaded_at(remote_file):
+    """Momento de la subida según el ``display_name`` (``streamlit_<epoch>_...``) o ``create_time``."""
+    match = _UPLOADED_AT_RE.match(getattr(remote_file, "display_name", "") or "")
+    if match:
+        return float(match.group(1))
+    create_time = getattr(remote_file, "create_time", None)
+    return create_time.timestamp() if hasattr(create_time, "timestamp") else None
+
+
+class FileRegistry:
+    """Archivos remotos reutilizables por hash de audio, con borrado diferido en un hilo de fondo."""
+
+    def __init__(self, path=None, ttl_s=None, gc_interval_s=None):
+        self.path = path or config.data_path(DEFAULT_DB_PATH)
+        self.ttl_s = min(config.FILE_REUSE_TTL_S if ttl_s is None else ttl_s, MAX_TTL_S)
+        self.gc_interval_s = config.FILE_GC_INTERVAL_S if gc_interval_s is None else gc_interval_s
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        if self.path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " digest TEXT PRIMARY KEY,"
+            " name TEXT NOT NULL,"
+            " size_bytes INTEGER,"
+            " cost_s REAL NOT NULL,"  # Subida + PROCESSING: lo que ahorra cada reutilización
+            " created_at REAL NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0,"
+            " in_use INTEGER NOT NULL DEFAULT 0,"  # Consultas entre acquire y release (de cualquier proceso)
+            " pinned_until REAL NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(files)")}
+        for column, definition in (("in_use", "INTEGER NOT NULL DEFAULT 0"), ("pinned_until", "REAL NOT NULL DEFAULT 0")):
+            if column not in columns:  # Registros creados antes de fijar los archivos en uso
+                self._conn.execute(f"ALTER TABLE files ADD COLUMN {column} {definition}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS files_expires ON files(expires_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS files_name ON files(name)")
+        self._pending = queue.Queue()  # Nombres remotos por borrar
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._gc_thread = None
+        self._last_orphan_scan = 0.0
+        self._active_files = 0  # Vigentes según el último barrido de collect (para la app, sin consultar la base)
+        self._counters = {"hits": 0, "misses": 0, "saved_s": 0.0, "deleted": 0, "orphans_deleted": 0,
+                          "delete_errors": 0}
+        self._lookup_latencies = deque(maxlen=RECENT_SAMPLES)
+
+    def _query(self, sql, params=()):
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _query_one(self, sql, params=()):
+        rows = self._query(sql, params)
+        return rows[0] if rows else None
+
+    # --- Reutilización ---
+    def acquire(self, digest, upload):
+        """``(referencia, reutilizada)`` para el audio ``digest``.
+
+        ``upload()`` debe subir el audio, esperar a que quede ACTIVE y devolver
+        ``(referencia, segundos)``; solo se llama si no hay un archivo vigente.
+        """
+        if self.ttl_s <= 0:
+            file_ref, _ = upload()
+            return file_ref, False
+        with self._stripes[int(digest[:8], 16) % LOCK_STRIPES]:
+            file_ref = self._lookup(digest)
+            if file_ref is not None:
+                return file_ref, True
+            with self._lock:
+                self._counters["misses"] += 1
+            file_ref, cost_s = upload()
+            now = time.time()
+            self._query(
+                "INSERT OR REPLACE INTO files (digest, name, size_bytes, cost_s, created_at, expires_at, in_use, pinned_until)"
+                " VALUES (?, ?, ?, ?, ?, ?, 1, ?)",
+                (digest, file_ref.name, getattr(file_ref, "size_bytes", None), cost_s, now, now + self.ttl_s, now + PIN_S),
+            )
+        self._ensure_gc()
+        return file_ref, False
+
+    def _lookup(self, digest):
+        now = time.time()
+        # Fija el archivo y renueva su TTL en una sola sentencia: ni este proceso ni otro lo
+        # borran mientras se genera. Se descarta si le queda poca vida (o se acerca a las 48 h de Google).
+        with self._db_lock:
+            pinned = self._conn.execute(
+                "UPDATE files SET in_use = in_use + 1, pinned_until = ?, expires_at = MIN(MAX(expires_at, ?), created_at + ?)"
+                " WHERE digest = ? AND expires_at > ? AND created_at + ? > ?",
+                (now + PIN_S, now + self.ttl_s, MAX_TTL_S, digest, now + REUSE_MIN_REMAINING_S, MAX_TTL_S, now + PIN_S),
+            ).rowcount
+        if not pinned:
+            return None
+        row = self._query_one("SELECT name, cost_s FROM files WHERE digest = ?", (digest,))
+        start = time.perf_counter()
+        try:
+            file_ref = clients.genai.get_file(row["name"])  # Confirma que sigue ACTIVE en el servidor
+        except Exception as e:
+            logger.info("El archivo %s del registro ya no está disponible (%s); se volverá a subir.", row["name"], e)
+            file_ref = None
+        if file_ref is None or file_ref.state.name != "ACTIVE":
+            self._query("DELETE FROM files WHERE digest = ?", (digest,))
+            return None
+        lookup_s = time.perf_counter() - start
+        self._query("UPDATE files SET hits = hits + 1 WHERE digest = ?", (digest,))
+        with self._lock:
+            self._counters["hits"] += 1
+            self._counters["saved_s"] += max(0.0, row["cost_s"] - lookup_s)
+            self._lookup_latencies.append(lookup_s)
+        logger.info("Reutilizando %s (ahorro estimado %.2f s).", row["name"], row["cost_s"] - lookup_s)
+        return file_ref
+
+    def release(self, file_ref):
+        """La consulta terminó con ``file_ref``: se conserva si está registrado y vigente, si no se borra en segundo plano."""
+        name = getattr(file_ref, "name", None)
+        if not name:
+            return
+        now = time.time()
+        with self._db_lock:
+            released = self._conn.execute(
+                "UPDATE files SET in_use = MAX(in_use - 1, 0), expires_at = MIN(MAX(expires_at, ?), created_at + ?)"
+                " WHERE name = ?", (now + self.ttl_s, MAX_TTL_S, name),
+            ).rowcount
+        if released:
+            return  # Se reutiliza hasta su TTL; el hilo de fondo lo borra cuando vence
+        self._pending.put(name)
+        self._ensure_gc()
+        self._wake.set()
+
+    # --- Borrado en segundo plano ---
+    def _ensure_gc(self):
+        with self._lock:
+            if self._gc_thread is None or not self._gc_thread.is_alive():
+                self._stop.clear()
+                self._gc_thread = threading.Thread(target=self._run_gc, name="citamed-file-gc", daemon=True)
+                self._gc_thread.start()
+
+    def _run_gc(self):
+        while not self._stop.is_set():
+            try:
+                self.collect()
+            except Exception as e:  # El hilo no debe morir por un error de red
+                logger.warning("Error en la limpieza de archivos de Google AI: %s", e)
+            self._wake.wait(self.gc_interval_s)
+            self._wake.clear()
+
+    def _delete(self, name, orphan=False):
+        try:
+            clients.genai.delete_file(name)
+        except (google_exceptions.NotFound, google_exceptions.PermissionDenied):
+            pass  # Ya no existe (venció o lo borró otro proceso)
+        except Exception as e:
+            logger.warning("No se pudo eliminar archivo '%s' de Google AI: %s. Se reintentará.", name, e)
+            with self._lock:
+                self._counters["delete_errors"] += 1
+            return False
+        with self._lock:
+            self._counters["orphans_deleted" if orphan else "deleted"] += 1
+        return True
+
+    def collect(self, scan_orphans=None):
+        """Borra los archivos pendientes, los vencidos y (cada ``ORPHAN_SCAN_S``) los huérfanos."""
+        now = time.time()
+        # Vencidos y sin uso (o con la fijación vencida: la consulta que lo usaba murió sin release)
+        expired_sql = "expires_at <= ? AND (in_use = 0 OR pinned_until <= ?)"
+        for row in self._query(f"SELECT digest, name FROM files WHERE {expired_sql}", (now, now)):
+            with self._db_lock:  # Se quita del registro antes de borrarlo: una reutilización concurrente ya no lo encuentra
+                removed = self._conn.execute(f"DELETE FROM files WHERE digest = ? AND {expired_sql}",
+                                             (row["digest"], now, now)).rowcount
+            if removed:
+                self._pending.put(row["name"])
+        retry = []
+        while True:
+            try:
+                name = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if not self._delete(name):
+                retry.append(name)
+        for name in retry:
+            self._pending.put(name)
+        self._active_files = self._query_one("SELECT COUNT(*) FROM files WHERE expires_at > ?", (now,))[0]
+        if scan_orphans is None:
+            scan_orphans = now - self._last_orphan_scan >= ORPHAN_SCAN_S
+        if scan_orphans:
+            self._last_orphan_scan = now
+            self._collect_orphans(now)
+
+    def _collect_orphans(self, now):
+        known = {row["name"] for row in self._query("SELECT name FROM files")}
+        min_age_s = self.ttl_s + ORPHAN_MIN_AGE_S
+        for remote_file in clients.genai.list_files():
+            if remote_file.name in known or not (getattr(remote_file, "display_name", "") or "").startswith(DISPLAY_NAME_PREFIX):
+                continue
+            uploaded_at = _uploaded_at(remote_file)
+            if uploaded_at is not None and now - uploaded_at >= min_age_s:
+                logger.info("Eliminando archivo huérfano %s (%s).", remote_file.name, remote_file.display_name)
+                self._delete(remote_file.name, orphan=True)
+
+    def close(self, delete_remote=True):
+        """Detiene el hilo de limpieza y, con ``delete_remote``, borra ya todos los archivos registrados."""
+        self._stop.set()
+        self._wake.set()
+        if self._gc_thread is not None:
+            self._gc_thread.join(timeout=30)
+        if delete_remote:
+            now = time.time()
+            # Los archivos que otra consulta (de este u otro proceso) está usando se conservan
+            unused_sql = "in_use = 0 OR pinned_until <= ?"
+            with self._db_lock:
+                self._conn.execute("BEGIN IMMEDIATE")  # Ninguna consulta lo fija entre la lectura y el borrado
+                try:
+                    names = [name for (name,) in self._conn.execute(f"SELECT name FROM files WHERE {unused_sql}", (now,))]
+                    self._conn.execute(f"DELETE FROM files WHERE {unused_sql}", (now,))
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+            for name in names:
+                self._pending.put(name)
+            self.collect(scan_orphans=False)
+
+    # --- Estadísticas ---
+    def summary(self, count_active=True):
+        """Contadores del proceso. Con ``count_active=False`` no consulta la base y los
+        archivos vigentes son los del último barrido del hilo de limpieza."""
+        with self._lock:
+            counters = dict(self._counters)
+            lookups = sorted(self._lookup_latencies)
+        if count_active:
+            active = self._query_one("SELECT COUNT(*) FROM files WHERE expires_at > ?", (time.time(),))[0]
+        else:
+            active = self._active_files
+        return {
+            "ttl_s": self.ttl_s,
+            "active_files": active,
+            "reuse_hits": counters["hits"],
+            "uploads": counters["misses"],
+            "saved_s": round(counters["saved_s"], 2),
+            "lookup_p50_s": round(lookups[len(lookups) // 2], 3) if lookups else 0.0,
+            "pending_deletes": self._pending.qsize(),
+            "deleted": counters["deleted"],
+            "orphans_deleted": counters["orphans_deleted"],
+            "delete_errors": counters["delete_errors"],
+        }
+
+    def rows(self):
+        """Resumen para mostrar en tabla (etiquetas en español), sin consultar la base."""
+        summary = self.summary(count_active=False)
+        return [{
+            "TTL (s)": summary["ttl_s"], "Archivos vigentes": summary["active_files"],
+            "Reutilizaciones": summary["reuse_hits"], "Subidas": summary["uploads"],
+            "Tiempo ahorrado (s)": summary["saved_s"], "Verificación p50 (s)": summary["lookup_p50_s"],
+            "Borrados pendientes": summary["pending_deletes"], "Borrados": summary["deleted"],
+            "Huérfanos borrados": summary["orphans_deleted"], "Errores al borrar": summary["delete_errors"],
+        }]
+
+
+registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """FileRegistry del proceso (se crea en el primer uso)."""
+    global registry
+    with _registry_lock:
+        if registry is None:
+            registry = FileRegistry()
+        return registry
+
+
+def use_registry(new_registry):
+    """Sustituye el registro del proceso (p. ej. uno en memoria con un backend simulado). Devuelve el anterior."""
+    global registry
+    with _registry_lock:
+        previous, registry = registry, new_registry
+        return previous
@@ -0,0 +1,300 @@
+"""Cola persistente de trabajos (SQLite) para procesar audios fuera de la sesión de Streamlit.
+
+La interfaz solo envía trabajos (``submit``) y consulta su estado y resultado
+por id; uno o más procesos ``worker.py`` los toman (``claim``), ejecutan el
+pipeline y guardan el resultado. Los trabajos sobreviven a recargas de la
+pestaña o caídas del websocket, y los workers escalan con independencia de las
+sesiones de la interfaz.
+
+El audio de cada trabajo se guarda como archivo en ``DATA_DIR/jobs/`` (la base
+solo guarda su ruta) y se borra en cuanto el trabajo termina, falla o se
+cancela. Si un worker muere, su trabajo deja de recibir latidos y
+``requeue_stale`` lo devuelve a la cola (hasta ``MAX_ATTEMPTS`` intentos). Los
+workers llaman a ``purge`` cada ``PURGE_INTERVAL_S`` para borrar los trabajos
+terminados hace más de ``CITAMED_JOB_RETENTION_DAYS`` (y el audio que quede).
+"""
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import config
+
+DEFAULT_DB_PATH = "jobs.sqlite3"  # Relativo a config.DATA_DIR
+AUDIO_DIR = "jobs"  # Relativo a config.DATA_DIR
+HEARTBEAT_S = 10.0  # Latido de los workers mientras procesan
+STALE_AFTER_S = 90.0  # Sin latido durante este tiempo, el trabajo se considera huérfano
+MAX_ATTEMPTS = 3
+PURGE_INTERVAL_S = 3600.0  # Cada cuánto cada worker borra los trabajos vencidos
+
+# Estados de un trabajo
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELED = "canceled"
+JOB_STATUS_LABELS = {
+    JOB_QUEUED: "En cola", JOB_RUNNING: "Procesando", JOB_DONE: "Completado",
+    JOB_FAILED: "Error", JOB_CANCELED: "Cancelado",
+}
+
+
+def job_options(preprocess=False, segment_long_audio=False, routing_policy=None, force_reprocess=False,
+                log_to_sheets=False):
+    """Opciones serializables de un trabajo (las mismas que acepta pipeline.process_audio)."""
+    return {
+        "preprocess": preprocess,
+        "segment_long_audio": segment_long_audio,
+        "routing_policy": vars(routing_policy) if routing_policy else None,  # routing.RoutingPolicy
+        "force_reprocess": force_reprocess,
+        "log_to_sheets": log_to_sheets,
+    }
+
+
+class JobQueue:
+    """Trabajos pendientes, en curso y terminados, compartidos entre procesos."""
+
+    def __init__(self, path=None):
+        self.path = path or config.data_path(DEFAULT_DB_PATH)
+        self.audio_dir = os.path.join(os.path.dirname(os.path.abspath(self.path)), AUDIO_DIR)
+        os.makedirs(self.audio_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # timeout: otro proceso puede tener la base bloqueada durante un claim
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " session_id TEXT,"
+            " filename TEXT NOT NULL,"
+            " model_name TEXT NOT NULL,"
+            " options_json TEXT NOT NULL,"
+            " audio_path TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " stage TEXT,"
+            " worker_id TEXT,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " started_at REAL,"
+            " finished_at REAL,"
+            " heartbeat_at REAL,"
+            " result_json TEXT,"
+            " error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session_id, created_at)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers ("
+            " id TEXT PRIMARY KEY, pid INTEGER, host TEXT, started_at REAL, heartbeat_at REAL,"
+            " jobs_done INTEGER NOT NULL DEFAULT 0)"
+        )
+
+    # --- Interfaz ---
+    def submit(self, data, filename, model_name, options=None, session_id=None):
+        """Guarda el audio y encola el trabajo. Devuelve su id."""
+        job_id = uuid.uuid4().hex
+        audio_path = os.path.join(self.audio_dir, f"{job_id}.ogg")
+        with open(audio_path, "wb") as f:
+            f.write(data)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, session_id, filename, model_name, options_json, audio_path, status, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, session_id, filename, model_name, json.dumps(options or {}), audio_path, JOB_QUEUED, time.time()),
+            )
+        return job_id
+
+    def get(self, job_id):
+        """Trabajo como dict (con ``result`` decodificado) o None."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job_dict(row) if row else None
+
+    def list_jobs(self, session_id=None, limit=50):
+        """Trabajos más recientes (de una sesión, si se indica)."""
+        query = "SELECT * FROM jobs" + (" WHERE session_id = ?" if session_id else "") + " ORDER BY created_at DESC LIMIT ?"
+        params = (session_id, limit) if session_id else (limit,)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [_job_dict(row) for row in rows]
+
+    def queue_position(self, job_id):
+        """Posición en la cola (1 = el siguiente) o None si ya no está en cola."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at <= "
+                "(SELECT created_at FROM jobs WHERE id = ? AND status = ?)",
+                (JOB_QUEUED, job_id, JOB_QUEUED),
+            ).fetchone()
+        return row[0] or None
+
+    def active_count(self, session_id):
+        """Trabajos de la sesión en cola o en curso."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE session_id = ? AND status IN (?, ?)",
+                (session_id, JOB_QUEUED, JOB_RUNNING),
+            ).fetchone()
+        return row[0]
+
+    def cancel(self, job_id):
+        """Cancela un trabajo que aún no empezó y borra su audio. Devuelve True si se canceló."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+                (JOB_CANCELED, time.time(), job_id, JOB_QUEUED),
+            )
+        if cursor.rowcount != 1:
+            return False
+        self._remove_audio(job_id)
+        return True
+
+    def active_workers(self, max_age_s=STALE_AFTER_S):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM workers WHERE heartbeat_at >= ? ORDER BY started_at", (time.time() - max_age_s,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    # --- Workers ---
+    def register_worker(self, worker_id):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO workers (id, pid, host, started_at, heartbeat_at) VALUES (?, ?, ?, ?, ?)",
+                (worker_id, os.getpid(), socket.gethostname(), now, now),
+            )
+
+    def claim(self, worker_id):
+        """Toma el trabajo en cola más antiguo (atómico entre procesos). Devuelve el trabajo o None."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (JOB_QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, worker_id = ?, attempts = attempts + 1, started_at = ?,"
+                        " heartbeat_at = ?, stage = NULL, error = NULL WHERE id = ?",
+                        (JOB_RUNNING, worker_id, now, now, row["id"]),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self.get(row["id"]) if row is not None else None
+
+    def heartbeat(self, worker_id, job_id=None, stage=None):
+        """Latido del worker (y del trabajo en curso, con su etapa actual)."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("UPDATE workers SET heartbeat_at = ? WHERE id = ?", (now, worker_id))
+            if job_id is not None:
+                self._conn.execute(
+                    "UPDATE jobs SET heartbeat_at = ?, stage = COALESCE(?, stage) WHERE id = ? AND worker_id = ?",
+                    (now, stage, job_id, worker_id),
+                )
+
+    def finish(self, job_id, worker_id, record):
+        """Guarda el resultado (``ConsultResult.as_record()``) y marca el trabajo como terminado."""
+        status = JOB_DONE if record.get("ok") else JOB_FAILED
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, finished_at = ?, result_json = ?, error = ?"
+                " WHERE id = ? AND worker_id = ?",
+                (status, record.get("status"), time.time(), json.dumps(record, ensure_ascii=False),
+                 record.get("error"), job_id, worker_id),
+            )
+            self._conn.execute("UPDATE workers SET jobs_done = jobs_done + 1 WHERE id = ?", (worker_id,))
+        self._remove_audio(job_id)  # El resultado ya está en la base; el audio del paciente no se conserva
+
+    def fail(self, job_id, worker_id, error):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ? AND worker_id = ?",
+                (JOB_FAILED, time.time(), str(error)[:2000], job_id, worker_id),
+            )
+        self._remove_audio(job_id)
+
+    def requeue_stale(self, stale_after_s=STALE_AFTER_S):
+        """Devuelve a la cola los trabajos cuyo worker dejó de latir. Devuelve cuántos."""
+        cutoff = time.time() - stale_after_s
+        with self._lock:
+            requeued = self._conn.execute(
+                "UPDATE jobs SET status = ?, worker_id = NULL WHERE status = ? AND heartbeat_at < ? AND attempts < ?",
+                (JOB_QUEUED, JOB_RUNNING, cutoff, MAX_ATTEMPTS),
+            ).rowcount
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE status = ? AND heartbeat_at < ?",
+                (JOB_FAILED, time.time(), f"Worker sin respuesta tras {MAX_ATTEMPTS} intentos", JOB_RUNNING, cutoff),
+            )
+        return requeued
+
+    def purge(self, retention_s=None):
+        """Borra los trabajos terminados hace más de ``retention_s`` (resultado incluido) y su audio."""
+        cutoff = time.time() - (config.JOB_RETENTION_S if retention_s is None else retention_s)
+        finished = (JOB_DONE, JOB_FAILED, JOB_CANCELED)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, audio_path FROM jobs WHERE status IN (?, ?, ?) AND finished_at < ?", (*finished, cutoff)
+            ).fetchall()
+            self._conn.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in rows])
+        for row in rows:
+            _remove_file(row["audio_path"])
+        return len(rows)
+
+    def _remove_audio(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT audio_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is not None:
+            _remove_file(row["audio_path"])
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _job_dict(row):
+    job = dict(row)
+    job["options"] = json.loads(job.pop("options_json") or "{}")
+    result_json = job.pop("result_json")
+    job["result"] = json.loads(result_json) if result_json else None
+    return job
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_job_queue(path=None):
+    """JobQueue compartida por proceso para la base en ``path``."""
+    path = path or config.data_path(DEFAULT_DB_PATH)
+    with _queues_lock:
+        queue = _queues.get(path)
+        if queue is None:
+            queue = _queues[path] = JobQueue(path)
+        return queue
+
+
+_local_worker = None
+
+
+def start_local_worker(processes=1):
+    """Arranca ``worker.py`` como subproceso de este proceso (una vez), p. ej. en un único contenedor."""
+    global _local_worker
+    with _queues_lock:
+        if _local_worker is None or _local_worker.poll() is not None:
+            worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+            _local_worker = subprocess.Popen([sys.executable, worker_script, "--processes", str(processes)])
+        return _local_worker
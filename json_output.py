@@ -0,0 +1,260 @@
+"""Salida JSON del modelo: esquema de respuesta, extracción y reparación tolerante.
+
+Con modelos que soportan salida estructurada se pide ``application/json`` con
+``RESPONSE_SCHEMA`` (la estructura ``existing-mrs`` del prompt), lo que elimina
+los delimitadores ```json y el JSON mal formado (en streaming solo se pide
+``application/json``: ver ``pipeline.generation_config_for``). Para modelos sin modo esquema,
+``parse_json_block`` intenta primero ``json.loads`` y, si falla, repara en una
+sola pasada los errores típicos: comentarios ``//`` copiados de la plantilla,
+comas finales y salida truncada. Los resultados se cuentan por modelo.
+"""
+import json
+import threading
+
+_STRING = {"type": "STRING"}
+
+
+def _object(properties, required=None):
+    schema = {"type": "OBJECT", "properties": properties}
+    schema["required"] = list(required if required is not None else properties)
+    return schema
+
+
+def _list_of(item_schema):
+    return {"type": "ARRAY", "items": item_schema}
+
+
+# Estructura de json_structure_example como esquema de respuesta (subconjunto OpenAPI).
+# La API no conserva este orden (devuelve las propiedades en orden alfabético), así que
+# en streaming no se envía el esquema y manda la plantilla del prompt (ver pipeline.generation_config_for)
+EXISTING_MRS_SCHEMA = _object({
+    "MotivoConsulta": _STRING,
+    "EnfermedadActual": _STRING,
+    "Antecedentes": _STRING,
+    "ExamenFisico": _STRING,
+    "DiasReposo": _STRING,
+    "SignosVitales": _object({
+        "FC": _STRING, "IMC": _STRING, "Size": _STRING,
+        "TAD": _STRING, "TAS": _STRING, "PESO": _STRING,
+    }),
+    "Examenes": _list_of(_object({"Name": _STRING, "Resultado": _STRING, "UnidadMedida": _STRING}, required=["Name"])),
+    "Diagnosticos": _list_of(_object({"ID": _STRING, "Nombre": _STRING}, required=["Nombre"])),
+    "Medicinas": _list_of(_object({"Nombre": _STRING, "Presentacion": _STRING, "Dosis": _STRING}, required=["Nombre"])),
+    # En modo esquema cada instrucción es una cadena (el renderer ya acepta ambos formatos)
+    "PlanDeAccion": _list_of(_STRING),
+    "ComentariosModelo": _STRING,
+    "Literal": _STRING,
+})
+RESPONSE_SCHEMA = _object({
+    "status": _STRING,
+    "message": _STRING,
+    "data": _object({"existing-mrs": EXISTING_MRS_SCHEMA}),
+})
+
+# Familias de modelos con response_mime_type + response_schema
+SCHEMA_MODEL_PREFIXES = ("gemini-1.5-pro", "gemini-1.5-flash", "gemini-2.")
+_schema_unsupported = set()  # Modelos que rechazaron el esquema en tiempo de ejecución
+
+
+def supports_response_schema(model_name):
+    name = model_name.removeprefix("models/")
+    return name.startswith(SCHEMA_MODEL_PREFIXES) and name not in _schema_unsupported
+
+
+def mark_schema_unsupported(model_name):
+    """Recuerda que el modelo rechazó el modo esquema para no volver a intentarlo."""
+    _schema_unsupported.add(model_name.removeprefix("models/"))
+
+
+# --- Extracción y reparación ---
+def extract_json_block(response_text):
+    """Extrae el bloque JSON del texto del modelo.
+
+    Devuelve (json_block, usado_texto_completo). Busca primero delimitadores
+    ```json y luego el primer '{' y el último '}'.
+    """
+    json_block = None
+    start_marker = "```json"
+    end_marker = "```"
+    start_index = response_text.find(start_marker)
+
+    if start_index != -1:  # Si encuentra ```json
+        start_index += len(start_marker)
+        end_index = response_text.find(end_marker, start_index)
+        if end_index != -1:
+            json_block = response_text[start_index:end_index].strip()
+        else:  # Salida truncada: el bloque llega hasta el final
+            json_block = response_text[start_index:].strip()
+    else:  # Si no, busca primer { y último }
+        json_start_index = response_text.find('{')
+        json_end_index = response_text.rfind('}')
+        if json_start_index != -1 and json_end_index != -1 and json_end_index > json_start_index:
+            json_block = response_text[json_start_index: json_end_index + 1].strip()
+        elif json_start_index != -1:  # Truncado antes del último '}'
+            json_block = response_text[json_start_index:].strip()
+
+    # Si nada funcionó, usa el texto completo como último recurso
+    if not json_block:
+        return response_text.strip(), True
+    return json_block, False
+
+
+def repair_json(text):
+    """Repara comentarios, comas finales y cierres faltantes en una sola pasada."""
+    out = []
+    stack = []  # Frames: [tipo, estado, inicio_de_clave_en_out]
+    in_string = False
+    escape = False
+    i, n = 0, len(text)
+    while i < n:
+        ch = text[i]
+        if in_string:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+                if stack and stack[-1][0] == "{" and stack[-1][1] == "key":
+                    stack[-1][1] = "colon"
+            i += 1
+            continue
+
+        if ch == "/" and i + 1 < n and text[i + 1] == "/":
+            # Comentario de línea (p. ej. los "// Añadir objetos aquí" de la plantilla)
+            newline = text.find("\n", i)
+            i = n if newline == -1 else newline
+            continue
+        if ch == "/" and i + 1 < n and text[i + 1] == "*":
+            end = text.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+            continue
+
+        if ch == '"':
+            in_string = True
+            if stack and stack[-1][0] == "{" and stack[-1][1] == "key":
+                stack[-1][2] = len(out)
+            elif stack and stack[-1][1] == "value":
+                stack[-1][1] = "after"
+            out.append(ch)
+        elif ch in "{[":
+            if stack and stack[-1][1] == "value":
+                stack[-1][1] = "after"
+            stack.append([ch, "key" if ch == "{" else "value", None])
+            out.append(ch)
+        elif ch in "}]":
+            _strip_trailing_comma(out)
+            if stack:
+                stack.pop()
+            out.append(ch)
+        elif ch == ",":
+            _rstrip(out)
+            if out and out[-1] in ",[{":
+                i += 1  # Coma duplicada o inicial: se descarta
+                continue
+            out.append(ch)
+            if stack:
+                stack[-1][1] = "key" if stack[-1][0] == "{" else "value"
+        elif ch == ":":
+            out.append(ch)
+            if stack and stack[-1][0] == "{":
+                stack[-1][1] = "value"
+        else:
+            if not ch.isspace() and stack and stack[-1][1] == "value":
+                stack[-1][1] = "after"
+            out.append(ch)
+        i += 1
+
+    # --- Salida truncada: cerrar lo que quedó abierto ---
+    if in_string:
+        if escape:
+            out.pop()  # Barra invertida colgante
+        out.append('"')
+        if stack and stack[-1][0] == "{" and stack[-1][1] == "key":
+            stack[-1][1] = "colon"
+    _rstrip(out)
+    if stack and stack[-1][0] == "{":
+        state = stack[-1][1]
+        if state == "colon" and stack[-1][2] is not None:
+            del out[stack[-1][2]:]  # Clave sin valor: se descarta
+        elif state == "value":
+            out.append(" null")
+    _strip_trailing_comma(out)
+    while stack:
+        frame = stack.pop()
+        _strip_trailing_comma(out)
+        out.append("}" if frame[0] == "{" else "]")
+    return "".join(out)
+
+
+def _rstrip(out):
+    while out and out[-1].isspace():
+        out.pop()
+
+
+def _strip_trailing_comma(out):
+    _rstrip(out)
+    if out and out[-1] == ",":
+        out.pop()
+        _rstrip(out)
+
+
+# --- Contadores de parseo por modelo ---
+class ParseStats:
+    """Contadores (thread-safe) del resultado del parseo por modelo."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_model = {}
+
+    def record(self, model_name, outcome):
+        """``outcome``: "direct", "repaired" o "failed"."""
+        with self._lock:
+            counts = self._by_model.setdefault(model_name or "desconocido", {"direct": 0, "repaired": 0, "failed": 0})
+            counts[outcome] += 1
+
+    def rows(self):
+        """Filas para mostrar en tabla: intentos y tasa de fallo por modelo."""
+        with self._lock:
+            items = [(m, dict(c)) for m, c in self._by_model.items()]
+        rows = []
+        for model_name, counts in sorted(items):
+            total = sum(counts.values())
+            rows.append({
+                "Modelo": model_name,
+                "Respuestas": total,
+                "JSON directo": counts["direct"],
+                "JSON reparado": counts["repaired"],
+                "Fallidos": counts["failed"],
+                "Tasa de fallo": round(counts["failed"] / total, 3) if total else 0.0,
+            })
+        return rows
+
+
+parse_stats = ParseStats()
+
+
+def parse_json_block(json_block, model_name=None):
+    """Parsea el bloque; si falla, lo repara. Devuelve (dict, "direct"|"repaired").
+
+    Lanza el json.JSONDecodeError original si ni la reparación produce JSON válido.
+    """
+    try:
+        parsed = json.loads(json_block)
+        parse_stats.record(model_name, "direct")
+        return parsed, "direct"
+    except json.JSONDecodeError as original_error:
+        try:
+            parsed = json.loads(repair_json(json_block))
+        except json.JSONDecodeError:
+            parse_stats.record(model_name, "failed")
+            raise original_error
+        parse_stats.record(model_name, "repaired")
+        return parsed, "repaired"
+
+
+def parse_model_json(response_text, model_name=None):
+    """Extrae y parsea el JSON de la respuesta completa del modelo."""
+    json_block, _ = extract_json_block(response_text)
+    return parse_json_block(json_block, model_name)
@@ -0,0 +1,304 @@
+"""Formato compacto de las celdas Literal y JSON_Completo de la hoja de log.
+
+Antes, JSON_Completo era ``json.dumps(parsed_json, indent=2)``: repetía la
+transcripción que ya va en la columna Literal y añadía la sangría. Formatos de
+la celda (``CITAMED_LOG_JSON_FORMAT``):
+
+- ``legacy``: el formato anterior, sin cambios.
+- ``compact`` (por defecto): JSON minificado; ``existing-mrs.Literal`` se
+  reemplaza por ``LITERAL_REF`` y se lee de la columna Literal. Si aun así supera
+  el límite de caracteres por celda, se comprime como en ``zlib``.
+- ``zlib``: el JSON compacto comprimido y en base64, con el prefijo ``zlib:``.
+
+Con ``CITAMED_LOG_BLOBS=1`` las celdas de más de ``CITAMED_LOG_BLOB_MIN_CHARS``
+caracteres se guardan en ``DATA_DIR/log_blobs/`` (direccionadas por SHA-256) y la
+hoja solo guarda ``blob:<sha256>``. Esos blobs solo se pueden leer en la máquina
+que los escribió (o copiando el directorio).
+
+``parsed_json_from_record`` y ``expand_record`` reconstruyen el registro
+completo desde cualquiera de los formatos. ``stats`` acumula los bytes ahorrados
+por fila y ``python log_format.py resultados.jsonl`` compara los formatos sobre
+un historial de la CLI.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import zlib
+
+import config
+
+logger = logging.getLogger(__name__)
+
+FORMAT_LEGACY = "legacy"
+FORMAT_COMPACT = "compact"
+FORMAT_ZLIB = "zlib"
+FORMAT_BLOB = "blob"
+FORMATS = (FORMAT_LEGACY, FORMAT_COMPACT, FORMAT_ZLIB)
+
+CELL_CHAR_LIMIT = 50_000  # Máximo de caracteres por celda en Google Sheets
+LITERAL_REF = "@Literal"  # Marca en JSON_Completo: la transcripción está en la columna Literal
+ZLIB_PREFIX = "zlib:"
+BLOB_PREFIX = "blob:"
+BLOB_DIR = "log_blobs"  # Relativo a config.DATA_DIR
+_ZLIB_RE = re.compile(r"^zlib:[A-Za-z0-9+/]+=*$")
+_BLOB_RE = re.compile(r"^blob:([0-9a-f]{64})$")
+
+_format = config.LOG_JSON_FORMAT if config.LOG_JSON_FORMAT in FORMATS else FORMAT_COMPACT
+_blobs_enabled = config.LOG_BLOBS
+
+
+def configure(json_format=None, blobs=None):
+    """Cambia el formato de las celdas y el uso del almacén de blobs para todo el proceso."""
+    global _format, _blobs_enabled
+    if json_format is not None:
+        if json_format not in FORMATS:
+            raise ValueError(f"Formato de log desconocido: {json_format} (válidos: {', '.join(FORMATS)})")
+        _format = json_format
+    if blobs is not None:
+        _blobs_enabled = blobs
+
+
+def json_format():
+    return _format
+
+
+# --- Almacén de blobs ---
+class BlobStore:
+    """Blobs comprimidos en disco, direccionados por el SHA-256 de su contenido."""
+
+    def __init__(self, root=None):
+        self.root = root or config.data_path(BLOB_DIR)
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + ".z")
+
+    def put(self, text):
+        """Guarda ``text`` (si no existía ya) y devuelve la referencia ``blob:<sha256>``."""
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(zlib.compress(data, 9))
+            os.replace(tmp_path, path)  # Escritura atómica: nunca queda un blob a medias
+        return BLOB_PREFIX + digest
+
+    def get(self, digest):
+        """Texto del blob o None si no está en este almacén."""
+        try:
+            with open(self._path(digest), "rb") as f:
+                return zlib.decompress(f.read()).decode("utf-8")
+        except FileNotFoundError:
+            return None
+
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+
+def get_blob_store():
+    global _blob_store
+    with _blob_store_lock:
+        if _blob_store is None:
+            _blob_store = BlobStore()
+        return _blob_store
+
+
+# --- Escritura ---
+def _compress(text):
+    return ZLIB_PREFIX + base64.b64encode(zlib.compress(text.encode("utf-8"), 9)).decode("ascii")
+
+
+def _offload(text, cell_format):
+    """Lleva la celda al almacén de blobs si está activado y supera el umbral."""
+    if _blobs_enabled and len(text) > config.LOG_BLOB_MIN_CHARS:
+        return get_blob_store().put(text), FORMAT_BLOB
+    return text, cell_format
+
+
+def _without_literal(parsed_json):
+    data = parsed_json.get("data")
+    existing_mrs = data.get("existing-mrs") if isinstance(data, dict) else None
+    if not isinstance(existing_mrs, dict) or not isinstance(existing_mrs.get("Literal"), str) or not existing_mrs["Literal"]:
+        return parsed_json
+    # Copia superficial de los dos niveles que cambian; el resto se comparte con parsed_json
+    existing_mrs = dict(existing_mrs, Literal=LITERAL_REF)
+    return dict(parsed_json, data=dict(data, **{"existing-mrs": existing_mrs}))
+
+
+def encode_json(parsed_json):
+    """Celda JSON_Completo en el formato configurado. Devuelve ``(celda, formato_usado)``."""
+    if _format == FORMAT_LEGACY:
+        return json.dumps(parsed_json, ensure_ascii=False, indent=2), FORMAT_LEGACY
+    text = json.dumps(_without_literal(parsed_json), ensure_ascii=False, separators=(",", ":"))
+    if _format == FORMAT_ZLIB or len(text) > CELL_CHAR_LIMIT:
+        return _offload(_compress(text), FORMAT_ZLIB)
+    return _offload(text, FORMAT_COMPACT)
+
+
+def encode_literal(literal):
+    """Celda Literal: el texto tal cual salvo que no quepa en una celda (blob o comprimido)."""
+    literal = literal if isinstance(literal, str) else str(literal)
+    if _format == FORMAT_LEGACY or len(literal) <= CELL_CHAR_LIMIT:
+        return literal
+    if _blobs_enabled:
+        return get_blob_store().put(literal)
+    return _compress(literal)
+
+
+# --- Lectura ---
+def decode_cell(cell, blobs=None):
+    """Texto original de una celda (descomprime ``zlib:`` y resuelve ``blob:``); None si falta el blob."""
+    if not isinstance(cell, str):
+        return cell
+    if _ZLIB_RE.match(cell):
+        try:
+            return zlib.decompress(base64.b64decode(cell[len(ZLIB_PREFIX):])).decode("utf-8")
+        except (ValueError, zlib.error):  # Texto que solo parece comprimido
+            return cell
+    match = _BLOB_RE.match(cell)
+    if match:
+        text = (blobs or get_blob_store()).get(match.group(1))
+        if text is None:
+            logger.warning("Blob %s no encontrado en el almacén local.", match.group(1))
+            return None
+        return decode_cell(text, blobs)  # Un blob puede contener una celda comprimida
+    return cell
+
+
+def literal_from_record(record, blobs=None):
+    """Transcripción de una fila del log (columna -> valor)."""
+    literal = decode_cell(record.get("Literal", ""), blobs)
+    return literal if literal is not None else record.get("Literal", "")
+
+
+def parsed_json_from_record(record, blobs=None):
+    """JSON completo de una fila, con la transcripción restituida; None si no se puede leer."""
+    text = decode_cell(record.get("JSON_Completo") or "", blobs)
+    try:
+        parsed_json = json.loads(text or "")
+    except ValueError:
+        return None
+    data = parsed_json.get("data") if isinstance(parsed_json, dict) else None
+    existing_mrs = data.get("existing-mrs") if isinstance(data, dict) else None
+    if isinstance(existing_mrs, dict) and existing_mrs.get("Literal") == LITERAL_REF:
+        existing_mrs["Literal"] = literal_from_record(record, blobs)
+    return parsed_json
+
+
+def expand_record(record, blobs=None):
+    """Fila con Literal y JSON_Completo en el formato ``legacy`` (como se escribían antes)."""
+    expanded = dict(record)
+    expanded["Literal"] = literal_from_record(record, blobs)
+    parsed_json = parsed_json_from_record(record, blobs)
+    if parsed_json is not None:
+        expanded["JSON_Completo"] = json.dumps(parsed_json, ensure_ascii=False, indent=2)
+    return expanded
+
+
+# --- Bytes ahorrados ---
+def _nbytes(text):
+    return len(str(text).encode("utf-8"))
+
+
+def legacy_nbytes(parsed_json, literal):
+    """Bytes que ocupaban Literal y JSON_Completo en el formato anterior."""
+    return _nbytes(literal) + _nbytes(json.dumps(parsed_json, ensure_ascii=False, indent=2))
+
+
+class LogRowStats:
+    """Bytes por fila escritos en la hoja frente a los del formato anterior, por formato de celda."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_format = {}  # formato -> {"rows", "legacy_bytes", "row_bytes", "max_cell"}
+
+    def record(self, cell_format, legacy_bytes, row_bytes, max_cell):
+        with self._lock:
+            item = self._by_format.setdefault(cell_format, {"rows": 0, "legacy_bytes": 0, "row_bytes": 0, "max_cell": 0})
+            item["rows"] += 1
+            item["legacy_bytes"] += legacy_bytes
+            item["row_bytes"] += row_bytes
+            item["max_cell"] = max(item["max_cell"], max_cell)
+
+    def rows(self):
+        with self._lock:
+            items = sorted((name, dict(item)) for name, item in self._by_format.items())
+        return [{
+            "Formato JSON_Completo": name,
+            "Filas": item["rows"],
+            "Bytes por fila (antes)": round(item["legacy_bytes"] / item["rows"]),
+            "Bytes por fila (ahora)": round(item["row_bytes"] / item["rows"]),
+            "Ahorro por fila (bytes)": round((item["legacy_bytes"] - item["row_bytes"]) / item["rows"]),
+            "Ahorro (%)": round(100 * (1 - item["row_bytes"] / item["legacy_bytes"]), 1) if item["legacy_bytes"] else 0.0,
+            "Celda más grande (caracteres)": item["max_cell"],
+        } for name, item in items]
+
+    def summary(self):
+        with self._lock:
+            items = list(self._by_format.values())
+        rows = sum(item["rows"] for item in items)
+        saved = sum(item["legacy_bytes"] - item["row_bytes"] for item in items)
+        return {"rows": rows, "bytes_saved": saved, "bytes_saved_per_row": round(saved / rows) if rows else 0}
+
+    def reset(self):
+        with self._lock:
+            self._by_format.clear()
+
+
+stats = LogRowStats()
+
+
+def compare_formats(parsed_jsons):
+    """Bytes medios de Literal + JSON_Completo por fila en cada formato (sin blobs)."""
+    global _blobs_enabled
+    totals = {name: 0 for name in FORMATS}
+    count = 0
+    previous = (_format, _blobs_enabled)
+    try:
+        _blobs_enabled = False
+        for parsed_json in parsed_jsons:
+            literal = ((parsed_json.get("data") or {}).get("existing-mrs") or {}).get("Literal", "")
+            for name in FORMATS:
+                configure(json_format=name)
+                totals[name] += _nbytes(encode_literal(literal)) + _nbytes(encode_json(parsed_json)[0])
+            count += 1
+    finally:
+        configure(*previous)
+    return {name: round(total / count) if count else 0 for name, total in totals.items()}, count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compara el tamaño de las filas del log en cada formato.")
+    parser.add_argument("input", help="JSONL con registros que incluyen parsed_json (salida de cli.py)")
+    args = parser.parse_args(argv)
+
+    def parsed_jsons():
+        with open(args.input, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    parsed_json = json.loads(line).get("parsed_json")
+                except ValueError:
+                    continue
+                if isinstance(parsed_json, dict):
+                    yield parsed_json
+
+    sizes, count = compare_formats(parsed_jsons())
+    legacy = sizes[FORMAT_LEGACY]
+    for name, size in sizes.items():
+        saved = legacy - size
+        print(f"{name:8s} {size:9d} bytes/fila  ahorro {saved:8d} bytes/fila ({100 * saved / legacy if legacy else 0:.1f} %)")
+    print(f"{count} filas.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
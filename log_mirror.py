@@ -0,0 +1,479 @@
+"""Copia local (SQLite) de la hoja de log para búsquedas y análisis sin la API de Sheets.
+
+La hoja de Google Sheets sigue siendo el registro oficial. ``sync`` lee solo las
+filas añadidas desde la última sincronización (por número de fila, en bloques
+de ``SYNC_CHUNK_ROWS``) y las guarda en ``DATA_DIR/log_mirror.sqlite3``:
+
+- ``consults``: una fila por consulta, con índices en Timestamp, Diagnosticos y
+  Medicinas y la fila completa de la hoja en JSON.
+- ``diagnoses`` y ``medications``: un registro por diagnóstico o medicamento
+  (nombre normalizado y código CIE-10, indexados) para filtros y rankings.
+- ``consults_fts``: índice FTS5 sobre Literal, Filename, Diagnosticos y
+  Medicinas (sin distinguir tildes). Si SQLite no trae FTS5 se usa ``LIKE``.
+
+Las filas editadas o borradas en la hoja no se detectan en la sincronización
+incremental; ``sync(..., full=True)`` reconstruye la copia desde cero.
+
+En la app, ``start_background_sync`` sincroniza en un hilo cada
+``CITAMED_LOG_MIRROR_MAX_AGE_S``: un rerun no llama a la API de Sheets. El
+estado (``status``) y los resultados de las consultas se guardan en memoria
+hasta la siguiente sincronización, así que repetir una búsqueda tampoco lee la
+base. Desde la terminal (mismos secretos que cli.py)::
+
+    python log_mirror.py --sync --search "dolor torácico" --dx I10 --since 2024-05-01
+"""
+import argparse
+import functools
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import cie10
+import config
+import log_format
+import scheduler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = "log_mirror.sqlite3"  # Relativo a config.DATA_DIR
+SYNC_CHUNK_ROWS = 500  # Filas por lectura a la API en la sincronización
+SEARCH_LIMIT = 200
+SNIPPET_TOKENS = 16  # Palabras del fragmento de Literal que se muestra en los resultados
+QUERY_MEMO_SIZE = 64  # Consultas distintas que se recuerdan hasta la siguiente sincronización
+
+# Columnas de la hoja que se copian a columnas propias (el resto queda en row_json)
+SHEET_COLUMNS = {
+    "timestamp": "Timestamp", "filename": "Filename", "model": "Model", "status": "Status",
+    "motivo": "MotivoConsulta", "diagnosticos": "Diagnosticos_Resumen", "medicinas": "Medicinas_Resumen",
+    "literal": "Literal",
+}
+FTS_COLUMNS = ("literal", "filename", "diagnosticos", "medicinas")
+_WORD_RE = re.compile(r"\w+")
+_DX_SUMMARY_RE = re.compile(r"^(.*?)\s*\(([^()]*)\)?$")  # "Nombre (ID)" de Diagnosticos_Resumen (sin ")" final)
+
+
+def column_letter(number):
+    """Letra de la columna ``number`` (1 -> A, 27 -> AA)."""
+    letters = ""
+    while number:
+        number, rest = divmod(number - 1, 26)
+        letters = chr(ord("A") + rest) + letters
+    return letters
+
+
+def read_range(worksheet, range_name):
+    """Valores de ``range_name``; las hojas sin cuota propia pasan por ``scheduler.sheets``."""
+    if getattr(worksheet, "self_scheduled", False):
+        return worksheet.get(range_name)
+    return scheduler.sheets.call(lambda: worksheet.get(range_name))
+
+
+def _fts_query(text, column=None):
+    """Consulta FTS5 segura: cada palabra entre comillas (AND) y la última como prefijo."""
+    words = _WORD_RE.findall(text or "")
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    query = " ".join(terms)
+    return f"{{{column}}} : ({query})" if column else query
+
+
+def _memoized_query(method):
+    """Guarda el resultado de la consulta hasta la próxima sincronización (ver LogMirror._refresh)."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        memo = self._memo  # Se reemplaza (no se vacía) al sincronizar: no hace falta lock
+        if key not in memo:
+            if len(memo) >= QUERY_MEMO_SIZE:
+                memo.clear()
+            memo[key] = method(self, *args, **kwargs)
+        return memo[key]
+    return wrapper
+
+
+def _since_clause(since):
+    return (" AND c.timestamp >= ?", (str(since),)) if since else ("", ())
+
+
+def _parse_consult(record):
+    """Diagnósticos [(nombre, código)] y medicamentos [nombre] de una fila de la hoja."""
+    existing_mrs = {}
+    try:
+        existing_mrs = log_format.parsed_json_from_record(record)["data"]["existing-mrs"]
+    except (TypeError, KeyError):
+        pass
+    if isinstance(existing_mrs, dict) and ("Diagnosticos" in existing_mrs or "Medicinas" in existing_mrs):
+        diagnoses = [(str(d.get("Nombre") or ""), cie10.normalize_code(d.get("ID")))
+                     for d in existing_mrs.get("Diagnosticos") or [] if isinstance(d, dict)]
+        medications = [str(m.get("Nombre") or "") for m in existing_mrs.get("Medicinas") or [] if isinstance(m, dict)]
+    else:  # Filas sin JSON_Completo legible: se usan los resúmenes
+        diagnoses = []
+        for part in (record.get("Diagnosticos_Resumen") or "").split(";"):
+            match = _DX_SUMMARY_RE.match(part.strip())
+            code = cie10.normalize_code(match.group(2)) if match else None
+            diagnoses.append((match.group(1) if code else part.strip(), code))
+        medications = [part.strip() for part in (record.get("Medicinas_Resumen") or "").split(";")]
+    diagnoses = [(name.strip(), code) for name, code in diagnoses if name.strip() or code]
+    medications = [name.strip() for name in medications if name.strip()]
+    return diagnoses, medications
+
+
+class LogMirror:
+    """Copia indexada de la hoja de log, sincronizada de forma incremental."""
+
+    def __init__(self, path=None):
+        self.path = path or config.data_path(DEFAULT_DB_PATH)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS consults ("
+            " row INTEGER PRIMARY KEY,"  # Número de fila en la hoja
+            " timestamp TEXT, filename TEXT, model TEXT, status TEXT, motivo TEXT,"
+            " diagnosticos TEXT, medicinas TEXT, literal TEXT,"
+            " row_json TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS consults_timestamp ON consults(timestamp);"
+            "CREATE INDEX IF NOT EXISTS consults_diagnosticos ON consults(diagnosticos);"
+            "CREATE INDEX IF NOT EXISTS consults_medicinas ON consults(medicinas);"
+            "CREATE TABLE IF NOT EXISTS diagnoses (row INTEGER NOT NULL, name TEXT, name_norm TEXT, code TEXT);"
+            "CREATE INDEX IF NOT EXISTS diagnoses_row ON diagnoses(row);"
+            "CREATE INDEX IF NOT EXISTS diagnoses_code ON diagnoses(code);"
+            "CREATE INDEX IF NOT EXISTS diagnoses_name ON diagnoses(name_norm);"
+            "CREATE TABLE IF NOT EXISTS medications (row INTEGER NOT NULL, name TEXT, name_norm TEXT);"
+            "CREATE INDEX IF NOT EXISTS medications_row ON medications(row);"
+            "CREATE INDEX IF NOT EXISTS medications_name ON medications(name_norm);"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+        )
+        try:
+            self._conn.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS consults_fts USING fts5({', '.join(FTS_COLUMNS)},"
+                " content='consults', content_rowid='row', tokenize='unicode61 remove_diacritics 2')"
+            )
+            self.fts = True
+        except sqlite3.OperationalError as e:  # SQLite compilado sin FTS5
+            logger.warning("FTS5 no disponible (%s); la búsqueda de texto usará LIKE.", e)
+            self.fts = False
+        self._refresh()
+
+    # --- Sincronización ---
+    def _meta(self, key, default=None):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row["value"]) if row else default
+
+    def _set_meta(self, key, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def last_row(self):
+        """Última fila de la hoja ya copiada (1 = solo el encabezado)."""
+        return self._meta("last_row", 1)
+
+    def sync(self, worksheet, full=False, chunk_rows=SYNC_CHUNK_ROWS):
+        """Copia las filas nuevas de la hoja. Devuelve el número de consultas añadidas.
+
+        Cada bloque se guarda en su propia transacción: si la API falla a mitad
+        de camino, la próxima sincronización continúa desde el último bloque.
+        """
+        try:
+            return self._sync(worksheet, full, chunk_rows)
+        finally:
+            self._refresh()  # También tras un fallo: los bloques ya copiados cuentan
+
+    def _sync(self, worksheet, full, chunk_rows):
+        with self._lock:
+            start = time.perf_counter()
+            header = None if full else self._meta("header")
+            if header is None:
+                values = read_range(worksheet, "1:1")
+                header = [str(name) for name in values[0]] if values else []
+                if not header:
+                    return 0  # Hoja vacía, sin encabezado
+                self._reset(header)
+            last_col = column_letter(len(header))
+            next_row = self.last_row() + 1
+            added = 0
+            while True:
+                values = read_range(worksheet, f"A{next_row}:{last_col}{next_row + chunk_rows - 1}")
+                if not values:
+                    break
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    for offset, row_values in enumerate(values):
+                        if any(str(value).strip() for value in row_values):
+                            self._insert(next_row + offset, dict(zip(header, row_values)))
+                            added += 1
+                    next_row += len(values)
+                    self._set_meta("last_row", next_row - 1)
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+                if len(values) < chunk_rows:
+                    break
+            elapsed = time.perf_counter() - start
+            self._set_meta("last_sync", {"at": time.time(), "added": added, "elapsed_s": round(elapsed, 3)})
+        logger.info("Copia local del log: %d filas nuevas en %.2f s (hasta la fila %d).", added, elapsed, next_row - 1)
+        return added
+
+    def _reset(self, header):
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.execute("DELETE FROM consults")
+        self._conn.execute("DELETE FROM diagnoses")
+        self._conn.execute("DELETE FROM medications")
+        if self.fts:
+            self._conn.execute("INSERT INTO consults_fts (consults_fts) VALUES ('delete-all')")
+        self._set_meta("header", header)
+        self._set_meta("last_row", 1)
+        self._conn.execute("COMMIT")
+
+    def _insert(self, row_number, record):
+        values = {column: str(record.get(sheet_column, "")) for column, sheet_column in SHEET_COLUMNS.items()}
+        values["literal"] = str(log_format.literal_from_record(record))  # Comprimido o en blob (ver log_format.py)
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO consults (row, {', '.join(values)}, row_json)"
+            f" VALUES (?, {', '.join('?' * len(values))}, ?)",
+            (row_number, *values.values(), json.dumps(record, ensure_ascii=False)),
+        )
+        if self.fts:
+            self._conn.execute(
+                f"INSERT INTO consults_fts (rowid, {', '.join(FTS_COLUMNS)}) VALUES (?, {', '.join('?' * len(FTS_COLUMNS))})",
+                (row_number, *(values[column] for column in FTS_COLUMNS)),
+            )
+        diagnoses, medications = _parse_consult(record)
+        self._conn.executemany(
+            "INSERT INTO diagnoses (row, name, name_norm, code) VALUES (?, ?, ?, ?)",
+            [(row_number, name, cie10.normalize_text(name), code) for name, code in diagnoses],
+        )
+        self._conn.executemany(
+            "INSERT INTO medications (row, name, name_norm) VALUES (?, ?, ?)",
+            [(row_number, name, cie10.normalize_text(name)) for name in medications],
+        )
+
+    # --- Consultas ---
+    @_memoized_query
+    def search(self, text="", diagnosis="", medication="", since=None, until=None, limit=SEARCH_LIMIT):
+        """Consultas que cumplen todos los filtros, de la más reciente a la más antigua.
+
+        ``text`` busca en Literal y Filename; ``diagnosis`` acepta un código
+        CIE-10 (``J45`` incluye sus subcódigos) o palabras del nombre; ``since``
+        y ``until`` son fechas ``AAAA-MM-DD`` (inclusive).
+        """
+        clauses, params, match_terms = [], [], []
+        code = cie10.normalize_code(diagnosis) if diagnosis else None
+        if code:
+            clauses.append("EXISTS (SELECT 1 FROM diagnoses d WHERE d.row = c.row AND d.code >= ? AND d.code < ?)")
+            params += [code, code + "￿"]
+        for column, value in (("literal filename", text), ("diagnosticos", "" if code else diagnosis),
+                              ("medicinas", medication)):
+            if not _WORD_RE.search(value or ""):
+                continue
+            if self.fts:
+                match_terms.append(_fts_query(value, column))
+            else:
+                for word in _WORD_RE.findall(value):
+                    clauses.append("(" + " OR ".join(f"c.{name} LIKE ?" for name in column.split()) + ")")
+                    params += [f"%{word}%"] * len(column.split())
+        if since:
+            clauses.append("c.timestamp >= ?")
+            params.append(str(since))
+        if until:
+            clauses.append("c.timestamp < ?")
+            params.append(f"{until}￿")
+        snippet = "''"
+        source = "consults c"
+        if match_terms:
+            source = "consults_fts f JOIN consults c ON c.row = f.rowid"
+            clauses.insert(0, "consults_fts MATCH ?")
+            params.insert(0, " AND ".join(match_terms))
+            if text:
+                snippet = f"snippet(consults_fts, 0, '«', '»', '…', {SNIPPET_TOKENS})"
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._conn.execute(
+            f"SELECT c.row, c.timestamp, c.filename, c.model, c.diagnosticos, c.medicinas, {snippet} AS fragment"
+            f" FROM {source} {where} ORDER BY c.timestamp DESC, c.row DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        return [{
+            "Fila": row["row"], "Timestamp": row["timestamp"], "Archivo": row["filename"], "Modelo": row["model"],
+            "Diagnósticos": row["diagnosticos"], "Medicamentos": row["medicinas"], "Fragmento": row["fragment"],
+        } for row in rows]
+
+    @_memoized_query
+    def get(self, row_number):
+        """Fila completa de la hoja (columna -> valor), con Literal y JSON_Completo reconstruidos, o None."""
+        row = self._conn.execute("SELECT row_json FROM consults WHERE row = ?", (row_number,)).fetchone()
+        return log_format.expand_record(json.loads(row["row_json"])) if row else None
+
+    @_memoized_query
+    def top_diagnoses(self, since=None, limit=10):
+        clause, params = _since_clause(since)
+        rows = self._conn.execute(
+            "SELECT COALESCE(d.code, '') AS code, MIN(d.name) AS name, COUNT(DISTINCT d.row) AS consults"
+            " FROM diagnoses d JOIN consults c ON c.row = d.row"
+            f" WHERE 1 = 1{clause} GROUP BY COALESCE(d.code, d.name_norm) ORDER BY consults DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        return [{"Código": row["code"], "Diagnóstico": row["name"], "Consultas": row["consults"]} for row in rows]
+
+    @_memoized_query
+    def top_medications(self, since=None, limit=10):
+        clause, params = _since_clause(since)
+        rows = self._conn.execute(
+            "SELECT MIN(m.name) AS name, COUNT(DISTINCT m.row) AS consults"
+            " FROM medications m JOIN consults c ON c.row = m.row"
+            f" WHERE 1 = 1{clause} GROUP BY m.name_norm ORDER BY consults DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        return [{"Medicamento": row["name"], "Consultas": row["consults"]} for row in rows]
+
+    @_memoized_query
+    def consults_per_day(self, since=None):
+        clause, params = _since_clause(since)
+        rows = self._conn.execute(
+            "SELECT substr(c.timestamp, 1, 10) AS day, COUNT(*) AS n FROM consults c"
+            f" WHERE c.timestamp != ''{clause} GROUP BY day ORDER BY day",
+            params,
+        ).fetchall()
+        return {row["day"]: row["n"] for row in rows}
+
+    def _refresh(self):
+        """Relee el estado y olvida las consultas memorizadas (tras cada sincronización)."""
+        self._status = self._read_status()
+        self._memo = {}
+
+    def status(self):
+        """Filas copiadas, última fila de la hoja y datos de la última sincronización (en memoria)."""
+        return dict(self._status)
+
+    def _read_status(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM consults").fetchone()[0]
+        last_sync = self._meta("last_sync") or {}
+        return {
+            "consults": count,
+            "last_row": self.last_row(),
+            "last_sync_at": last_sync.get("at"),
+            "last_sync_added": last_sync.get("added", 0),
+            "last_sync_s": last_sync.get("elapsed_s"),
+            "bytes": sum(os.path.getsize(p) for p in (self.path, self.path + "-wal") if os.path.exists(p)),
+            "fts": self.fts,
+        }
+
+    def is_stale(self, max_age_s):
+        last_sync_at = self.status()["last_sync_at"]
+        return last_sync_at is None or time.time() - last_sync_at > max_age_s
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_log_mirror(path=None):
+    """LogMirror compartida por proceso para la base en ``path``."""
+    path = path or config.data_path(DEFAULT_DB_PATH)
+    with _mirrors_lock:
+        mirror = _mirrors.get(path)
+        if mirror is None:
+            mirror = _mirrors[path] = LogMirror(path)
+        return mirror
+
+
+class MirrorSyncer(threading.Thread):
+    """Hilo que sincroniza la copia cuando tiene más de ``interval_s`` (fuera de los reruns de la app)."""
+
+    def __init__(self, mirror, worksheet_factory, interval_s):
+        super().__init__(name="citamed-log-mirror-sync", daemon=True)
+        self.mirror = mirror
+        # Callable que devuelve la hoja de log (objeto con ``get``) o None
+        self.worksheet_factory = worksheet_factory
+        self.interval_s = interval_s
+        self.last_error = None
+        self._stopping = threading.Event()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self.join(timeout)
+
+    def run(self):
+        while not self._stopping.is_set():
+            if self.mirror.is_stale(self.interval_s):
+                try:
+                    worksheet = self.worksheet_factory()
+                    if worksheet is None:
+                        raise RuntimeError("No hay hoja de log disponible.")
+                    self.mirror.sync(worksheet)
+                    self.last_error = None
+                except Exception as e:  # Se reintenta en la siguiente vuelta; la copia sigue sirviendo lo ya copiado
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    logger.warning("No se pudo sincronizar la copia local del log: %s", e)
+            self._stopping.wait(self.interval_s)
+
+
+_syncers = {}
+
+
+def start_background_sync(worksheet_factory, path=None, interval_s=None):
+    """Arranca una vez por proceso el MirrorSyncer de la base en ``path`` y lo devuelve.
+
+    Llamadas posteriores solo actualizan la fábrica de hojas (p. ej. si
+    cambiaron los secretos). Con ``interval_s`` <= 0 no se sincroniza en segundo
+    plano y devuelve None.
+    """
+    interval_s = config.LOG_MIRROR_MAX_AGE_S if interval_s is None else interval_s
+    if interval_s <= 0:
+        return None
+    mirror = get_log_mirror(path)
+    with _mirrors_lock:
+        syncer = _syncers.get(mirror.path)
+        if syncer is None:
+            syncer = _syncers[mirror.path] = MirrorSyncer(mirror, worksheet_factory, interval_s)
+            syncer.start()
+        else:
+            syncer.worksheet_factory = worksheet_factory
+        return syncer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sincroniza y consulta la copia local de la hoja de log.")
+    parser.add_argument("--sync", action="store_true", help="Copiar antes las filas nuevas de la hoja")
+    parser.add_argument("--rebuild", action="store_true", help="Reconstruir la copia completa desde la hoja")
+    parser.add_argument("--search", default="", help="Palabras en Literal o Filename")
+    parser.add_argument("--dx", default="", help="Código CIE-10 o nombre del diagnóstico")
+    parser.add_argument("--med", default="", help="Nombre del medicamento")
+    parser.add_argument("--since", help="Fecha inicial AAAA-MM-DD")
+    parser.add_argument("--until", help="Fecha final AAAA-MM-DD")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--top", action="store_true", help="Diagnósticos y medicamentos más frecuentes")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    mirror = get_log_mirror()
+    if args.sync or args.rebuild:
+        import cli
+        import clients
+        secrets = cli.load_secrets()
+        if not (secrets.get("GOOGLE_CREDENTIALS_JSON") and secrets.get("GOOGLE_SHEET_LOG_URL")):
+            logger.error("Faltan GOOGLE_CREDENTIALS_JSON o GOOGLE_SHEET_LOG_URL (variable de entorno o %s).",
+                         cli.SECRETS_FILE)
+            return 2
+        worksheet = clients.get_sheets_client(secrets["GOOGLE_CREDENTIALS_JSON"]).log_worksheet(
+            secrets["GOOGLE_SHEET_LOG_URL"])
+        mirror.sync(worksheet, full=args.rebuild)
+    if args.search or args.dx or args.med or args.since or args.until:
+        for row in mirror.search(args.search, args.dx, args.med, args.since, args.until, limit=args.limit):
+            print(json.dumps(row, ensure_ascii=False))
+    if args.top:
+        print(json.dumps({"diagnosticos": mirror.top_diagnoses(args.since), "medicamentos": mirror.top_medications(args.since)},
+                         ensure_ascii=False, indent=2))
+    print(json.dumps(mirror.status(), ensure_ascii=False), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""Consultas largas: división en segmentos solapados y fusión de resultados.
+
+Una sola llamada ``generate_content`` sobre una consulta de 30-40 minutos es la
+etapa más lenta y a veces alcanza el timeout de generación. En modo "audio
+largo" el audio se divide en segmentos que se solapan unos segundos, cada uno
+se transcribe y clasifica en paralelo (map) y los ``existing-mrs`` parciales se
+fusionan en un solo registro (reduce):
+
+* Diagnosticos, Medicinas, Examenes y PlanDeAccion se deduplican (sin
+  distinguir mayúsculas ni acentos) completando los campos vacíos.
+* Literal se concatena en orden, recortando el texto repetido por el solape.
+* Los campos de texto se unen sin repetir; los signos vitales toman el primer
+  valor encontrado y DiasReposo el último.
+"""
+import difflib
+import re
+import unicodedata
+
+# --- Parámetros de la división ---
+LONG_AUDIO_THRESHOLD_S = 10 * 60  # A partir de esta duración se divide el audio
+SEGMENT_S = 5 * 60  # Duración de cada segmento
+SEGMENT_OVERLAP_S = 15  # Solape entre segmentos consecutivos (no se pierden frases en los cortes)
+MIN_LAST_SEGMENT_S = 60  # Un último segmento más corto se une al anterior
+SEGMENT_MAX_WORKERS = 4  # Segmentos de una misma consulta en paralelo
+
+NOT_FOUND = "NO_ENCONTRADO"
+TEXT_FIELDS = ("MotivoConsulta", "EnfermedadActual", "Antecedentes", "ExamenFisico", "ComentariosModelo")
+# Campos que identifican un elemento repetido en cada lista: el primero decide; los demás
+# solo desempatan si falta (p. ej. dos diagnósticos distintos pueden compartir código CIE-10)
+LIST_KEY_FIELDS = {
+    "Diagnosticos": ("Nombre", "ID"),
+    "Medicinas": ("Nombre",),
+    "Examenes": ("Name",),
+}
+# Solape del Literal: palabras que se comparan y mínimo para considerarlo repetido
+LITERAL_OVERLAP_WINDOW_WORDS = 120
+LITERAL_OVERLAP_MIN_WORDS = 4
+
+
+def plan_segments(duration_s, segment_s=SEGMENT_S, overlap_s=SEGMENT_OVERLAP_S):
+    """Tramos [(inicio_s, fin_s)] que cubren ``duration_s`` con solape entre vecinos."""
+    if duration_s <= segment_s:
+        return [(0.0, float(duration_s))]
+    step = segment_s - overlap_s
+    segments = []
+    start = 0.0
+    while start + segment_s < duration_s:
+        segments.append((start, start + segment_s))
+        start += step
+    if duration_s - start < MIN_LAST_SEGMENT_S and segments:
+        segments[-1] = (segments[-1][0], float(duration_s))
+    else:
+        segments.append((start, float(duration_s)))
+    return segments
+
+
+def _clock(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes:02d}:{seconds:02d}"
+
+
+def segment_prompt(prompt_text, index, total, start_s, end_s, overlap_s=SEGMENT_OVERLAP_S):
+    """Prompt de un segmento: el prompt normal más el contexto del fragmento."""
+    return prompt_text + (
+        f"\nNOTA: Este audio es el segmento {index + 1} de {total} de una consulta más larga "
+        f"(de {_clock(start_s)} a {_clock(end_s)}). Los segmentos consecutivos se solapan {overlap_s:.0f} s. "
+        "Transcribe y clasifica únicamente lo que se escucha en este segmento; "
+        f"si un dato no aparece en él, usa {NOT_FOUND} o listas vacías.\n"
+    )
+
+
+# --- Fusión (reduce) ---
+def normalize_text(text):
+    """Minúsculas, sin acentos, sin puntuación y con espacios simples."""
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def _is_empty(value):
+    return value is None or (isinstance(value, str) and value.strip() in ("", NOT_FOUND))
+
+
+def _merge_text(values):
+    """Une textos no vacíos sin repetir los ya contenidos en otro."""
+    merged = []
+    for value in values:
+        if _is_empty(value):
+            continue
+        norm = normalize_text(value)
+        if any(norm in normalize_text(existing) for existing in merged):
+            continue
+        merged = [existing for existing in merged if normalize_text(existing) not in norm]
+        merged.append(str(value).strip())
+    return " ".join(merged) if merged else NOT_FOUND
+
+
+def dedupe_items(items, key_fields):
+    """Deduplica dicts y completa campos vacíos.
+
+    Dos elementos son el mismo si coincide el primer campo de ``key_fields``
+    (normalizado). Los demás campos solo se usan cuando a uno de los dos le
+    falta el primero: un diagnóstico sin nombre se une al de su mismo código,
+    pero dos nombres distintos con el mismo código se conservan.
+    """
+    primary_field, tie_fields = key_fields[0], key_fields[1:]
+    merged = []
+    by_primary = {}  # valor_normalizado -> posición en merged
+    by_tie = {}  # (campo, valor_normalizado) -> posiciones en merged
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        primary = None if _is_empty(item.get(primary_field)) else normalize_text(item[primary_field])
+        ties = [(f, normalize_text(item[f])) for f in tie_fields if not _is_empty(item.get(f))]
+        if primary is not None:
+            position = by_primary.get(primary)
+            if position is None:  # Un elemento anterior sin nombre con el mismo código
+                position = next((p for k in ties for p in by_tie.get(k, ())
+                                 if _is_empty(merged[p].get(primary_field))), None)
+        else:
+            position = next((by_tie[k][0] for k in ties if k in by_tie), None)
+        if position is None:
+            position = len(merged)
+            merged.append(dict(item))
+        else:
+            existing = merged[position]
+            for name, value in item.items():
+                if _is_empty(existing.get(name)) and not _is_empty(value):
+                    existing[name] = value
+        if primary is not None:
+            by_primary.setdefault(primary, position)
+        for k in ties:
+            if position not in by_tie.setdefault(k, []):
+                by_tie[k].append(position)
+    return merged
+
+
+def _plan_item_text(item):
+    if isinstance(item, dict):
+        return " ".join(str(v) for v in item.values())
+    return str(item)
+
+
+def _dedupe_plan(items):
+    merged, seen = [], set()
+    for item in items:
+        norm = normalize_text(_plan_item_text(item))
+        if norm and norm not in seen:
+            seen.add(norm)
+            merged.append(item)
+    return merged
+
+
+def join_transcripts(parts):
+    """Concatena los Literal en orden eliminando la repetición del solape."""
+    tokens = []  # Palabras con su espacio original (conserva saltos de línea)
+    for part in parts:
+        if _is_empty(part):
+            continue
+        new_tokens = re.findall(r"\S+\s*", str(part).strip())
+        if tokens:
+            tail = tokens[-LITERAL_OVERLAP_WINDOW_WORDS:]
+            head = new_tokens[:LITERAL_OVERLAP_WINDOW_WORDS]
+            matcher = difflib.SequenceMatcher(
+                None, [normalize_text(t) for t in tail], [normalize_text(t) for t in head], autojunk=False
+            )
+            match = matcher.find_longest_match(0, len(tail), 0, len(head))
+            if match.size >= LITERAL_OVERLAP_MIN_WORDS:
+                # Se conserva el texto anterior hasta el final del tramo común y se sigue desde ahí
+                del tokens[len(tokens) - len(tail) + match.a + match.size:]
+                new_tokens = new_tokens[match.b + match.size:]
+            if tokens and not tokens[-1][-1].isspace():
+                tokens[-1] += " "
+        tokens.extend(new_tokens)
+    return "".join(tokens).strip()
+
+
+def merge_existing_mrs(parts):
+    """Fusiona los ``existing-mrs`` de los segmentos (en orden) en un solo registro."""
+    parts = [p for p in parts if isinstance(p, dict)]
+    merged = {"Literal": join_transcripts(p.get("Literal") for p in parts) or NOT_FOUND}
+    for name in TEXT_FIELDS:
+        merged[name] = _merge_text(p.get(name) for p in parts)
+
+    # DiasReposo suele indicarse al final de la consulta: gana el último valor
+    dias_reposo = [p.get("DiasReposo") for p in parts if not _is_empty(p.get("DiasReposo"))]
+    merged["DiasReposo"] = dias_reposo[-1] if dias_reposo else NOT_FOUND
+
+    vitals = {}
+    for part in parts:
+        part_vitals = part.get("SignosVitales")
+        if not isinstance(part_vitals, dict):
+            continue
+        for name, value in part_vitals.items():
+            if _is_empty(vitals.get(name)):
+                vitals[name] = value
+    merged["SignosVitales"] = vitals
+
+    for name, key_fields in LIST_KEY_FIELDS.items():
+        items = [item for p in parts if isinstance(p.get(name), list) for item in p[name]]
+        merged[name] = dedupe_items(items, key_fields)
+    merged["PlanDeAccion"] = _dedupe_plan(
+        item for p in parts if isinstance(p.get("PlanDeAccion"), list) for item in p["PlanDeAccion"]
+    )
+    return merged
+
+
+def merge_results(parsed_results):
+    """Fusiona las respuestas JSON completas de los segmentos en una sola."""
+    parts = []
+    for parsed in parsed_results:
+        data = parsed.get("data", {}) if isinstance(parsed, dict) else {}
+        existing_mrs = data.get("existing-mrs") if isinstance(data, dict) else None
+        if isinstance(existing_mrs, dict):
+            parts.append(existing_mrs)
+    return {
+        "status": "OK" if parts else "ERROR",
+        "message": f"SUCCESS ({len(parsed_results)} segmentos fusionados)",
+        "data": {"existing-mrs": merge_existing_mrs(parts)},
+    }
@@ -0,0 +1,239 @@
+"""Instrumentación por etapa del procesamiento de una consulta.
+
+Cada etapa (escritura del archivo temporal, subida, espera de PROCESSING,
+generación, extracción de JSON, construcción de la fila, append a Sheets y
+borrado del archivo remoto) se mide con ``stage()``. Cada medición:
+
+* se emite como una línea JSON en el logger ``citamed.metrics`` (y, si se
+  define ``CITAMED_METRICS_LOG``, en ese archivo JSONL);
+* se acumula en histogramas exportables en formato de texto de Prometheus
+  (``prometheus_text()`` o el endpoint HTTP opcional ``CITAMED_METRICS_PORT``);
+* se guarda en el diccionario de tiempos de la consulta en curso (``bind``),
+  que alimenta ``ConsultResult.stage_times`` y las columnas de tiempos opcionales
+  de la hoja de log.
+"""
+import contextvars
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+logger = logging.getLogger("citamed.metrics")
+
+# Etapas en el orden del pipeline (mismas claves que ConsultResult.stage_times); sheets_flush es el envío en segundo plano
+STAGES = ("split", "temp_write", "upload", "processing", "generation", "parsing", "row_build", "sheets", "delete",
+          "sheets_flush")
+# Límites de los buckets del histograma de duración (s)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+RECENT_SAMPLES = 500  # Duraciones recientes por serie para percentiles exactos en la interfaz
+
+# Consulta en curso en este hilo: modelo, archivo y diccionario de tiempos
+_consult = contextvars.ContextVar("citamed_consult", default=None)
+
+
+def bind(model=None, filename=None, times=None):
+    """Asocia las próximas etapas de este hilo a una consulta. Devuelve el dict de tiempos."""
+    context = {"model": model, "filename": filename, "times": times if times is not None else {}}
+    _consult.set(context)
+    return context["times"]
+
+
+def current_times():
+    """Tiempos por etapa de la consulta asociada al hilo ({} si no hay ninguna)."""
+    context = _consult.get()
+    return context["times"] if context else {}
+
+
+class _Series:
+    __slots__ = ("bucket_counts", "count", "total_s", "bytes_total", "retries_total", "recent")
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.total_s = 0.0
+        self.bytes_total = 0
+        self.retries_total = 0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+
+class MetricsRegistry:
+    """Histogramas y contadores por (etapa, modelo, resultado), thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, stage, duration_s, model=None, outcome="ok", nbytes=None, retries=0):
+        key = (stage, model or "", outcome)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series()
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration_s <= bound:
+                    series.bucket_counts[i] += 1
+            series.count += 1
+            series.total_s += duration_s
+            series.bytes_total += nbytes or 0
+            series.retries_total += retries
+            series.recent.append(duration_s)
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def rows(self):
+        """Resumen por serie (para mostrar en tabla)."""
+        with self._lock:
+            items = [(key, s.count, s.total_s, s.bytes_total, s.retries_total, sorted(s.recent))
+                     for key, s in self._series.items()]
+        order = {name: i for i, name in enumerate(STAGES)}
+        rows = []
+        for (stage, model, outcome), count, total_s, bytes_total, retries_total, recent in sorted(
+                items, key=lambda item: (order.get(item[0][0], len(order)), item[0][1], item[0][2])):
+            rows.append({
+                "Etapa": stage,
+                "Modelo": model or "-",
+                "Resultado": outcome,
+                "Mediciones": count,
+                "Media (s)": round(total_s / count, 3) if count else 0.0,
+                "p50 (s)": round(_quantile(recent, 0.50), 3),
+                "p95 (s)": round(_quantile(recent, 0.95), 3),
+                "MB": round(bytes_total / (1024 * 1024), 2),
+                "Reintentos": retries_total,
+            })
+        return rows
+
+    def prometheus_text(self):
+        """Métricas en el formato de exposición de texto de Prometheus."""
+        with self._lock:
+            items = [(key, list(s.bucket_counts), s.count, s.total_s, s.bytes_total, s.retries_total)
+                     for key, s in sorted(self._series.items())]
+        lines = [
+            "# HELP citamed_stage_duration_seconds Duración de cada etapa del procesamiento.",
+            "# TYPE citamed_stage_duration_seconds histogram",
+        ]
+        for (stage, model, outcome), buckets, count, total_s, _, _ in items:
+            labels = f'stage="{stage}",model="{_escape(model)}",outcome="{outcome}"'
+            for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                lines.append(f'citamed_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {bucket_count}')
+            lines.append(f'citamed_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"citamed_stage_duration_seconds_sum{{{labels}}} {total_s:.6f}")
+            lines.append(f"citamed_stage_duration_seconds_count{{{labels}}} {count}")
+        lines += [
+            "# HELP citamed_stage_bytes_total Bytes procesados por etapa.",
+            "# TYPE citamed_stage_bytes_total counter",
+        ]
+        lines += [f'citamed_stage_bytes_total{{stage="{stage}",model="{_escape(model)}",outcome="{outcome}"}} {nbytes}'
+                  for (stage, model, outcome), _, _, _, nbytes, _ in items if nbytes]
+        lines += [
+            "# HELP citamed_stage_retries_total Reintentos dentro de cada etapa.",
+            "# TYPE citamed_stage_retries_total counter",
+        ]
+        lines += [f'citamed_stage_retries_total{{stage="{stage}",model="{_escape(model)}",outcome="{outcome}"}} {retries}'
+                  for (stage, model, outcome), _, _, _, _, retries in items if retries]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _quantile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def stage(name, model=None, nbytes=None, **fields):
+    """Mide una etapa. El bloque puede completar ``span["bytes"]``, ``span["retries"]`` u otros campos."""
+    context = _consult.get()
+    span = {"bytes": nbytes, "retries": 0, **fields}
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield span
+    except BaseException as e:
+        outcome = "error"
+        span["error"] = type(e).__name__
+        raise
+    finally:
+        duration_s = time.perf_counter() - start
+        model = model or (context["model"] if context else None)
+        if context is not None:
+            context["times"][name] = context["times"].get(name, 0.0) + duration_s
+        registry.observe(name, duration_s, model, outcome, span["bytes"], span["retries"])
+        event = {
+            "event": "stage",
+            "stage": name,
+            "model": model,
+            "filename": context["filename"] if context else None,
+            "outcome": outcome,
+            "duration_s": round(duration_s, 4),
+            "ts": round(time.time(), 3),
+        }
+        event.update((k, v) for k, v in span.items() if v not in (None, 0) or k == "retries")
+        logger.info(json.dumps(event, ensure_ascii=False, default=str))
+
+
+def prometheus_text():
+    return registry.prometheus_text()
+
+
+# --- Exportación ---
+def _configure_json_log():
+    if not config.METRICS_LOG_PATH:
+        return
+    handler = logging.FileHandler(config.METRICS_LOG_PATH, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))  # Cada mensaje ya es una línea JSON
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_http_server = None
+_http_lock = threading.Lock()
+
+
+def start_http_server(port=None, host="0.0.0.0"):
+    """Sirve ``/metrics`` para Prometheus en un hilo de fondo (una vez por proceso)."""
+    global _http_server
+    port = port or config.METRICS_PORT
+    if not port:
+        return None
+    with _http_lock:
+        if _http_server is None:
+            try:
+                _http_server = ThreadingHTTPServer((host, int(port)), _MetricsHandler)
+            except OSError as e:
+                logger.warning("No se pudo abrir el endpoint de métricas en el puerto %s: %s", port, e)
+                return None
+            threading.Thread(target=_http_server.serve_forever, name="citamed-metrics-http", daemon=True).start()
+        return _http_server
+
+
+_configure_json_log()
@@ -0,0 +1,1186 @@
+"""Pipeline de procesamiento de audio médico, sin dependencias de la interfaz.
+
+Contiene las etapas subir -> esperar PROCESSING -> generar -> extraer JSON ->
+registrar en Google Sheets, de modo que puedan ejecutarse tanto desde el botón
+de la app como desde un pool de workers (modo por lotes).
+"""
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import pytz
+
+import audio_preprocess
+import cie10
+import clients
+import config
+import file_registry
+import json_output
+import log_format
+import long_audio
+import metrics
+import prompt_cache
+import result_cache
+import routing
+import scheduler
+import streaming_json
+import vitals
+from startup import lazy_import
+
+# SDK pesados: se importan en su primer uso (ver startup.py)
+genai = lazy_import("google.generativeai")
+google_exceptions = lazy_import("google.api_core.exceptions")
+
+logger = logging.getLogger(__name__)
+
+# --- Constantes del pipeline ---
+# Espera del estado PROCESSING: sondeo rápido al inicio y backoff exponencial con jitter
+PROCESSING_POLL_INITIAL_S = 0.25
+PROCESSING_POLL_MAX_S = 8.0
+PROCESSING_POLL_FACTOR = 2.0
+# Timeout proporcional al tamaño del archivo (base + s/MB, acotado)
+PROCESSING_TIMEOUT_BASE_S = 60
+PROCESSING_TIMEOUT_PER_MB_S = 15
+PROCESSING_TIMEOUT_MAX_S = 1800
+PROCESSING_TIMEOUT_S = 300  # Timeout cuando no se conoce el tamaño
+UPLOAD_MEASURE_MEMORY = config.UPLOAD_MEASURE_MEMORY  # Medir el pico de memoria de cada subida (tracemalloc)
+PREPROCESS_CACHE_VARIANT = "preprocesado"  # Parte de la clave de caché con preprocesamiento
+LONG_AUDIO_CACHE_VARIANT = "segmentado"  # Parte de la clave de caché en modo audio largo
+CIE10_CACHE_VARIANT = "cie10"  # Códigos CIE-10 revisados con la tabla local (CITAMED_CIE10)
+VITALS_CACHE_VARIANT = "vitales"  # Signos vitales normalizados (CITAMED_VITALS)
+GENERATION_TIMEOUT_S = 600  # Timeout de la llamada generate_content (10 min)
+LOG_TIMEZONE = 'America/Caracas'
+
+# Asegúrate que este orden sea EXACTO al de tu hoja de log
+EXPECTED_GSHEET_COLUMNS = [
+    "Timestamp", "Filename", "Model", "Status", "Message", "MotivoConsulta",
+    "EnfermedadActual", "Antecedentes", "ExamenFisico", "DiasReposo",
+    "SignosVitales_Resumen", "Examenes_Resumen", "Diagnosticos_Resumen",
+    "Medicinas_Resumen", # Mapeado desde la columna '850mg' original
+    "PlanDeAccion_Resumen", "ComentariosModelo", "Literal",
+    "JSON_Completo"
+]
+
+# Columnas opcionales de tiempos por etapa al final de la hoja (CITAMED_LOG_STAGE_TIMINGS=1)
+STAGE_TIMING_COLUMNS = [
+    ("upload", "T_Subida_s"), ("processing", "T_Processing_s"),
+    ("generation", "T_Generacion_s"), ("parsing", "T_ExtraccionJSON_s"),
+]
+
+# Columnas opcionales con los signos vitales numéricos (CITAMED_LOG_VITALS_COLUMNS=1, ver vitals.py)
+VITALS_COLUMNS = [
+    ("FC_lpm", "FC_lpm"), ("TAS_mmHg", "TAS_mmHg"), ("TAD_mmHg", "TAD_mmHg"),
+    ("Peso_kg", "Peso_kg"), ("Talla_m", "Talla_m"), ("IMC", "IMC"), ("Alertas", "Alertas_SignosVitales"),
+]
+
+# Estados visibles en la tabla de progreso
+STATUS_QUEUED = "En cola"
+STATUS_PREPROCESSING = "Preprocesando audio"
+STATUS_SEGMENTING = "Procesando segmentos"
+STATUS_UPLOADING = "Subiendo"
+STATUS_PROCESSING = "Procesando en Google AI"
+STATUS_WAITING_QUOTA = "Esperando cuota"  # En la cola de scheduler.gemini
+STATUS_GENERATING = "Generando"
+STATUS_PARSING = "Extrayendo JSON"
+STATUS_LOGGING = "Registrando en Sheets"
+STATUS_DONE = "Completado"
+STATUS_FAILED = "Error"
+
+# Lock para serializar escrituras en la hoja desde varios workers
+_sheet_lock = threading.Lock()
+
+
+@dataclass
+class ConsultResult:
+    """Resultado (y progreso) del procesamiento de un archivo de audio."""
+    filename: str
+    model_name: str
+    status: str = STATUS_QUEUED
+    parsed_json: dict | None = None
+    response_text: str | None = None
+    error: str | None = None
+    logged: bool = False
+    from_cache: bool = False
+    processing_polls: int = 0
+    parse_method: str | None = None  # "direct", "repaired" o "merged" (audio largo)
+    preprocess_report: object = None  # audio_preprocess.PreprocessReport
+    preprocess_error: str | None = None
+    upload_peak_memory_bytes: int | None = None
+    segment_count: int = 0  # Segmentos procesados en modo audio largo (0 = audio completo)
+    route: str | None = None  # Ruta de modelos con enrutamiento (ver routing)
+    route_summary: str | None = None  # routing.RouteOutcome.summary() de la consulta
+    first_field_s: float | None = None  # En streaming: primer campo de existing-mrs visible (s desde la llamada)
+    cie10_checks: list = field(default_factory=list)  # cie10.Cie10Check por diagnóstico
+    file_reused: bool = False  # El audio ya estaba en Google AI (ver file_registry)
+    stage_times: dict = field(default_factory=dict)
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @property
+    def ok(self):
+        return self.status == STATUS_DONE and self.parsed_json is not None
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def as_record(self):
+        """Registro serializable (JSON) del resultado, p. ej. para la salida JSONL de la CLI."""
+        return {
+            "filename": self.filename,
+            "model": self.model_name,
+            "status": self.status,
+            "ok": self.ok,
+            "error": self.error,
+            "from_cache": self.from_cache,
+            "file_reused": self.file_reused,
+            "logged": self.logged,
+            "parse_method": self.parse_method,
+            "route": self.route,
+            "upload_peak_memory_bytes": self.upload_peak_memory_bytes,
+            "first_field_s": None if self.first_field_s is None else round(self.first_field_s, 3),
+            "cie10": cie10.summarize(self.cie10_checks),
+            "segments": self.segment_count or 1,
+            "preprocess": self.preprocess_report.as_dict() if self.preprocess_report else None,
+            "stage_times": {stage: round(seconds, 3) for stage, seconds in self.stage_times.items()},
+            "elapsed_s": round(self.elapsed, 3),
+            "parsed_json": self.parsed_json,
+        }
+
+    def as_row(self):
+        """Fila para la tabla de progreso por archivo."""
+        return {
+            "Archivo": self.filename,
+            "Estado": self.status,
+            "Modelo": self.model_name,
+            "Ruta": self.route or "-",
+            "Ahorro preproc. (KB)": round(self.preprocess_report.bytes_saved / 1024) if self.preprocess_report else 0,
+            "Segmentos": self.segment_count or 1,
+            "Subida (s)": round(self.stage_times.get("upload", 0.0), 2),
+            "Memoria subida (MB)": round((self.upload_peak_memory_bytes or 0) / (1024 * 1024), 2),
+            "PROCESSING (s)": round(self.stage_times.get("processing", 0.0), 2),
+            "Consultas estado": self.processing_polls,
+            "Generación (s)": round(self.stage_times.get("generation", 0.0), 2),
+            "Total (s)": round(self.elapsed, 2),
+            "Caché": "Sí" if self.from_cache else "No",
+            "Archivo reutilizado": "Sí" if self.file_reused else "No",
+            "Sheets": "Sí" if self.logged else "No",
+            "Error": self.error or "",
+        }
+
+
+# --- Backend de Gemini intercambiable (benchmarks y pruebas sin cuota) ---
+@contextmanager
+def use_backend(backend):
+    """Sustituye el SDK de Gemini (``genai``) por ``backend`` durante el bloque.
+
+    ``backend`` debe ofrecer ``upload_file``, ``get_file``, ``delete_file``,
+    ``GenerativeModel`` y ``GenerationConfig`` (ver fakes.FakeGenAI). Afecta a
+    todo el proceso, así que no debe usarse mientras la app atiende sesiones.
+    """
+    global genai
+    previous = genai
+    genai = clients.genai = backend
+    clients.reset_models()
+    prompt_cache.context.clear()
+    # Registro de archivos propio (en memoria): los archivos del backend no se mezclan con los reales
+    previous_registry = file_registry.use_registry(file_registry.FileRegistry(":memory:"))
+    try:
+        yield backend
+    finally:
+        file_registry.use_registry(previous_registry).close()  # Borra ya los archivos que quedaron en el backend
+        prompt_cache.context.clear()  # Las entradas en caché pertenecen al backend sustituido
+        genai = clients.genai = previous
+        clients.reset_models()
+
+
+# --- Etapas individuales ---
+@dataclass
+class UploadStats:
+    """Métricas de una subida: bytes, duración, modo y pico de memoria de Python."""
+    size_bytes: int
+    upload_s: float
+    mode: str  # "stream" (desde memoria) o "tempfile" (SDK antiguo)
+    peak_memory_bytes: int | None = None
+
+
+def audio_size(source):
+    """Tamaño en bytes de un audio dado como bytes o como objeto tipo archivo."""
+    if hasattr(source, "getbuffer"):
+        with source.getbuffer() as view:
+            return view.nbytes
+    if hasattr(source, "seek") and hasattr(source, "tell"):
+        position = source.tell()
+        size = source.seek(0, os.SEEK_END)
+        source.seek(position)
+        return size
+    return len(source)
+
+
+def audio_view(source):
+    """Vista de solo lectura de los bytes del audio, sin copiarlos si es posible.
+
+    Para BytesIO (y el UploadedFile de Streamlit) usa ``getbuffer()``; el
+    llamador debe liberar la vista (``with``) antes de que el buffer cambie.
+    """
+    if hasattr(source, "getbuffer"):
+        return source.getbuffer()
+    if hasattr(source, "read"):
+        source.seek(0)
+        return memoryview(source.read())
+    return memoryview(source)
+
+
+def _as_stream(source):
+    """Objeto tipo archivo posicionado al inicio, reutilizando el buffer original."""
+    if hasattr(source, "read") and hasattr(source, "seek"):
+        source.seek(0)
+        return source
+    # BytesIO sobre bytes comparte el buffer hasta que se modifica (no copia)
+    return io.BytesIO(source)
+
+
+_stream_upload_supported = True  # Se desactiva si el SDK instalado solo acepta rutas
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0  # Bloques measure_peak_memory abiertos en el proceso
+_tracemalloc_owned = False  # True si tracemalloc lo arrancó measure_peak_memory (y lo detiene)
+
+
+@contextmanager
+def measure_peak_memory():
+    """Mide el pico de memoria de Python (tracemalloc) durante el bloque.
+
+    El pico solo se reinicia cuando no hay otra medición abierta: con varias
+    subidas en paralelo, cada una ve el pico desde que empezó la primera, con
+    las asignaciones de todos los hilos (cota superior por archivo en modo por
+    lotes). Si otro código ya usa tracemalloc (p. ej. bench.py), no se reinicia
+    ni se detiene.
+    """
+    global _tracemalloc_users, _tracemalloc_owned
+    stats = {"peak_memory_bytes": None}
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0:
+            _tracemalloc_owned = not tracemalloc.is_tracing()
+            if _tracemalloc_owned:
+                tracemalloc.start()
+        _tracemalloc_users += 1
+        baseline = tracemalloc.get_traced_memory()[0]
+    try:
+        yield stats
+    finally:
+        with _tracemalloc_lock:
+            stats["peak_memory_bytes"] = max(0, tracemalloc.get_traced_memory()[1] - baseline)
+            _tracemalloc_users -= 1
+            if _tracemalloc_users == 0 and _tracemalloc_owned:
+                tracemalloc.stop()
+                _tracemalloc_owned = False
+
+
+def _upload_via_tempfile(stream, display_name):
+    """Ruta para SDKs que solo aceptan rutas: copia por bloques a un archivo temporal."""
+    temp_file_path = None
+    try:
+        with metrics.stage("temp_write") as span, tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as temp_file:
+            shutil.copyfileobj(stream, temp_file)
+            temp_file_path = temp_file.name
+            span["bytes"] = temp_file.tell()
+        return genai.upload_file(path=temp_file_path, display_name=display_name, mime_type="audio/ogg")
+    finally:
+        # Asegura la eliminación del archivo temporal local
+        if temp_file_path and os.path.exists(temp_file_path):
+            try:
+                os.remove(temp_file_path)
+            except OSError as e_remove:
+                logger.warning("No se pudo eliminar archivo temporal local %s: %s", temp_file_path, e_remove)
+
+
+def upload_audio_with_stats(source, filename, measure_memory=None):
+    """Sube el audio a Google AI File Service directamente desde memoria.
+
+    ``source`` puede ser bytes o un objeto tipo archivo (p. ej. el UploadedFile
+    de Streamlit). El SDK lee del mismo buffer, sin materializar una copia con
+    ``getvalue()`` ni escribirla a disco; si la versión instalada del SDK no
+    acepta objetos tipo archivo se usa un archivo temporal como antes.
+    Devuelve (referencia, UploadStats).
+    """
+    measure_memory = UPLOAD_MEASURE_MEMORY if measure_memory is None else measure_memory
+    size_bytes = audio_size(source)
+    display_name = f"streamlit_{int(time.time())}_{filename}"
+    memory_ctx = measure_peak_memory() if measure_memory else nullcontext({"peak_memory_bytes": None})
+    start_time = time.time()
+    global _stream_upload_supported
+    with metrics.stage("upload", nbytes=size_bytes) as span, memory_ctx as memory_stats:
+        audio_file_ref = None
+        if _stream_upload_supported:
+            try:
+                audio_file_ref = genai.upload_file(path=_as_stream(source), display_name=display_name, mime_type="audio/ogg")
+                mode = "stream"
+            except TypeError:
+                # SDK anterior a la subida desde objetos tipo archivo: no volver a intentarlo
+                logger.info("El SDK no acepta objetos tipo archivo en upload_file; se usará archivo temporal.")
+                _stream_upload_supported = False
+        if audio_file_ref is None:
+            audio_file_ref = _upload_via_tempfile(_as_stream(source), display_name)
+            mode = "tempfile"
+        span["mode"] = mode
+    stats = UploadStats(size_bytes, time.time() - start_time, mode, memory_stats["peak_memory_bytes"])
+    logger.info("Subida de %s: %d bytes en %.2f s (%s), pico de memoria %s bytes.",
+                filename, size_bytes, stats.upload_s, mode, stats.peak_memory_bytes)
+    return audio_file_ref, stats
+
+
+def upload_audio(source, filename):
+    """Sube el audio a Google AI File Service y devuelve la referencia."""
+    return upload_audio_with_stats(source, filename)[0]
+
+
+@dataclass
+class FileReadiness:
+    """Resultado de esperar a que un archivo subido deje el estado PROCESSING."""
+    file_ref: object
+    processing_s: float
+    polls: int
+
+
+def processing_timeout(size_bytes=None):
+    """Timeout de la espera de PROCESSING según el tamaño del archivo."""
+    if not size_bytes:
+        return PROCESSING_TIMEOUT_S
+    timeout = PROCESSING_TIMEOUT_BASE_S + PROCESSING_TIMEOUT_PER_MB_S * size_bytes / (1024 * 1024)
+    return min(PROCESSING_TIMEOUT_MAX_S, timeout)
+
+
+def poll_delays(initial=PROCESSING_POLL_INITIAL_S, maximum=PROCESSING_POLL_MAX_S, factor=PROCESSING_POLL_FACTOR):
+    """Intervalos de sondeo: crecen exponencialmente hasta ``maximum``, con jitter."""
+    delay = initial
+    while True:
+        yield delay * random.uniform(0.8, 1.2)
+        delay = min(maximum, delay * factor)
+
+
+def _check_final_state(audio_file_ref):
+    if audio_file_ref.state.name == "FAILED":
+        raise ValueError(f"Error: Subida/procesamiento de '{audio_file_ref.name}' falló en Google AI.")
+
+
+def wait_for_file(audio_file_ref, size_bytes=None, timeout=None):
+    """Espera a que el archivo deje PROCESSING y mide cuánto tardó.
+
+    Lanza TimeoutError si se supera el timeout (por defecto proporcional a
+    ``size_bytes``) y ValueError si Google AI marca el archivo como FAILED.
+    """
+    with metrics.stage("processing", nbytes=size_bytes) as span:
+        readiness = _wait_for_file(audio_file_ref, size_bytes, timeout)
+        span["polls"] = readiness.polls
+        return readiness
+
+
+def _wait_for_file(audio_file_ref, size_bytes=None, timeout=None):
+    timeout = timeout or processing_timeout(size_bytes)
+    start_time = time.time()
+    polls = 0
+    delays = poll_delays()
+    while audio_file_ref.state.name == "PROCESSING":
+        # Timeout para evitar esperas infinitas
+        if time.time() - start_time > timeout:
+            raise TimeoutError(f"Timeout: El archivo '{audio_file_ref.name}' sigue en estado PROCESSING tras {timeout:.0f} s.")
+        time.sleep(next(delays))
+        polls += 1
+        try:
+            # Re-obtiene el estado del archivo
+            audio_file_ref = genai.get_file(audio_file_ref.name)
+        except Exception as get_file_e:
+            # Si hay error obteniendo estado, el siguiente intervalo ya es más largo
+            logger.warning("Error obteniendo estado de %s: %s. Reintentando...", audio_file_ref.name, get_file_e)
+
+    _check_final_state(audio_file_ref)
+    processing_s = time.time() - start_time
+    logger.info("Archivo %s listo (%s) tras %.2f s en PROCESSING y %d consultas.",
+                audio_file_ref.name, audio_file_ref.state.name, processing_s, polls)
+    return FileReadiness(audio_file_ref, processing_s, polls)
+
+
+def wait_until_active(audio_file_ref, size_bytes=None, timeout=None):
+    """Como wait_for_file, pero devuelve solo la referencia actualizada."""
+    return wait_for_file(audio_file_ref, size_bytes=size_bytes, timeout=timeout).file_ref
+
+
+async def wait_for_file_async(audio_file_ref, size_bytes=None, timeout=None):
+    """Variante asíncrona de wait_for_file (no bloquea el event loop)."""
+    timeout = timeout or processing_timeout(size_bytes)
+    start_time = time.time()
+    polls = 0
+    delays = poll_delays()
+    while audio_file_ref.state.name == "PROCESSING":
+        if time.time() - start_time > timeout:
+            raise TimeoutError(f"Timeout: El archivo '{audio_file_ref.name}' sigue en estado PROCESSING tras {timeout:.0f} s.")
+        await asyncio.sleep(next(delays))
+        polls += 1
+        try:
+            # El SDK es síncrono: la consulta se ejecuta en un hilo del pool por defecto
+            audio_file_ref = await asyncio.to_thread(genai.get_file, audio_file_ref.name)
+        except Exception as get_file_e:
+            logger.warning("Error obteniendo estado de %s: %s. Reintentando...", audio_file_ref.name, get_file_e)
+
+    _check_final_state(audio_file_ref)
+    return FileReadiness(audio_file_ref, time.time() - start_time, polls)
+
+
+async def wait_for_files_async(files):
+    """Espera varios archivos a la vez. ``files``: [(file_ref, size_bytes)].
+
+    Devuelve una lista alineada con la entrada con FileReadiness o la excepción
+    de cada archivo.
+    """
+    return await asyncio.gather(
+        *(wait_for_file_async(ref, size_bytes) for ref, size_bytes in files),
+        return_exceptions=True,
+    )
+
+
+def wait_for_files(files):
+    """Versión síncrona de wait_for_files_async para código sin event loop."""
+    return asyncio.run(wait_for_files_async(files))
+
+
+def generation_config_for(model_name, use_schema=True, stream=False):
+    """GenerationConfig con salida JSON por esquema si el modelo lo soporta.
+
+    En streaming se pide JSON sin esquema: ``protos.Schema.properties`` es un
+    mapa y la API devuelve las propiedades en orden alfabético, con lo que
+    ``Literal`` (el campo más largo) llegaría antes que ``MotivoConsulta``,
+    ``Medicinas``, ``PlanDeAccion`` o ``SignosVitales``. Sin esquema el modelo
+    sigue el orden de la plantilla del prompt, que deja ``Literal`` al final.
+    """
+    if use_schema and json_output.supports_response_schema(model_name):
+        if stream:
+            return genai.GenerationConfig(temperature=0.1, response_mime_type="application/json")
+        return genai.GenerationConfig(
+            temperature=0.1,
+            response_mime_type="application/json",
+            response_schema=json_output.RESPONSE_SCHEMA,
+        )
+    return genai.GenerationConfig(temperature=0.1)
+
+
+def generate_content(audio_file_ref, model_name, prompt_text, stream=False, on_wait=None):
+    """Llama al modelo con el prompt y el audio ya subido.
+
+    Pide JSON validado por esquema cuando el modelo lo admite; si el modelo
+    rechaza el esquema (400), se recuerda y se repite la llamada en modo texto.
+    La llamada pasa por ``scheduler.gemini`` (cuota compartida, turnos por
+    sesión y reintentos de 429/503); ``on_wait(posición, espera_s)`` informa la
+    posición en la cola mientras se espera.
+
+    Con ``prompt_cache`` activado, el prompt va en la caché de contexto del
+    modelo y la solicitud lleva solo el audio y una referencia corta.
+    """
+    if stream:
+        # La duración real incluye consumir los fragmentos: se mide en generate_content_streaming
+        return _generate(audio_file_ref, model_name, prompt_text, stream, {}, on_wait)
+    start = time.perf_counter()
+    with metrics.stage("generation", model=model_name) as span:
+        response = _generate(audio_file_ref, model_name, prompt_text, stream, span, on_wait)
+    prompt_cache.stats.record(model_name, span.get("prompt_cache"), time.perf_counter() - start, response)
+    return response
+
+
+def _generate(audio_file_ref, model_name, prompt_text, stream, span, on_wait=None, use_prompt_cache=True):
+    cached_model = prompt_cache.context.model_for(model_name, prompt_text) if use_prompt_cache else None
+    if cached_model is not None:
+        model, contents = cached_model, [audio_file_ref, prompt_cache.PROMPT_REFERENCE]
+    else:
+        model, contents = clients.get_generative_model(model_name), [prompt_text, audio_file_ref]
+    span["prompt_cache"] = cached_model is not None
+    schema_mode = json_output.supports_response_schema(model_name)
+    estimated_tokens = scheduler.estimate_generate_tokens(prompt_text, getattr(audio_file_ref, "size_bytes", 0))
+
+    def request(use_schema):
+        return scheduler.gemini.call(
+            lambda: model.generate_content(
+                contents,
+                generation_config=generation_config_for(model_name, use_schema=use_schema, stream=stream),
+                request_options={'timeout': GENERATION_TIMEOUT_S},
+                stream=stream
+            ),
+            tokens=estimated_tokens, on_wait=on_wait, span=span,
+            usage=None if stream else scheduler.response_tokens,  # En streaming el uso se conoce al final
+        )
+
+    try:
+        return request(use_schema=True)
+    except (google_exceptions.NotFound, google_exceptions.PermissionDenied) as cache_err:
+        if cached_model is None:
+            raise
+        # La entrada venció o se borró en el servidor: esta llamada va con el prompt completo
+        logger.warning("Caché de contexto no disponible para %s (%s). Se envía el prompt completo.", model_name, cache_err)
+        prompt_cache.context.invalidate(model_name)
+        span["retries"] = span.get("retries", 0) + 1
+        return _generate(audio_file_ref, model_name, prompt_text, stream, span, on_wait, use_prompt_cache=False)
+    except google_exceptions.InvalidArgument as schema_err:
+        if not schema_mode:
+            raise
+        logger.warning("El modelo %s rechazó el esquema de respuesta (%s). Se usará modo texto.", model_name, schema_err)
+        json_output.mark_schema_unsupported(model_name)
+        span["retries"] = span.get("retries", 0) + 1
+        return request(use_schema=False)
+
+
+@dataclass
+class StreamTiming:
+    """Tiempos de una generación en streaming, medidos desde la llamada."""
+    first_chunk_s: float | None = None
+    first_field_s: float | None = None
+    total_s: float = 0.0
+    chunks: int = 0
+
+
+def generate_content_streaming(audio_file_ref, model_name, prompt_text, on_field=None, on_wait=None):
+    """Genera en modo streaming e invoca ``on_field(campo, valor)`` por cada campo
+    de ``existing-mrs`` completo, en cuanto llega.
+
+    Devuelve (response, texto_completo, StreamTiming). La respuesta ya está
+    consumida, así que ``response.text`` y ``prompt_feedback`` siguen disponibles.
+    Los 429/503 se reintentan solo hasta el primer fragmento (ver
+    ``scheduler.ApiScheduler.call``); un error a mitad del stream se propaga.
+    """
+    timing = StreamTiming()
+    parser = streaming_json.FieldStreamParser()
+    text_parts = []
+    start_time = time.time()
+    with metrics.stage("generation", model=model_name, streaming=True) as span:
+        response = _generate(audio_file_ref, model_name, prompt_text, True, span, on_wait)
+        for chunk in response:
+            chunk_text = chunk.text
+            timing.chunks += 1
+            if timing.first_chunk_s is None:
+                timing.first_chunk_s = time.time() - start_time
+            text_parts.append(chunk_text)
+            for field_name, value in parser.feed(chunk_text):
+                if timing.first_field_s is None:
+                    timing.first_field_s = time.time() - start_time
+                if on_field:
+                    on_field(field_name, value)
+        timing.total_s = time.time() - start_time
+        span.update(chunks=timing.chunks, first_chunk_s=timing.first_chunk_s, first_field_s=timing.first_field_s)
+    prompt_cache.stats.record(model_name, span.get("prompt_cache"), timing.total_s, response)
+    return response, "".join(text_parts), timing
+
+
+# --- Enrutamiento entre modelos (ver routing) ---
+def _generate_and_parse(audio_file_ref, model_name, prompt_text, on_wait=None):
+    response = generate_content(audio_file_ref, model_name, prompt_text, on_wait=on_wait)
+    response_text = response.text
+    with metrics.stage("parsing", model=model_name, nbytes=len(response_text.encode("utf-8"))):
+        parsed_json, parse_method = json_output.parse_model_json(response_text, model_name)
+    return response_text, parsed_json, parse_method
+
+
+def generate_routed(audio_file_ref, prompt_text, policy, on_wait=None):
+    """Genera y parsea sobre un archivo ya subido siguiendo ``policy`` (routing.RoutingPolicy).
+
+    Empieza por ``policy.primary_model``; escala si su respuesta no es JSON o
+    deja campos obligatorios vacíos, y lanza la solicitud de cobertura si no
+    responde antes de ``policy.hedge_after_s``. Gana la primera respuesta
+    completa; si ninguna lo es, la que menos campos deja vacíos. Devuelve
+    (parsed_json, response_text, parse_method, routing.RouteOutcome) o lanza el
+    último error si ningún modelo produjo JSON.
+
+    Las solicitudes perdedoras no se pueden cancelar: terminan en segundo plano
+    y su respuesta se descarta. ``on_wait`` (ver generate_content) se invoca
+    desde los hilos de las solicitudes.
+    """
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="citamed-route")
+    attempts, pending, hedged = [], {}, set()
+    best = None  # (campos vacíos, modelo, texto, json, método) de la mejor respuesta incompleta
+    last_error = None
+    reason = None
+
+    def launch(model_name):
+        attempts.append(model_name)
+        # Cada solicitud conserva la sesión (turnos del scheduler) y la consulta (metrics) del llamador
+        future = executor.submit(contextvars.copy_context().run, _generate_and_parse, audio_file_ref, model_name,
+                                 prompt_text, on_wait)
+        pending[future] = model_name
+
+    def finish(model_name, response_text, parsed_json, parse_method):
+        if model_name == policy.primary_model:
+            route = routing.ROUTE_DIRECT
+        elif model_name in hedged:
+            route = routing.ROUTE_HEDGED
+        else:
+            route = routing.ROUTE_ESCALATED
+        outcome = routing.RouteOutcome(route, model_name, tuple(attempts), time.perf_counter() - start, reason)
+        routing.route_stats.record(outcome)
+        logger.info("%s", outcome.summary())
+        return parsed_json, response_text, parse_method, outcome
+
+    launch(policy.primary_model)
+    try:
+        while pending:
+            hedge_target = policy.hedge_target
+            timeout = None
+            if hedge_target and hedge_target not in attempts:
+                timeout = max(0.0, policy.hedge_after_s - (time.perf_counter() - start))
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # Umbral de latencia superado: segunda solicitud en paralelo
+                hedged.add(hedge_target)
+                reason = reason or f"{policy.primary_model} sin respuesta tras {policy.hedge_after_s:g} s"
+                launch(hedge_target)
+                continue
+            for future in done:
+                model_name = pending.pop(future)
+                try:
+                    response_text, parsed_json, parse_method = future.result()
+                except Exception as e:
+                    last_error = e
+                    problem = f"{model_name}: {type(e).__name__}"
+                else:
+                    missing = routing.missing_required_fields(parsed_json, policy.required_fields)
+                    if not missing:
+                        return finish(model_name, response_text, parsed_json, parse_method)
+                    if best is None or len(missing) < best[0]:
+                        best = (len(missing), model_name, response_text, parsed_json, parse_method)
+                    problem = f"{model_name}: {', '.join(missing)} {routing.NOT_FOUND}"
+                if model_name == policy.primary_model:
+                    reason = problem
+                if policy.escalation_model and policy.escalation_model not in attempts:
+                    launch(policy.escalation_model)
+        if best is not None:
+            return finish(*best[1:])
+        raise last_error
+    finally:
+        executor.shutdown(wait=False)
+
+
+def log_timestamp():
+    """Timestamp para el log en la zona horaria configurada (UTC como respaldo)."""
+    try:
+        tz = pytz.timezone(LOG_TIMEZONE)
+        return datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
+    except Exception:  # Fallback a UTC si pytz falla
+        return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S") + " UTC"
+
+
+def log_columns():
+    """Columnas de la hoja de log, incluidas las opcionales (signos vitales y tiempos) si están activadas."""
+    columns = list(EXPECTED_GSHEET_COLUMNS)
+    if config.LOG_VITALS_COLUMNS:
+        columns += [column for _, column in VITALS_COLUMNS]
+    if config.LOG_STAGE_TIMINGS:
+        columns += [column for _, column in STAGE_TIMING_COLUMNS]
+    return columns
+
+
+def build_log_row(parsed_json, filename, model_name, timestamp=None, stage_times=None):
+    """Construye la fila de la hoja de log en el orden de log_columns().
+
+    Con ``CITAMED_LOG_VITALS_COLUMNS=1`` se añaden los signos vitales como
+    números y con ``CITAMED_LOG_STAGE_TIMINGS=1`` los tiempos por etapa de
+    ``stage_times`` (por defecto, los de la consulta en curso, ver metrics.bind).
+    """
+    with metrics.stage("row_build", model=model_name):
+        row = _build_log_row(parsed_json, filename, model_name, timestamp)
+        if config.LOG_VITALS_COLUMNS:
+            normalized = vitals.from_consult(parsed_json).as_json()
+            normalized["Alertas"] = "; ".join(normalized["Alertas"])
+            row += ["" if normalized[key] is None else normalized[key] for key, _ in VITALS_COLUMNS]
+        if config.LOG_STAGE_TIMINGS:
+            times = stage_times if stage_times is not None else metrics.current_times()
+            row += [round(times[stage], 3) if stage in times else "" for stage, _ in STAGE_TIMING_COLUMNS]
+        return row
+
+
+def _build_log_row(parsed_json, filename, model_name, timestamp=None):
+    timestamp = timestamp or log_timestamp()
+
+    # Extraer datos del JSON parseado (con valores por defecto seguros)
+    json_status = parsed_json.get("status", "NO_STATUS")
+    json_message = parsed_json.get("message", "NO_MESSAGE")
+    data = parsed_json.get("data", {})
+    existing_mrs = data.get("existing-mrs", {}) if isinstance(data, dict) else {}
+
+    motivo_consulta = existing_mrs.get("MotivoConsulta", "")
+    enf_actual = existing_mrs.get("EnfermedadActual", "")
+    antecedentes = existing_mrs.get("Antecedentes", "")
+    exam_fisico = existing_mrs.get("ExamenFisico", "")
+    # Asegurar que días de reposo sea string para la hoja
+    dias_reposo = str(existing_mrs.get("DiasReposo", ""))
+    comentarios_modelo = existing_mrs.get("ComentariosModelo", "")
+    literal = existing_mrs.get("Literal", "")
+    # JSON completo en formato compacto, sin repetir el Literal (ver log_format.py)
+    json_completo_str, json_format = log_format.encode_json(parsed_json)
+    literal_cell = log_format.encode_literal(literal)
+
+    # Crear resúmenes para campos complejos (listas/dicts)
+    # Signos vitales normalizados (unidades fijas, IMC calculado y alertas); si no se pudo leer ninguno, los textos originales
+    sv_data = existing_mrs.get("SignosVitales", {})
+    sv_resumen = vitals.from_consult(parsed_json).summary()
+    if not sv_resumen and isinstance(sv_data, dict):
+        sv_resumen = "; ".join([f"{k}: {v}" for k, v in sv_data.items() if v not in [None, "NO_ENCONTRADO", ""]])
+
+    ex_data = existing_mrs.get("Examenes", [])
+    ex_resumen = "; ".join([f"{e.get('Name', '')}: {e.get('Resultado', '')}".strip(": ") for e in ex_data if isinstance(e, dict)]) if isinstance(ex_data, list) else ""
+
+    dx_data = existing_mrs.get("Diagnosticos", [])
+    dx_resumen = "; ".join([f"{d.get('Nombre', '')} ({d.get('ID', '')})".strip(" ()") for d in dx_data if isinstance(d, dict)]) if isinstance(dx_data, list) else ""
+
+    med_data = existing_mrs.get("Medicinas", [])
+    med_resumen = "; ".join([f"{m.get('Nombre', '')} {m.get('Presentacion', '')} {m.get('Dosis', '')}".strip() for m in med_data if isinstance(m, dict)]) if isinstance(med_data, list) else ""
+
+    plan_data = existing_mrs.get("PlanDeAccion", [])
+    # Extrae solo el valor (la instrucción) de cada dict en la lista; en modo esquema son cadenas
+    plan_resumen = "; ".join([p if isinstance(p, str) else list(p.values())[0] for p in plan_data if (isinstance(p, str) and p) or (isinstance(p, dict) and len(p) == 1 and list(p.values())[0])]) if isinstance(plan_data, list) else ""
+
+    # Lista de datos en el orden EXACTO de las columnas esperadas
+    row = [
+        timestamp, filename, model_name, json_status, json_message,
+        motivo_consulta, enf_actual, antecedentes, exam_fisico, dias_reposo,
+        sv_resumen, ex_resumen, dx_resumen,
+        med_resumen,  # Columna 14
+        plan_resumen, comentarios_modelo, literal_cell,
+        json_completo_str
+    ]
+    row_bytes = sum(len(str(value).encode("utf-8")) for value in row)
+    legacy_bytes = row_bytes - len(literal_cell.encode("utf-8")) - len(json_completo_str.encode("utf-8")) \
+        + log_format.legacy_nbytes(parsed_json, literal)
+    log_format.stats.record(json_format, legacy_bytes, row_bytes, max(len(str(value)) for value in row))
+    return row
+
+
+def append_log_row(worksheet, row_data):
+    """Añade una fila a la hoja de log (serializado entre workers).
+
+    Las hojas que no gestionan su propia cuota (una gspread.Worksheet directa o
+    un fake) pasan por ``scheduler.sheets``; la cola local y LogWorksheet ya lo hacen.
+    """
+    with metrics.stage("sheets", nbytes=sum(len(str(value)) for value in row_data)) as span, _sheet_lock:
+        def append():
+            worksheet.append_row(row_data, value_input_option='USER_ENTERED')
+
+        if getattr(worksheet, "self_scheduled", False):
+            append()
+        else:
+            scheduler.sheets.call(append, span=span)
+
+
+def acquire_audio_file(data, filename, result, set_status=None):
+    """Referencia ACTIVE al audio en Google AI: reutilizada del registro o subida y esperada.
+
+    Con una subida nueva, los tiempos de subida y PROCESSING quedan en ``result``;
+    con una reutilización, ``result.file_reused`` pasa a True y no hay subida.
+    """
+    set_status = set_status or (lambda status: None)
+
+    def upload():
+        set_status(STATUS_UPLOADING)
+        audio_file_ref, upload_stats = upload_audio_with_stats(data, filename)
+        result.stage_times["upload"] = upload_stats.upload_s
+        result.upload_peak_memory_bytes = upload_stats.peak_memory_bytes
+        try:
+            set_status(STATUS_PROCESSING)
+            readiness = wait_for_file(audio_file_ref, size_bytes=upload_stats.size_bytes)
+            audio_file_ref = readiness.file_ref
+            result.stage_times["processing"] = readiness.processing_s
+            result.processing_polls = readiness.polls
+            if audio_file_ref.state.name != "ACTIVE":
+                raise ValueError(f"Estado final de subida inesperado: {audio_file_ref.state.name}.")
+        except Exception:
+            release_remote_file(audio_file_ref)  # No se registró: se borra en segundo plano
+            raise
+        return audio_file_ref, upload_stats.upload_s + readiness.processing_s
+
+    with audio_view(data) as view:
+        digest = result_cache.audio_hash(view)
+    audio_file_ref, result.file_reused = file_registry.get_registry().acquire(digest, upload)
+    return audio_file_ref
+
+
+def release_remote_file(audio_file_ref):
+    """Libera el archivo subido: queda para reutilizarse hasta su TTL o se borra en segundo plano."""
+    if audio_file_ref is not None:
+        file_registry.get_registry().release(audio_file_ref)
+
+
+def cache_variant(preprocess=False, segment_long_audio=False, routing_policy=None):
+    """Sufijo de la clave de caché según las opciones que cambian el resultado.
+
+    La caché guarda el JSON ya posprocesado, así que también entran
+    ``CITAMED_CIE10`` y ``CITAMED_VITALS`` (ver postprocess_consult).
+    """
+    parts = [PREPROCESS_CACHE_VARIANT if preprocess else "", LONG_AUDIO_CACHE_VARIANT if segment_long_audio else "",
+             routing_policy.cache_variant() if routing_policy is not None else "",
+             CIE10_CACHE_VARIANT if config.CIE10_VALIDATE else "", VITALS_CACHE_VARIANT if config.VITALS_NORMALIZE else ""]
+    return "+".join(p for p in parts if p)
+
+
+def preprocess_for_upload(data, result=None):
+    """Aplica el preprocesamiento local si ffmpeg está disponible.
+
+    Devuelve el audio a subir: el procesado o, si la etapa falla o el procesado
+    no es más chico, el original.
+    """
+    try:
+        with audio_view(data) as view:
+            processed, report = audio_preprocess.preprocess_audio(view)
+    except audio_preprocess.AudioPreprocessError as e:
+        logger.warning("Preprocesamiento omitido: %s", e)
+        if result is not None:
+            result.preprocess_error = str(e)
+        return data
+    logger.info("Preprocesamiento: %s", report.summary())
+    if result is not None:
+        result.preprocess_report = report
+        result.stage_times["preprocess"] = report.elapsed_s
+    if report.kept_original:
+        return data  # ``processed`` es la vista de ``data``, que ya se liberó
+    return processed
+
+
+def process_audio(data, filename, model_name, prompt_text, worksheet=None, on_update=None, result=None,
+                  cache=None, force_reprocess=False, preprocess=False, segment_long_audio=False, routing_policy=None,
+                  on_field=None, on_wait=None):
+    """Ejecuta subida -> PROCESSING -> generación -> JSON -> Sheets para un archivo.
+
+    No lanza excepciones: los errores quedan en ``result.error`` con estado
+    STATUS_FAILED. ``on_update`` se invoca en cada cambio de estado; con
+    enrutamiento también desde los hilos de las solicitudes. ``on_field`` y
+    ``on_wait`` se pasan a extract_consult (vista previa en streaming y posición
+    en la cola de cuota). Si se pasa
+    ``cache`` (ResultCache) y hay un acierto, se omiten subida, generación y
+    registro (el resultado ya se procesó antes). Con ``preprocess`` el audio se
+    pasa a mono/16 kHz/Opus y se acortan los silencios antes de subirlo. Con
+    ``segment_long_audio`` las consultas más largas que el umbral se dividen en
+    segmentos que se procesan en paralelo y se fusionan (ver long_audio). Con
+    ``routing_policy`` el modelo se elige por consulta (ver generate_routed).
+    """
+    result = result or ConsultResult(filename=filename, model_name=model_name)
+    result.started_at = time.time()
+    metrics.bind(model=model_name, filename=filename, times=result.stage_times)
+
+    def set_status(status):
+        result.status = status
+        if on_update:
+            on_update(result)
+
+    cache_key = None
+    if cache is not None:
+        with audio_view(data) as view:
+            cache_key = result_cache.make_key(view, model_name, prompt_text, variant=cache_variant(preprocess, segment_long_audio, routing_policy))
+        cached_json = None if force_reprocess else cache.get(cache_key)
+        if cached_json is not None:
+            result.parsed_json = cached_json
+            result.from_cache = True
+            result.finished_at = time.time()
+            set_status(STATUS_DONE)
+            return result
+
+    try:
+        # --- Preprocesamiento local (opcional) ---
+        if preprocess:
+            set_status(STATUS_PREPROCESSING)
+            data = preprocess_for_upload(data, result)
+
+        segments = plan_long_audio(data) if segment_long_audio else None
+        if segments:
+            # --- Audio largo: segmentos en paralelo (map) y fusión (reduce) ---
+            set_status(STATUS_SEGMENTING)
+            result.parsed_json = process_segments(data, filename, model_name, prompt_text, segments, result,
+                                                  routing_policy=routing_policy)
+            result.parse_method = "merged"
+        else:
+            # --- Subida, PROCESSING, generación y extracción de JSON ---
+            extract_consult(data, filename, model_name, prompt_text, result, set_status, routing_policy,
+                            on_field=on_field, on_wait=on_wait)
+        postprocess_consult(result.parsed_json, result)
+        if cache is not None:
+            cache.put(cache_key, result.parsed_json, model_name=model_name, filename=filename)
+
+        # --- Registro en Google Sheets ---
+        if worksheet is not None:
+            set_status(STATUS_LOGGING)
+            row_data = build_log_row(result.parsed_json, filename, result.model_name, stage_times=result.stage_times)
+            append_log_row(worksheet, row_data)
+            result.logged = True
+
+        result.finished_at = time.time()
+        set_status(STATUS_DONE)
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+        result.finished_at = time.time()
+        set_status(STATUS_FAILED)
+    return result
+
+
+def postprocess_consult(parsed_json, result=None):
+    """Pasos locales tras la generación: códigos CIE-10 y signos vitales normalizados.
+
+    Devuelve los cie10.Cie10Check de los diagnósticos.
+    """
+    checks = validate_diagnoses(parsed_json, result)
+    if config.VITALS_NORMALIZE and parsed_json:
+        vitals.apply(parsed_json)
+    return checks
+
+
+def validate_diagnoses(parsed_json, result=None):
+    """Completa o corrige los códigos CIE-10 de ``Diagnosticos`` con el índice local (ver cie10)."""
+    if not config.CIE10_VALIDATE or not parsed_json:
+        return []
+    checks = cie10.apply(parsed_json)
+    if result is not None:
+        result.cie10_checks = checks
+    return checks
+
+
+def extract_consult(data, filename, model_name, prompt_text, result, set_status=None, routing_policy=None,
+                    on_field=None, on_wait=None):
+    """Subida -> PROCESSING -> generación -> JSON para un audio (o un segmento).
+
+    Rellena ``result`` (tiempos, texto y JSON parseado) y libera siempre el
+    archivo remoto (ver file_registry). Lanza la excepción de la etapa que falle. Los tiempos de
+    cada etapa quedan en ``result.stage_times`` si la consulta se asoció con
+    ``metrics.bind``. Con ``routing_policy`` el modelo lo decide la política
+    (``model_name`` se ignora) y ``result.model_name`` pasa a ser el que respondió.
+    Sin enrutamiento, ``on_field(campo, valor)`` activa la generación en
+    streaming (ver generate_content_streaming). ``on_wait(posición, espera_s)``
+    recibe la posición en la cola de ``scheduler.gemini``.
+    """
+    set_status = set_status or (lambda status: None)
+    audio_file_ref = None
+    try:
+        audio_file_ref = acquire_audio_file(data, filename, result, set_status)
+
+        set_status(STATUS_GENERATING)
+
+        def waiting(position, wait_s):
+            set_status(f"{STATUS_WAITING_QUOTA} (posición {position})" if position else STATUS_GENERATING)
+            if on_wait:
+                on_wait(position, wait_s)
+
+        if routing_policy is not None:
+            result.parsed_json, result.response_text, result.parse_method, outcome = generate_routed(
+                audio_file_ref, prompt_text, routing_policy, waiting)
+            result.model_name = outcome.model_name
+            result.route = outcome.route
+            result.route_summary = outcome.summary()
+            result.stage_times["generation"] = outcome.latency_s
+            return result.parsed_json
+
+        if on_field is not None:
+            _, response_text, timing = generate_content_streaming(audio_file_ref, model_name, prompt_text,
+                                                                  on_field=on_field, on_wait=waiting)
+            result.first_field_s = timing.first_field_s
+        else:
+            response_text = generate_content(audio_file_ref, model_name, prompt_text, on_wait=waiting).text
+
+        set_status(STATUS_PARSING)
+        with metrics.stage("parsing", model=model_name) as span:
+            result.response_text = response_text
+            span["bytes"] = len(result.response_text.encode("utf-8"))
+            result.parsed_json, result.parse_method = json_output.parse_model_json(result.response_text, model_name)
+            span["method"] = result.parse_method
+        return result.parsed_json
+    finally:
+        release_remote_file(audio_file_ref)
+
+
+# --- Audio largo (map-reduce por segmentos) ---
+def plan_long_audio(data, threshold_s=None):
+    """Segmentos [(inicio_s, fin_s)] si el audio supera el umbral de audio largo, si no None.
+
+    Requiere ffmpeg para cortar y una duración legible en los encabezados Ogg.
+    """
+    threshold_s = long_audio.LONG_AUDIO_THRESHOLD_S if threshold_s is None else threshold_s
+    if not audio_preprocess.ffmpeg_available():
+        return None
+    with audio_view(data) as view:
+        duration_s = audio_preprocess.ogg_info(view).duration_s
+    if not duration_s or duration_s <= threshold_s:
+        return None
+    return long_audio.plan_segments(duration_s)
+
+
+def process_segments(data, filename, model_name, prompt_text, segments, result=None, max_workers=None,
+                     routing_policy=None):
+    """Procesa cada segmento en paralelo y fusiona sus ``existing-mrs`` en orden.
+
+    Si algún segmento falla se lanza un error (un registro parcial podría omitir
+    diagnósticos o medicinas). En ``result.stage_times`` queda el segmento más
+    lento de cada etapa, que es lo que marca el tiempo total.
+    """
+    with audio_view(data) as view:
+        audio_bytes = bytes(view)  # Cada worker de ffmpeg lee el audio completo
+    total = len(segments)
+    segment_results = [ConsultResult(filename=f"{filename} [{i + 1}/{total}]", model_name=model_name) for i in range(total)]
+
+    def run_segment(index):
+        start_s, end_s = segments[index]
+        segment_result = segment_results[index]
+        # Cada segmento mide en su propio resultado (se combinan al final)
+        metrics.bind(model=model_name, filename=segment_result.filename, times=segment_result.stage_times)
+        with metrics.stage("split"):
+            segment_data = audio_preprocess.extract_segment(audio_bytes, start_s, end_s - start_s)
+        return extract_consult(
+            segment_data, segment_result.filename, model_name,
+            long_audio.segment_prompt(prompt_text, index, total, start_s, end_s), segment_result,
+            routing_policy=routing_policy,
+        )
+
+    workers = min(total, max_workers or long_audio.SEGMENT_MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="citamed-segment") as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run_segment, i) for i in range(total)]
+        parsed_segments, errors = [], []
+        for i, future in enumerate(futures):
+            try:
+                parsed_segments.append(future.result())
+            except Exception as e:
+                errors.append(f"segmento {i + 1}: {type(e).__name__}: {e}")
+    if result is not None:
+        result.segment_count = total
+        for segment_result in segment_results:
+            for stage, seconds in segment_result.stage_times.items():
+                result.stage_times[stage] = max(result.stage_times.get(stage, 0.0), seconds)
+            result.processing_polls += segment_result.processing_polls
+        if routing_policy is not None:
+            # Cada segmento se enruta por separado: se resumen las rutas y modelos usados
+            result.route = "/".join(sorted({r.route for r in segment_results if r.route})) or None
+            result.model_name = "+".join(dict.fromkeys(r.model_name for r in segment_results if r.route)) or model_name
+    if errors:
+        raise RuntimeError(f"Fallaron {len(errors)} de {total} segmentos: " + "; ".join(errors))
+
+    stage_start = time.time()
+    merged = long_audio.merge_results(parsed_segments)
+    if result is not None:
+        result.stage_times["merge"] = time.time() - stage_start
+        result.response_text = json.dumps(merged, ensure_ascii=False)
+    return merged
+
+
+# --- Modo por lotes ---
+@dataclass
+class BatchSummary:
+    """Resumen de throughput y fallos de un lote."""
+    total: int
+    succeeded: int
+    failed: int
+    logged: int
+    cache_hits: int
+    wall_time_s: float
+    failures: list = field(default_factory=list)  # [(filename, error)]
+    preprocess_bytes_saved: int = 0
+    preprocess_time_saved_s: float = 0.0  # Estimado (ver audio_preprocess)
+
+    @property
+    def files_per_minute(self):
+        return (self.succeeded + self.failed) * 60.0 / self.wall_time_s if self.wall_time_s > 0 else 0.0
+
+
+class BatchRun:
+    """Procesa varios archivos en un pool acotado de workers.
+
+    ``files`` es una lista de (nombre, audio), con el audio como bytes o como
+    objeto tipo archivo (se sube directamente desde su buffer).
+
+    Cada archivo avanza por las etapas de forma independiente; ``snapshot()``
+    puede llamarse desde otro hilo (p. ej. el de Streamlit) para pintar el progreso.
+    """
+
+    def __init__(self, files, model_name, prompt_text, max_workers=4, worksheet=None, cache=None, force_reprocess=False,
+                 preprocess=False, segment_long_audio=False, routing_policy=None):
+        self.files = list(files)  # [(filename, bytes u objeto tipo archivo)]
+        self.model_name = model_name
+        self.prompt_text = prompt_text
+        self.max_workers = max(1, int(max_workers))
+        self.worksheet = worksheet
+        self.cache = cache
+        self.force_reprocess = force_reprocess
+        self.preprocess = preprocess
+        self.segment_long_audio = segment_long_audio
+        self.routing_policy = routing_policy
+        self.results = [ConsultResult(filename=name, model_name=model_name) for name, _ in self.files]
+        self._executor = None
+        self._futures = []
+        self._start_time = None
+        self._end_time = None
+
+    def start(self):
+        """Envía todos los archivos al pool y retorna inmediatamente."""
+        self._start_time = time.time()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="citamed-batch")
+        for (name, data), result in zip(self.files, self.results):
+            # Cada archivo conserva la sesión del llamador (turnos del scheduler)
+            self._futures.append(self._executor.submit(
+                contextvars.copy_context().run, process_audio, data, name, self.model_name, self.prompt_text,
+                worksheet=self.worksheet, result=result,
+                cache=self.cache, force_reprocess=self.force_reprocess, preprocess=self.preprocess,
+                segment_long_audio=self.segment_long_audio, routing_policy=self.routing_policy,
+            ))
+        self._executor.shutdown(wait=False)
+        return self
+
+    def done(self):
+        return bool(self._futures) and all(f.done() for f in self._futures)
+
+    def wait(self, timeout=None):
+        """Bloquea hasta que termine el lote (o expire ``timeout``). Devuelve done()."""
+        deadline = None if timeout is None else time.time() + timeout
+        for future in self._futures:
+            remaining = None if deadline is None else max(0.0, deadline - time.time())
+            try:
+                future.result(timeout=remaining)
+            except Exception:
+                break
+        finished = self.done()
+        if finished and self._end_time is None:
+            self._end_time = time.time()
+        return finished
+
+    def snapshot(self):
+        """Filas de la tabla de progreso por archivo."""
+        # Cada worker solo modifica su propio ConsultResult, así que leerlos es seguro
+        return [r.as_row() for r in self.results]
+
+    def summary(self):
+        end_time = self._end_time or time.time()
+        failures = [(r.filename, r.error) for r in self.results if r.status == STATUS_FAILED]
+        succeeded = sum(1 for r in self.results if r.ok)
+        reports = [r.preprocess_report for r in self.results if r.preprocess_report]
+        return BatchSummary(
+            total=len(self.results),
+            succeeded=succeeded,
+            failed=len(failures),
+            logged=sum(1 for r in self.results if r.logged),
+            cache_hits=sum(1 for r in self.results if r.from_cache),
+            wall_time_s=end_time - (self._start_time or end_time),
+            failures=failures,
+            preprocess_bytes_saved=sum(r.bytes_saved for r in reports),
+            preprocess_time_saved_s=sum(r.estimated_time_saved_s for r in reports),
+        )
+
+
+def run_batch(files, model_name, prompt_text, max_workers=4, worksheet=None, cache=None, force_reprocess=False,
+              preprocess=False, segment_long_audio=False, routing_policy=None):
+    """Versión bloqueante de BatchRun: procesa el lote y devuelve (resultados, resumen)."""
+    batch = BatchRun(files, model_name, prompt_text, max_workers=max_workers, worksheet=worksheet,
+                     cache=cache, force_reprocess=force_reprocess, preprocess=preprocess,
+                     segment_long_audio=segment_long_audio, routing_policy=routing_policy).start()
+    batch.wait()
+    return batch.results, batch.summary()
@@ -0,0 +1,241 @@
+"""Caché de contexto de Gemini para el prompt estático.
+
+Las instrucciones y la plantilla JSON de ``prompts.PROMPT_TEXT`` son iguales en
+todas las llamadas. Con la caché activada se suben una vez por modelo como
+``genai.caching.CachedContent`` (con TTL) y cada solicitud envía solo el audio y
+``PROMPT_REFERENCE``. La entrada se renueva al acercarse el vencimiento y se
+recrea cuando cambia el hash del prompt.
+
+Si el modelo no admite caché de contexto (alias ``-latest``, prompt por debajo
+del mínimo de tokens cacheables, SDK sin ``caching``...), se recuerda y ese
+modelo vuelve a enviar el prompt completo. Un error transitorio al crear la
+entrada (429, 503, red) solo la pospone, con backoff exponencial. ``stats`` compara tokens de entrada y
+latencia con y sin caché.
+"""
+import datetime
+import logging
+import threading
+import time
+from collections import deque
+
+import clients
+import config
+from result_cache import prompt_version
+from startup import lazy_import
+
+google_exceptions = lazy_import("google.api_core.exceptions")
+
+logger = logging.getLogger(__name__)
+
+# Lo único que acompaña al audio cuando las instrucciones están en caché
+PROMPT_REFERENCE = "Procesa este audio siguiendo exactamente las instrucciones y la estructura JSON del contexto."
+REFRESH_MARGIN_S = 120  # Se renueva la entrada si vence antes de este margen
+RECENT_SAMPLES = 500  # Latencias recientes por modelo y modo para las medianas
+RETRY_BASE_S = 30.0  # Espera tras un error transitorio al crear la entrada (se duplica en cada fallo)
+RETRY_MAX_S = 900.0
+
+_enabled = config.PROMPT_CACHE_ENABLED
+_ttl_s = config.PROMPT_CACHE_TTL_S
+
+
+def configure(enabled=None, ttl_s=None):
+    """Activa o desactiva la caché para todo el proceso y ajusta el TTL."""
+    global _enabled, _ttl_s
+    if enabled is not None:
+        _enabled = enabled
+    if ttl_s is not None:
+        _ttl_s = ttl_s
+
+
+def enabled():
+    return _enabled
+
+
+class _Entry:
+    def __init__(self, cached_content, version, expires_at):
+        self.cached_content = cached_content
+        self.version = version
+        self.expires_at = expires_at
+        self.model = clients.genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+
+
+class PromptContextCache:
+    """Una entrada ``CachedContent`` por modelo, creada y renovada bajo demanda (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # modelo -> _Entry
+        self._unsupported = {}  # modelo -> motivo
+        self._retry = {}  # modelo -> (fallos consecutivos, no reintentar antes de)
+
+    def model_for(self, model_name, prompt_text):
+        """GenerativeModel ligado al prompt en caché, o None si hay que enviar el prompt completo."""
+        if not _enabled or model_name in self._unsupported:
+            return None
+        failures, retry_at = self._retry.get(model_name, (0, 0.0))
+        if time.time() < retry_at:
+            return None
+        version = prompt_version(prompt_text)
+        with self._lock:  # Una sola creación por modelo aunque lleguen varias consultas a la vez
+            entry = self._entries.get(model_name)
+            now = time.time()
+            if entry is not None and entry.version == version and entry.expires_at - now > REFRESH_MARGIN_S:
+                return entry.model
+            if entry is not None and entry.version == version:
+                entry = self._extend(model_name, entry)
+                if entry is not None:
+                    return entry.model
+            try:
+                entry = self._create(model_name, prompt_text, version)
+            except Exception as e:
+                if _is_permanent_error(e):
+                    self._mark_unsupported(model_name, e)
+                else:
+                    self._back_off(model_name, failures + 1, e)
+                return None
+            self._retry.pop(model_name, None)
+            previous = self._entries.get(model_name)
+            self._entries[model_name] = entry
+        if previous is not None:
+            _delete_quietly(previous.cached_content)  # El prompt cambió: la entrada anterior ya no sirve
+        return entry.model
+
+    def _create(self, model_name, prompt_text, version):
+        start = time.perf_counter()
+        cached_content = clients.genai.caching.CachedContent.create(
+            model=model_name if model_name.startswith("models/") else f"models/{model_name}",
+            display_name=f"citamed-prompt-{version}",
+            contents=[prompt_text],
+            ttl=datetime.timedelta(seconds=_ttl_s),
+        )
+        tokens = getattr(getattr(cached_content, "usage_metadata", None), "total_token_count", None)
+        logger.info("Prompt en caché de contexto para %s (%s tokens, %.2f s, TTL %d s).",
+                    model_name, tokens, time.perf_counter() - start, _ttl_s)
+        return _Entry(cached_content, version, time.time() + _ttl_s)
+
+    def _extend(self, model_name, entry):
+        """Amplía el TTL de la entrada vigente; None si ya venció en el servidor."""
+        try:
+            entry.cached_content.update(ttl=datetime.timedelta(seconds=_ttl_s))
+        except Exception as e:
+            logger.info("No se pudo renovar la caché de %s (%s); se recreará.", model_name, e)
+            self._entries.pop(model_name, None)
+            return None
+        entry.expires_at = time.time() + _ttl_s
+        return entry
+
+    def _mark_unsupported(self, model_name, err):
+        reason = f"{type(err).__name__}: {err}"
+        self._unsupported[model_name] = reason
+        logger.warning("El modelo %s no admite caché de contexto (%s). Se enviará el prompt completo.",
+                       model_name, reason)
+
+    def _back_off(self, model_name, failures, err):
+        delay = min(RETRY_MAX_S, RETRY_BASE_S * 2 ** (failures - 1))
+        self._retry[model_name] = (failures, time.time() + delay)
+        logger.warning("No se pudo crear la caché de contexto para %s (%s: %s). Prompt completo durante %.0f s.",
+                       model_name, type(err).__name__, err, delay)
+
+    def invalidate(self, model_name):
+        """Descarta la entrada de ``model_name`` (p. ej. si el servidor ya no la encuentra)."""
+        with self._lock:
+            self._entries.pop(model_name, None)
+
+    def unsupported(self):
+        return dict(self._unsupported)
+
+    def clear(self):
+        """Borra las entradas del servidor y olvida los modelos sin soporte."""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            self._unsupported.clear()
+            self._retry.clear()
+        for entry in entries:
+            _delete_quietly(entry.cached_content)
+
+
+def _is_permanent_error(err):
+    """True si el modelo no admite la caché: 400 (modelo sin soporte o prompt bajo el mínimo de tokens),
+    404 (modelo desconocido) o un SDK sin ``caching``. 429, 5xx y errores de red son transitorios."""
+    if isinstance(err, (AttributeError, NotImplementedError)):
+        return True
+    return isinstance(err, (google_exceptions.InvalidArgument, google_exceptions.NotFound))
+
+
+def _delete_quietly(cached_content):
+    try:
+        cached_content.delete()
+    except Exception as e:  # Expira sola con el TTL
+        logger.debug("No se pudo borrar la caché de contexto %s: %s", getattr(cached_content, "name", "?"), e)
+
+
+def _median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2] if ordered else 0.0
+
+
+class PromptCacheStats:
+    """Tokens de entrada y latencia de generación por modelo, con y sin caché de contexto."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_key = {}  # (modelo, con_cache) -> {"requests", "input_tokens", "cached_tokens", "latencies"}
+
+    def record(self, model_name, cached, latency_s, response=None):
+        usage = getattr(response, "usage_metadata", None)
+        with self._lock:
+            item = self._by_key.setdefault((model_name, bool(cached)), {
+                "requests": 0, "input_tokens": 0, "cached_tokens": 0, "latencies": deque(maxlen=RECENT_SAMPLES),
+            })
+            item["requests"] += 1
+            item["input_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+            item["cached_tokens"] += getattr(usage, "cached_content_token_count", 0) or 0
+            item["latencies"].append(latency_s)
+
+    def rows(self):
+        """Filas para mostrar en tabla, con el ahorro frente a las llamadas sin caché del mismo modelo."""
+        with self._lock:
+            items = {key: dict(item, latencies=list(item["latencies"])) for key, item in self._by_key.items()}
+        rows = []
+        for (model_name, cached), item in sorted(items.items()):
+            requests = item["requests"]
+            row = {
+                "Modelo": model_name,
+                "Caché de contexto": "Sí" if cached else "No",
+                "Llamadas": requests,
+                "Tokens de entrada (media)": round(item["input_tokens"] / requests),
+                "Tokens enviados (media)": round((item["input_tokens"] - item["cached_tokens"]) / requests),
+                "Tokens desde caché": item["cached_tokens"],
+                "Generación p50 (s)": round(_median(item["latencies"]), 2),
+                "Ahorro p50 (s)": "",
+            }
+            baseline = items.get((model_name, False))
+            if cached and baseline:
+                row["Ahorro p50 (s)"] = round(_median(baseline["latencies"]) - _median(item["latencies"]), 2)
+            rows.append(row)
+        return rows
+
+    def summary(self):
+        """Totales para la CLI y el benchmark."""
+        with self._lock:
+            items = list(self._by_key.items())
+        cached = [item for (_, is_cached), item in items if is_cached]
+        uncached = [item for (_, is_cached), item in items if not is_cached]
+        cached_latencies = [s for item in cached for s in item["latencies"]]
+        uncached_latencies = [s for item in uncached for s in item["latencies"]]
+        return {
+            "cached_requests": sum(item["requests"] for item in cached),
+            "uncached_requests": sum(item["requests"] for item in uncached),
+            "cached_tokens": sum(item["cached_tokens"] for item in cached),
+            "generate_p50_cached_s": round(_median(cached_latencies), 3),
+            "generate_p50_uncached_s": round(_median(uncached_latencies), 3),
+        }
+
+    def reset(self):
+        with self._lock:
+            self._by_key.clear()
+
+
+context = PromptContextCache()
+stats = PromptCacheStats()
@@ -0,0 +1,82 @@
+"""Prompt para Gemini: instrucciones y plantilla JSON de ``existing-mrs``.
+
+Vive en su propio módulo (sin Streamlit) para que la app y la CLI por lotes
+usen exactamente el mismo texto, y por tanto la misma clave de caché.
+"""
+import config
+
+
+prompt_part1 = """
+Por favor, realiza las siguientes tareas con el audio proporcionado:
+1.  **Transcribe** el contenido completo del audio. Mantén la transcripción lo más fiel posible al audio original, sin resumir. Puedes añadir mínimas palabras de conexión si mejora mucho la legibilidad, pero prioriza la fidelidad absoluta.
+2.  **Clasifica** la información extraída de la transcripción en un formato JSON **válido**.
+3.  **Utiliza exactamente la siguiente estructura JSON** como plantilla. Rellena los campos con la información correspondiente extraída del audio.
+
+**Estructura JSON requerida (salida SÓLO JSON):**
+"""
+json_structure_example = '''
+```json
+{
+    "status": "OK",
+    "message": "SUCCESS",
+    "data": {
+        "existing-mrs": {
+            "MotivoConsulta": "EXTRAER_EL_MOTIVO_PRINCIPAL_DE_LA_CONSULTA_O_LLAMADA",
+            "EnfermedadActual": "EXTRAER_LA_DESCRIPCION_DE_LA_ENFERMEDAD_ACTUAL_O_SINTOMAS_PRINCIPALES",
+            "Antecedentes": "EXTRAER_ANTECEDENTES_PERSONALES_PATOLOGICOS_Y_NO_PATOLOGICOS_DEL_PACIENTE",
+            "ExamenFisico": "EXTRAER_HALLAZGOS_DETALLADOS_DEL_EXAMEN_FISICO_DESCRITO_EN_EL_AUDIO",
+            "DiasReposo": "EXTRAER_SI_SE_INDICA_DIAS_DE_REPOSO_PARA_LA_CONSULTA",
+            "SignosVitales": {
+                "FC": "EXTRAER_FRECUENCIA_CARDIACA_(pulsaciones_por_minuto)",
+                "IMC": "EXTRAER_INDICE_DE_MASA_CORPORAL_SOLO_SI_SE_MENCIONA_(no_calcularlo)",
+                "Size": "EXTRAER_ESTATURA_DEL_PACIENTE_(en_metros)",
+                "TAD": "EXTRAER_TENSION_ARTERIAL_DIASTOLICA_(mmHg)",
+                "TAS": "EXTRAER_TENSION_ARTERIAL_SISTOLICA_(mmHg)",
+                "PESO": "EXTRAER_PESO_DEL_PACIENTE_(en_kg)"
+            },
+            "Examenes": [
+                // Añadir objetos aquí por cada examen mencionado
+                // Ejemplo: { "Name": "NOMBRE_EXAMEN_O_ESTUDIO_SOLICITADO", "Resultado": "EXTRAE_CUANDO_EN_EL_AUDIO_LO_MUESTRA","UnidadMedida": "BUSCA_LA_UNIDAD_DEL_VALOR" }
+            ],
+            "Diagnosticos": [
+                // Añadir objetos aquí por cada diagnóstico/patología mencionado que tiene el paciente, no excluir ninguno de estos
+                // Ejemplo: { "ID": "CODIGO_CIE_10", "Nombre": "NOMBRE_DIAGNOSTICO_MENCIONADO_DEL_PACIENTE" }
+            ],
+            "Medicinas": [
+                // Añadir objetos aquí por cada medicamento mencionado que se haya administrado al paciente
+                // Ejemplo: { "Nombre": "NOMBRE_COMERCIAL", "Presentacion": "FORMA", "Dosis": "DOSIS_Y_FRECUENCIA" }
+            ],
+            "PlanDeAccion": [
+                // EXTRAER_CUALQUIER_INSTRUCCION_QUE_EL_MEDICO_INCLUYA_O_COMENTARIOS_NO_CLASIFICABLES_EN_EL_RESTO_DE_CATEGORIA
+                //Añadir objetos aqui, donde el texto sea una instruccion y
+                //Ejemplo: { "NUMERO_CONSECUTIVO": "INSTRUCCION_OBTENIDA" }
+            ],
+            "ComentariosModelo": "INCLUIR_CUALQUIER_OBSERVACION_DE_PROBLEMAS_QUE_HAYAS_ENCONTRADO_EN_LA_TAREA",
+            "Literal": "AQUI_VA_LA_TRANSCRIPCION_COMPLETA_Y_FIEL_DEL_AUDIO._Incluir_observaciones_adicionales_si_no_encajan_en_otros_campos."
+        }
+    }
+}
+'''
+# Instrucción del código CIE-10; con CITAMED_CIE10_FROM_MODEL=0 el código lo asigna cie10.py (solo con la tabla completa)
+cie10_model_instruction = """Para Diagnosticos, es necesario que busque el CIED_10 al que corresponde e incluyas en el atributo ID
+"""
+cie10_local_instruction = """Para Diagnosticos, deja el atributo ID como cadena vacía "": el código CIE-10 se asigna después con una tabla local.
+"""
+prompt_part3_final_instructions = """
+Instrucciones IMPORTANTES para el formato de salida:
+No incluyas texto explicativo, saludos, respeta las categorias y la forma en que se desglozan en el ejemplo.
+{cie10_instruction}Presta atencion durante el audio el transcurao del audio se mencionan varios diagnosticos/patologias del paciente.
+Si encuentras en el audio algun examen de laboratorio con el valor que le corresponde al resultado, busca el simbolo o la unidad de medida que corresponde
+En los examenes es necesario identificar si son examenes ya con resultado por el paciente o si son examenes solictados
+El campo LITERAL es crucial: debe contener la transcripción LITERAL del audio. Escríbelo al final, después de todos los demás campos, respetando el orden de la plantilla.
+El campo MOTIVO_CONSULTA es importante: debe contener las razones porque el paciente asiste a consulta, no excluyas el preambulo que incluye el medico a las razones.
+Presta atención a los tipos de datos esperados (números para signos vitales, cadenas para descripciones, listas para exámenes/diagnósticos/medicamentos).
+Si una pieza específica de información (ej. Signos Vitales - FC) no se menciona explícitamente en el audio, utiliza la cadena NO_ENCONTRADO
+Si no se mencionan Examenes, Diagnosticoss o Medicinas, deja las listas correspondientes vacías: [].
+"""
+
+prompt_part3_final_instructions = prompt_part3_final_instructions.format(
+    cie10_instruction=cie10_model_instruction if config.CIE10_FROM_MODEL else cie10_local_instruction
+)
+
+PROMPT_TEXT = prompt_part1 + json_structure_example + prompt_part3_final_instructions
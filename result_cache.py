@@ -0,0 +1,194 @@
+"""Caché local de resultados, direccionada por contenido.
+
+La clave combina el SHA-256 del audio, el nombre del modelo y el hash del
+prompt, de modo que volver a subir el mismo .ogg (p. ej. tras refrescar el
+navegador) no repite la subida ni la generación. Cada entrada es un archivo
+JSON en disco; el tamaño total está acotado con expulsión LRU y cada entrada
+expira tras un TTL. El TTL se cuenta desde ``stored_at`` (guardado al inicio
+de cada archivo); el mtime solo ordena la LRU, porque ``get`` lo renueva en
+cada acierto.
+
+``stats()`` no toca el disco (la app lo muestra en cada rerun): el número de
+entradas y los bytes se leen del directorio al crear la caché y se actualizan
+en cada ``put`` (que ya recorre el directorio para expulsar) y en cada
+expiración. Con varios procesos sobre el mismo directorio son aproximados
+hasta el siguiente ``put``.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+STORED_AT_HEAD_BYTES = 64  # put() escribe "stored_at" primero: basta leer el inicio del archivo
+_STORED_AT_RE = re.compile(rb'^\{"stored_at":\s*([0-9.eE+-]+)')
+
+
+def audio_hash(data):
+    """SHA-256 hexadecimal de los bytes del audio."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def prompt_version(prompt_text):
+    """Versión corta del prompt: cambia cuando cambia cualquier carácter del texto."""
+    return hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:16]
+
+
+def make_key(data, model_name, prompt_text, variant=""):
+    """Clave de caché para (audio, modelo, prompt). ``variant`` distingue opciones
+    que cambian el resultado (p. ej. el preprocesamiento del audio)."""
+    raw = f"{audio_hash(data)}|{model_name}|{prompt_version(prompt_text)}"
+    if variant:
+        raw += f"|{variant}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Caché en disco de JSON parseados con LRU por tamaño y TTL."""
+
+    def __init__(self, directory=None, max_bytes=None, ttl_s=None):
+        self.directory = directory or config.data_path("result_cache")
+        self.max_bytes = max_bytes if max_bytes is not None else config.RESULT_CACHE_MAX_BYTES
+        self.ttl_s = ttl_s if ttl_s is not None else config.RESULT_CACHE_TTL_S
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._stored_at = {}  # Ruta -> stored_at, para no releer el archivo en cada expulsión
+        os.makedirs(self.directory, exist_ok=True)
+        self._set_usage(self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """JSON cacheado para ``key`` o None. Marca la entrada como usada (LRU)."""
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    entry = json.load(f)
+                    size = os.fstat(f.fileno()).st_size
+                if time.time() - entry.get("stored_at", 0) > self.ttl_s:
+                    os.remove(path)
+                    self._stored_at.pop(path, None)
+                    self._entry_count -= 1
+                    self._total_bytes -= size
+                    raise FileNotFoundError(path)
+                os.utime(path)  # El mtime funciona como "último acceso" para la LRU
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["parsed_json"]
+
+    def put(self, key, parsed_json, **meta):
+        """Guarda el JSON de forma atómica y aplica la política de expulsión."""
+        entry = {"stored_at": time.time(), "parsed_json": parsed_json, **meta}
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(entry, f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(tmp_path, path)
+                self._stored_at[path] = entry["stored_at"]
+            except OSError as e:
+                logger.warning("No se pudo guardar el resultado en la caché: %s", e)
+                return
+            self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _set_usage(self, entries):
+        self._entry_count = len(entries)
+        self._total_bytes = sum(size for _, size, _ in entries)
+
+    def _read_stored_at(self, path, mtime):
+        """``stored_at`` de una entrada; el mtime nunca es anterior, así que sirve de cota."""
+        if time.time() - mtime > self.ttl_s:
+            return mtime  # Ni el último acceso está dentro del TTL: expirada sin leer el archivo
+        stored_at = self._stored_at.get(path)
+        if stored_at is None:
+            try:
+                with open(path, "rb") as f:
+                    head = f.read(STORED_AT_HEAD_BYTES)
+                    match = _STORED_AT_RE.match(head)
+                    if match:
+                        stored_at = float(match.group(1))
+                    else:  # Escrita con otro orden de claves: se lee entera
+                        stored_at = json.loads(head + f.read()).get("stored_at", 0)
+            except (OSError, ValueError):
+                return 0  # Ilegible: se trata como expirada
+            self._stored_at[path] = stored_at
+        return stored_at
+
+    def _evict(self):
+        """Borra entradas expiradas (por ``stored_at``) y, si se excede ``max_bytes``, las menos usadas (por mtime)."""
+        now = time.time()
+        entries = sorted(self._entries())  # Menos usadas primero
+        total = sum(size for _, size, _ in entries)
+        kept = []
+        for entry in entries:
+            mtime, size, path = entry
+            if total <= self.max_bytes and now - self._read_stored_at(path, mtime) <= self.ttl_s:
+                kept.append(entry)
+                continue
+            try:
+                os.remove(path)
+                self._stored_at.pop(path, None)
+                total -= size
+            except OSError:
+                kept.append(entry)
+        self._set_usage(kept)
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._stored_at.clear()
+            self._set_usage(self._entries())
+
+    def stats(self):
+        """Contadores de aciertos/fallos y ocupación (en memoria, sin leer el directorio)."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": self._entry_count,
+                "bytes": self._total_bytes,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """Caché compartida por todo el proceso (los contadores son globales)."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
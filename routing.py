@@ -0,0 +1,125 @@
+"""Enrutamiento entre modelos: modelo rápido primero, escalado y solicitudes de cobertura.
+
+Cada consulta empieza en un modelo rápido (flash). Solo se escala a un modelo
+más capaz (pro) cuando la respuesta del primero no es JSON válido o deja como
+``NO_ENCONTRADO`` alguno de los campos obligatorios de ``existing-mrs``.
+Opcionalmente, si el primer modelo no ha respondido tras ``hedge_after_s``, se
+lanza una segunda solicitud de cobertura (hedge) y se toma la primera respuesta
+válida que llegue.
+
+Aquí viven la política y las estadísticas por ruta; la ejecución (sobre el
+archivo ya subido) está en ``pipeline.generate_routed``.
+"""
+import threading
+from collections import deque
+from dataclasses import dataclass
+
+DEFAULT_PRIMARY_MODEL = "gemini-1.5-flash-latest"
+DEFAULT_ESCALATION_MODEL = "gemini-1.5-pro-latest"
+# Campos de existing-mrs sin los cuales el registro no sirve
+DEFAULT_REQUIRED_FIELDS = ("MotivoConsulta", "EnfermedadActual", "Diagnosticos")
+NOT_FOUND = "NO_ENCONTRADO"
+RECENT_SAMPLES = 500  # Latencias recientes por ruta para los percentiles
+
+# Rutas posibles
+ROUTE_DIRECT = "directa"  # El modelo rápido respondió bien
+ROUTE_ESCALATED = "escalada"  # El modelo rápido falló o dejó campos vacíos
+ROUTE_HEDGED = "cobertura"  # Ganó la solicitud lanzada tras el umbral de latencia
+
+
+@dataclass(frozen=True)
+class RoutingPolicy:
+    """Modelos y umbrales del enrutamiento. ``hedge_after_s=None`` desactiva la cobertura."""
+    primary_model: str = DEFAULT_PRIMARY_MODEL
+    escalation_model: str | None = DEFAULT_ESCALATION_MODEL
+    required_fields: tuple = DEFAULT_REQUIRED_FIELDS
+    hedge_after_s: float | None = None
+    hedge_model: str | None = None  # Por defecto, el modelo de escalado
+
+    @property
+    def hedge_target(self):
+        if not self.hedge_after_s:
+            return None
+        return self.hedge_model or self.escalation_model
+
+    def cache_variant(self):
+        """Parte de la clave de caché: el resultado depende de los modelos de la ruta."""
+        models = [self.primary_model, self.escalation_model or "", self.hedge_target or ""]
+        return "ruta=" + ">".join(models) + "|" + ",".join(self.required_fields)
+
+
+def missing_required_fields(parsed_json, required_fields=DEFAULT_REQUIRED_FIELDS):
+    """Campos obligatorios de ``existing-mrs`` ausentes, vacíos o ``NO_ENCONTRADO``."""
+    data = parsed_json.get("data") if isinstance(parsed_json, dict) else None
+    existing_mrs = data.get("existing-mrs") if isinstance(data, dict) else None
+    if not isinstance(existing_mrs, dict):
+        return list(required_fields)
+    missing = []
+    for name in required_fields:
+        value = existing_mrs.get(name)
+        if isinstance(value, str):
+            value = value.strip()
+            if value.upper() == NOT_FOUND:
+                value = ""
+        elif isinstance(value, list):
+            # Listas de dicts (p. ej. Diagnosticos): vacías si ningún elemento tiene datos
+            value = [item for item in value if item not in (None, "", NOT_FOUND, {})
+                     and not (isinstance(item, dict) and all(v in (None, "", NOT_FOUND) for v in item.values()))]
+        if not value:
+            missing.append(name)
+    return missing
+
+
+@dataclass
+class RouteOutcome:
+    """Ruta que tomó una consulta."""
+    route: str
+    model_name: str  # Modelo cuya respuesta se usó
+    attempts: tuple  # Modelos consultados, en orden de lanzamiento
+    latency_s: float
+    reason: str | None = None  # Motivo del escalado, si lo hubo
+
+    def summary(self):
+        chain = " → ".join(self.attempts)
+        reason = f" ({self.reason})" if self.reason else ""
+        return f"Ruta {self.route}: {chain}, respuesta de {self.model_name} en {self.latency_s:.2f} s{reason}"
+
+
+def _quantile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class RouteStats:
+    """Conteo y latencias (p50/p95) por ruta y modelo final, thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_route = {}
+
+    def record(self, outcome):
+        with self._lock:
+            latencies = self._by_route.setdefault((outcome.route, outcome.model_name), deque(maxlen=RECENT_SAMPLES))
+            latencies.append(outcome.latency_s)
+
+    def rows(self):
+        """Filas para mostrar en tabla."""
+        with self._lock:
+            items = [(key, sorted(latencies)) for key, latencies in self._by_route.items()]
+        total = sum(len(latencies) for _, latencies in items)
+        order = {ROUTE_DIRECT: 0, ROUTE_HEDGED: 1, ROUTE_ESCALATED: 2}
+        rows = []
+        for (route, model_name), latencies in sorted(items, key=lambda item: (order.get(item[0][0], 3), item[0][1])):
+            rows.append({
+                "Ruta": route,
+                "Modelo final": model_name,
+                "Consultas": len(latencies),
+                "Proporción": round(len(latencies) / total, 3) if total else 0.0,
+                "p50 (s)": round(_quantile(latencies, 0.50), 2),
+                "p95 (s)": round(_quantile(latencies, 0.95), 2),
+            })
+        return rows
+
+
+route_stats = RouteStats()
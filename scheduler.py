@@ -0,0 +1,337 @@
+"""Planificador de llamadas a las APIs de Gemini y Google Sheets, compartido por el proceso.
+
+Todas las sesiones de Streamlit viven en el mismo proceso y consumen la misma
+cuota. Cada ``generate_content`` y cada escritura en la hoja pasa por el
+``ApiScheduler`` de su API, que:
+
+* limita solicitudes y tokens por minuto con cubetas de tokens (token bucket);
+* atiende a las sesiones por turnos: un lote de 20 audios de una sesión no deja
+  esperando a otra que procesa un solo archivo;
+* reintenta los 429/503 con backoff exponencial, respetando ``Retry-After`` o el
+  ``retry_delay`` que indique el servidor; un 429 frena a toda la API mientras dure;
+* informa la posición en la cola (``on_wait``) para mostrarla en lugar de fallar.
+
+Los límites se ajustan con ``CITAMED_GEMINI_RPM``, ``CITAMED_GEMINI_TPM`` y
+``CITAMED_SHEETS_RPM``; ``configure()`` los reemplaza en tiempo de ejecución
+(p. ej. en bench.py contra fakes.FakeGenAI con ``quota_rpm``).
+"""
+import contextvars
+import email.utils
+import itertools
+import logging
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+import config
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = (429, 503)
+MAX_RETRIES = 5
+BACKOFF_BASE_S = 1.0
+BACKOFF_MAX_S = 60.0
+DEFAULT_SESSION = "proceso"
+# Estimación de tokens de una consulta antes de conocer el uso real
+AUDIO_TOKENS_PER_S = 32  # Gemini cuenta 32 tokens por segundo de audio
+AUDIO_BYTES_PER_S = 4000  # ~32 kbit/s, típico de las notas de voz Opus
+EXPECTED_OUTPUT_TOKENS = 2048
+
+_session = contextvars.ContextVar("citamed_session", default=DEFAULT_SESSION)
+
+
+def bind_session(session_id):
+    """Asocia las llamadas de este hilo/contexto a una sesión (para el reparto por turnos)."""
+    _session.set(session_id or DEFAULT_SESSION)
+
+
+def current_session():
+    return _session.get()
+
+
+def estimate_generate_tokens(prompt_text, audio_bytes):
+    """Tokens estimados de una llamada a generate_content (prompt + audio + respuesta)."""
+    audio_s = (audio_bytes or 0) / AUDIO_BYTES_PER_S
+    return len(prompt_text) // 4 + int(audio_s * AUDIO_TOKENS_PER_S) + EXPECTED_OUTPUT_TOKENS
+
+
+def response_tokens(response):
+    """Tokens reales de una respuesta de Gemini (None si el SDK no los informa)."""
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) or None
+
+
+def error_status(err):
+    """Código HTTP de un error de Gemini (api_core) o de gspread (compatible con gspread 5 y 6)."""
+    code = getattr(err, "code", None)
+    if isinstance(code, int):
+        return int(code)
+    return getattr(getattr(err, "response", None), "status_code", None)
+
+
+_RETRY_DELAY_RE = re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)")
+
+
+def retry_after_s(err):
+    """Espera sugerida por el servidor: cabecera Retry-After, RetryInfo o texto del error."""
+    headers = getattr(getattr(err, "response", None), "headers", None)
+    value = headers.get("Retry-After") if hasattr(headers, "get") else None
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:  # Retry-After también puede ser una fecha HTTP
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    for detail in getattr(err, "details", None) or ():
+        delay = getattr(detail, "retry_delay", None)  # google.rpc.RetryInfo
+        if delay is not None:
+            return getattr(delay, "seconds", 0) + getattr(delay, "nanos", 0) / 1e9
+        if isinstance(detail, dict) and detail.get("retryDelay"):
+            try:
+                return float(str(detail["retryDelay"]).rstrip("s"))
+            except ValueError:
+                pass
+    match = _RETRY_DELAY_RE.search(str(err))
+    return float(match.group(1)) if match else None
+
+
+class QueueTimeout(TimeoutError):
+    """La solicitud esperó en la cola más de lo permitido."""
+
+
+class TokenBucket:
+    """Cubeta de tokens: ``rate_per_minute`` de reposición y ráfaga de hasta ``capacity``.
+
+    No es thread-safe por sí misma; la protege el lock del ApiScheduler.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None, clock=time.monotonic):
+        self.rate_per_s = rate_per_minute / 60.0
+        self.capacity = float(capacity or rate_per_minute)
+        self.level = self.capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate_per_s)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """Segundos hasta poder tomar ``amount`` (0 si ya se puede)."""
+        self._refill()
+        needed = min(amount, self.capacity)  # Una solicitud mayor que la ráfaga pasa con la cubeta llena
+        return 0.0 if self.level >= needed else (needed - self.level) / self.rate_per_s
+
+    def take(self, amount):
+        self._refill()
+        self.level -= amount  # Puede quedar en negativo: la deuda retrasa a los siguientes
+
+    def adjust(self, delta):
+        """Corrige lo tomado con el uso real (positivo = se consumió más de lo estimado)."""
+        self._refill()
+        self.level = min(self.capacity, self.level - delta)
+
+
+@dataclass
+class _Ticket:
+    session: str
+    round: int
+    seq: int
+    tokens: int
+
+
+@dataclass
+class SchedulerStats:
+    granted: int = 0
+    waited: int = 0  # Solicitudes que tuvieron que esperar turno o cuota
+    wait_s_total: float = 0.0
+    max_wait_s: float = 0.0
+    throttled: int = 0  # Respuestas 429
+    unavailable: int = 0  # Respuestas 503
+    retries: int = 0
+    queue_timeouts: int = 0
+
+
+class ApiScheduler:
+    """Cola justa por sesión con límites de solicitudes y tokens por minuto para una API.
+
+    El orden es por turnos: cada solicitud recibe el turno siguiente al último
+    de su sesión (o el turno en curso, si la sesión estaba inactiva), y se
+    atiende por (turno, llegada).
+    """
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute=None, max_retries=MAX_RETRIES,
+                 queue_timeout_s=None, clock=time.monotonic):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute, clock=clock)
+        self.tokens = TokenBucket(tokens_per_minute, clock=clock) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.queue_timeout_s = queue_timeout_s or config.API_QUEUE_TIMEOUT_S
+        self.stats = SchedulerStats()
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._session_round = {}  # sesión -> último turno asignado
+        self._round = 0  # Turno de la última solicitud atendida
+        self._seq = itertools.count()
+        self._paused_until = 0.0  # Pausa de toda la API tras un 429
+
+    def _wait_for_budget(self, tokens):
+        now = self._clock()
+        wait_s = max(self._paused_until - now, self.requests.wait_time(1))
+        if self.tokens is not None:
+            wait_s = max(wait_s, self.tokens.wait_time(tokens))
+        return wait_s
+
+    def acquire(self, tokens=1, session=None, on_wait=None):
+        """Espera turno y cuota. Devuelve los tokens tomados (para ``settle``).
+
+        ``on_wait(posición, espera_s)`` se invoca cuando cambia la posición en la
+        cola (1 = siguiente, esperando cuota) y con posición 0 al obtener turno
+        tras haber esperado. Se llama sin el lock del planificador, así que puede
+        actualizar la interfaz o escribir en disco sin frenar a otras sesiones.
+        """
+        session = session or current_session()
+        start = self._clock()
+        deadline = start + self.queue_timeout_s
+        with self._cond:
+            ticket_round = max(self._session_round.get(session, -1) + 1, self._round)
+            self._session_round[session] = ticket_round
+            ticket = _Ticket(session, ticket_round, next(self._seq), tokens)
+            self._waiting.append(ticket)
+            last_position = None
+            try:
+                while True:
+                    position = 1 + sum(1 for t in self._waiting if (t.round, t.seq) < (ticket.round, ticket.seq))
+                    wait_s = self._wait_for_budget(tokens) if position == 1 else None
+                    if wait_s is not None and wait_s <= 0:
+                        break
+                    if on_wait and position != last_position:
+                        last_position = position
+                        self._cond.release()  # El callback corre fuera del lock; luego se recalcula la posición
+                        try:
+                            on_wait(position, wait_s)
+                        finally:
+                            self._cond.acquire()
+                        continue
+                    last_position = position
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        self.stats.queue_timeouts += 1
+                        raise QueueTimeout(f"{self.name}: más de {self.queue_timeout_s:.0f} s esperando cuota "
+                                           f"(posición {position} en la cola)")
+                    self._cond.wait(timeout=min(wait_s, remaining) if wait_s else remaining)
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+            self._round = ticket.round
+            self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            waited_s = self._clock() - start
+            self.stats.granted += 1
+            if last_position is not None:
+                self.stats.waited += 1
+                self.stats.wait_s_total += waited_s
+                self.stats.max_wait_s = max(self.stats.max_wait_s, waited_s)
+        if on_wait and last_position is not None:
+            on_wait(0, 0.0)
+        return tokens
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Corrige la cubeta de tokens con el uso real informado por la API."""
+        if self.tokens is None or actual_tokens is None:
+            return
+        with self._cond:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+            self._cond.notify_all()
+
+    def backoff_delay(self, attempt, hint_s=None):
+        """Backoff exponencial con jitter; nunca menor que la espera pedida por el servidor."""
+        delay = min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+        return max(delay, hint_s or 0.0)
+
+    def pause(self, seconds):
+        """Detiene todas las solicitudes de esta API durante ``seconds``."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+    def call(self, fn, tokens=1, session=None, on_wait=None, usage=None, span=None):
+        """Ejecuta ``fn()`` con turno y cuota, reintentando los 429/503.
+
+        ``usage(resultado)`` devuelve los tokens reales para corregir la
+        estimación. Los reintentos se suman a ``span["retries"]`` (metrics.stage).
+
+        Solo se reintentan los errores que lanza ``fn()``. Con ``stream=True`` el
+        SDK pide el primer fragmento dentro de ``generate_content``, así que un
+        429/503 antes del primer fragmento sí se reintenta. Un error al iterar
+        los fragmentos siguientes llega al llamador sin reintento: la salida ya
+        se mostró en parte y repetirla duplicaría la cuota.
+        """
+        attempt = 0
+        while True:
+            taken = self.acquire(tokens, session, on_wait)
+            try:
+                result = fn()
+            except Exception as e:
+                status = error_status(e)
+                if status not in RETRYABLE_STATUSES or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                delay = self.backoff_delay(attempt, retry_after_s(e))
+                with self._cond:
+                    self.stats.retries += 1
+                    if status == 429:
+                        self.stats.throttled += 1
+                    else:
+                        self.stats.unavailable += 1
+                if span is not None:
+                    span["retries"] = span.get("retries", 0) + 1
+                logger.warning("%s: respuesta %s (%s). Reintento %d/%d en %.1f s.",
+                               self.name, status, e, attempt, self.max_retries, delay)
+                if status == 429:
+                    self.pause(delay)  # La cuota es compartida: frena a todas las sesiones
+                else:
+                    time.sleep(delay)
+                continue
+            if usage is not None:
+                self.settle(taken, usage(result))
+            return result
+
+    def snapshot(self):
+        """Estado para mostrar en la interfaz."""
+        with self._cond:
+            paused_s = max(0.0, self._paused_until - self._clock())
+            stats = self.stats
+            return {
+                "API": self.name,
+                "En cola": len(self._waiting),
+                "Atendidas": stats.granted,
+                "Esperaron": stats.waited,
+                "Espera media (s)": round(stats.wait_s_total / stats.waited, 2) if stats.waited else 0.0,
+                "Espera máx. (s)": round(stats.max_wait_s, 2),
+                "429": stats.throttled,
+                "503": stats.unavailable,
+                "Reintentos": stats.retries,
+                "Pausada (s)": round(paused_s, 1),
+            }
+
+
+gemini = ApiScheduler("gemini", config.GEMINI_RPM, config.GEMINI_TPM)
+sheets = ApiScheduler("sheets", config.SHEETS_RPM)
+
+
+def configure(gemini_rpm=None, gemini_tpm=None, sheets_rpm=None, **kwargs):
+    """Reemplaza los planificadores con otros límites (benchmarks y pruebas)."""
+    global gemini, sheets
+    gemini = ApiScheduler("gemini", gemini_rpm or config.GEMINI_RPM, gemini_tpm or config.GEMINI_TPM, **kwargs)
+    sheets = ApiScheduler("sheets", sheets_rpm or config.SHEETS_RPM, **kwargs)
+
+
+def rows():
+    return [gemini.snapshot(), sheets.snapshot()]
@@ -0,0 +1,285 @@
+"""Escritor de registros para Google Sheets con cola local durable (SQLite).
+
+Cada fila del log se guarda primero en un archivo SQLite local y un hilo en
+segundo plano la envía a la hoja con ``append_rows`` en lotes, reintentando con
+backoff exponencial ante 429/5xx o errores de red. Si Google no está disponible
+las filas siguen en la cola y se envían cuando el servicio vuelve.
+
+La app, la CLI y cada worker tienen su propio flusher sobre la misma cola:
+``peek`` reserva el lote (``claimed_by``/``claimed_at``, dentro de ``BEGIN
+IMMEDIATE``) para que dos flushers no envíen las mismas filas. Una reserva
+vence a los ``CLAIM_LEASE_S`` o al fallar el envío.
+
+La entrega es "al menos una vez": si el proceso muere entre ``append_rows`` y el
+borrado local, el lote se reenviará cuando venza su reserva.
+"""
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+import clients
+import config
+import metrics
+from startup import lazy_import
+
+# Solo se cargan si hay que clasificar un error (ver startup.py)
+gspread = lazy_import("gspread")
+requests = lazy_import("requests")
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_PATH = "sheets_spool.sqlite3"  # Relativo a config.DATA_DIR
+FLUSH_BATCH_SIZE = 50  # Filas por llamada a append_rows
+FLUSH_INTERVAL_S = 2.0  # Espera entre vaciados cuando no hay errores
+BACKOFF_BASE_S = 2.0
+BACKOFF_MAX_S = 300.0
+# Reserva de un lote: cubre la espera en scheduler.sheets y la llamada a append_rows
+CLAIM_LEASE_S = config.API_QUEUE_TIMEOUT_S + 120.0
+
+
+def is_retryable_error(err):
+    """True si el error es transitorio (429, 5xx o fallo de red)."""
+    if isinstance(err, gspread.exceptions.APIError):
+        status = clients.api_error_status(err)
+        return status == 429 or (status is not None and status >= 500)
+    return isinstance(err, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, TimeoutError))
+
+
+class SheetsSpool:
+    """Cola durable de filas pendientes de escribir en la hoja."""
+
+    def __init__(self, path=None):
+        self.path = path or config.data_path(DEFAULT_SPOOL_PATH)
+        self.owner = uuid.uuid4().hex  # Identifica las reservas de este proceso
+        self._lock = threading.Lock()
+        # timeout: otro proceso puede tener la base bloqueada durante una reserva
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")  # La fila debe sobrevivir a un corte
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending_rows ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " row_json TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT,"
+            " claimed_by TEXT,"
+            " claimed_at REAL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(pending_rows)")}
+        for column, column_type in (("claimed_by", "TEXT"), ("claimed_at", "REAL")):  # Colas creadas antes de las reservas
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE pending_rows ADD COLUMN {column} {column_type}")
+
+    def enqueue(self, row_data):
+        """Guarda la fila de forma durable y devuelve su id en la cola."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO pending_rows (row_json, created_at) VALUES (?, ?)",
+                (json.dumps(row_data, ensure_ascii=False), time.time()),
+            )
+            return cursor.lastrowid
+
+    def peek(self, limit, lease_s=CLAIM_LEASE_S):
+        """Reserva y devuelve las primeras ``limit`` filas libres (o con la reserva vencida): [(id, fila)].
+
+        La reserva es atómica entre procesos: otro flusher no recibe estas
+        filas hasta que se borren, falle su envío o pasen ``lease_s``.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, row_json FROM pending_rows WHERE claimed_by IS NULL OR claimed_at < ?"
+                    " ORDER BY id LIMIT ?", (now - lease_s, limit)
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE pending_rows SET claimed_by = ?, claimed_at = ? WHERE id = ?",
+                    [(self.owner, now, row_id) for row_id, _ in rows],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [(row_id, json.loads(row_json)) for row_id, row_json in rows]
+
+    def remove(self, ids):
+        with self._lock:
+            self._conn.executemany("DELETE FROM pending_rows WHERE id = ?", [(i,) for i in ids])
+
+    def record_failure(self, ids, error):
+        """Anota el intento fallido y libera la reserva para el siguiente vaciado."""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE pending_rows SET attempts = attempts + 1, last_error = ?, claimed_by = NULL, claimed_at = NULL"
+                " WHERE id = ? AND claimed_by = ?",
+                [(str(error)[:500], i, self.owner) for i in ids],
+            )
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM pending_rows").fetchone()[0]
+
+    def flush_batch(self, worksheet, batch_size=FLUSH_BATCH_SIZE):
+        """Envía un lote con ``append_rows`` y lo borra de la cola. Devuelve filas enviadas.
+
+        Los errores se propagan; las filas quedan en la cola con el intento anotado.
+        """
+        batch = self.peek(batch_size)
+        if not batch:
+            return 0
+        ids = [row_id for row_id, _ in batch]
+        try:
+            with metrics.stage("sheets_flush", rows=len(ids)):
+                worksheet.append_rows([row for _, row in batch], value_input_option='USER_ENTERED')
+        except Exception as e:
+            self.record_failure(ids, e)
+            raise
+        self.remove(ids)
+        return len(ids)
+
+
+class SpoolFlusher(threading.Thread):
+    """Hilo que vacía la cola hacia la hoja, con backoff ante errores."""
+
+    def __init__(self, spool, worksheet_factory, batch_size=FLUSH_BATCH_SIZE, interval=FLUSH_INTERVAL_S):
+        super().__init__(name="citamed-sheets-flusher", daemon=True)
+        self.spool = spool
+        # Callable que devuelve un objeto con append_rows (hoja real o fake) o None
+        self.worksheet_factory = worksheet_factory
+        self.batch_size = batch_size
+        self.interval = interval
+        self.rows_sent = 0
+        self.api_calls = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.last_flush_at = None
+        # Filas en la cola según el último recuento del hilo (la app lo muestra sin consultar la base)
+        self.pending_rows = 0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def wake(self):
+        """Pide un vaciado inmediato (p. ej. justo después de encolar)."""
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wake.set()
+        self.join(timeout)
+
+    def backoff_delay(self):
+        """Backoff exponencial con jitter según los fallos consecutivos."""
+        delay = min(BACKOFF_MAX_S, BACKOFF_BASE_S * (2 ** max(0, self.consecutive_failures - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def flush_pending(self):
+        """Envía todo lo pendiente en lotes. Devuelve filas enviadas (propaga errores)."""
+        worksheet = self.worksheet_factory()
+        if worksheet is None:
+            raise RuntimeError("No hay hoja de log disponible.")
+        sent = 0
+        while not self._stopping.is_set():
+            n = self.spool.flush_batch(worksheet, self.batch_size)
+            if not n:
+                break
+            self.api_calls += 1
+            sent += n
+            self.rows_sent += n
+        self.last_flush_at = time.time()
+        return sent
+
+    def run(self):
+        delay = 0.0
+        while not self._stopping.is_set():
+            if delay:
+                # Durante el backoff se ignoran los wake() para no insistir sobre la API
+                self._stopping.wait(delay)
+            else:
+                self._wake.wait(timeout=self.interval)
+            self._wake.clear()
+            self.pending_rows = self.spool.pending_count()
+            if self._stopping.is_set() or not self.pending_rows:
+                delay = 0.0
+                continue
+            try:
+                self.flush_pending()
+                self.pending_rows = self.spool.pending_count()
+                self.consecutive_failures = 0
+                self.last_error = None
+                delay = 0.0
+            except Exception as e:
+                self.consecutive_failures += 1
+                self.last_error = f"{type(e).__name__}: {e}"
+                delay = self.backoff_delay()
+                if is_retryable_error(e):
+                    logger.warning("GSHEET: error transitorio al vaciar la cola (%s). Reintento en %.1f s.", e, delay)
+                else:
+                    # Permisos, URL, etc.: se reintenta más espaciado, sin perder filas
+                    delay = max(delay, BACKOFF_MAX_S / 2)
+                    logger.error("GSHEET: error al vaciar la cola (%s). Reintento en %.1f s.", e, delay)
+
+
+class SpooledLogWriter:
+    """Interfaz de escritura usada por el pipeline: encola y despierta al flusher.
+
+    Expone ``append_row`` como una hoja de gspread para que el pipeline no
+    distinga entre la hoja real y la cola.
+    """
+
+    self_scheduled = True  # Solo escribe en la cola local; el flusher pasa por scheduler.sheets
+
+    def __init__(self, spool, flusher):
+        self.spool = spool
+        self.flusher = flusher
+
+    def append_row(self, values, **kwargs):
+        row_id = self.spool.enqueue(values)
+        self.flusher.wake()
+        return row_id
+
+    def pending_count(self):
+        return self.spool.pending_count()
+
+    def drain(self, timeout=None, poll_s=0.5):
+        """Espera a que el flusher vacíe la cola (p. ej. antes de salir de la CLI).
+
+        Devuelve el número de filas que siguen pendientes; quedan en la cola
+        local y se envían en la siguiente ejecución.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.spool.pending_count():
+            if deadline is not None and time.time() >= deadline:
+                break
+            self.flusher.wake()
+            time.sleep(poll_s)
+        return self.spool.pending_count()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_log_writer(worksheet_factory, path=None):
+    """SpooledLogWriter compartido por proceso para la cola en ``path``.
+
+    El flusher se arranca una sola vez; llamadas posteriores actualizan la
+    fábrica de hojas (p. ej. si cambiaron los secretos).
+    """
+    path = path or config.data_path(DEFAULT_SPOOL_PATH)
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            spool = SheetsSpool(path)
+            flusher = SpoolFlusher(spool, worksheet_factory)
+            flusher.start()
+            writer = SpooledLogWriter(spool, flusher)
+            _writers[path] = writer
+        else:
+            writer.flusher.worksheet_factory = worksheet_factory
+        return writer
@@ -0,0 +1,142 @@
+"""Arranque de la app: importaciones diferidas, validación única y tiempos de ejecución.
+
+Streamlit vuelve a ejecutar el script completo con cada interacción. Aquí vive
+lo que solo debe hacerse una vez por proceso:
+
+* ``lazy_import`` difiere la carga de los SDK pesados (``google.generativeai``,
+  ``gspread``, ``google.oauth2``...) hasta el primer uso real, de modo que la
+  primera pintura de la página no espera a que se importen.
+* ``check_secrets`` valida los secretos una sola vez por combinación de valores.
+* ``run_timings`` registra la duración del arranque en frío y de cada rerun.
+
+``python startup.py`` mide el costo de importar los módulos de la app en un
+proceso nuevo, con y sin las importaciones pesadas.
+"""
+import functools
+import importlib
+import json
+import statistics
+import subprocess
+import sys
+import threading
+import types
+from dataclasses import dataclass
+
+
+class LazyModule(types.ModuleType):
+    """Módulo que se importa la primera vez que se accede a uno de sus atributos."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_lazy_name"] = name
+
+    def _load(self):
+        # import_module es thread-safe y devuelve el módulo de sys.modules tras la primera carga
+        return importlib.import_module(self.__dict__["_lazy_name"])
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name):
+    """Devuelve el módulo ``name`` si ya está cargado o un LazyModule que lo carga al usarse."""
+    return sys.modules.get(name) or LazyModule(name)
+
+
+# --- Validación de secretos (una vez por proceso y combinación de valores) ---
+@dataclass(frozen=True)
+class SecretsCheck:
+    api_key_ok: bool
+    sheets_ok: bool
+    missing: tuple = ()
+    credentials_error: str | None = None
+
+
+@functools.lru_cache(maxsize=8)
+def check_secrets(api_key, creds_json_str, sheet_url):
+    """Valida presencia y formato de los secretos sin importar ningún SDK."""
+    missing = tuple(name for name, value in (
+        ("GOOGLE_API_KEY", api_key),
+        ("GOOGLE_CREDENTIALS_JSON", creds_json_str),
+        ("GOOGLE_SHEET_LOG_URL", sheet_url),
+    ) if not value)
+    credentials_error = None
+    if creds_json_str:
+        try:
+            info = json.loads(creds_json_str)
+            absent = [k for k in ("client_email", "private_key") if k not in info]
+            if absent:
+                credentials_error = f"Faltan campos en el JSON de credenciales: {', '.join(absent)}"
+        except (ValueError, TypeError) as e:
+            credentials_error = f"No se pudo decodificar el JSON de credenciales: {e}"
+    return SecretsCheck(
+        api_key_ok=bool(api_key),
+        sheets_ok=bool(creds_json_str and sheet_url) and credentials_error is None,
+        missing=missing,
+        credentials_error=credentials_error,
+    )
+
+
+# --- Tiempos de ejecución del script ---
+class RunTimings:
+    """Duración del primer run del proceso (arranque en frío) y de los reruns."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.cold_start_s = None
+        self.reruns = []
+
+    def record(self, seconds):
+        with self._lock:
+            if self.cold_start_s is None:
+                self.cold_start_s = seconds
+            else:
+                self.reruns.append(seconds)
+                del self.reruns[:-200]  # Solo los más recientes
+
+    def summary(self):
+        with self._lock:
+            reruns = list(self.reruns)
+        return {
+            "cold_start_s": self.cold_start_s,
+            "reruns": len(reruns),
+            "rerun_p50_s": statistics.median(reruns) if reruns else None,
+            "rerun_max_s": max(reruns) if reruns else None,
+        }
+
+
+run_timings = RunTimings()
+
+
+# --- Medición del costo de importación ---
+APP_MODULES = ("clients", "pipeline", "sheets_spool", "result_cache", "json_output", "prompts")
+HEAVY_MODULES = ("google.generativeai", "gspread", "google.oauth2.service_account", "google.auth.transport.requests")
+
+
+def _time_imports(modules):
+    code = (
+        "import importlib, time; t = time.perf_counter(); "
+        f"[importlib.import_module(m) for m in {list(modules)!r}]; "
+        "print(time.perf_counter() - t)"
+    )
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return float(completed.stdout.strip())
+
+
+def main(repeat=3):
+    """Imprime (JSON) la mediana del tiempo de importación en un proceso nuevo."""
+    lazy = [_time_imports(APP_MODULES) for _ in range(repeat)]
+    eager = [_time_imports(APP_MODULES + HEAVY_MODULES) for _ in range(repeat)]
+    print(json.dumps({
+        "app_imports_lazy_s": round(statistics.median(lazy), 3),
+        "app_imports_with_sdks_s": round(statistics.median(eager), 3),
+        "saved_at_first_paint_s": round(statistics.median(eager) - statistics.median(lazy), 3),
+    }))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
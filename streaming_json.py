@@ -0,0 +1,147 @@
+"""Parser JSON incremental para mostrar campos de ``existing-mrs`` mientras se generan.
+
+El modelo devuelve el JSON por fragmentos (``stream=True``). ``FieldStreamParser``
+recorre solo el texto nuevo de cada fragmento, siguiendo cadenas, escapes y
+anidamiento, y emite cada campo directo del objeto ``existing-mrs`` en cuanto
+su valor está completo (p. ej. ``MotivoConsulta`` o ``SignosVitales``), sin
+esperar al final de la respuesta. Ignora el texto fuera del JSON (```json).
+"""
+import json
+
+TARGET_OBJECT_KEY = "existing-mrs"
+
+# Estados de un objeto mientras se recorre
+_EXPECT_KEY = "key"
+_EXPECT_COLON = "colon"
+_EXPECT_VALUE = "value"
+_IN_VALUE = "in_value"
+
+
+class _Frame:
+    __slots__ = ("kind", "parent_key", "state", "key", "value_start", "emitted", "is_target")
+
+    def __init__(self, kind, parent_key, is_target):
+        self.kind = kind  # "{" o "["
+        self.parent_key = parent_key
+        self.state = _EXPECT_KEY if kind == "{" else _EXPECT_VALUE
+        self.key = None
+        self.value_start = None
+        self.emitted = False
+        self.is_target = is_target
+
+
+class FieldStreamParser:
+    """Detecta campos completos de ``existing-mrs`` en un JSON que llega por partes."""
+
+    def __init__(self, target_key=TARGET_OBJECT_KEY):
+        self.target_key = target_key
+        self.buffer = ""
+        self.fields = {}  # Campos ya completos, en orden de llegada
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._done = False
+
+    def feed(self, chunk):
+        """Añade texto y devuelve [(campo, valor)] completados con este fragmento."""
+        self.buffer += chunk
+        completed = []
+        buf = self.buffer
+        i = self._pos
+        n = len(buf)
+        while i < n and not self._done:
+            ch = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._on_string_end(self._string_start, i, completed)
+                i += 1
+                continue
+
+            frame = self._stack[-1] if self._stack else None
+            if frame is None:
+                # Fuera del JSON: solo interesa el primer '{'
+                if ch == "{":
+                    self._stack.append(_Frame("{", None, False))
+                i += 1
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+                if frame.state == _EXPECT_VALUE:
+                    self._begin_value(frame, i)
+            elif ch in "{[":
+                parent_key = frame.key if frame.kind == "{" else None
+                if frame.state == _EXPECT_VALUE:
+                    self._begin_value(frame, i)
+                is_target = ch == "{" and frame.kind == "{" and parent_key == self.target_key
+                self._stack.append(_Frame(ch, parent_key, is_target))
+            elif ch in "}]":
+                self._end_value(frame, i, completed)
+                self._stack.pop()
+                if not self._stack:
+                    self._done = True
+                else:
+                    self._on_container_end(self._stack[-1], i, completed)
+            elif ch == ":":
+                if frame.kind == "{" and frame.state == _EXPECT_COLON:
+                    frame.state = _EXPECT_VALUE
+            elif ch == ",":
+                self._end_value(frame, i, completed)
+                frame.state = _EXPECT_KEY if frame.kind == "{" else _EXPECT_VALUE
+            elif not ch.isspace() and frame.state == _EXPECT_VALUE:
+                # Número, true, false o null
+                self._begin_value(frame, i)
+            i += 1
+        self._pos = i
+        return completed
+
+    @property
+    def complete(self):
+        """True cuando se cerró el objeto JSON raíz."""
+        return self._done
+
+    def _begin_value(self, frame, start):
+        frame.state = _IN_VALUE
+        frame.value_start = start
+        frame.emitted = False
+
+    def _emit(self, frame, end, completed):
+        """Emite el valor actual si el frame es ``existing-mrs``."""
+        if not frame.is_target or frame.emitted or frame.value_start is None:
+            return
+        frame.emitted = True
+        try:
+            value = json.loads(self.buffer[frame.value_start:end])
+        except ValueError:
+            return
+        self.fields[frame.key] = value
+        completed.append((frame.key, value))
+
+    def _on_string_end(self, start, end, completed):
+        frame = self._stack[-1]
+        if frame.kind == "{" and frame.state == _EXPECT_KEY:
+            try:
+                frame.key = json.loads(self.buffer[start:end + 1])
+            except ValueError:
+                frame.key = self.buffer[start + 1:end]
+            frame.state = _EXPECT_COLON
+        elif frame.state == _IN_VALUE and frame.value_start == start:
+            self._emit(frame, end + 1, completed)
+
+    def _on_container_end(self, parent, end, completed):
+        # Un objeto/lista que es el valor directo de un campo acaba de cerrarse
+        if parent.state == _IN_VALUE:
+            self._emit(parent, end + 1, completed)
+
+    def _end_value(self, frame, end, completed):
+        # Valores primitivos (números, true/false/null) terminan en ',' o en el cierre
+        if frame.state == _IN_VALUE:
+            self._emit(frame, end, completed)
@@ -1,127 +1,81 @@
+import time
+_script_start = time.perf_counter() # Duración de este run (arranque en frío o rerun), ver pie de página
 import streamlit as st
-import google.generativeai as genai
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx # Pintar desde hilos del pipeline
 import json
-import time
 import pathlib # Aunque no se usa directamente, genai puede depender de él
 import io # Necesario para manejar el archivo en memoria
+import uuid # Identificador de la sesión del navegador para el scheduler
+import threading # Algunos callbacks del pipeline llegan desde sus hilos (enrutamiento)
 from datetime import datetime
 import pytz # Necesario para zona horaria específica
-import tempfile
-import os
 
-# --- IMPORTACIONES PARA GOOGLE SHEETS ---
-import gspread
-from google.oauth2.service_account import Credentials
-import gspread.exceptions # Para capturar errores específicos de API
+import startup # Importaciones diferidas, validación única de secretos y tiempos de ejecución
+
+# --- SDK PESADOS (Google Sheets; Gemini vive en clients/pipeline): se importan en su primer uso, no en cada arranque ---
+gspread = startup.lazy_import("gspread") # gspread.exceptions para capturar errores específicos de API
 # --------------------------------------------
 
+import clients # Clientes de Gemini y Sheets compartidos por todo el proceso
+import pipeline # Etapas del procesamiento sin dependencias de UI (individual y por lotes)
+import sheets_spool # Cola local durable para los registros de Google Sheets
+import result_cache # Caché en disco de resultados por hash de audio/modelo/prompt
+import json_output # Esquema de respuesta JSON y parser tolerante
+import audio_preprocess # Preprocesamiento local opcional del audio (ffmpeg)
+import long_audio # División de consultas largas en segmentos y fusión de resultados
+import cie10 # Índice local de la CIE-10 para completar/corregir los códigos de diagnóstico
+import vitals # Signos vitales numéricos, IMC calculado y alertas de valores implausibles
+import prompts # Prompt y plantilla JSON compartidos con la CLI
+import file_registry # Archivos subidos a Google AI reutilizables por hash y limpieza en segundo plano
+import job_queue # Cola persistente de trabajos procesados por worker.py fuera de la sesión
+import log_format # Formato compacto de Literal/JSON_Completo en el log y almacén de blobs
+import log_mirror # Copia local (SQLite + FTS) de la hoja de log para búsquedas y análisis
+import compare # Comparación de varios modelos sobre una sola subida del audio
+import routing # Enrutamiento flash -> pro con escalado y solicitudes de cobertura
+import prompt_cache # Caché de contexto de Gemini para el prompt estático (CITAMED_PROMPT_CACHE=1)
+import scheduler # Cuota compartida de Gemini/Sheets, turnos por sesión y reintentos de 429/503
+import config # Ajustes por variables de entorno (métricas, cola de Sheets...)
+import metrics # Tiempos por etapa: log JSON, exportación Prometheus y columnas opcionales del log
+
 # --- 0. Configuración Inicial y Constantes ---
 st.set_page_config(layout="wide", page_title="citamedVOZ")
 st.title("CITAMED - Procesador de Audio Médico con IA Generativa")
 
-# --- Prompt para Gemini ---
-prompt_part1 = """
-Por favor, realiza las siguientes tareas con el audio proporcionado:
-1.  **Transcribe** el contenido completo del audio. Mantén la transcripción lo más fiel posible al audio original, sin resumir. Puedes añadir mínimas palabras de conexión si mejora mucho la legibilidad, pero prioriza la fidelidad absoluta.
-2.  **Clasifica** la información extraída de la transcripción en un formato JSON **válido**.
-3.  **Utiliza exactamente la siguiente estructura JSON** como plantilla. Rellena los campos con la información correspondiente extraída del audio.
-
-**Estructura JSON requerida (salida SÓLO JSON):**
-"""
-json_structure_example = '''
-```json
-{
-    "status": "OK",
-    "message": "SUCCESS",
-    "data": {
-        "existing-mrs": {
-            "Literal": "AQUI_VA_LA_TRANSCRIPCION_COMPLETA_Y_FIEL_DEL_AUDIO._Incluir_observaciones_adicionales_si_no_encajan_en_otros_campos.",
-            "MotivoConsulta": "EXTRAER_EL_MOTIVO_PRINCIPAL_DE_LA_CONSULTA_O_LLAMADA",
-            "EnfermedadActual": "EXTRAER_LA_DESCRIPCION_DE_LA_ENFERMEDAD_ACTUAL_O_SINTOMAS_PRINCIPALES",
-            "Antecedentes": "EXTRAER_ANTECEDENTES_PERSONALES_PATOLOGICOS_Y_NO_PATOLOGICOS_DEL_PACIENTE",
-            "ExamenFisico": "EXTRAER_HALLAZGOS_DETALLADOS_DEL_EXAMEN_FISICO_DESCRITO_EN_EL_AUDIO",
-            "DiasReposo": "EXTRAER_SI_SE_INDICA_DIAS_DE_REPOSO_PARA_LA_CONSULTA",
-            "SignosVitales": {
-                "FC": "EXTRAER_FRECUENCIA_CARDIACA_(pulsaciones_por_minuto)",
-                "IMC": "EXTRAER_INDICE_DE_MASA_CORPORAL_SI_SE_MENCIONA_EN_SU_DEFECTO_CALCULALO_POR_FAVOR",
-                "Size": "EXTRAER_ESTATURA_DEL_PACIENTE_(en_metros)",
-                "TAD": "EXTRAER_TENSION_ARTERIAL_DIASTOLICA_(mmHg)",
-                "TAS": "EXTRAER_TENSION_ARTERIAL_SISTOLICA_(mmHg)",
-                "PESO": "EXTRAER_PESO_DEL_PACIENTE_(en_kg)"
-            },
-            "Examenes": [
-                // Añadir objetos aquí por cada examen mencionado
-                // Ejemplo: { "Name": "NOMBRE_EXAMEN_O_ESTUDIO_SOLICITADO", "Resultado": "EXTRAE_CUANDO_EN_EL_AUDIO_LO_MUESTRA","UnidadMedida": "BUSCA_LA_UNIDAD_DEL_VALOR" }
-            ],
-            "Diagnosticos": [
-                // Añadir objetos aquí por cada diagnóstico/patología mencionado que tiene el paciente, no excluir ninguno de estos
-                // Ejemplo: { "ID": "CODIGO_CIE_10", "Nombre": "NOMBRE_DIAGNOSTICO_MENCIONADO_DEL_PACIENTE" }
-            ],
-            "Medicinas": [
-                // Añadir objetos aquí por cada medicamento mencionado que se haya administrado al paciente
-                // Ejemplo: { "Nombre": "NOMBRE_COMERCIAL", "Presentacion": "FORMA", "Dosis": "DOSIS_Y_FRECUENCIA" }
-            ],
-            "PlanDeAccion": [
-                // EXTRAER_CUALQUIER_INSTRUCCION_QUE_EL_MEDICO_INCLUYA_O_COMENTARIOS_NO_CLASIFICABLES_EN_EL_RESTO_DE_CATEGORIA
-                //Añadir objetos aqui, donde el texto sea una instruccion y
-                //Ejemplo: { "NUMERO_CONSECUTIVO": "INSTRUCCION_OBTENIDA" }
-            ],
-            "ComentariosModelo": "INCLUIR_CUALQUIER_OBSERVACION_DE_PROBLEMAS_QUE_HAYAS_ENCONTRADO_EN_LA_TAREA"
-        }
-    }
-}
-'''
-prompt_part3_final_instructions = """
-Instrucciones IMPORTANTES para el formato de salida:
-No incluyas texto explicativo, saludos, respeta las categorias y la forma en que se desglozan en el ejemplo.
-Para Diagnosticos, es necesario que busque el CIED_10 al que corresponde e incluyas en el atributo ID
-Presta atencion durante el audio el transcurao del audio se mencionan varios diagnosticos/patologias del paciente.
-Si encuentras en el audio algun examen de laboratorio con el valor que le corresponde al resultado, busca el simbolo o la unidad de medida que corresponde
-En los examenes es necesario identificar si son examenes ya con resultado por el paciente o si son examenes solictados
-El campo LITERAL es crucial: debe contener la transcripción LITERAL del audio.
-El campo MOTIVO_CONSULTA es importante: debe contener las razones porque el paciente asiste a consulta, no excluyas el preambulo que incluye el medico a las razones.
-Presta atención a los tipos de datos esperados (números para signos vitales, cadenas para descripciones, listas para exámenes/diagnósticos/medicamentos).
-Si una pieza específica de información (ej. Signos Vitales - FC) no se menciona explícitamente en el audio, utiliza la cadena NO_ENCONTRADO
-Si no se mencionan Examenes, Diagnosticoss o Medicinas, deja las listas correspondientes vacías: [].
-"""
-prompt_text = prompt_part1 + json_structure_example + prompt_part3_final_instructions
+# Identificador de la sesión del navegador. Va en la URL (?sesion=...) para recuperar los trabajos
+# en segundo plano tras recargar la pestaña; el scheduler atiende por turnos a cada sesión.
+browser_session_id = st.query_params.get("sesion") or st.session_state.setdefault("browser_session_id", uuid.uuid4().hex[:12])
+if st.query_params.get("sesion") != browser_session_id:
+    st.query_params["sesion"] = browser_session_id
+scheduler.bind_session(browser_session_id)
+
+# Endpoint /metrics para Prometheus (solo si CITAMED_METRICS_PORT está definido; una vez por proceso)
+metrics.start_http_server()
+
+# --- Prompt para Gemini (ver prompts.py) ---
+prompt_text = prompts.PROMPT_TEXT
 
 # --- CONSTANTES PARA GOOGLE SHEETS ---
-GSHEET_SCOPES = [
-    'https://www.googleapis.com/auth/spreadsheets',
-    'https://www.googleapis.com/auth/drive.file' # A veces necesario para algunas operaciones de gspread
-]
-# Asegúrate que este orden sea EXACTO al de tu hoja de log
-EXPECTED_GSHEET_COLUMNS = [
-    "Timestamp", "Filename", "Model", "Status", "Message", "MotivoConsulta",
-    "EnfermedadActual", "Antecedentes", "ExamenFisico", "DiasReposo",
-    "SignosVitales_Resumen", "Examenes_Resumen", "Diagnosticos_Resumen",
-    "Medicinas_Resumen", # Mapeado desde la columna '850mg' original
-    "PlanDeAccion_Resumen", "ComentariosModelo", "Literal",
-    "JSON_Completo"
-]
+GSHEET_SCOPES = clients.GSHEET_SCOPES
+# El orden EXACTO de las columnas de la hoja de log vive en pipeline.py (pipeline.log_columns)
 # -----------------------------------
 
 # --- FUNCIONES PARA GOOGLE SHEETS ---
 def connect_to_gsheet():
-    """Carga credenciales de Sheets desde secretos y conecta con gspread."""
+    """Obtiene el cliente compartido de Sheets (autoriza solo la primera vez por proceso)."""
     try:
         # Lee las credenciales JSON del secreto
         creds_json_str = st.secrets["GOOGLE_CREDENTIALS_JSON"]
+        # Cliente cacheado por credencial; authorize() reutiliza el token mientras sea válido
+        sheets_client = clients.get_sheets_client(creds_json_str)
         try:
-            # Parsea el string JSON a un diccionario
-            creds_dict = json.loads(creds_json_str)
+            sheets_client.authorize()
         except json.JSONDecodeError as json_err:
              st.error(f"GSHEET Error: No se pudo decodificar el JSON de credenciales: {json_err}")
              # Opcional: Mostrar inicio del JSON problemático para depurar
              # st.text_area("GSHEET: Inicio del JSON problemático:", creds_json_str[:200] + "...", height=50)
              return None
-
-        # Crea las credenciales y autoriza gspread
-        creds = Credentials.from_service_account_info(creds_dict, scopes=GSHEET_SCOPES)
-        gc = gspread.authorize(creds)
         # st.write("GSHEET: Conexión establecida.") # Mensaje de depuración opcional
-        return gc
+        return sheets_client
 
     except KeyError:
         # Error si falta el secreto de credenciales
@@ -133,18 +87,16 @@ def connect_to_gsheet():
         return None
 
 def get_worksheet(gc):
-    """Obtiene la hoja de cálculo de log usando la URL del secreto."""
+    """Obtiene la hoja de cálculo de log usando la URL del secreto (handle cacheado)."""
     try:
         # Lee la URL completa de la hoja desde los secretos
         sheet_url = st.secrets["GOOGLE_SHEET_LOG_URL"]
         # st.write(f"GSHEET: Intentando abrir hoja por URL: '{sheet_url[:50]}...'") # Mensaje de depuración opcional
 
-        # Abre la hoja de cálculo usando su URL
-        spreadsheet = gc.open_by_url(sheet_url)
-        # Asume que se usará la primera hoja (sheet1)
-        worksheet = spreadsheet.sheet1
-        # st.write("GSHEET: Hoja obtenida por URL.") # Mensaje de depuración opcional
-        return worksheet
+        # Resuelve la hoja (sheet1) una sola vez; los reruns reutilizan el handle cacheado
+        gc.open_worksheet(sheet_url)
+        # Devuelve la hoja envuelta con re-autenticación transparente
+        return gc.log_worksheet(sheet_url)
 
     except KeyError:
         # Error si falta el secreto de la URL
@@ -164,55 +116,99 @@ def get_worksheet(gc):
         # Captura cualquier otro error inesperado
         st.error(f"GSHEET Error inesperado al abrir por URL: {e}")
         return None
+def make_worksheet_factory():
+    """Fábrica de la hoja de log para los hilos de fondo (cola de registros y copia local)."""
+    creds_json_str = st.secrets["GOOGLE_CREDENTIALS_JSON"]
+    sheet_url = st.secrets["GOOGLE_SHEET_LOG_URL"]
+
+    def worksheet_factory():
+        # Se ejecuta en un hilo de fondo: sin llamadas a st.*
+        return clients.get_sheets_client(creds_json_str).log_worksheet(sheet_url)
+
+    return worksheet_factory
+
+
+def get_log_writer():
+    """Escritor de log con cola local durable; un hilo de fondo envía las filas a la hoja."""
+    return sheets_spool.get_log_writer(make_worksheet_factory())
 # ----------------------------------
 
 
 # --- 1. Verificación de Secretos Necesarios ---
-st.divider()
-st.subheader("Verificación de Claves API y Secretos")
-api_key_configured = False
-google_sheets_configured = False
+def read_secret(name):
+    """Valor del secreto o None (sin secrets.toml, st.secrets lanza una excepción)."""
+    try:
+        return st.secrets.get(name)
+    except Exception:
+        return None
 
-# Verificar API Key de Gemini
-try:
-    google_api_key = st.secrets.get("GOOGLE_API_KEY")
-    if google_api_key:
-        genai.configure(api_key=google_api_key)
-        api_key_configured = True
+
+def ensure_genai_configured():
+    """Configura el SDK de Gemini justo antes de usarlo (importa el SDK solo la primera vez)."""
+    clients.configure_genai(read_secret("GOOGLE_API_KEY")) # Solo reconfigura si cambió la clave
+
+
+# La validación se memoriza por proceso: los reruns solo vuelven a pintar el resultado
+secrets_check = startup.check_secrets(
+    read_secret("GOOGLE_API_KEY"), read_secret("GOOGLE_CREDENTIALS_JSON"), read_secret("GOOGLE_SHEET_LOG_URL")
+)
+api_key_configured = secrets_check.api_key_ok
+google_sheets_configured = secrets_check.sheets_ok
+
+st.divider()
+with st.expander("Verificación de Claves API y Secretos", expanded=not (api_key_configured and google_sheets_configured)):
+    # Verificar API Key de Gemini
+    if api_key_configured:
         st.success("✅ API Key de Google Gemini configurada.")
     else:
         st.error("❌ Falta el secreto 'GOOGLE_API_KEY'.")
-except Exception as e:
-    st.error(f"Error configurando API Key Gemini: {e}")
-
-# Verificar Secretos de Google Sheets (Credenciales JSON y URL de la hoja)
-try:
-    required_sheets_secrets = ["GOOGLE_CREDENTIALS_JSON", "GOOGLE_SHEET_LOG_URL"]
-    missing_secrets = [s for s in required_sheets_secrets if s not in st.secrets]
 
-    if not missing_secrets:
-         google_sheets_configured = True
-         st.success("✅ Secretos para Google Sheets encontrados (JSON y URL).")
+    # Verificar Secretos de Google Sheets (Credenciales JSON y URL de la hoja)
+    missing_secrets = [name for name in secrets_check.missing if name != "GOOGLE_API_KEY"]
+    if google_sheets_configured:
+        st.success("✅ Secretos para Google Sheets encontrados (JSON y URL).")
+    elif secrets_check.credentials_error:
+        st.error(f"❌ GSHEET Error: {secrets_check.credentials_error}")
     else:
-         st.error(f"❌ Faltan secretos para Google Sheets: {', '.join(missing_secrets)}.")
-         st.markdown("""
+        st.error(f"❌ Faltan secretos para Google Sheets: {', '.join(missing_secrets)}.")
+        st.markdown("""
             **ACCIÓN REQUERIDA (Google Sheets):**
             1.  Asegúrate de tener `GOOGLE_CREDENTIALS_JSON` con el JSON de la cuenta de servicio.
             2.  Asegúrate de tener `GOOGLE_SHEET_LOG_URL` con la URL completa de tu hoja de log.
             """)
-except Exception as e:
-     st.error(f"Error verificando secretos de Sheets: {e}")
 
 
 # --- 2. Subida del Archivo de Audio ---
 st.divider()
 st.subheader("1. Sube tu archivo de audio")
-uploaded_file = st.file_uploader(
-    "Selecciona un archivo de audio (.ogg):",
-    type=['ogg'],
-    accept_multiple_files=False,
-    help="Sube el archivo OGG que contiene la consulta médica."
+processing_mode = st.radio(
+    "Modo de procesamiento:",
+    options=["Individual", "Por lotes"],
+    horizontal=True,
+    help="En modo por lotes se pueden subir varias consultas y se procesan en paralelo."
 )
+batch_mode = processing_mode == "Por lotes"
+if batch_mode:
+    uploaded_files = st.file_uploader(
+        "Selecciona los archivos de audio (.ogg):",
+        type=['ogg'],
+        accept_multiple_files=True,
+        help="Sube todos los archivos OGG de las consultas del día."
+    ) or []
+    batch_workers = st.slider(
+        "Archivos procesados en paralelo:",
+        min_value=1, max_value=8, value=4,
+        help="Número máximo de archivos que avanzan por el pipeline al mismo tiempo."
+    )
+    uploaded_file = None
+else:
+    uploaded_file = st.file_uploader(
+        "Selecciona un archivo de audio (.ogg):",
+        type=['ogg'],
+        accept_multiple_files=False,
+        help="Sube el archivo OGG que contiene la consulta médica."
+    )
+    uploaded_files = []
 
 # --- 2.5 Selección del Modelo de IA ---
 st.divider()
@@ -225,478 +221,699 @@ selected_model_name = st.selectbox(
     index=0, # Modelo por defecto
     help="Selecciona el modelo a usar para procesar el audio."
 )
-st.info(f"Modelo seleccionado: **{selected_model_name}**")
+use_routing = st.checkbox(
+    "Enrutamiento automático: empezar con el modelo seleccionado y escalar solo si hace falta",
+    value=False,
+    help=("Si la respuesta no es JSON válido o deja vacíos campos obligatorios "
+          f"({', '.join(routing.DEFAULT_REQUIRED_FIELDS)}), se repite la consulta con el modelo de escalado "
+          "usando el mismo archivo subido. Conviene elegir arriba un modelo rápido (flash).")
+)
+routing_policy = None
+if use_routing:
+    col_escalate, col_hedge = st.columns(2)
+    escalation_options = [m for m in model_options if m != selected_model_name]
+    escalation_model = col_escalate.selectbox(
+        "Modelo de escalado:",
+        options=escalation_options,
+        index=escalation_options.index(routing.DEFAULT_ESCALATION_MODEL) if routing.DEFAULT_ESCALATION_MODEL in escalation_options else 0,
+    )
+    hedge_after_s = col_hedge.number_input(
+        "Solicitud de cobertura tras (s, 0 = desactivada):", min_value=0.0, max_value=600.0, value=0.0, step=5.0,
+        help="Si el modelo rápido no ha respondido en este tiempo, se lanza la misma consulta al modelo de escalado y se usa la primera respuesta válida. Puede duplicar el costo de las consultas lentas."
+    )
+    routing_policy = routing.RoutingPolicy(primary_model=selected_model_name, escalation_model=escalation_model,
+                                           hedge_after_s=hedge_after_s or None)
+    route_rows = routing.route_stats.rows()
+    if route_rows:
+        with st.expander("Rutas tomadas y latencia de generación por ruta", expanded=False):
+            st.dataframe(route_rows, use_container_width=True, hide_index=True)
+compare_mode = not batch_mode and st.checkbox(
+    "Comparar modelos: procesar el mismo audio con varios modelos a la vez",
+    value=False,
+    help=("El audio se sube una sola vez y cada modelo genera en paralelo. Se muestran latencia, tokens, "
+          "validez del JSON y las diferencias en diagnósticos, medicamentos y signos vitales. No se registra en la hoja de log.")
+)
+compare_model_names = []
+if compare_mode:
+    compare_model_names = st.multiselect(
+        "Modelos a comparar:",
+        options=model_options,
+        default=model_options[:2],
+        max_selections=compare.MAX_PARALLEL_MODELS,
+    )
+st.info(f"Modelo seleccionado: **{selected_model_name}**" + (f" (escalado a **{routing_policy.escalation_model}**)" if routing_policy else ""))
+if json_output.supports_response_schema(selected_model_name):
+    st.caption("Este modelo usa salida JSON validada por esquema.")
+else:
+    st.caption("Este modelo no admite salida por esquema: el JSON se extrae del texto y se repara si es necesario.")
+
+
+# --- 2.6 Vista Previa en Streaming ---
+# Campos de existing-mrs en el orden en que se muestran durante la generación
+LIVE_PREVIEW_FIELDS = [
+    "MotivoConsulta", "EnfermedadActual", "Antecedentes", "ExamenFisico", "SignosVitales",
+    "Examenes", "Diagnosticos", "Medicinas", "PlanDeAccion", "DiasReposo", "ComentariosModelo", "Literal"
+]
 
 
-# --- 3. Botón de Procesamiento y Lógica Principal ---
-st.divider()
-# El botón se deshabilita si falta la API Key de Gemini o no se ha subido archivo
-process_button_disabled = not api_key_configured or not uploaded_file
-if st.button("2. Procesar Audio y Generar Información", disabled=process_button_disabled):
+def render_live_field(placeholder, field_name, value):
+    """Muestra un campo de existing-mrs recién completado en su placeholder."""
+    with placeholder.container():
+        if isinstance(value, (dict, list)):
+            st.markdown(f"**{field_name}**")
+            st.json(value, expanded=True)
+        else:
+            text = str(value)
+            if field_name == "Literal" and len(text) > 500: # La transcripción completa se ve en los resultados
+                text = text[:500] + "…"
+            st.markdown(f"**{field_name}:** {text}")
 
-    # Solo procede si hay archivo y la API de Gemini está lista
-    if uploaded_file is not None and api_key_configured:
-        st.info(f"Archivo '{uploaded_file.name}' cargado. Usando modelo '{selected_model_name}'. Iniciando procesamiento...")
 
-        # Variables para controlar el flujo y almacenar resultados/referencias
-        audio_file_ref = None
-        google_upload_successful = False
-        generation_successful = False
-        response = None
-        parsed_json = None # Aquí se guardará el JSON parseado si tiene éxito
-        temp_file_path = None # Ruta al archivo temporal local
+def ui_callback(func):
+    """Envuelve un callback del pipeline para que pueda pintar aunque se invoque desde otro hilo.
 
-        try:
-            # --- 3.1. Subir archivo a Google AI ---
-            with st.spinner(f"Subiendo '{uploaded_file.name}' a Google AI..."):
-                upload_start_time = time.time()
-                try:
-                    # Guarda el archivo subido en un archivo temporal local
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as temp_file:
-                        temp_file.write(uploaded_file.getvalue())
-                        temp_file_path = temp_file.name
-
-                    # Sube el archivo temporal a Google AI File Service
-                    audio_file_ref = genai.upload_file(
-                        path=temp_file_path,
-                        display_name=f"streamlit_{int(time.time())}_{uploaded_file.name}",
-                        mime_type="audio/ogg" # Asegura el tipo MIME correcto
-                    )
-                    # st.write(f"Archivo enviado ({audio_file_ref.name}). Esperando procesamiento...") # Opcional
-
-                    # Espera a que el archivo esté listo (ACTIVE) en Google AI
-                    while audio_file_ref.state.name == "PROCESSING":
-                        time.sleep(5) # Espera prudencial
-                        try:
-                            # Re-obtiene el estado del archivo
-                            audio_file_ref = genai.get_file(audio_file_ref.name)
-                        except Exception as get_file_e:
-                            # Si hay error obteniendo estado, espera y reintenta
-                            st.warning(f"Error obteniendo estado: {get_file_e}. Reintentando...")
-                            time.sleep(5)
-                            continue
-
-                        # Timeout para evitar esperas infinitas
-                        if time.time() - upload_start_time > 300: # 5 minutos
-                            raise TimeoutError(f"Timeout: El archivo '{audio_file_ref.name}' sigue en estado PROCESSING.")
-
-                    # Verifica el estado final de la subida/procesamiento en Google AI
-                    if audio_file_ref.state.name == "FAILED":
-                        raise ValueError(f"Error: Subida/procesamiento de '{audio_file_ref.name}' falló en Google AI.")
-
-                    google_upload_successful = (audio_file_ref.state.name == "ACTIVE")
-                    if not google_upload_successful:
-                        st.warning(f"Estado final de subida inesperado: {audio_file_ref.state.name}. Se intentará continuar.")
-                    else:
-                         st.write(f"Archivo '{audio_file_ref.name}' está ACTIVO y listo para usar.")
-
-                except Exception as e:
-                    # Captura cualquier error durante la subida
-                    st.error(f"Error durante la subida a Google AI: {e}")
-                    raise e # Propaga el error para detener el flujo si es necesario
-                finally:
-                     # Asegura la eliminación del archivo temporal local
-                     if temp_file_path and os.path.exists(temp_file_path):
-                        try:
-                            os.remove(temp_file_path)
-                            # st.write(f"Archivo temporal local '{temp_file_path}' eliminado.") # Opcional
-                        except Exception as e_remove:
-                            st.warning(f"No se pudo eliminar archivo temporal local {temp_file_path}: {e_remove}")
-
-            # Si la subida falló, no continuar
-            if not google_upload_successful:
-                st.error("Fallo en la subida a Google AI. No se puede procesar.")
-            else:
-                # --- 3.2. Generar Contenido con el Modelo Gemini ---
-                with st.spinner(f"Generando contenido con '{selected_model_name}' (esto puede tardar)..."):
-                    try:
-                        # Instancia el modelo seleccionado por el usuario
-                        model = genai.GenerativeModel(selected_model_name)
-                        # Configuración de generación (opcional, ajusta según necesidad)
-                        generation_config = genai.GenerationConfig(temperature=0.1)
-                        # Llamada a la API de Gemini
-                        model_start_time = time.time()
-                        response = model.generate_content(
-                            [prompt_text, audio_file_ref], # Combina prompt e info del archivo
-                            generation_config=generation_config,
-                            request_options={'timeout': 600} # Timeout para la llamada a la API (10 min)
-                        )
-                        model_end_time = time.time()
-                        st.write(f"Respuesta del modelo recibida en {model_end_time - model_start_time:.2f} segundos.")
-                        generation_successful = True
-
-                    except genai.types.generation_types.BlockedPromptException as blocked_error:
-                        # Captura errores de bloqueo por políticas de seguridad
-                        st.error(f"Error: La solicitud fue bloqueada por políticas de seguridad.")
-                        # Intenta mostrar feedback si está disponible
-                        try:
-                            feedback = getattr(blocked_error, 'response', {}).get('prompt_feedback', None)
-                            if feedback: st.warning(f"Razón del bloqueo: {feedback}")
-                            elif response and hasattr(response, 'prompt_feedback'): st.warning(f"Feedback: {response.prompt_feedback}")
-                        except Exception: pass
-                        generation_successful = False
-
-                    except Exception as e:
-                        # Captura otros errores durante la generación
-                        st.error(f"Ocurrió un error durante la generación de contenido: {e}")
-                        if hasattr(e, 'message'): st.error(f"Detalle: {e.message}")
-                        try: # Intenta mostrar feedback si hubo respuesta parcial
-                           if response and hasattr(response, 'prompt_feedback') and response.prompt_feedback:
-                              st.warning(f"Feedback del Prompt: {response.prompt_feedback}")
-                        except Exception: pass
-                        generation_successful = False # Marcar como fallida
-
-                # --- 3.3. Procesar Respuesta, Extraer JSON y Registrar en Google Sheets ---
-                if generation_successful and response:
-                    st.write("Procesando respuesta del modelo...")
-                    json_block = None # Texto que potencialmente es JSON
-                    parsed_json = None # Diccionario Python si el parseo es exitoso
-
-                    try:
-                        # Intenta extraer el bloque JSON de la respuesta de texto
-                        response_text = response.text
-                        start_marker = "```json"
-                        end_marker = "```"
-                        start_index = response_text.find(start_marker)
-
-                        if start_index != -1: # Si encuentra ```json
-                            start_index += len(start_marker)
-                            end_index = response_text.find(end_marker, start_index)
-                            if end_index != -1:
-                                json_block = response_text[start_index:end_index].strip()
-                                # st.write("JSON extraído usando delimitadores ```json.") # Opcional
-                        else: # Si no, busca primer { y último }
-                            json_start_index = response_text.find('{')
-                            json_end_index = response_text.rfind('}')
-                            if json_start_index != -1 and json_end_index != -1 and json_end_index > json_start_index:
-                                json_block = response_text[json_start_index : json_end_index + 1].strip()
-                                # st.write("JSON extraído buscando primer '{' y último '}'.") # Opcional
-                        # Si nada funcionó, usa el texto completo como último recurso
-                        if not json_block:
-                            json_block = response_text.strip()
-                            st.warning("No se detectó estructura JSON clara. Usando respuesta completa.")
-
-                        # Intenta parsear el bloque extraído como JSON
-                        try:
-                            parsed_json = json.loads(json_block)
-                            st.success("JSON extraído y validado exitosamente.")
-
-                            # --- INICIO: LÓGICA PARA REGISTRAR EN GOOGLE SHEETS ---
-                            if google_sheets_configured: # Solo si los secretos de Sheets están presentes
-                                st.write("Intentando registrar datos en Google Sheet...")
-                                try:
-                                    # 1. Preparar los datos para la fila de la hoja
-                                    # Obtener timestamp en zona horaria deseada
-                                    try:
-                                        tz = pytz.timezone('America/Caracas')
-                                        timestamp = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
-                                    except Exception: # Fallback a UTC si pytz falla
-                                        timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S") + " UTC"
-
-                                    filename = uploaded_file.name if uploaded_file else "NO_FILENAME"
-                                    model_name_log = selected_model_name
-
-                                    # Extraer datos del JSON parseado (con valores por defecto seguros)
-                                    json_status = parsed_json.get("status", "NO_STATUS")
-                                    json_message = parsed_json.get("message", "NO_MESSAGE")
-                                    # Acceder de forma segura a la data anidada
-                                    data = parsed_json.get("data", {})
-                                    existing_mrs = data.get("existing-mrs", {}) if isinstance(data, dict) else {}
-
-                                    motivo_consulta = existing_mrs.get("MotivoConsulta", "")
-                                    enf_actual = existing_mrs.get("EnfermedadActual", "")
-                                    antecedentes = existing_mrs.get("Antecedentes", "")
-                                    exam_fisico = existing_mrs.get("ExamenFisico", "")
-                                    # Asegurar que días de reposo sea string para la hoja
-                                    dias_reposo = str(existing_mrs.get("DiasReposo", ""))
-                                    comentarios_modelo = existing_mrs.get("ComentariosModelo", "")
-                                    literal = existing_mrs.get("Literal", "")
-                                    # Convertir el JSON completo a string para guardarlo
-                                    json_completo_str = json.dumps(parsed_json, ensure_ascii=False, indent=2)
-
-                                    # Crear resúmenes para campos complejos (listas/dicts)
-                                    sv_data = existing_mrs.get("SignosVitales", {})
-                                    sv_resumen = "; ".join([f"{k}: {v}" for k, v in sv_data.items() if v not in [None, "NO_ENCONTRADO", ""]]) if isinstance(sv_data, dict) else ""
-
-                                    ex_data = existing_mrs.get("Examenes", [])
-                                    ex_resumen = "; ".join([f"{e.get('Name', '')}: {e.get('Resultado', '')}".strip(": ") for e in ex_data if isinstance(e, dict)]) if isinstance(ex_data, list) else ""
-
-                                    dx_data = existing_mrs.get("Diagnosticos", [])
-                                    dx_resumen = "; ".join([f"{d.get('Nombre', '')} ({d.get('ID', '')})".strip(" ()") for d in dx_data if isinstance(d, dict)]) if isinstance(dx_data, list) else ""
-
-                                    med_data = existing_mrs.get("Medicinas", [])
-                                    med_resumen = "; ".join([f"{m.get('Nombre', '')} {m.get('Presentacion', '')} {m.get('Dosis', '')}".strip() for m in med_data if isinstance(m, dict)]) if isinstance(med_data, list) else ""
-
-                                    plan_data = existing_mrs.get("PlanDeAccion", [])
-                                    # Extrae solo el valor (la instrucción) de cada dict en la lista
-                                    plan_resumen = "; ".join([list(p.values())[0] for p in plan_data if isinstance(p, dict) and len(p)==1 and list(p.values())[0]]) if isinstance(plan_data, list) else ""
-
-
-                                    # 2. Crear la lista de datos en el orden EXACTO de las columnas esperadas
-                                    row_data = [
-                                        timestamp, filename, model_name_log, json_status, json_message,
-                                        motivo_consulta, enf_actual, antecedentes, exam_fisico, dias_reposo,
-                                        sv_resumen, ex_resumen, dx_resumen,
-                                        med_resumen, # Columna 14
-                                        plan_resumen, comentarios_modelo, literal,
-                                        json_completo_str
-                                    ]
-
-                                    # 3. Validar longitud y Escribir en la hoja
-                                    if len(row_data) != len(EXPECTED_GSHEET_COLUMNS):
-                                        # Error crítico si el número de columnas no coincide
-                                        st.error(f"GSHEET Error: Discrepancia en número de columnas. Esperadas: {len(EXPECTED_GSHEET_COLUMNS)}, Generadas: {len(row_data)}. No se registrará.")
-                                    else:
-                                        # Conecta a Google Sheets
-                                        gc = connect_to_gsheet()
-                                        if gc:
-                                            # Obtiene la hoja de trabajo usando la URL
-                                            worksheet = get_worksheet(gc)
-                                            if worksheet:
-                                                # Añade la fila al final de la hoja
-                                                with st.spinner("Escribiendo registro en Google Sheet..."):
-                                                    worksheet.append_row(row_data, value_input_option='USER_ENTERED')
-                                                st.success("✅ ¡Registro agregado exitosamente a Google Sheet!")
-                                            else:
-                                                st.warning("GSHEET: No se pudo obtener la hoja de trabajo (verifica URL/Permisos). No se registró.")
-                                        else:
-                                             st.warning("GSHEET: No se pudo conectar con Google Sheets. No se registró.")
-
-                                except Exception as log_err:
-                                    # Captura errores durante el proceso de registro
-                                    st.error(f"GSHEET Error durante el proceso de registro: {log_err}")
-                                    st.exception(log_err) # Muestra traceback para depuración
-
-                            else: # Si google_sheets_configured es False
-                                st.warning("Registro en Google Sheet omitido porque faltan los secretos necesarios (JSON de credenciales o URL de la hoja).")
-                            # --- FIN: LÓGICA PARA GOOGLE SHEETS ---
-
-                            # Mostrar el JSON completo parseado en un expander
-                            st.divider()
-                            st.subheader("JSON Completo Recibido del Modelo")
-                            with st.expander("Ver/Ocultar JSON completo", expanded=False):
-                                st.json(parsed_json, expanded=True)
-                            st.divider()
-
-                        except json.JSONDecodeError as json_error:
-                            # Error si el texto extraído no se pudo parsear como JSON
-                            st.error(f"Error: El texto extraído del modelo NO es un JSON válido.")
-                            st.error(f"Detalle del error: {json_error}")
-                            # Muestra el texto problemático para ayudar a identificar el error
-                            st.text_area("Texto recibido del modelo (con error de JSON):", value=json_block if json_block else response_text, height=200)
-                            parsed_json = None # Asegurar que parsed_json es None si falla
-
-                    except AttributeError:
-                         # Error si la respuesta del modelo no tiene el atributo .text
-                         st.error("Error: La respuesta del modelo no tiene el atributo 'text'.")
-                         st.write("Respuesta completa recibida:")
-                         st.write(response)
-                         parsed_json = None # Marcar como fallido
-                    except Exception as proc_err:
-                        # Captura otros errores durante el procesamiento de la respuesta
-                        st.error(f"Error procesando la respuesta del modelo: {proc_err}")
-                        parsed_json = None # Marcar como fallido
-
-                elif not generation_successful:
-                    # Mensaje si la generación falló o fue bloqueada
-                    st.warning("La generación de contenido no fue exitosa o fue bloqueada. No hay JSON para procesar.")
-                else: # response is None
-                    # Mensaje si no se recibió respuesta alguna
-                     st.error("No se recibió respuesta del modelo.")
-
-        # --- Manejo de Errores Generales del Flujo ---
-        except Exception as main_e:
-            st.error(f"Ocurrió un error en el flujo principal de procesamiento: {main_e}")
-            st.exception(main_e) # Muestra el traceback completo para depuración
-            parsed_json = None # Asegurar que es None si hay error antes de mostrar resultados
-
-        finally:
-            # --- 3.4. Limpieza de Recursos (Archivo en Google AI) ---
-            # Intenta eliminar el archivo subido a Google AI para no acumular archivos
-            if audio_file_ref and hasattr(audio_file_ref, 'name'):
-                try:
-                    # No usar spinner aquí para no ocultar mensajes finales
-                    genai.delete_file(audio_file_ref.name)
-                    st.caption(f"Archivo temporal '{audio_file_ref.name}' eliminado de Google AI.")
-                except Exception as e_clean:
-                    st.caption(f"Advertencia: No se pudo eliminar archivo '{audio_file_ref.name}' de Google AI: {e_clean}. Puede requerir limpieza manual.")
-            elif google_upload_successful:
-                 # Mensaje si la subida tuvo éxito pero no hay referencia para borrar
-                 st.caption("No se pudo intentar eliminar el archivo de Google AI (falta referencia válida).")
+    generate_routed llama a ``on_wait`` desde los hilos de sus solicitudes; sin el
+    contexto del script, Streamlit ignora lo que esos hilos escriben en la página.
+    """
+    script_ctx = get_script_run_ctx()
+    script_thread = threading.current_thread()
 
-            st.info("Proceso de análisis completado (revisa mensajes anteriores para posibles errores o advertencias).")
+    def wrapper(*args):
+        if script_ctx is not None and threading.current_thread() is not script_thread:
+            add_script_run_ctx(threading.current_thread(), script_ctx)
+        return func(*args)
 
+    return wrapper
 
-        # --- 4. Mostrar Resultados del Procesamiento ---
-        st.divider()
-        st.subheader("3. Resultados del Procesamiento")
 
-        # Solo muestra resultados si el JSON fue parseado exitosamente (parsed_json no es None)
-        if parsed_json:
-            try:
-                # Verifica la estructura básica esperada del JSON
-                if parsed_json.get("status") == "OK" and "data" in parsed_json and isinstance(parsed_json.get("data"), dict) and "existing-mrs" in parsed_json["data"]:
-                    informacion_medica = parsed_json["data"]["existing-mrs"]
-                    st.success("Mostrando información médica extraída del audio:")
-
-                    # --- SECCIONES DE VISUALIZACIÓN (SIN CAMBIOS RESPECTO A TU CÓDIGO ORIGINAL) ---
-
-                    # SECCION: Consulta (3 Columnas)
-                    with st.expander("Detalles de la Consulta", expanded=True):
-                        col_motivo, col_enf, col_ant = st.columns(3)
-                        with col_motivo:
-                            st.subheader("Motivo Consulta")
-                            st.text_area("MotivoConsulta_disp", value=informacion_medica.get("MotivoConsulta", "No encontrado"), height=200, label_visibility="collapsed", disabled=True, key="motivo_c_disp")
-                        with col_enf:
-                            st.subheader("Enfermedad Actual")
-                            st.text_area("EnfermedadActual_disp", value=informacion_medica.get("EnfermedadActual", "No encontrado"), height=200, label_visibility="collapsed", disabled=True, key="enf_act_disp")
-                        with col_ant:
-                            st.subheader("Antecedentes")
-                            st.text_area("Antecedentes_disp", value=informacion_medica.get("Antecedentes", "No encontrado"), height=200, label_visibility="collapsed", disabled=True, key="antec_disp")
-
-                    # SECCION: Examen Físico
-                    with st.expander("Examen Físico"):
-                        st.text_area("ExamenFisico_disp", value=informacion_medica.get("ExamenFisico", "No encontrado"), height=150, label_visibility="collapsed", disabled=True, key="exam_fis_disp")
-
-                    # SECCION: Signos Vitales (Usando st.metric)
-                    with st.expander("Signos Vitales"):
-                        signos_vitales_data = informacion_medica.get("SignosVitales", {})
-                        if isinstance(signos_vitales_data, dict) and signos_vitales_data:
-                            num_sv = len(signos_vitales_data)
-                            cols_sv = st.columns(min(num_sv, 6)) # Máximo 6 columnas para SV
-                            i = 0
-                            sv_order = ["TAS", "TAD", "FC", "PESO", "Size", "IMC"] # Orden preferido
-                            displayed_keys = set()
-                            # Mostrar en orden preferido
-                            for key in sv_order:
-                                if key in signos_vitales_data:
-                                    value = signos_vitales_data[key]
-                                    display_value = str(value) if str(value).upper() != "NO_ENCONTRADO" and value is not None else "---"
-                                    with cols_sv[i % min(num_sv, 6)]:
-                                        st.metric(label=key, value=display_value)
-                                    displayed_keys.add(key)
-                                    i += 1
-                            # Mostrar claves restantes
-                            extra_keys = [k for k in signos_vitales_data if k not in displayed_keys]
-                            for key in extra_keys:
-                                value = signos_vitales_data[key]
-                                display_value = str(value) if str(value).upper() != "NO_ENCONTRADO" and value is not None else "---"
-                                with cols_sv[i % min(num_sv, 6)]:
-                                    st.metric(label=key, value=display_value)
-                                i += 1
-                        else:
-                            st.info("No se encontraron datos de Signos Vitales.")
-
-                    # SECCION: Exámenes
-                    with st.expander("Exámenes Solicitados/Resultados"):
-                        examenes_data = informacion_medica.get("Examenes", [])
-                        if isinstance(examenes_data, list):
-                            if examenes_data:
-                                for examen_dict in examenes_data:
-                                    if isinstance(examen_dict, dict):
-                                        name = examen_dict.get("Name", "N/E")
-                                        resultado = examen_dict.get("Resultado", "N/E")
-                                        unidad = examen_dict.get("UnidadMedida", "")
-                                        display_text = f"- **{name}:** {resultado}"
-                                        if unidad and str(unidad).upper() != "NO_ENCONTRADO": display_text += f" {unidad}"
-                                        st.markdown(display_text)
-                                    else: st.warning(f"Elemento inesperado en Examenes: {examen_dict}")
-                            else: st.info("No se especificaron exámenes.")
-                        else: st.warning(f"Formato inesperado para Examenes: {type(examenes_data)}")
-
-                    # SECCION: Diagnósticos
-                    with st.expander("Diagnósticos"):
-                        diagnosticos_data = informacion_medica.get("Diagnosticos", [])
-                        if isinstance(diagnosticos_data, list):
-                            if diagnosticos_data:
-                                for diag_dict in diagnosticos_data:
-                                    if isinstance(diag_dict, dict):
-                                        nombre_diag = diag_dict.get("Nombre", "N/E")
-                                        diag_id = diag_dict.get("ID", "")
-                                        display_text = f"- **{nombre_diag}**"
-                                        if diag_id and str(diag_id).strip().upper() != "NO_ENCONTRADO": display_text += f" (ID: {diag_id})"
-                                        st.markdown(display_text)
-                                    else: st.warning(f"Elemento inesperado en Diagnosticos: {diag_dict}")
-                            else: st.info("No se especificaron diagnósticos.")
-                        else: st.warning(f"Formato inesperado para Diagnosticos: {type(diagnosticos_data)}")
-
-                    # SECCION: Medicamentos
-                    with st.expander("Medicamentos Indicados"):
-                        medicamentos_data = informacion_medica.get("Medicinas", [])
-                        if isinstance(medicamentos_data, list):
-                            if medicamentos_data:
-                                for i, med_dict in enumerate(medicamentos_data):
-                                    if isinstance(med_dict, dict):
-                                        nombre = med_dict.get("Nombre", f"Med_{i+1}")
-                                        presentacion = med_dict.get("Presentacion", "")
-                                        dosis = med_dict.get("Dosis", "N/E")
-                                        st.markdown(f"**{nombre}** {f'({presentacion})' if presentacion else ''}")
-                                        st.text_area(f"Dosis_{i}_disp", value=dosis, key=f"med_dosis_disp_{i}", height=68, label_visibility="collapsed", disabled=True)
-                                        if i < len(medicamentos_data) - 1: st.divider() # Separador entre meds
-                                    else: st.warning(f"Elemento inesperado en Medicinas: {med_dict}")
-                            else: st.info("No se especificaron medicamentos.")
-                        else: st.warning(f"Formato inesperado para Medicinas: {type(medicamentos_data)}")
-
-                    # SECCION: Plan de Acción
-                    with st.expander("Plan de Acción"):
-                        plan_data = informacion_medica.get("PlanDeAccion", [])
-                        if isinstance(plan_data, list):
-                            if plan_data:
-                                items_markdown = []
-                                for item_dict in plan_data:
-                                    if isinstance(item_dict, dict) and len(item_dict) == 1:
-                                        instruccion = list(item_dict.values())[0]
-                                        if instruccion: items_markdown.append(f"- {instruccion}")
-                                    elif isinstance(item_dict, str) and item_dict: # Acepta strings directamente
-                                        items_markdown.append(f"- {item_dict}")
-                                if items_markdown: st.markdown("\n".join(items_markdown))
-                                else: st.info("Plan de acción vacío o con formato no reconocido.")
-                            else: st.info("No se especificó plan de acción.")
-                        elif isinstance(plan_data, str) and plan_data: # Acepta string simple
-                             st.markdown(f"Plan: {plan_data}")
-                        else: st.warning(f"Formato inesperado o vacío para PlanDeAccion: {type(plan_data)}")
-
-
-                    # SECCION: Días de Reposo
-                    with st.expander("Indicación de Reposo"):
-                        dias_reposo_val = str(informacion_medica.get("DiasReposo", "NO_ENCONTRADO"))
-                        if dias_reposo_val.upper() != "NO_ENCONTRADO" and dias_reposo_val.strip():
-                             if dias_reposo_val.isdigit():
-                                st.metric("Días de Reposo Indicados", value=dias_reposo_val)
-                             else: # Si no es número, muestra el texto
-                                st.write(f"Indicación: {dias_reposo_val}")
-                        else:
-                            st.info("No se especificó indicación de reposo.")
-
-                    # SECCION: Comentarios y Literal
-                    with st.expander("Comentarios del Modelo y Transcripción Completa", expanded=False): # Inicia cerrado
-                        col_comm, col_lit = st.columns(2)
-                        with col_comm:
-                            st.subheader("Comentarios del Modelo")
-                            st.text_area("Comentarios_disp", value=informacion_medica.get("ComentariosModelo", ""), height=300, label_visibility="collapsed", disabled=True, key="comm_mod_disp")
-                        with col_lit:
-                            st.subheader("Transcripción Literal")
-                            st.text_area("Literal_disp", value=informacion_medica.get("Literal", "Transcripción no encontrada en el JSON"), height=300, label_visibility="collapsed", disabled=True, key="lit_tx_disp")
-
-                # Mensaje si el JSON se parseó pero no tiene la estructura esperada
-                elif parsed_json and "message" in parsed_json:
-                    st.error(f"Error en la respuesta JSON del modelo: {parsed_json.get('message', 'Mensaje no encontrado')}")
+# --- 2.7 Procesamiento por Lotes ---
+def process_batch(files, model_name, max_workers):
+    """Procesa varios archivos en un pool de workers mostrando el progreso por archivo."""
+    # Las filas del lote van a la cola local y se envían a Sheets en lotes
+    worksheet = None
+    if google_sheets_configured:
+        worksheet = get_log_writer()
+    else:
+        st.warning("Registro en Google Sheet omitido porque faltan los secretos necesarios (JSON de credenciales o URL de la hoja).")
+
+    st.info(f"Procesando {len(files)} archivos con '{model_name}' ({max_workers} en paralelo)...")
+    batch = pipeline.BatchRun(
+        [(f.name, f) for f in files], model_name, prompt_text, # Se suben desde su buffer, sin copias
+        max_workers=max_workers, worksheet=worksheet,
+        cache=result_cache.get_result_cache(), force_reprocess=force_reprocess,
+        preprocess=preprocess_enabled, segment_long_audio=segment_long_audio, routing_policy=routing_policy
+    ).start()
+
+    # Refresca la tabla de progreso desde el hilo de Streamlit mientras trabajan los workers
+    progress_bar = st.progress(0.0)
+    progress_table = st.empty()
+    while True:
+        finished = batch.wait(timeout=1.0)
+        rows = batch.snapshot()
+        n_done = sum(1 for r in rows if r["Estado"] in (pipeline.STATUS_DONE, pipeline.STATUS_FAILED))
+        progress_bar.progress(n_done / len(rows), text=f"{n_done}/{len(rows)} archivos terminados")
+        progress_table.dataframe(rows, use_container_width=True, hide_index=True)
+        if finished:
+            break
+
+    # Resumen de throughput y fallos
+    summary = batch.summary()
+    st.subheader("Resumen del Lote")
+    col_ok, col_fail, col_time, col_rate = st.columns(4)
+    col_ok.metric("Exitosos", f"{summary.succeeded}/{summary.total}")
+    col_fail.metric("Fallidos", summary.failed)
+    col_time.metric("Tiempo total", f"{summary.wall_time_s:.1f} s")
+    col_rate.metric("Throughput", f"{summary.files_per_minute:.1f} archivos/min")
+    if summary.preprocess_bytes_saved:
+        st.caption(f"Preprocesamiento: {summary.preprocess_bytes_saved / (1024 * 1024):.1f} MB menos subidos; "
+                   f"tiempo ahorrado estimado: {summary.preprocess_time_saved_s:.0f} s")
+    if summary.cache_hits:
+        st.caption(f"Recuperados de la caché (sin subir ni generar): {summary.cache_hits}/{summary.total}")
+    if worksheet is not None:
+        st.caption(f"Registros en cola para Google Sheet: {summary.logged}/{summary.total} (pendientes de envío: {worksheet.pending_count()})")
+    if summary.failures:
+        st.error("Archivos con error:\n" + "\n".join(f"- {name}: {error}" for name, error in summary.failures))
+
+    # Los resultados correctos pasan al historial de la sesión (se muestran en "Resultados del Procesamiento")
+    for result in reversed([r for r in batch.results if r.ok][:SESSION_HISTORY_SIZE]):
+        remember_consult(result.parsed_json, result.filename, result.model_name, from_cache=result.from_cache) # Con enrutamiento, el que respondió
+
+
+# --- 2.7.1 Procesamiento de un Archivo ---
+def process_single(file, model_name):
+    """Procesa un archivo con pipeline.process_audio y muestra el informe de cada etapa."""
+    # El registro va a la cola local y se envía a Sheets en segundo plano
+    worksheet = None
+    if google_sheets_configured:
+        worksheet = get_log_writer()
+    else:
+        st.warning("Registro en Google Sheet omitido porque faltan los secretos necesarios (JSON de credenciales o URL de la hoja).")
+
+    status_line = st.empty()
+    quota_notice = st.empty()
+    last_stage = [pipeline.STATUS_QUEUED] # Etapa en curso, para el mensaje si falla
+
+    def show_status(result):
+        if result.status != pipeline.STATUS_FAILED:
+            last_stage[0] = result.status
+        status_line.info(f"⏳ {result.status}...")
+
+    def show_queue_position(position, wait_s):
+        # Con mucha carga la solicitud espera turno en lugar de fallar con 429
+        if position:
+            eta = f" (~{wait_s:.0f} s)" if wait_s else ""
+            quota_notice.info(f"⏳ Cuota de Gemini ocupada por otras consultas: tu solicitud está en la posición {position} de la cola{eta}.")
+        else:
+            quota_notice.empty()
+
+    # Vista previa: cada campo de existing-mrs aparece en cuanto está completo (sin enrutamiento)
+    live_preview = None
+    show_live_field = None
+    if stream_results and routing_policy is None:
+        live_preview = st.empty()
+        live_container = live_preview.container()
+        live_container.caption("Vista previa en vivo (los campos aparecen a medida que el modelo los genera):")
+        field_placeholders = {name: live_container.empty() for name in LIVE_PREVIEW_FIELDS}
+
+        def show_live_field(field_name, value):
+            placeholder = field_placeholders.get(field_name) or live_container.empty()
+            render_live_field(placeholder, field_name, value)
+
+    with st.spinner(f"Procesando '{file.name}' con '{model_name}' (esto puede tardar)..."):
+        result = pipeline.process_audio(
+            file, file.name, model_name, prompt_text, worksheet=worksheet, # Se sube desde su buffer, sin copias
+            on_update=ui_callback(show_status), cache=result_cache.get_result_cache(), force_reprocess=force_reprocess,
+            preprocess=preprocess_enabled, segment_long_audio=segment_long_audio, routing_policy=routing_policy,
+            on_field=ui_callback(show_live_field) if show_live_field else None, on_wait=ui_callback(show_queue_position),
+        )
+    status_line.empty()
+    quota_notice.empty()
+    render_single_report(result, failed_stage=last_stage[0])
+
+    # --- Guardar el Resultado en la Sesión (se muestra más abajo y persiste entre reruns) ---
+    if result.ok:
+        if live_preview is not None:
+            live_preview.empty() # La vista previa se reemplaza por los resultados completos
+        remember_consult(result.parsed_json, file.name, result.model_name, from_cache=result.from_cache) # Con enrutamiento, el que respondió
+
+
+def render_single_report(result, failed_stage=None):
+    """Informe por etapas de un ConsultResult de process_audio (tiempos, avisos y errores)."""
+    if result.from_cache:
+        # Acierto: se omitieron subida, generación y registro (ya se procesó antes)
+        st.success("⚡ Resultado recuperado de la caché local (mismo audio, modelo y prompt). No se volvió a subir ni a generar.")
+        st.caption("Marca 'Forzar reprocesamiento' para volver a procesar este audio con el modelo.")
+        return
+
+    times = result.stage_times
+    if result.preprocess_report is not None:
+        st.caption(f"Preprocesamiento: {result.preprocess_report.summary()}")
+    elif result.preprocess_error:
+        st.warning(f"No se pudo preprocesar el audio; se subió el original. Detalle: {result.preprocess_error}")
+
+    if result.segment_count:
+        st.write(f"{result.segment_count} segmentos procesados y fusionados "
+                 f"(segmento más lento: subida {times.get('upload', 0.0):.2f} s, generación {times.get('generation', 0.0):.2f} s).")
+        if result.route:
+            st.caption(f"Rutas de los segmentos: {result.route} ({result.model_name}).")
+    elif result.file_reused:
+        st.write(f"Audio reutilizado de una subida anterior (sin subir ni esperar PROCESSING; "
+                 f"vigente hasta {file_registry.get_registry().ttl_s / 60:.0f} min tras su subida).")
+    elif "upload" in times:
+        st.write(f"Archivo ACTIVO en Google AI (subida: {times['upload']:.2f} s, "
+                 f"PROCESSING: {times.get('processing', 0.0):.2f} s, {result.processing_polls} consultas de estado).")
+    if result.upload_peak_memory_bytes is not None:
+        st.caption(f"Pico de memoria durante la subida: {result.upload_peak_memory_bytes / (1024 * 1024):.2f} MB.")
+
+    if result.route_summary and not result.segment_count:
+        st.write(result.route_summary + ".")
+    elif "generation" in times and not result.segment_count:
+        first_field_msg = f" (primer campo visible a los {result.first_field_s:.2f} s)" if result.first_field_s is not None else ""
+        st.write(f"Respuesta del modelo recibida en {times['generation']:.2f} segundos{first_field_msg}.")
+
+    if not result.ok:
+        if result.error and result.error.startswith("BlockedPromptException"):
+            st.error("Error: La solicitud fue bloqueada por políticas de seguridad.")
+        st.error(f"Error en la etapa '{failed_stage or 'procesamiento'}': {result.error}")
+        if result.response_text:
+            # Muestra el texto problemático para ayudar a identificar el error
+            st.text_area("Texto recibido del modelo:", value=result.response_text, height=200)
+        st.warning("No hay información para mostrar debido a errores en pasos anteriores (subida, generación, JSON, etc.).")
+        return
+
+    if result.parse_method == "repaired":
+        st.warning("El JSON del modelo tenía errores de formato (comentarios, comas finales o salida truncada) y se reparó automáticamente. Revisa los campos finales.")
+    st.success("JSON extraído y validado exitosamente.")
+    # Códigos CIE-10 completados o corregidos con la tabla local
+    cie10_counts = cie10.summarize(result.cie10_checks)
+    if cie10_counts.get(cie10.ACTION_FILLED) or cie10_counts.get(cie10.ACTION_CORRECTED):
+        st.info("Códigos CIE-10 revisados con la tabla local: " +
+                ", ".join(f"{count} {action}" for action, count in cie10_counts.items()))
+    if result.logged:
+        st.success("✅ Registro guardado y en cola para Google Sheet (se envía en segundo plano).")
+
+    # Mostrar el JSON completo parseado en un expander
+    st.divider()
+    st.subheader("JSON Completo Recibido del Modelo")
+    with st.expander("Ver/Ocultar JSON completo", expanded=False):
+        st.json(result.parsed_json, expanded=True)
+    st.divider()
+
+
+# --- 2.7.2 Comparación de Modelos ---
+def compare_models(file, model_names):
+    """Procesa el mismo audio con ``model_names`` (una subida, generación en paralelo) y muestra las diferencias."""
+    status = st.empty()
+    status.info(f"Subiendo '{file.name}' una sola vez para {len(model_names)} modelos...")
+    finished = []
+
+    def show_progress(run):  # compare_audio lo llama desde este hilo
+        finished.append(run.model_name)
+        status.info(f"Modelos terminados: {len(finished)}/{len(model_names)} (último: {run.model_name}, {run.latency_s:.1f} s)")
+
+    with st.spinner("Generando con todos los modelos en paralelo..."):
+        runs, upload = compare.compare_audio(file, file.name, model_names, prompt_text, on_run=show_progress)
+    status.empty()
+    if upload.file_reused:
+        st.caption("Audio reutilizado de Google AI (sin subir ni esperar PROCESSING).")
+    else:
+        st.caption(f"Subida única: {upload.stage_times.get('upload', 0.0):.2f} s · "
+                   f"PROCESSING: {upload.stage_times.get('processing', 0.0):.2f} s")
+
+    st.subheader("Comparación de Modelos")
+    diff_rows = compare.field_diff(runs)
+    st.dataframe(compare.summary_rows(runs, diff_rows), use_container_width=True, hide_index=True)
+    if diff_rows:
+        n_differing = sum(1 for row in diff_rows if row["Coincide"] == "No")
+        st.caption(f"{n_differing} de {len(diff_rows)} campos con diferencias entre los modelos con JSON válido.")
+        sections = [compare.SECTION_DIAGNOSES, compare.SECTION_MEDICATIONS, compare.SECTION_VITALS]
+        for tab, section in zip(st.tabs(sections), sections):
+            with tab:
+                # Las filas con diferencias primero
+                rows = sorted(({key: value for key, value in row.items() if key != "Sección"}
+                               for row in diff_rows if row["Sección"] == section), key=lambda row: row["Coincide"] == "Sí")
+                if rows:
+                    st.dataframe(rows, use_container_width=True, hide_index=True)
                 else:
-                    st.error("El JSON generado por el modelo no tiene la estructura esperada (status, data, existing-mrs).")
-                    # st.json(parsed_json if parsed_json else {"error": "No se pudo parsear JSON"}) # Opcional
-
-            except Exception as display_e:
-                # Error durante la visualización de los datos del JSON
-                st.error(f"Ocurrió un error al mostrar los datos del JSON: {display_e}")
-                st.exception(display_e) # Muestra traceback completo
-                # st.write("JSON problemático:") # Opcional
-                # st.json(parsed_json)
-
-        # Mensajes si no hay JSON para mostrar
-        elif generation_successful: # La generación fue exitosa pero el parseo falló
-             st.error("No se pudo mostrar la información porque el JSON generado por el modelo no es válido o no se pudo extraer.")
-        else: # La generación misma falló
-            st.warning("No hay información para mostrar debido a errores en pasos anteriores (subida, generación, etc.).")
+                    st.info("Ningún modelo extrajo datos de esta sección.")
+    elif any(run.valid_json for run in runs):
+        st.info("Ningún modelo extrajo diagnósticos, medicamentos ni signos vitales.")
+    for run in runs:
+        with st.expander(f"JSON de {run.model_name}", expanded=False):
+            if run.valid_json:
+                st.json(run.parsed_json)
+            else:
+                st.error(f"Sin JSON válido: {run.error}")
+    st.download_button("Descargar comparación (JSON)",
+                       json.dumps({"runs": [run.as_record() for run in runs], "diff": diff_rows}, ensure_ascii=False, indent=2),
+                       file_name=f"comparacion_{file.name}.json", mime="application/json")
+
+
+# --- 2.7.5 Cola de Trabajos en Segundo Plano ---
+JOB_POLL_S = 2 # Cada cuánto se refresca el estado de los trabajos
+JOB_LIST_SIZE = 20 # Trabajos de la sesión que se muestran
+
+
+def submit_jobs(files, model_name):
+    """Encola los archivos para worker.py; la sesión solo consulta su estado por id."""
+    queue = job_queue.get_job_queue()
+    options = job_queue.job_options(
+        preprocess=preprocess_enabled, segment_long_audio=segment_long_audio, routing_policy=routing_policy,
+        force_reprocess=force_reprocess, log_to_sheets=google_sheets_configured,
+    )
+    for f in files:
+        with pipeline.audio_view(f) as audio_buffer:
+            queue.submit(bytes(audio_buffer), f.name, model_name, options, session_id=browser_session_id)
+    st.session_state["has_jobs"] = True
+    st.success(f"✅ {len(files)} trabajo(s) en cola. Puedes recargar la página o cerrar la pestaña: el progreso se conserva en este enlace.")
+    if not queue.active_workers():
+        st.warning("No hay workers activos: los trabajos esperarán hasta que se inicie uno (python worker.py).")
+
+
+def render_jobs():
+    """Estado de los trabajos de esta sesión; los terminados pasan al historial de resultados.
+
+    Solo mientras la sesión tiene trabajos en cola o en curso, la sección se
+    refresca cada ``JOB_POLL_S`` (st.fragment con run_every, Streamlit >= 1.37);
+    el resto de las sesiones no consulta la base en segundo plano. Una sesión
+    sin trabajos consulta la cola una sola vez (al abrir un enlace ?sesion=).
+    """
+    queue = job_queue.get_job_queue()
+    if "has_jobs" not in st.session_state:
+        st.session_state["has_jobs"] = bool(queue.list_jobs(session_id=browser_session_id, limit=1))
+    if not st.session_state["has_jobs"]:
+        return
+    polling = queue.active_count(browser_session_id) > 0
+    if hasattr(st, "fragment"):
+        st.fragment(run_every=JOB_POLL_S if polling else None)(_render_jobs)(polling)
+    else:
+        _render_jobs(polling)
+
+
+def _render_jobs(polling):
+    queue = job_queue.get_job_queue()
+    jobs = queue.list_jobs(session_id=browser_session_id, limit=JOB_LIST_SIZE)
+    if not jobs:
+        return
+    st.divider()
+    st.subheader("Trabajos en Segundo Plano")
+    workers = queue.active_workers()
+    rows = []
+    for job in jobs:
+        position = queue.queue_position(job["id"]) if job["status"] == job_queue.JOB_QUEUED else None
+        elapsed_end = job["finished_at"] or time.time()
+        rows.append({
+            "Trabajo": job["id"][:8],
+            "Archivo": job["filename"],
+            "Modelo": job["model_name"],
+            "Estado": job_queue.JOB_STATUS_LABELS.get(job["status"], job["status"]),
+            "Etapa": job["stage"] or "",
+            "Posición": position or "",
+            "Tiempo (s)": round(elapsed_end - (job["started_at"] or elapsed_end), 1),
+            "Error": job["error"] or "",
+        })
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+    st.caption(f"Workers activos: {len(workers)}. Enlace de esta sesión: ?sesion={browser_session_id}")
+    queued_ids = [job["id"] for job in jobs if job["status"] == job_queue.JOB_QUEUED]
+    if not workers and queued_ids:
+        st.warning("No hay workers activos. Inicia uno con `python worker.py` o desde aquí.")
+        if st.button("Iniciar un worker local"):
+            job_queue.start_local_worker()
+            st.toast("Worker iniciado.")
+    if queued_ids and st.button(f"Cancelar los trabajos en cola ({len(queued_ids)})"):
+        canceled = sum(queue.cancel(job_id) for job_id in queued_ids) # Los que ya empezó un worker siguen
+        st.toast(f"{canceled} trabajo(s) cancelado(s); su audio se borró.")
+        st.rerun()
+
+    # Los resultados nuevos se guardan una sola vez en el historial de la sesión
+    remembered = st.session_state.setdefault("remembered_jobs", set())
+    new_results = [job for job in jobs if job["status"] == job_queue.JOB_DONE and job["id"] not in remembered]
+    for job in reversed(new_results):
+        remembered.add(job["id"])
+        record = job["result"]
+        remember_consult(record["parsed_json"], job["filename"], record["model"], from_cache=record["from_cache"])
+    if new_results or (polling and not queue.active_count(browser_session_id)):
+        st.rerun() # Redibuja "Resultados del Procesamiento" y deja de refrescar si ya no quedan trabajos activos
+
+
+# --- 2.8 Visualización de Resultados ---
+SESSION_HISTORY_SIZE = 10 # Consultas recientes que se conservan en la sesión del navegador
+# st.fragment (Streamlit >= 1.37) reejecuta solo esta función al interactuar con sus widgets
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+
+
+def remember_consult(parsed_json, filename, model_name, from_cache=False):
+    """Guarda un resultado en st.session_state para que sobreviva a los reruns."""
+    history = st.session_state.setdefault("consult_history", [])
+    st.session_state["consult_seq"] = st.session_state.get("consult_seq", 0) + 1
+    history.insert(0, {
+        "id": st.session_state["consult_seq"],
+        "filename": filename,
+        "model_name": model_name,
+        "from_cache": from_cache,
+        "processed_at": datetime.now().strftime("%H:%M:%S"),
+        "parsed_json": parsed_json,
+    })
+    del history[SESSION_HISTORY_SIZE:]
+
+
+@fragment
+def render_results(parsed_json, key_prefix=""):
+    """Muestra la información médica de un JSON parseado. ``key_prefix`` distingue los widgets de cada consulta."""
+    try:
+        # Verifica la estructura básica esperada del JSON
+        if parsed_json.get("status") == "OK" and "data" in parsed_json and isinstance(parsed_json.get("data"), dict) and "existing-mrs" in parsed_json["data"]:
+            informacion_medica = parsed_json["data"]["existing-mrs"]
+            st.success("Mostrando información médica extraída del audio:")
+
+            # --- SECCIONES DE VISUALIZACIÓN (SIN CAMBIOS RESPECTO A TU CÓDIGO ORIGINAL) ---
+
+            # SECCION: Consulta (3 Columnas)
+            with st.expander("Detalles de la Consulta", expanded=True):
+                col_motivo, col_enf, col_ant = st.columns(3)
+                with col_motivo:
+                    st.subheader("Motivo Consulta")
+                    st.text_area("MotivoConsulta_disp", value=informacion_medica.get("MotivoConsulta", "No encontrado"), height=200, label_visibility="collapsed", disabled=True, key=f"{key_prefix}motivo_c_disp")
+                with col_enf:
+                    st.subheader("Enfermedad Actual")
+                    st.text_area("EnfermedadActual_disp", value=informacion_medica.get("EnfermedadActual", "No encontrado"), height=200, label_visibility="collapsed", disabled=True, key=f"{key_prefix}enf_act_disp")
+                with col_ant:
+                    st.subheader("Antecedentes")
+                    st.text_area("Antecedentes_disp", value=informacion_medica.get("Antecedentes", "No encontrado"), height=200, label_visibility="collapsed", disabled=True, key=f"{key_prefix}antec_disp")
+
+            # SECCION: Examen Físico
+            with st.expander("Examen Físico"):
+                st.text_area("ExamenFisico_disp", value=informacion_medica.get("ExamenFisico", "No encontrado"), height=150, label_visibility="collapsed", disabled=True, key=f"{key_prefix}exam_fis_disp")
+
+            # SECCION: Signos Vitales (Usando st.metric)
+            with st.expander("Signos Vitales"):
+                signos_vitales_data = informacion_medica.get("SignosVitales", {})
+                normalized_vitals = vitals.from_consult(parsed_json)
+                if normalized_vitals.summary():
+                    # Valores normalizados localmente (unidades fijas e IMC calculado con peso y talla)
+                    vitals_metrics = [
+                        ("TAS", normalized_vitals.tas_mmhg, "mmHg"), ("TAD", normalized_vitals.tad_mmhg, "mmHg"),
+                        ("FC", normalized_vitals.fc_lpm, "lpm"), ("Peso", normalized_vitals.peso_kg, "kg"),
+                        ("Talla", normalized_vitals.talla_m, "m"), ("IMC", normalized_vitals.imc, ""),
+                    ]
+                    cols_sv = st.columns(len(vitals_metrics))
+                    for col, (label, value, unit) in zip(cols_sv, vitals_metrics):
+                        with col:
+                            st.metric(label=label, value=f"{value:g} {unit}".strip() if value is not None else "---")
+                    if normalized_vitals.imc is not None:
+                        st.caption("IMC calculado con peso y talla." if normalized_vitals.imc_calculado else "IMC informado en la consulta (falta peso o talla).")
+                    for alerta in normalized_vitals.alertas:
+                        st.warning(f"Revisar signos vitales: {alerta}")
+                elif isinstance(signos_vitales_data, dict) and signos_vitales_data:
+                    num_sv = len(signos_vitales_data)
+                    cols_sv = st.columns(min(num_sv, 6)) # Máximo 6 columnas para SV
+                    i = 0
+                    sv_order = ["TAS", "TAD", "FC", "PESO", "Size", "IMC"] # Orden preferido
+                    displayed_keys = set()
+                    # Mostrar en orden preferido
+                    for key in sv_order:
+                        if key in signos_vitales_data:
+                            value = signos_vitales_data[key]
+                            display_value = str(value) if str(value).upper() != "NO_ENCONTRADO" and value is not None else "---"
+                            with cols_sv[i % min(num_sv, 6)]:
+                                st.metric(label=key, value=display_value)
+                            displayed_keys.add(key)
+                            i += 1
+                    # Mostrar claves restantes
+                    extra_keys = [k for k in signos_vitales_data if k not in displayed_keys]
+                    for key in extra_keys:
+                        value = signos_vitales_data[key]
+                        display_value = str(value) if str(value).upper() != "NO_ENCONTRADO" and value is not None else "---"
+                        with cols_sv[i % min(num_sv, 6)]:
+                            st.metric(label=key, value=display_value)
+                        i += 1
+                else:
+                    st.info("No se encontraron datos de Signos Vitales.")
+
+            # SECCION: Exámenes
+            with st.expander("Exámenes Solicitados/Resultados"):
+                examenes_data = informacion_medica.get("Examenes", [])
+                if isinstance(examenes_data, list):
+                    if examenes_data:
+                        for examen_dict in examenes_data:
+                            if isinstance(examen_dict, dict):
+                                name = examen_dict.get("Name", "N/E")
+                                resultado = examen_dict.get("Resultado", "N/E")
+                                unidad = examen_dict.get("UnidadMedida", "")
+                                display_text = f"- **{name}:** {resultado}"
+                                if unidad and str(unidad).upper() != "NO_ENCONTRADO": display_text += f" {unidad}"
+                                st.markdown(display_text)
+                            else: st.warning(f"Elemento inesperado en Examenes: {examen_dict}")
+                    else: st.info("No se especificaron exámenes.")
+                else: st.warning(f"Formato inesperado para Examenes: {type(examenes_data)}")
+
+            # SECCION: Diagnósticos
+            with st.expander("Diagnósticos"):
+                diagnosticos_data = informacion_medica.get("Diagnosticos", [])
+                if isinstance(diagnosticos_data, list):
+                    if diagnosticos_data:
+                        for diag_dict in diagnosticos_data:
+                            if isinstance(diag_dict, dict):
+                                nombre_diag = diag_dict.get("Nombre", "N/E")
+                                diag_id = diag_dict.get("ID", "")
+                                display_text = f"- **{nombre_diag}**"
+                                if diag_id and str(diag_id).strip().upper() != "NO_ENCONTRADO": display_text += f" (ID: {diag_id})"
+                                if diag_dict.get("IDModelo"): display_text += f" — corregido con la tabla CIE-10 local (el modelo indicó {diag_dict['IDModelo']})"
+                                st.markdown(display_text)
+                            else: st.warning(f"Elemento inesperado en Diagnosticos: {diag_dict}")
+                    else: st.info("No se especificaron diagnósticos.")
+                else: st.warning(f"Formato inesperado para Diagnosticos: {type(diagnosticos_data)}")
+
+            # SECCION: Medicamentos
+            with st.expander("Medicamentos Indicados"):
+                medicamentos_data = informacion_medica.get("Medicinas", [])
+                if isinstance(medicamentos_data, list):
+                    if medicamentos_data:
+                        for i, med_dict in enumerate(medicamentos_data):
+                            if isinstance(med_dict, dict):
+                                nombre = med_dict.get("Nombre", f"Med_{i+1}")
+                                presentacion = med_dict.get("Presentacion", "")
+                                dosis = med_dict.get("Dosis", "N/E")
+                                st.markdown(f"**{nombre}** {f'({presentacion})' if presentacion else ''}")
+                                st.text_area(f"Dosis_{i}_disp", value=dosis, key=f"{key_prefix}med_dosis_disp_{i}", height=68, label_visibility="collapsed", disabled=True)
+                                if i < len(medicamentos_data) - 1: st.divider() # Separador entre meds
+                            else: st.warning(f"Elemento inesperado en Medicinas: {med_dict}")
+                    else: st.info("No se especificaron medicamentos.")
+                else: st.warning(f"Formato inesperado para Medicinas: {type(medicamentos_data)}")
+
+            # SECCION: Plan de Acción
+            with st.expander("Plan de Acción"):
+                plan_data = informacion_medica.get("PlanDeAccion", [])
+                if isinstance(plan_data, list):
+                    if plan_data:
+                        items_markdown = []
+                        for item_dict in plan_data:
+                            if isinstance(item_dict, dict) and len(item_dict) == 1:
+                                instruccion = list(item_dict.values())[0]
+                                if instruccion: items_markdown.append(f"- {instruccion}")
+                            elif isinstance(item_dict, str) and item_dict: # Acepta strings directamente
+                                items_markdown.append(f"- {item_dict}")
+                        if items_markdown: st.markdown("\n".join(items_markdown))
+                        else: st.info("Plan de acción vacío o con formato no reconocido.")
+                    else: st.info("No se especificó plan de acción.")
+                elif isinstance(plan_data, str) and plan_data: # Acepta string simple
+                     st.markdown(f"Plan: {plan_data}")
+                else: st.warning(f"Formato inesperado o vacío para PlanDeAccion: {type(plan_data)}")
+
+
+            # SECCION: Días de Reposo
+            with st.expander("Indicación de Reposo"):
+                dias_reposo_val = str(informacion_medica.get("DiasReposo", "NO_ENCONTRADO"))
+                if dias_reposo_val.upper() != "NO_ENCONTRADO" and dias_reposo_val.strip():
+                     if dias_reposo_val.isdigit():
+                        st.metric("Días de Reposo Indicados", value=dias_reposo_val)
+                     else: # Si no es número, muestra el texto
+                        st.write(f"Indicación: {dias_reposo_val}")
+                else:
+                    st.info("No se especificó indicación de reposo.")
+
+            # SECCION: Comentarios y Literal
+            with st.expander("Comentarios del Modelo y Transcripción Completa", expanded=False): # Inicia cerrado
+                col_comm, col_lit = st.columns(2)
+                with col_comm:
+                    st.subheader("Comentarios del Modelo")
+                    st.text_area("Comentarios_disp", value=informacion_medica.get("ComentariosModelo", ""), height=300, label_visibility="collapsed", disabled=True, key=f"{key_prefix}comm_mod_disp")
+                with col_lit:
+                    st.subheader("Transcripción Literal")
+                    st.text_area("Literal_disp", value=informacion_medica.get("Literal", "Transcripción no encontrada en el JSON"), height=300, label_visibility="collapsed", disabled=True, key=f"{key_prefix}lit_tx_disp")
+
+        # Mensaje si el JSON se parseó pero no tiene la estructura esperada
+        elif parsed_json and "message" in parsed_json:
+            st.error(f"Error en la respuesta JSON del modelo: {parsed_json.get('message', 'Mensaje no encontrado')}")
+        else:
+            st.error("El JSON generado por el modelo no tiene la estructura esperada (status, data, existing-mrs).")
+            # st.json(parsed_json if parsed_json else {"error": "No se pudo parsear JSON"}) # Opcional
+
+    except Exception as display_e:
+        # Error durante la visualización de los datos del JSON
+        st.error(f"Ocurrió un error al mostrar los datos del JSON: {display_e}")
+        st.exception(display_e) # Muestra traceback completo
+        # st.write("JSON problemático:") # Opcional
+        # st.json(parsed_json)
+
+
+# --- 3. Botón de Procesamiento y Lógica Principal ---
+st.divider()
+force_reprocess = st.checkbox(
+    "Forzar reprocesamiento (ignorar caché de resultados)",
+    value=False,
+    help="Por defecto, si el mismo audio ya se procesó con este modelo y prompt, se muestra el resultado guardado."
+)
+cache_stats = result_cache.get_result_cache().stats()
+st.caption(
+    f"Caché de resultados: {cache_stats['hits']} aciertos / {cache_stats['misses']} fallos · "
+    f"{cache_stats['entries']} entradas ({cache_stats['bytes'] / (1024 * 1024):.1f} MB)"
+)
+preprocess_enabled = st.checkbox(
+    "Preprocesar audio antes de subir (mono, 16 kHz, recorte de silencios largos, Opus)",
+    value=False,
+    disabled=not audio_preprocess.ffmpeg_available(),
+    help="Reduce el tamaño y la duración del audio enviado. Requiere ffmpeg instalado en el servidor."
+)
+if not audio_preprocess.ffmpeg_available():
+    st.caption("Preprocesamiento no disponible: ffmpeg no está instalado (ver packages.txt).")
+segment_long_audio = st.checkbox(
+    f"Modo audio largo: dividir consultas de más de {long_audio.LONG_AUDIO_THRESHOLD_S // 60} min en segmentos procesados en paralelo",
+    value=False,
+    disabled=not audio_preprocess.ffmpeg_available(),
+    help=(f"Segmentos de {long_audio.SEGMENT_S // 60} min con {long_audio.SEGMENT_OVERLAP_S} s de solape. "
+          "Los diagnósticos, medicinas y exámenes se deduplican y la transcripción se une en orden. "
+          "Evita que una consulta larga agote el tiempo máximo de generación.")
+)
+stream_results = not batch_mode and st.checkbox(
+    "Mostrar los campos a medida que se generan (streaming)",
+    value=True,
+    help="Muestra Motivo de Consulta, Signos Vitales, Diagnósticos, etc. en cuanto el modelo los completa."
+)
+scheduler_rows = scheduler.rows()
+if any(row["Atendidas"] or row["En cola"] for row in scheduler_rows):
+    with st.expander("Cuota de las APIs (todas las sesiones)", expanded=False):
+        st.dataframe(scheduler_rows, use_container_width=True, hide_index=True)
+        st.caption(f"Límites: Gemini {config.GEMINI_RPM:g} solicitudes/min y {config.GEMINI_TPM:g} tokens/min; "
+                   f"Sheets {config.SHEETS_RPM:g} escrituras/min. Los 429/503 se reintentan automáticamente.")
+stage_metrics_rows = metrics.registry.rows()
+if stage_metrics_rows:
+    with st.expander("Métricas por etapa (proceso)", expanded=False):
+        st.dataframe(stage_metrics_rows, use_container_width=True, hide_index=True)
+        st.download_button("Descargar métricas (formato Prometheus)", metrics.prometheus_text(),
+                           file_name="citamed_metrics.prom", mime="text/plain")
+        if config.METRICS_PORT:
+            st.caption(f"Endpoint para Prometheus: http://<host>:{config.METRICS_PORT}/metrics")
+prompt_cache_rows = prompt_cache.stats.rows()
+if prompt_cache.enabled() and prompt_cache_rows:
+    with st.expander("Caché de contexto del prompt (proceso)", expanded=False):
+        st.dataframe(prompt_cache_rows, use_container_width=True, hide_index=True)
+        for model_name, reason in prompt_cache.context.unsupported().items():
+            st.caption(f"{model_name} envía el prompt completo: {reason}")
+file_reuse = file_registry.get_registry().summary(count_active=False)
+if file_reuse["uploads"] or file_reuse["reuse_hits"] or file_reuse["deleted"] or file_reuse["orphans_deleted"]:
+    with st.expander("Archivos en Google AI: reutilización y limpieza (proceso)", expanded=False):
+        st.dataframe(file_registry.get_registry().rows(), use_container_width=True, hide_index=True)
+        st.caption("Un audio ya subido se reutiliza (sin subir ni esperar PROCESSING) hasta que vence su TTL "
+                   "(CITAMED_FILE_TTL_S). Los archivos vencidos y los huérfanos de sesiones anteriores se borran en segundo plano.")
+log_row_rows = log_format.stats.rows()
+if log_row_rows:
+    with st.expander("Tamaño de las filas del log (proceso)", expanded=False):
+        st.dataframe(log_row_rows, use_container_width=True, hide_index=True)
+        st.caption("Bytes de cada fila enviada a Google Sheets frente al formato anterior (JSON con sangría y Literal repetido). "
+                   "Formato: CITAMED_LOG_JSON_FORMAT (legacy, compact o zlib).")
+parse_stats_rows = json_output.parse_stats.rows()
+if parse_stats_rows:
+    with st.expander("Estadísticas de parseo JSON por modelo", expanded=False):
+        st.dataframe(parse_stats_rows, use_container_width=True, hide_index=True)
+background_jobs = st.checkbox(
+    "Procesar en segundo plano (cola de trabajos)",
+    value=False,
+    help=("El audio se envía a una cola persistente y lo procesa un worker (python worker.py). "
+          "El trabajo sigue aunque se recargue la pestaña o se corte la conexión; los resultados aparecen abajo.")
+)
+# El botón se deshabilita si falta la API Key de Gemini o no se ha subido archivo
+process_button_disabled = not api_key_configured or not (uploaded_files if batch_mode else uploaded_file)
+if background_jobs:
+    if st.button("2. Enviar a la Cola de Trabajos", disabled=process_button_disabled):
+        submit_jobs(uploaded_files if batch_mode else [uploaded_file], selected_model_name)
+elif batch_mode:
+    if st.button("2. Procesar Lote de Audios", disabled=process_button_disabled):
+        ensure_genai_configured()
+        process_batch(uploaded_files, selected_model_name, batch_workers)
+elif compare_mode:
+    if st.button("2. Comparar Modelos", disabled=process_button_disabled or len(compare_model_names) < 2):
+        ensure_genai_configured()
+        compare_models(uploaded_file, compare_model_names)
+    elif len(compare_model_names) < 2:
+        st.caption("Elige al menos dos modelos para comparar.")
+elif st.button("2. Procesar Audio y Generar Información", disabled=process_button_disabled):
+
+    # Solo procede si hay archivo y la API de Gemini está lista
+    if uploaded_file is not None and api_key_configured:
+        ensure_genai_configured()
+        st.info(f"Archivo '{uploaded_file.name}' cargado. Usando modelo '{selected_model_name}'. Iniciando procesamiento...")
+        process_single(uploaded_file, selected_model_name)
 
     # Mensajes si el botón se presionó pero faltaban requisitos
     elif not uploaded_file:
@@ -704,6 +921,130 @@ if st.button("2. Procesar Audio y Generar Información", disabled=process_button
     elif not api_key_configured:
          st.error("La API Key de Gemini no está configurada. No se puede procesar.")
 
+# --- 3.5 Trabajos en segundo plano de esta sesión (se refrescan solos) ---
+render_jobs()
+
+# --- 4. Mostrar Resultados del Procesamiento (guardados en la sesión, persisten entre reruns) ---
+consult_history = st.session_state.get("consult_history", [])
+if consult_history:
+    st.divider()
+    st.subheader("3. Resultados del Procesamiento")
+    if len(consult_history) > 1:
+        selected_index = st.selectbox(
+            "Consultas de esta sesión:",
+            options=range(len(consult_history)),
+            format_func=lambda i: f"{consult_history[i]['processed_at']} · {consult_history[i]['filename']} ({consult_history[i]['model_name']})",
+            help=f"Se conservan las últimas {SESSION_HISTORY_SIZE} consultas procesadas en esta sesión del navegador."
+        )
+    else:
+        selected_index = 0
+    selected_consult = consult_history[selected_index]
+    st.caption(f"Archivo: {selected_consult['filename']} · Modelo: {selected_consult['model_name']} · "
+               f"Procesado a las {selected_consult['processed_at']}{' (desde la caché)' if selected_consult['from_cache'] else ''}")
+    render_results(selected_consult["parsed_json"], key_prefix=f"consult_{selected_consult['id']}_")
+    with st.expander("Ver/Ocultar JSON completo", expanded=False):
+        st.json(selected_consult["parsed_json"], expanded=False)
+
+# --- Estado de la Cola de Registros (Google Sheets) ---
+if google_sheets_configured:
+    st.divider()
+    log_writer = get_log_writer()
+    flusher = log_writer.flusher
+    pending_rows = flusher.pending_rows # Recuento del hilo de envío: el rerun no consulta la cola
+    col_pending, col_sent, col_calls = st.columns(3)
+    col_pending.metric("Registros pendientes de envío", pending_rows)
+    col_sent.metric("Registros enviados (proceso)", flusher.rows_sent)
+    col_calls.metric("Llamadas a append_rows", flusher.api_calls)
+    if flusher.last_error:
+        st.warning(f"GSHEET: Último error al enviar la cola (se reintentará automáticamente): {flusher.last_error}")
+    if pending_rows and st.button("Enviar registros pendientes ahora"):
+        # Envío en primer plano para ver errores de conexión/permisos en pantalla
+        gc = connect_to_gsheet()
+        worksheet = get_worksheet(gc) if gc else None
+        if worksheet:
+            try:
+                with st.spinner("Enviando registros pendientes a Google Sheet..."):
+                    sent_rows = 0
+                    while True:
+                        n = log_writer.spool.flush_batch(worksheet)
+                        if not n:
+                            break
+                        sent_rows += n
+                st.success(f"✅ {sent_rows} registros enviados a Google Sheet.")
+            except Exception as flush_err:
+                st.error(f"GSHEET Error al enviar registros pendientes: {flush_err}")
+
+# --- Búsqueda en el Historial (copia local de la hoja, sin llamadas a la API) ---
+@fragment
+def render_log_search():
+    """Búsqueda y análisis sobre la copia local; sus widgets solo reejecutan esta sección.
+
+    La copia se sincroniza en un hilo de fondo (log_mirror.start_background_sync) y
+    el estado y los resultados se leen de memoria: un rerun no lee la hoja ni la base.
+    """
+    st.divider()
+    st.subheader("Buscar en el Historial")
+    mirror = log_mirror.get_log_mirror()
+    syncer = log_mirror.start_background_sync(make_worksheet_factory())
+    col_sync, col_rebuild = st.columns(2)
+    sync_now = col_sync.button("Sincronizar ahora", help="Copia solo las filas añadidas a la hoja desde la última sincronización.")
+    rebuild = col_rebuild.button("Reconstruir copia completa", help="Vuelve a leer toda la hoja (si se editaron o borraron filas).")
+    if sync_now or rebuild:
+        gc = connect_to_gsheet()
+        worksheet = get_worksheet(gc) if gc else None
+        if worksheet:
+            try:
+                with st.spinner("Sincronizando la copia local del historial..."):
+                    mirror.sync(worksheet, full=rebuild)
+            except Exception as sync_err:
+                st.warning(f"GSHEET: No se pudo sincronizar la copia local (se muestran los datos ya copiados): {sync_err}")
+    elif syncer is not None and syncer.last_error:
+        st.caption(f"Última sincronización automática fallida (se reintentará): {syncer.last_error}")
+    mirror_status = mirror.status()
+    last_sync = datetime.fromtimestamp(mirror_status["last_sync_at"]).strftime("%Y-%m-%d %H:%M:%S") if mirror_status["last_sync_at"] else "nunca"
+    st.caption(f"Copia local: {mirror_status['consults']} consultas ({mirror_status['bytes'] / (1024 * 1024):.1f} MB) · "
+               f"última sincronización: {last_sync} (+{mirror_status['last_sync_added']} filas)"
+               f"{'' if mirror_status['fts'] else ' · búsqueda de texto sin FTS5'}")
+    tab_search, tab_stats = st.tabs(["Búsqueda", "Análisis"])
+    with tab_search:
+        col_text, col_dx, col_med = st.columns(3)
+        search_text = col_text.text_input("Texto en la transcripción o archivo", key="log_search_text")
+        search_dx = col_dx.text_input("Diagnóstico (nombre o código CIE-10)", key="log_search_dx")
+        search_med = col_med.text_input("Medicamento", key="log_search_med")
+        search_dates = st.date_input("Rango de fechas", value=(), key="log_search_dates")
+        since = search_dates[0] if len(search_dates) > 0 else None
+        until = search_dates[1] if len(search_dates) > 1 else since
+        if search_text or search_dx or search_med or since:
+            search_rows = mirror.search(search_text, search_dx, search_med, since, until)
+            st.caption(f"{len(search_rows)} consultas encontradas" + (f" (se muestran las {log_mirror.SEARCH_LIMIT} más recientes)" if len(search_rows) == log_mirror.SEARCH_LIMIT else ""))
+            if search_rows:
+                st.dataframe(search_rows, use_container_width=True, hide_index=True)
+                selected_row = st.selectbox(
+                    "Ver consulta:", options=[row["Fila"] for row in search_rows],
+                    format_func=lambda n: next(f"{row['Timestamp']} · {row['Archivo']}" for row in search_rows if row["Fila"] == n),
+                    key="log_search_row",
+                )
+                record = mirror.get(selected_row) or {}
+                try:
+                    st.json(json.loads(record.get("JSON_Completo") or ""), expanded=False)
+                except ValueError:
+                    st.json(record, expanded=False)
+    with tab_stats:
+        stats_since = st.date_input("Desde", value=None, key="log_stats_since")
+        per_day = mirror.consults_per_day(stats_since)
+        if per_day:
+            st.caption("Consultas por día")
+            st.bar_chart(per_day)
+            col_dx_top, col_med_top = st.columns(2)
+            col_dx_top.dataframe(mirror.top_diagnoses(stats_since), use_container_width=True, hide_index=True)
+            col_med_top.dataframe(mirror.top_medications(stats_since), use_container_width=True, hide_index=True)
+        else:
+            st.caption("La copia local aún no tiene consultas.")
+
+
+if google_sheets_configured:
+    render_log_search()
+
 # --- Sección Opcional: Hora Actual ---
 st.divider()
 try:
@@ -718,4 +1059,10 @@ col1, col2 = st.columns([1, 1])
 with col1:
     st.caption(f"Hora actual: {current_time_str}")
 with col2:
-    st.link_button("Ver Historial", "https://docs.google.com/spreadsheets/d/1Unu2MvvBszTVlOz9eu_NPwOBea3xf6R4H9n9vYIoS-w/edit?usp=sharing")
\ No newline at end of file
+    st.link_button("Ver Historial", "https://docs.google.com/spreadsheets/d/1Unu2MvvBszTVlOz9eu_NPwOBea3xf6R4H9n9vYIoS-w/edit?usp=sharing")
+
+# --- Tiempos de ejecución del script (arranque en frío y reruns) ---
+startup.run_timings.record(time.perf_counter() - _script_start)
+run_stats = startup.run_timings.summary()
+rerun_msg = f" · rerun típico: {run_stats['rerun_p50_s'] * 1000:.0f} ms ({run_stats['reruns']} reruns)" if run_stats["reruns"] else ""
+st.caption(f"Arranque en frío: {run_stats['cold_start_s'] * 1000:.0f} ms{rerun_msg}")
\ No newline at end of file
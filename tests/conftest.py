@@ -0,0 +1,8 @@
+"""Configuración común de las pruebas: módulos de la raíz importables y datos locales en un directorio temporal."""
+import os
+import sys
+import tempfile
+
+# config.py lee CITAMED_DATA_DIR al importarse: las pruebas no deben tocar el .citamed del repositorio
+os.environ.setdefault("CITAMED_DATA_DIR", tempfile.mkdtemp(prefix="citamed-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,65 @@
+import pytest
+
+import cie10
+
+
+@pytest.fixture(scope="module")
+def index():
+    return cie10.Cie10Index(cie10.load_table(cie10.DEFAULT_TABLE_PATH))
+
+
+@pytest.mark.parametrize("name", [
+    "hipertension arterial sistemica",
+    "HIPERTENSIÓN ARTERIAL",
+    "hipertencion arterial sistemica",  # Errata
+])
+def test_completa_el_codigo_que_falta(index, name):
+    check = index.check(name, None)
+    assert (check.accion, check.id) == (cie10.ACTION_FILLED, "I10")
+
+
+def test_corrige_un_codigo_de_otra_enfermedad(index):
+    check = index.check("Hipertensión arterial", "E11.9")
+    assert (check.accion, check.id, check.id_modelo) == (cie10.ACTION_CORRECTED, "I10", "E11.9")
+
+
+def test_confirma_un_codigo_de_la_misma_categoria(index):
+    check = index.check("diabetes tipo 2", "E11.2")
+    assert (check.accion, check.id) == (cie10.ACTION_CONFIRMED, "E11.2")
+
+
+def test_normaliza_el_formato_del_codigo(index):
+    check = index.check("Diabetes tipo 2", "e119")
+    assert (check.accion, check.id) == (cie10.ACTION_CONFIRMED, "E11.9")
+
+
+def test_no_decide_un_nombre_ambiguo(index):
+    # "fractura" se parece igual a varias categorías: no se completa
+    check = index.check("fractura", None)
+    assert check.accion == cie10.ACTION_NO_MATCH
+    assert check.id is None
+
+
+def test_deja_sin_verificar_un_codigo_fuera_de_la_tabla(index):
+    check = index.check("algo raro", "Z99.9")
+    assert (check.accion, check.id) == (cie10.ACTION_UNVERIFIED, "Z99.9")
+
+
+def test_apply_modifica_diagnosticos_en_el_sitio(index):
+    parsed = {"data": {"existing-mrs": {"Diagnosticos": [
+        {"Nombre": "Hipertensión arterial", "ID": "E11.9"},
+        {"Nombre": "hta", "ID": ""},
+        {"ID": "I10"},  # Sin nombre: no se revisa
+    ]}}}
+    checks = cie10.apply(parsed, index)
+    assert cie10.summarize(checks) == {cie10.ACTION_CORRECTED: 1, cie10.ACTION_FILLED: 1}
+    assert parsed["data"]["existing-mrs"]["Diagnosticos"] == [
+        {"Nombre": "Hipertensión arterial", "ID": "I10", "IDModelo": "E11.9"},
+        {"Nombre": "hta", "ID": "I10"},
+        {"ID": "I10"},
+    ]
+
+
+def test_apply_tolera_json_sin_diagnosticos(index):
+    assert cie10.apply({"data": {"existing-mrs": {}}}, index) == []
+    assert cie10.apply(None, index) == []
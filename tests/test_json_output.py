@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+import json_output
+
+
+@pytest.mark.parametrize("malformed, expected", [
+    ('{"a": 1,}', {"a": 1}),
+    ('{"a": [1, 2,], "b": {"c": true,},}', {"a": [1, 2], "b": {"c": True}}),
+    ('{"a": [1, 2, // comentario\n 3]}', {"a": [1, 2, 3]}),
+    ('{"a": /* bloque */ "x"}', {"a": "x"}),
+    ('{"url": "http://ejemplo.com/a//b"}', {"url": "http://ejemplo.com/a//b"}),
+    ('{"a": {"b": "tru', {"a": {"b": "tru"}}),
+    ('{"a": "x", "b": [1, 2', {"a": "x", "b": [1, 2]}),
+    ('{"a": 1, "b', {"a": 1}),
+])
+def test_repair_json_produce_json_valido(malformed, expected):
+    assert json.loads(json_output.repair_json(malformed)) == expected
+
+
+def test_repair_json_no_cambia_json_valido():
+    text = json.dumps({"Literal": 'dijo "no, gracias" // y se fue', "Lista": [1, {"x": None}]}, ensure_ascii=False)
+    assert json.loads(json_output.repair_json(text)) == json.loads(text)
+
+
+def test_parse_model_json_directo():
+    assert json_output.parse_model_json('{"a": 1}') == ({"a": 1}, "direct")
+
+
+def test_parse_model_json_extrae_el_bloque_y_lo_repara():
+    response = 'Aquí está el resultado:\n```json\n{"a": 1, "b": [2,],}\n```\nSaludos.'
+    assert json_output.parse_model_json(response) == ({"a": 1, "b": [2]}, "repaired")
+
+
+def test_parse_model_json_sin_json_lanza_el_error_original():
+    with pytest.raises(json.JSONDecodeError):
+        json_output.parse_model_json("El audio no contiene una consulta médica.")
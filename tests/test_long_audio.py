@@ -0,0 +1,46 @@
+from long_audio import NOT_FOUND, dedupe_items, join_transcripts
+
+
+def test_dedupe_items_une_por_nombre_normalizado_y_completa_campos_vacios():
+    items = [
+        {"Nombre": "Hipertensión arterial", "ID": ""},
+        {"Nombre": "hipertension  ARTERIAL", "ID": "I10"},
+    ]
+    assert dedupe_items(items, ("Nombre", "ID")) == [{"Nombre": "Hipertensión arterial", "ID": "I10"}]
+
+
+def test_dedupe_items_une_un_elemento_sin_nombre_con_el_de_su_codigo():
+    items = [
+        {"Nombre": NOT_FOUND, "ID": "E11.9"},
+        {"Nombre": "Diabetes tipo 2", "ID": "E11.9"},
+    ]
+    assert dedupe_items(items, ("Nombre", "ID")) == [{"Nombre": "Diabetes tipo 2", "ID": "E11.9"}]
+
+
+def test_dedupe_items_conserva_nombres_distintos_con_el_mismo_codigo():
+    items = [
+        {"Nombre": "Diabetes tipo 2", "ID": "E11.9"},
+        {"Nombre": "Diabetes no insulinodependiente", "ID": "E11.9"},
+        "no es un dict",
+    ]
+    assert dedupe_items(items, ("Nombre", "ID")) == items[:2]
+
+
+def test_dedupe_items_no_modifica_los_elementos_de_entrada():
+    first = {"Nombre": "Losartán", "Dosis": ""}
+    dedupe_items([first, {"Nombre": "losartan", "Dosis": "50 mg"}], ("Nombre",))
+    assert first == {"Nombre": "Losartán", "Dosis": ""}
+
+
+def test_join_transcripts_elimina_la_repeticion_del_solape():
+    parts = ["uno dos tres cuatro cinco seis siete", "Cuatro, cinco seis siete ocho nueve"]
+    assert join_transcripts(parts) == "uno dos tres cuatro cinco seis siete ocho nueve"
+
+
+def test_join_transcripts_sin_solape_concatena_y_omite_vacios():
+    assert join_transcripts(["hola que tal", None, NOT_FOUND, "", "adiós amigo"]) == "hola que tal adiós amigo"
+
+
+def test_join_transcripts_no_recorta_coincidencias_cortas():
+    # Menos de LITERAL_OVERLAP_MIN_WORDS palabras en común no se tratan como solape
+    assert join_transcripts(["dolor de cabeza", "de cabeza fuerte"]) == "dolor de cabeza de cabeza fuerte"
@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+
+import scheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condición no cumplida a tiempo")
+        time.sleep(0.005)
+
+
+def test_token_bucket_repone_a_la_tasa_configurada():
+    clock = FakeClock()
+    bucket = scheduler.TokenBucket(60, clock=clock)  # 1 por segundo, ráfaga de 60
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0)
+    clock.advance(0.5)
+    assert bucket.wait_time(1) == pytest.approx(0.5)
+    clock.advance(0.5)
+    assert bucket.wait_time(1) == 0.0
+
+
+def test_token_bucket_no_supera_la_capacidad_y_admite_deuda():
+    clock = FakeClock()
+    bucket = scheduler.TokenBucket(60, capacity=10, clock=clock)
+    clock.advance(3600)
+    assert bucket.level == 10  # No acumula más que la ráfaga
+    bucket.take(10)
+    assert bucket.wait_time(100) == pytest.approx(10.0)  # Más que la ráfaga: basta con la cubeta llena
+    bucket.take(5)
+    assert bucket.wait_time(1) == pytest.approx(6.0)  # La deuda retrasa a los siguientes
+
+
+def test_token_bucket_adjust_corrige_con_el_uso_real():
+    clock = FakeClock()
+    bucket = scheduler.TokenBucket(60, clock=clock)
+    bucket.take(30)
+    bucket.adjust(-20)  # Se estimaron 20 tokens de más
+    assert bucket.level == pytest.approx(50)
+
+
+def test_api_scheduler_atiende_las_sesiones_por_turnos():
+    clock = FakeClock()
+    api = scheduler.ApiScheduler("prueba", requests_per_minute=1, clock=clock, queue_timeout_s=10_000)
+    api.acquire(session="a")  # Agota la cubeta: las siguientes esperan en la cola
+    granted = []
+
+    def request(name, session):
+        queued = threading.Event()
+        thread = threading.Thread(target=lambda: (api.acquire(session=session, on_wait=lambda *_: queued.set()),
+                                                  granted.append(name)), daemon=True)
+        thread.start()
+        assert queued.wait(5)  # Ya está en la cola: el orden de llegada es el de las llamadas
+        return thread
+
+    threads = [request("a2", "a"), request("a3", "a"), request("b1", "b"), request("a4", "a"), request("c1", "c")]
+    for expected_count in range(1, len(threads) + 1):
+        clock.advance(60)  # Repone una solicitud
+        with api._cond:
+            api._cond.notify_all()
+        wait_until(lambda: len(granted) == expected_count)
+    for thread in threads:
+        thread.join(5)
+    # La sesión "a" llegó primero con tres solicitudes, pero "b" y "c" no esperan a que termine
+    assert granted == ["b1", "c1", "a2", "a3", "a4"]
+    assert api.stats.granted == 6
+    assert api.stats.waited == 5
+
+
+def test_api_scheduler_respeta_el_limite_de_tokens():
+    clock = FakeClock()
+    api = scheduler.ApiScheduler("prueba", requests_per_minute=1000, tokens_per_minute=600, clock=clock)
+    api.acquire(tokens=600)
+    assert api._wait_for_budget(60) == pytest.approx(6.0)
+    api.settle(600, 300)  # La API informó la mitad de lo estimado
+    assert api._wait_for_budget(60) == 0.0
+
+
+def test_api_scheduler_reintenta_429_con_pausa_global(monkeypatch):
+    clock = FakeClock()
+    api = scheduler.ApiScheduler("prueba", requests_per_minute=1000, clock=clock)
+    monkeypatch.setattr(api, "backoff_delay", lambda attempt, hint_s=None: 0.0)
+    calls = []
+
+    class Throttled(Exception):
+        code = 429
+
+    def flaky():
+        calls.append(clock())
+        if len(calls) < 3:
+            raise Throttled("cuota")
+        return "ok"
+
+    assert api.call(flaky) == "ok"
+    assert (api.stats.retries, api.stats.throttled) == (2, 2)
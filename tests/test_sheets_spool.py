@@ -0,0 +1,61 @@
+import pytest
+
+import fakes
+import sheets_spool
+
+
+@pytest.fixture
+def spool_path(tmp_path):
+    return str(tmp_path / "spool.sqlite3")
+
+
+def test_la_reserva_excluye_a_otros_flushers_hasta_que_vence(spool_path):
+    first, second = sheets_spool.SheetsSpool(spool_path), sheets_spool.SheetsSpool(spool_path)
+    ids = [first.enqueue(["fila", i]) for i in range(3)]
+    assert [row_id for row_id, _ in first.peek(10)] == ids
+    assert second.peek(10) == []  # Reservadas por el otro proceso
+    assert first.peek(10) == []  # Tampoco se vuelven a entregar al mismo flusher
+    assert [row for _, row in second.peek(10, lease_s=-1)] == [["fila", i] for i in range(3)]  # Reserva vencida
+
+
+def test_flush_batch_envia_cada_fila_una_sola_vez(spool_path):
+    spool = sheets_spool.SheetsSpool(spool_path)
+    for i in range(5):
+        spool.enqueue(["fila", i])
+    worksheet = fakes.FakeWorksheet()
+    assert spool.flush_batch(worksheet, batch_size=3) == 3
+    assert spool.flush_batch(worksheet, batch_size=3) == 2
+    assert spool.flush_batch(worksheet, batch_size=3) == 0
+    assert worksheet.rows == [["fila", i] for i in range(5)]
+    assert spool.pending_count() == 0
+
+
+def test_un_envio_fallido_libera_la_reserva_y_se_reintenta(spool_path):
+    spool = sheets_spool.SheetsSpool(spool_path)
+    spool.enqueue(["fila", 1])
+    failing = fakes.FakeWorksheet(failure_rate=1.0, failure_status=429)
+    with pytest.raises(Exception):
+        spool.flush_batch(failing)
+    attempts, last_error, claimed_by = spool._conn.execute(
+        "SELECT attempts, last_error, claimed_by FROM pending_rows").fetchone()
+    assert (attempts, claimed_by) == (1, None)
+    assert last_error
+    worksheet = fakes.FakeWorksheet()
+    assert spool.flush_batch(worksheet) == 1
+    assert worksheet.rows == [["fila", 1]]
+    assert failing.rows == []
+
+
+def test_record_failure_no_libera_la_reserva_de_otro_flusher(spool_path):
+    owner, other = sheets_spool.SheetsSpool(spool_path), sheets_spool.SheetsSpool(spool_path)
+    row_id = owner.enqueue(["fila"])
+    owner.peek(10)
+    other.record_failure([row_id], "error ajeno")
+    assert other.peek(10) == []  # Sigue reservada por ``owner``
+
+
+def test_las_filas_sobreviven_a_reabrir_la_cola(spool_path):
+    sheets_spool.SheetsSpool(spool_path).enqueue(["durable", "ñ"])
+    reopened = sheets_spool.SheetsSpool(spool_path)
+    assert reopened.pending_count() == 1
+    assert [row for _, row in reopened.peek(10)] == [["durable", "ñ"]]
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from streaming_json import FieldStreamParser
+
+CONSULT = {
+    "data": {
+        "existing-mrs": {
+            "MotivoConsulta": 'dolor "agudo" en {hipocondrio} derecho',
+            "SignosVitales": {"FC": "78", "TAS": "120/80"},
+            "Diagnosticos": [{"Nombre": "Colecistitis", "ID": "K81.0"}],
+            "DiasReposo": 3,
+            "Literal": "doctor: buenos días\\n paciente: [me duele] aquí",
+        }
+    }
+}
+
+
+def feed_in_chunks(text, size):
+    parser = FieldStreamParser()
+    completed = []
+    for i in range(0, len(text), size):
+        completed.extend(parser.feed(text[i:i + size]))
+    return parser, completed
+
+
+@pytest.mark.parametrize("size", [1, 2, 7, 40, 10_000])
+def test_emite_cada_campo_una_vez_y_en_orden_con_cualquier_fragmentacion(size):
+    text = "```json\n" + json.dumps(CONSULT, ensure_ascii=False) + "\n```"
+    parser, completed = feed_in_chunks(text, size)
+    assert completed == list(CONSULT["data"]["existing-mrs"].items())
+    assert parser.fields == CONSULT["data"]["existing-mrs"]
+    assert parser.complete
+
+
+def test_no_emite_un_campo_hasta_que_su_valor_esta_completo():
+    parser = FieldStreamParser()
+    assert parser.feed('{"data": {"existing-mrs": {"MotivoConsulta": "dol') == []
+    assert parser.feed('or", "DiasReposo": 1') == [("MotivoConsulta", "dolor")]
+    assert parser.feed("2") == []  # El número puede seguir creciendo
+    assert parser.feed("}}}") == [("DiasReposo", 12)]
+    assert parser.complete
+
+
+def test_ignora_campos_fuera_de_existing_mrs():
+    text = json.dumps({"data": {"otro": {"MotivoConsulta": "x"}, "existing-mrs": {"Literal": "y"}}})
+    _, completed = feed_in_chunks(text, 5)
+    assert completed == [("Literal", "y")]
+
+
+def test_respuesta_truncada_conserva_los_campos_ya_completos():
+    text = json.dumps(CONSULT, ensure_ascii=False)
+    cut = text.index('"Literal"') + len('"Literal": "doctor')
+    parser, completed = feed_in_chunks(text[:cut], 16)
+    assert [name for name, _ in completed] == ["MotivoConsulta", "SignosVitales", "Diagnosticos", "DiasReposo"]
+    assert not parser.complete
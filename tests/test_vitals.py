@@ -0,0 +1,45 @@
+import vitals
+
+
+def test_normaliza_unidades_y_calcula_el_imc():
+    v = vitals.normalize({"FC": "78 lpm", "TAS": "120/80", "TAD": "NO_ENCONTRADO",
+                          "PESO": "78,5 kg", "Size": "170 cm", "IMC": "NO_ENCONTRADO"})
+    assert (v.fc_lpm, v.tas_mmhg, v.tad_mmhg, v.peso_kg, v.talla_m) == (78, 120, 80, 78.5, 1.7)
+    assert (v.imc, v.imc_calculado, v.alertas) == (27.2, True, [])
+
+
+def test_presion_en_cmhg_y_peso_en_libras():
+    v = vitals.normalize({"TAS": "12/8", "PESO": "172 lb", "Size": "1.70"})
+    assert (v.tas_mmhg, v.tad_mmhg, v.peso_kg, v.talla_m) == (120, 80, 78.0, 1.7)
+
+
+def test_usa_el_imc_informado_solo_sin_peso_o_talla():
+    assert vitals.normalize({"IMC": "31,2"}).imc == 31.2
+    v = vitals.normalize({"PESO": "80", "Size": "1,80 m", "IMC": "30"})
+    assert (v.imc, v.imc_calculado) == (24.7, True)
+    assert v.alertas == ["IMC informado 30 difiere del calculado 24.7"]
+
+
+def test_marca_valores_implausibles_sin_descartarlos():
+    v = vitals.normalize({"FC": "400", "TAS": "80", "TAD": "120", "PESO": "3500 g"})
+    assert (v.fc_lpm, v.peso_kg) == (400, 3.5)
+    assert v.alertas == ["FC fuera de rango (400)", "TAD mayor o igual que TAS"]
+
+
+def test_signos_ausentes_o_no_encontrados():
+    assert vitals.normalize(None) == vitals.Vitals()
+    assert vitals.normalize({name: "NO_ENCONTRADO" for name in vitals.FIELDS}) == vitals.Vitals()
+
+
+def test_normalize_columns_coincide_con_normalize():
+    rows = [{"FC": "78", "TAS": "12/8"}, {"FC": "78"}, None, {"PESO": "70 kilos", "Size": "175"}]
+    assert vitals.normalize_columns(rows) == [vitals.normalize(row) for row in rows]
+
+
+def test_apply_guarda_los_normalizados_y_fija_el_imc_calculado():
+    parsed = {"data": {"existing-mrs": {"SignosVitales": {"PESO": "80 kg", "Size": "1,80 m", "IMC": "NO_ENCONTRADO"}}}}
+    vitals.apply(parsed)
+    existing_mrs = parsed["data"]["existing-mrs"]
+    assert existing_mrs["SignosVitales"]["IMC"] == "24.7"
+    assert existing_mrs[vitals.NORMALIZED_KEY]["IMC"] == 24.7
+    assert vitals.from_consult(parsed) == vitals.normalize(existing_mrs["SignosVitales"])
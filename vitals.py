@@ -0,0 +1,297 @@
+"""Normalización local de ``SignosVitales``: valores numéricos, unidades, IMC y alertas.
+
+El modelo devuelve cadenas libres ("120", "120 mmHg", "1,70 m", "78 kilos",
+"12/8", ``NO_ENCONTRADO``). Aquí se convierten a números en unidades fijas
+(lpm, mmHg, kg, m), se calcula el IMC con peso y talla y se marcan los valores
+fuera de rango fisiológico. El IMC que informe el modelo solo se usa si falta
+el peso o la talla.
+
+``normalize_columns`` procesa lotes completos columna por columna: las cadenas
+repetidas (muy frecuentes en el historial) se convierten una sola vez. Con un
+JSONL de la CLI o del historial::
+
+    python vitals.py resultados.jsonl -o signos_vitales.csv
+"""
+import argparse
+import csv
+import json
+import re
+import sys
+from dataclasses import dataclass, field
+
+NOT_FOUND = "NO_ENCONTRADO"
+FIELDS = ("FC", "TAS", "TAD", "PESO", "Size", "IMC")
+NORMALIZED_KEY = "SignosVitalesNormalizados"  # Clave añadida a existing-mrs
+
+# Rangos plausibles por campo (fuera de ellos el valor se conserva, con alerta)
+PLAUSIBLE_RANGES = {
+    "FC": (25, 250),  # lpm
+    "TAS": (50, 280),  # mmHg
+    "TAD": (20, 180),  # mmHg
+    "PESO": (0.4, 350),  # kg (incluye neonatos)
+    "Size": (0.3, 2.5),  # m
+    "IMC": (10, 80),
+}
+IMC_MISMATCH = 1.0  # Diferencia tolerada entre el IMC del modelo y el calculado
+
+LB_TO_KG = 0.45359237
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+_PAIR_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*/\s*(\d+(?:[.,]\d+)?)")  # "120/80" o "12/8"
+_WEIGHT_UNIT_RE = re.compile(r"\b(kg|kgs|kilo|kilos|kilogramos?|lb|lbs|libras?|g|gr|gramos?)\b")
+_HEIGHT_UNIT_RE = re.compile(r"\b(m|mt|mts|metros?|cm|cms|centimetros?)\b")
+
+
+@dataclass
+class Vitals:
+    """Signos vitales en unidades fijas; None si no se mencionan o no se pudieron leer."""
+    fc_lpm: float | None = None
+    tas_mmhg: float | None = None
+    tad_mmhg: float | None = None
+    peso_kg: float | None = None
+    talla_m: float | None = None
+    imc: float | None = None
+    imc_calculado: bool = False  # True si el IMC se calculó con peso y talla
+    alertas: list = field(default_factory=list)
+
+    def as_json(self):
+        """Forma guardada en ``existing-mrs`` (claves en español, como el resto del JSON)."""
+        return {
+            "FC_lpm": self.fc_lpm, "TAS_mmHg": self.tas_mmhg, "TAD_mmHg": self.tad_mmhg,
+            "Peso_kg": self.peso_kg, "Talla_m": self.talla_m, "IMC": self.imc,
+            "IMC_Calculado": self.imc_calculado, "Alertas": list(self.alertas),
+        }
+
+    def summary(self):
+        """Resumen legible para la columna SignosVitales_Resumen."""
+        parts = []
+        if self.tas_mmhg is not None or self.tad_mmhg is not None:
+            parts.append(f"TA: {_fmt(self.tas_mmhg)}/{_fmt(self.tad_mmhg)} mmHg")
+        if self.fc_lpm is not None:
+            parts.append(f"FC: {_fmt(self.fc_lpm)} lpm")
+        if self.peso_kg is not None:
+            parts.append(f"Peso: {_fmt(self.peso_kg)} kg")
+        if self.talla_m is not None:
+            parts.append(f"Talla: {self.talla_m:.2f} m")
+        if self.imc is not None:
+            parts.append(f"IMC: {self.imc:.1f}" + ("" if self.imc_calculado else " (informado)"))
+        if self.alertas:
+            parts.append("Alertas: " + ", ".join(self.alertas))
+        return "; ".join(parts)
+
+
+def _fmt(value):
+    if value is None:
+        return "-"
+    return f"{value:g}" if value == int(value) else f"{value:.1f}"
+
+
+def _text(raw):
+    if raw is None:
+        return ""
+    text = str(raw).strip().lower()
+    return "" if not text or text.upper() == NOT_FOUND else text
+
+
+def _number(text):
+    match = _NUMBER_RE.search(text)
+    return float(match.group().replace(",", ".")) if match else None
+
+
+def parse_rate(raw):
+    """Frecuencia cardíaca en lpm ("78", "78 lpm", "78 x'")."""
+    return _number(_text(raw))
+
+
+def parse_pressure(raw, index=0):
+    """Presión en mmHg. Acepta "120/80" (``index`` elige el valor) y la forma en cmHg ("12/8")."""
+    text = _text(raw)
+    if not text:
+        return None
+    pair = _PAIR_RE.search(text)
+    value = float(pair.group(index + 1).replace(",", ".")) if pair else _number(text)
+    if value is not None and value < 30 and "mmhg" not in text:
+        value *= 10  # "doce ocho": cmHg
+    return value
+
+
+def parse_weight(raw):
+    """Peso en kg ("78", "78,5 kg", "172 lb", "3500 g")."""
+    text = _text(raw)
+    value = _number(text)
+    if value is None:
+        return None
+    unit = _WEIGHT_UNIT_RE.search(text)
+    unit = unit.group(1) if unit else ""
+    if unit.startswith(("lb", "libra")):
+        return round(value * LB_TO_KG, 1)
+    if unit in ("g", "gr") or unit.startswith("gramo"):
+        return round(value / 1000, 3)
+    return value
+
+
+def parse_height(raw):
+    """Talla en m ("1,70 m", "170 cm", "1.70"; sin unidad, más de 3 se toma como cm)."""
+    text = _text(raw)
+    value = _number(text)
+    if value is None:
+        return None
+    unit = _HEIGHT_UNIT_RE.search(text)
+    unit = unit.group(1) if unit else ""
+    if unit.startswith("c") or (not unit and value > 3):
+        return round(value / 100, 3)
+    return value
+
+
+def parse_bmi(raw):
+    return _number(_text(raw))
+
+
+PARSERS = {
+    "FC": parse_rate,
+    "TAS": lambda raw: parse_pressure(raw, 0),
+    "TAD": lambda raw: parse_pressure(raw, 1),
+    "PESO": parse_weight,
+    "Size": parse_height,
+    "IMC": parse_bmi,
+}
+
+
+def compute_bmi(peso_kg, talla_m):
+    if not peso_kg or not talla_m:
+        return None
+    return round(peso_kg / (talla_m * talla_m), 1)
+
+
+def _finish(values):
+    """Vitals a partir de los valores ya convertidos de un registro: IMC y alertas."""
+    vitals = Vitals(values["FC"], values["TAS"], values["TAD"], values["PESO"], values["Size"])
+    bmi = compute_bmi(vitals.peso_kg, vitals.talla_m)
+    reported = values["IMC"]
+    if bmi is not None:
+        vitals.imc, vitals.imc_calculado = bmi, True
+        if reported is not None and abs(reported - bmi) > IMC_MISMATCH:
+            vitals.alertas.append(f"IMC informado {reported:g} difiere del calculado {bmi:g}")
+    else:
+        vitals.imc = reported
+    checked = {"FC": vitals.fc_lpm, "TAS": vitals.tas_mmhg, "TAD": vitals.tad_mmhg,
+               "PESO": vitals.peso_kg, "Size": vitals.talla_m, "IMC": vitals.imc}
+    for name, value in checked.items():
+        low, high = PLAUSIBLE_RANGES[name]
+        if value is not None and not low <= value <= high:
+            vitals.alertas.append(f"{name} fuera de rango ({value:g})")
+    if vitals.tas_mmhg is not None and vitals.tad_mmhg is not None and vitals.tad_mmhg >= vitals.tas_mmhg:
+        vitals.alertas.append("TAD mayor o igual que TAS")
+    return vitals
+
+
+def _raw_fields(signos):
+    signos = signos if isinstance(signos, dict) else {}
+    raw = {name: signos.get(name) for name in FIELDS}
+    # "TA 120/80" en TAS sin TAD: el par completo sirve para ambos campos
+    if not _text(raw["TAD"]) and _PAIR_RE.search(_text(raw["TAS"])):
+        raw["TAD"] = raw["TAS"]
+    return raw
+
+
+def normalize(signos):
+    """Vitals de un diccionario ``SignosVitales``."""
+    raw = _raw_fields(signos)
+    return _finish({name: PARSERS[name](raw[name]) for name in FIELDS})
+
+
+def normalize_columns(signos_list):
+    """Normaliza un lote de ``SignosVitales``. Devuelve una lista de Vitals en el mismo orden.
+
+    Convierte columna por columna y memoriza cada cadena distinta, así que el
+    costo crece con los valores distintos y no con el número de registros.
+    """
+    raw_rows = [_raw_fields(signos) for signos in signos_list]
+    columns = {}
+    for name in FIELDS:
+        parser = PARSERS[name]
+        memo = {}
+        column = []
+        for row in raw_rows:
+            raw = row[name]
+            key = raw if isinstance(raw, (str, int, float, type(None))) else str(raw)
+            if key not in memo:
+                memo[key] = parser(raw)
+            column.append(memo[key])
+        columns[name] = column
+    return [_finish({name: columns[name][i] for name in FIELDS}) for i in range(len(raw_rows))]
+
+
+def apply(parsed_json):
+    """Añade ``SignosVitalesNormalizados`` a ``existing-mrs`` y fija el IMC calculado. Devuelve Vitals o None."""
+    existing_mrs = _existing_mrs(parsed_json)
+    if existing_mrs is None:
+        return None
+    vitals = normalize(existing_mrs.get("SignosVitales"))
+    signos = existing_mrs.get("SignosVitales")
+    if vitals.imc_calculado and isinstance(signos, dict):
+        signos["IMC"] = f"{vitals.imc:.1f}"
+    existing_mrs[NORMALIZED_KEY] = vitals.as_json()
+    return vitals
+
+
+def from_consult(parsed_json):
+    """Vitals de una consulta, ya normalizados o calculados en el momento (registros antiguos)."""
+    existing_mrs = _existing_mrs(parsed_json)
+    if existing_mrs is None:
+        return Vitals()
+    stored = existing_mrs.get(NORMALIZED_KEY)
+    if isinstance(stored, dict):
+        return Vitals(stored.get("FC_lpm"), stored.get("TAS_mmHg"), stored.get("TAD_mmHg"), stored.get("Peso_kg"),
+                      stored.get("Talla_m"), stored.get("IMC"), bool(stored.get("IMC_Calculado")),
+                      list(stored.get("Alertas") or []))
+    return normalize(existing_mrs.get("SignosVitales"))
+
+
+def _existing_mrs(parsed_json):
+    data = parsed_json.get("data") if isinstance(parsed_json, dict) else None
+    existing_mrs = data.get("existing-mrs") if isinstance(data, dict) else None
+    return existing_mrs if isinstance(existing_mrs, dict) else None
+
+
+# --- Historial (JSONL de la CLI o exportación del log) ---
+CSV_COLUMNS = ["filename", "FC_lpm", "TAS_mmHg", "TAD_mmHg", "Peso_kg", "Talla_m", "IMC", "IMC_Calculado", "Alertas"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Normaliza los signos vitales de un JSONL de resultados.")
+    parser.add_argument("input", help="JSONL con registros que incluyen parsed_json (salida de cli.py)")
+    parser.add_argument("-o", "--output", help="CSV de salida (por defecto, stdout)")
+    args = parser.parse_args(argv)
+
+    filenames, signos_list = [], []
+    with open(args.input, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            existing_mrs = _existing_mrs(record.get("parsed_json"))
+            if existing_mrs is None:
+                continue
+            filenames.append(record.get("filename") or record.get("path"))
+            signos_list.append(existing_mrs.get("SignosVitales"))
+
+    out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        writer = csv.DictWriter(out, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        flagged = 0
+        for filename, vitals in zip(filenames, normalize_columns(signos_list)):
+            row = vitals.as_json()
+            row["Alertas"] = "; ".join(row["Alertas"])
+            flagged += bool(vitals.alertas)
+            writer.writerow({"filename": filename, **row})
+    finally:
+        if args.output:
+            out.close()
+    print(f"{len(signos_list)} consultas, {flagged} con alertas.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""Worker de la cola de trabajos: procesa en segundo plano los audios enviados desde la app.
+
+Toma trabajos de ``job_queue`` (SQLite compartida en ``CITAMED_DATA_DIR``), ejecuta
+el mismo pipeline que la app y la CLI y guarda el resultado para que la interfaz
+lo consulte por id. Pueden correr varios workers (procesos o máquinas con el
+mismo directorio de datos); cada uno procesa un trabajo a la vez::
+
+    python worker.py --processes 4
+
+Las credenciales se leen como en la CLI (entorno o ``.streamlit/secrets.toml``).
+Cada proceso tiene su propio scheduler: con N workers, repartir la cuota con
+``CITAMED_GEMINI_RPM`` (total / N).
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+import cli
+import clients
+import config
+import file_registry
+import job_queue
+import pipeline
+import prompts
+import result_cache
+import routing
+import scheduler
+
+logger = logging.getLogger("citamed.worker")
+
+POLL_S = 1.0  # Espera entre consultas a la cola cuando está vacía
+
+
+def routing_policy_from_options(options):
+    policy = options.get("routing_policy")
+    if not policy:
+        return None
+    return routing.RoutingPolicy(**{**policy, "required_fields": tuple(policy.get("required_fields") or ())})
+
+
+def process_job(job, on_update=None, worksheet=None):
+    """Ejecuta el pipeline para un trabajo. Devuelve el ConsultResult."""
+    options = job["options"]
+    with open(job["audio_path"], "rb") as f:
+        data = f.read()
+    scheduler.bind_session(job["session_id"])  # La cuota se reparte por sesión de origen
+    return pipeline.process_audio(
+        data, job["filename"], job["model_name"], prompts.PROMPT_TEXT,
+        worksheet=worksheet if options.get("log_to_sheets") else None, on_update=on_update,
+        cache=result_cache.get_result_cache(), force_reprocess=options.get("force_reprocess", False),
+        preprocess=options.get("preprocess", False), segment_long_audio=options.get("segment_long_audio", False),
+        routing_policy=routing_policy_from_options(options),
+    )
+
+
+def run_worker(db_path=None, poll_s=POLL_S, once=False):
+    """Bucle del worker: toma trabajos hasta que se interrumpe (o, con ``once``, hasta vaciar la cola)."""
+    secrets = cli.load_secrets()
+    if not secrets.get("GOOGLE_API_KEY"):
+        logger.error("Falta GOOGLE_API_KEY (variable de entorno o %s).", cli.SECRETS_FILE)
+        return 2
+    clients.configure_genai(secrets["GOOGLE_API_KEY"])
+    worksheet = None
+    if secrets.get("GOOGLE_CREDENTIALS_JSON") and secrets.get("GOOGLE_SHEET_LOG_URL"):
+        worksheet = cli.make_log_writer(secrets)
+
+    queue = job_queue.get_job_queue(db_path)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    queue.register_worker(worker_id)
+    current = {"job_id": None}
+    stopping = threading.Event()
+
+    def beat():
+        while not stopping.wait(job_queue.HEARTBEAT_S):
+            queue.heartbeat(worker_id, current["job_id"])
+
+    threading.Thread(target=beat, name="citamed-worker-heartbeat", daemon=True).start()
+    logger.info("Worker %s esperando trabajos en %s.", worker_id, queue.path)
+    last_purge = 0.0
+    try:
+        while True:
+            queue.requeue_stale()
+            if time.monotonic() - last_purge >= job_queue.PURGE_INTERVAL_S:
+                last_purge = time.monotonic()
+                purged = queue.purge()
+                if purged:
+                    logger.info("Borrados %d trabajos terminados hace más de %.0f días.", purged,
+                                config.JOB_RETENTION_S / 86400)
+            job = queue.claim(worker_id)
+            if job is None:
+                if once:
+                    break
+                time.sleep(poll_s)
+                queue.heartbeat(worker_id)
+                continue
+            current["job_id"] = job["id"]
+            logger.info("Trabajo %s: %s con %s (intento %d).", job["id"], job["filename"], job["model_name"], job["attempts"])
+            try:
+                result = process_job(job, on_update=lambda r: queue.heartbeat(worker_id, job["id"], r.status),
+                                     worksheet=worksheet)
+                queue.finish(job["id"], worker_id, result.as_record())
+                logger.info("Trabajo %s: %s (%.1f s).", job["id"], result.status, result.elapsed)
+            except Exception as e:  # p. ej. audio borrado: el trabajo falla, el worker sigue
+                logger.exception("Trabajo %s falló.", job["id"])
+                queue.fail(job["id"], worker_id, f"{type(e).__name__}: {e}")
+            finally:
+                current["job_id"] = None
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopping.set()
+        file_registry.get_registry().collect(scan_orphans=False)  # Borrados pendientes antes de salir
+        if worksheet is not None:
+            worksheet.drain(timeout=cli.SHEETS_DRAIN_TIMEOUT_S)
+    return 0
+
+
+def _worker_process(db_path, poll_s, once, verbose):
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    sys.exit(run_worker(db_path, poll_s, once))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Procesa en segundo plano los trabajos enviados desde la app.")
+    parser.add_argument("--processes", type=int, default=1, help="Procesos worker (cada uno procesa un trabajo a la vez)")
+    parser.add_argument("--db", help="Base SQLite de la cola (por defecto, la de CITAMED_DATA_DIR)")
+    parser.add_argument("--poll", type=float, default=POLL_S, help="Espera entre consultas a la cola vacía (s)")
+    parser.add_argument("--once", action="store_true", help="Salir cuando la cola quede vacía")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    if args.processes <= 1:
+        _worker_process(args.db, args.poll, args.once, args.verbose)
+    processes = [multiprocessing.Process(target=_worker_process, args=(args.db, args.poll, args.once, args.verbose))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+    return max((p.exitcode or 0) for p in processes)
+
+
+if __name__ == "__main__":
+    sys.exit(main())